@@ -3,21 +3,43 @@ import os
 import sys
 import sqlite3
 import math
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
 from dotenv import load_dotenv
-from models import db, Asset, Settings, User, TradeHistory, Option, OptionSpread, FixedIncome, InvestmentFund, Crypto, Pension, International, Dividend, MarketIndex, StudyOption, StudyStock, StudyIntlStock, StudyStrategy, StructuredOp, StructuredLeg, SimulacaoOpcoes, SimulacaoLeg, OptionRollSimulation, PutSale, CollarSimulation, SelicMensal, RankingVol, SearchedOption, RtdOptionData, PortfolioSnapshot, PMEvent, AssetTxn
-from services import get_quotes, get_raw_quote_data
+from models import db, Asset, Settings, User, TradeHistory, Option, OptionSpread, FixedIncome, InvestmentFund, Crypto, Pension, International, Dividend, MarketIndex, StudyOption, StudyStock, StudyIntlStock, StructuredOp, StructuredLeg, SimulacaoOpcoes, SimulacaoLeg, OptionRollSimulation, PutSale, CollarSimulation, SelicMensal, RankingVol, SearchedOption, RtdOptionData, PortfolioSnapshot, PMEvent, AssetTxn, OptionChainCache, SchedulerLease, SchedulerJob, Quote, QuoteUser
+from services import get_quotes, get_raw_quote_data, yahoo_quote, yahoo_quotes, yahoo_dividends, fetch_many
+import candle_store
+import price_history
+import vol_hist_store
+import estudos
+from estudos import ranking_liq_filter as _ranking_liq_filter
+import bg_tasks
+from bg_tasks import set_task as _set_task, submit as _submit_task
+import dividend_history
+import ledger_position
+import pm_engine
+import quote_store
+import schema_indexes
+import schema_migrations
+import version_counter
+from oplab_client import (OplabApiError, get_json as _oplab_get_json, headers as _oplab_headers,
+                          is_available as _oplab_is_available, session as _oplab_session)
+from pricing import (norm_cdf as _norm_cdf, bs_price as _bs_price, implied_vol as _implied_vol,
+                     ChainIV, bs_greeks_vec, chain_delta_pct,
+                     payoff_legs, pop_closed_form, pop_grid)
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 import requests
 import time
 import threading
 import uuid
+import socket
 import json
+import zlib
 import tempfile
 from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
 import pytz
-import yfinance as yf
+# yfinance (e o pandas que ele arrasta) custa ~0,5 s de import: cada função
+# que o usa importa localmente, no primeiro uso — não na partida do worker.
 
 # Load env vars
 load_dotenv()
@@ -67,7 +89,9 @@ def parse_json(value):
 
 
 basedir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.abspath(os.path.dirname(__file__))
-instance_path = os.path.join(basedir, 'instance')
+# CONTROLE_ACOES_INSTANCE: outra pasta para o banco (ex.: o teste de tempo de
+# import sobe o app num diretório temporário, sem tocar no banco real)
+instance_path = os.environ.get('CONTROLE_ACOES_INSTANCE') or os.path.join(basedir, 'instance')
 if not os.path.exists(instance_path):
     os.makedirs(instance_path)
 
@@ -100,130 +124,6 @@ def brl_fmt(value):
 app.jinja_env.filters['brl_fmt'] = brl_fmt
 
 
-class OplabApiError(Exception):
-    def __init__(self, message, status_code=None, body_preview=None):
-        super().__init__(message)
-        self.status_code = status_code
-        self.body_preview = body_preview
-
-
-def _oplab_headers(token):
-    return {
-        'Access-Token': (token or '').strip(),
-        'Accept': 'application/json',
-        'User-Agent': 'MyInvest/1.0',
-    }
-
-
-# Session compartilhada: reaproveita a conexão TCP/TLS entre chamadas. Sem isso
-# cada request refaz o handshake (~380ms vs ~50ms medidos) — o que multiplicava
-# por 7 o tempo do Ranking de Volatilidade, que faz 100+ chamadas.
-# pool_maxsize acompanha o max_workers usado nas varreduras paralelas (8) para
-# as threads não ficarem em fila esperando conexão livre.
-_oplab_session = requests.Session()
-_oplab_session.mount('https://', requests.adapters.HTTPAdapter(
-    pool_connections=8, pool_maxsize=8, max_retries=0))
-
-
-# A OpLab faz rate-limiting: sob concorrência ela devolve 503 em parte das
-# chamadas (medido: 32% com 8 threads, 6% com 4, 0% com 2). Esses 503 são
-# transitórios — repetir depois de uma pausa curta resolve. Sem isso, o
-# Ranking marcava dezenas de tickers como "com falha" a cada atualização.
-_OPLAB_RETRY_STATUS = (429, 500, 502, 503, 504)
-
-
-def _oplab_get_json(path_or_url, token, params=None, timeout=15, retries=2):
-    """GET OpLab com validacao de HTTP/conteudo antes de decodificar JSON.
-
-    Repete até `retries` vezes em erros transitórios (429/5xx), com backoff
-    exponencial curto (0,25s, 0,5s)."""
-    url = path_or_url if str(path_or_url).startswith('http') else f'https://api.oplab.com.br/v3{path_or_url}'
-    token = (token or '').strip()
-    params = dict(params or {})
-
-    def _request(use_query_token=False):
-        req_params = dict(params)
-        if use_query_token:
-            req_params['access_token'] = token
-        last_exc = None
-        for attempt in range(retries + 1):
-            try:
-                r = _oplab_session.get(url, params=req_params,
-                                       headers=_oplab_headers(token), timeout=timeout)
-                if r.status_code in _OPLAB_RETRY_STATUS and attempt < retries:
-                    time.sleep(0.25 * (2 ** attempt))
-                    continue
-                return r
-            except (requests.exceptions.Timeout,
-                    requests.exceptions.ConnectionError) as exc:
-                last_exc = exc
-                if attempt < retries:
-                    time.sleep(0.25 * (2 ** attempt))
-                    continue
-                raise
-        if last_exc:
-            raise last_exc
-        return r
-
-    try:
-        resp = _request(False)
-        body = (resp.text or '').strip()
-        # 401/403 com token no header não vira 200 ao repetir com token na query
-        # (é a mesma credencial) — repetir só dobra o tempo até o erro. O retry
-        # fica para o caso de resposta vazia/não-JSON, onde pode haver diferença.
-        retry_with_query = not body
-        if not retry_with_query:
-            if 200 <= resp.status_code < 300:
-                try:
-                    return resp.json()
-                except ValueError:
-                    retry_with_query = True
-        if retry_with_query:
-            resp = _request(True)
-            body = (resp.text or '').strip()
-    except requests.exceptions.Timeout as exc:
-        raise OplabApiError('A OpLab demorou para responder. Tente novamente em instantes.') from exc
-    except requests.exceptions.RequestException as exc:
-        raise OplabApiError(f'Nao foi possivel conectar na OpLab: {exc.__class__.__name__}') from exc
-
-    preview = body[:300]
-    if resp.status_code in (401, 403):
-        raise OplabApiError('Token OpLab recusado ou sem permissao para este endpoint.', resp.status_code, preview)
-    if resp.status_code == 404:
-        raise OplabApiError('Endpoint ou ticker nao encontrado na OpLab.', resp.status_code, preview)
-    if resp.status_code < 200 or resp.status_code >= 300:
-        raise OplabApiError(f'OpLab retornou HTTP {resp.status_code}.', resp.status_code, preview)
-    if not body:
-        raise OplabApiError('OpLab retornou resposta vazia.', resp.status_code)
-    try:
-        return resp.json()
-    except ValueError as exc:
-        raise OplabApiError('OpLab retornou resposta invalida em vez de JSON.', resp.status_code, preview) from exc
-
-
-def _oplab_is_available(token: str, timeout: int = 4) -> bool:
-    """
-    Probe rápido de disponibilidade do servidor OpLab.
-    Retorna True se responder com 2xx ou 4xx (token inválido mas servidor OK).
-    Retorna False em timeout, ConnectionError ou 5xx (servidor fora do ar).
-
-    Usa /market/status (endpoint mais leve da spec v3). O antigo /user/me não
-    existe na v3 e devolvia 404 — como 404 < 500, o probe passava mesmo assim,
-    mas gastava uma ida à rede sem validar nada de útil.
-    """
-    try:
-        r = _oplab_session.get(
-            'https://api.oplab.com.br/v3/market/status',
-            headers=_oplab_headers(token),
-            timeout=timeout,
-        )
-        return r.status_code < 500
-    except (requests.exceptions.Timeout,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.RequestException):
-        return False
-
-
 def _do_oplab_bulk_update_safe(uid: int, token: str, deadline_secs: int = 25):
     """
     Wrapper que executa _do_oplab_bulk_update em thread separada com deadline total.
@@ -274,7 +174,8 @@ def format_date(value):
 db.init_app(app)
 
 # WAL mode: leituras simultâneas com escrita → reduz bloqueios do scheduler OpLab
-from sqlalchemy import event as _sa_event
+from sqlalchemy import event as _sa_event, case as _sa_case, text as _sa_text, inspect as _sa_inspect
+from sqlalchemy.orm import Session as _SASession
 from sqlalchemy.engine import Engine as _Engine
 import sqlite3 as _sqlite3_pragma
 @_sa_event.listens_for(_Engine, 'connect')
@@ -284,10 +185,6 @@ def _set_sqlite_pragma(conn, _rec):
         conn.execute('PRAGMA synchronous=NORMAL')
         conn.execute('PRAGMA busy_timeout=30000')
 
-# File-based task store (shared across gunicorn workers)
-_TASK_DIR = os.path.join(tempfile.gettempdir(), 'ca_update_tasks')
-os.makedirs(_TASK_DIR, exist_ok=True)
-
 _BRT = ZoneInfo('America/Sao_Paulo')
 
 def now_brt():
@@ -308,26 +205,271 @@ def du_count(start: date, end: date) -> int:
     return count
 
 
-def _task_file(task_id):
-    return os.path.join(_TASK_DIR, task_id + '.json')
+# ─────────────────────────────────────────────────────────────────────────────
+# Cache compartilhado da cadeia de opções (/market/options/{ativo})
+# ─────────────────────────────────────────────────────────────────────────────
+# Busca de opção, rolagem, cadeia, busca de operações, manejo de put,
+# lançamento coberto, venda de put longa, liquidez e a passada de deltas do
+# scheduler baixavam cada um a MESMA cadeia (centenas de KB, 1-3s por chamada).
+# Abrir duas telas do mesmo ativo — ou o scheduler rodando junto com o
+# usuário — repetia o download, e com vários workers do gunicorn nem o cache
+# em memória ajudava. Aqui ficam três camadas:
+#   1. _chain_mem  — por processo, devolve a cadeia já parseada em ~µs;
+#   2. OptionChainCache — tabela SQLite, compartilhada entre os workers;
+#   3. OpLab — só quando as duas acima estão vencidas.
+# Chamadas simultâneas para o mesmo ativo esperam um único download: um lock
+# por ativo dentro do processo e um flock num arquivo entre processos; quem
+# esperou relê o cache em vez de baixar de novo.
+_CHAIN_TTL_PREGAO = 60          # s — no pregão bid/ask mudam a todo momento
+_CHAIN_TTL_FORA   = 15 * 60     # s — fora do pregão só muda o último negócio
+_CHAIN_LOCK_WAIT  = 30          # s — espera máxima pelo download de outro worker
+_CHAIN_LOCK_DIR   = os.path.join(tempfile.gettempdir(), 'ca_chain_locks')
+os.makedirs(_CHAIN_LOCK_DIR, exist_ok=True)
+
+try:
+    import fcntl as _fcntl
+except ImportError:             # Windows (app desktop): processo único, basta o lock de thread
+    _fcntl = None
+
+_chain_mem: dict = {}           # {ativo: OptionChain}
+_chain_locks: dict = {}         # {ativo: threading.Lock}
+_chain_locks_guard = threading.Lock()
+
+
+def _chain_option_list(data):
+    """Normaliza a resposta de /market/options: lista ou dict com
+    'options' / 'calls' + 'puts'."""
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        return data.get('options') or data.get('calls', []) + data.get('puts', []) or []
+    return []
+
+
+def _option_kind(o):
+    """'CALL' ou 'PUT' pela categoria da OpLab; sem ela, pela letra do
+    vencimento no código (padrão B3: A-L = calls, M-X = puts)."""
+    raw = str(o.get('category') or o.get('type') or o.get('option_type') or '').upper()
+    if 'PUT' in raw or raw == 'P':
+        return 'PUT'
+    if 'CALL' in raw or raw == 'C':
+        return 'CALL'
+    sym = str(o.get('symbol') or o.get('ticker') or '').upper()
+    if len(sym) >= 5 and sym[4].isalpha():
+        return 'PUT' if sym[4] in 'MNOPQRSTUVWX' else 'CALL'
+    return 'CALL'
+
+
+class OptionChain:
+    """Cadeia de opções de um ativo.
+
+    - options:    lista crua da OpLab (mesmo formato que os endpoints já liam);
+    - calls/puts: {vencimento 'YYYY-MM-DD': [itens ordenados por strike]};
+    - by_symbol:  {código da opção: item}.
+
+    Os índices são montados no primeiro acesso e ficam com a cadeia no cache,
+    então as telas só percorrem os vencimentos que vão mostrar. Os itens são
+    compartilhados entre requisições — trate como somente leitura (copie antes
+    de alterar)."""
+
+    __slots__ = ('underlying', 'options', 'fetched_at', '_by_symbol', '_sides')
+
+    def __init__(self, underlying, options, fetched_at):
+        self.underlying = underlying
+        self.options = options
+        self.fetched_at = fetched_at      # epoch (time.time()) do download
+        self._by_symbol = None
+        self._sides = None
+
+    @property
+    def by_symbol(self):
+        if self._by_symbol is None:
+            idx = {}
+            for o in self.options:
+                if isinstance(o, dict):
+                    sym = str(o.get('symbol') or o.get('ticker') or '').upper()
+                    if sym:
+                        idx[sym] = o
+            self._by_symbol = idx
+        return self._by_symbol
+
+    def _index(self):
+        if self._sides is None:
+            calls, puts = {}, {}
+            for o in self.options:
+                if not isinstance(o, dict):
+                    continue
+                due = str(o.get('due_date') or o.get('expiration_date') or '')[:10]
+                if not due:
+                    continue
+                side = puts if _option_kind(o) == 'PUT' else calls
+                side.setdefault(due, []).append(o)
+            for side in (calls, puts):
+                for lst in side.values():
+                    lst.sort(key=lambda o: float(o.get('strike') or 0))
+            self._sides = (calls, puts)
+        return self._sides
+
+    @property
+    def calls(self):
+        return self._index()[0]
+
+    @property
+    def puts(self):
+        return self._index()[1]
+
+    def expirations(self):
+        """Vencimentos com alguma opção, em ordem."""
+        calls, puts = self._index()
+        return sorted(calls.keys() | puts.keys())
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+def _chain_rows(items):
+    """Linhas enxutas (strike > 0) de uma lista de OptionChain.calls/puts,
+    na mesma ordem de strike — formato da busca de operações e do manejo."""
+    out = []
+    for o in items:
+        strike = float(o.get('strike') or 0)
+        if strike <= 0:
+            continue
+        delta_raw = o.get('delta')
+        if delta_raw is None and isinstance(o.get('greeks'), dict):
+            delta_raw = o['greeks'].get('delta')
+        out.append({'symbol': str(o.get('symbol') or o.get('ticker') or '').upper(),
+                    'strike': round(strike, 2),
+                    'bid': round(float(o.get('bid') or 0), 2),
+                    'ask': round(float(o.get('ask') or 0), 2),
+                    'close': round(float(o.get('close') or 0), 2),
+                    'vol_fin': round(float(o.get('financial_volume') or o.get('volume_financial') or 0), 2),
+                    'delta': delta_raw})
+    return out
+
+def _chain_ttl():
+    """Validade da cadeia: curta no pregão (seg-sex, 10h-17h), longa fora dele."""
+    n = now_brt()
+    if n.weekday() < 5 and 10 <= n.hour < 17:
+        return _CHAIN_TTL_PREGAO
+    return _CHAIN_TTL_FORA
+
+
+def _chain_lock(underlying):
+    with _chain_locks_guard:
+        lk = _chain_locks.get(underlying)
+        if lk is None:
+            lk = _chain_locks[underlying] = threading.Lock()
+        return lk
+
+
+class _ChainFileLock:
+    """flock exclusivo por ativo entre os workers. Se outro worker segurar o
+    lock além de _CHAIN_LOCK_WAIT (OpLab travada), segue sem ele — melhor um
+    download duplicado do que a requisição parada."""
 
-def _set_task(task_id, data):
-    with open(_task_file(task_id), 'w') as f:
-        json.dump(data, f)
+    def __init__(self, underlying):
+        self.path = os.path.join(_CHAIN_LOCK_DIR, underlying + '.lock')
+        self.fh = None
 
-def _get_task(task_id):
+    def __enter__(self):
+        if _fcntl is None:
+            return self
+        try:
+            self.fh = open(self.path, 'a+')
+        except OSError:
+            return self
+        deadline = time.time() + _CHAIN_LOCK_WAIT
+        while True:
+            try:
+                _fcntl.flock(self.fh, _fcntl.LOCK_EX | _fcntl.LOCK_NB)
+                return self
+            except OSError:
+                if time.time() >= deadline:
+                    self.fh.close()
+                    self.fh = None
+                    return self
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        if self.fh is not None:
+            try:
+                _fcntl.flock(self.fh, _fcntl.LOCK_UN)
+            finally:
+                self.fh.close()
+        return False
+
+
+def _chain_db_load(underlying, max_age):
+    """Lê a cadeia gravada por qualquer worker se tiver menos de max_age s."""
+    import gzip as _gzip
+    tbl = OptionChainCache.__table__
     try:
-        with open(_task_file(task_id), 'r') as f:
-            return json.load(f)
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                tbl.select().where(tbl.c.underlying == underlying)).first()
+        if not row:
+            return None
+        fetched = row.fetched_at.replace(tzinfo=None)
+        age = (datetime.utcnow() - fetched).total_seconds()
+        if age > max_age:
+            return None
+        options = json.loads(_gzip.decompress(row.chain_gz))
+        return OptionChain(underlying, options, time.time() - max(0.0, age))
     except Exception:
-        return {'status': 'not_found', 'msg': '', 'category': ''}
+        app.logger.exception('option_chain_cache: leitura falhou para %s', underlying)
+        return None
 
-def run_migrations():
-    """Auto-migrate database schema on startup."""
-    import sqlite3 as _sqlite3
-    conn = _sqlite3.connect(db_path)
-    cursor = conn.cursor()
 
+def _chain_db_save(underlying, options):
+    # Conexão própria (não a db.session da requisição): a gravação do cache não
+    # pode comitar de carona alterações pendentes do endpoint que a chamou.
+    import gzip as _gzip
+    tbl = OptionChainCache.__table__
+    blob = _gzip.compress(json.dumps(options, separators=(',', ':')).encode('utf-8'), 6)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(tbl.insert().prefix_with('OR REPLACE'),
+                         {'underlying': underlying, 'fetched_at': datetime.utcnow(),
+                          'chain_gz': blob})
+    except Exception:
+        app.logger.exception('option_chain_cache: gravação falhou para %s', underlying)
+
+
+def _oplab_chain(underlying, token, timeout=20, max_age=None, retries=2):
+    """Cadeia de opções de `underlying`, do cache quando ainda válida.
+
+    max_age (s) sobrescreve a validade padrão (_chain_ttl); timeout/retries
+    valem só para o download. Erros da OpLab sobem como OplabApiError, igual
+    a _oplab_get_json."""
+    underlying = ''.join(ch for ch in str(underlying or '').upper() if ch.isalnum())
+    if max_age is None:
+        max_age = _chain_ttl()
+
+    ch = _chain_mem.get(underlying)
+    if ch is not None and ch.age() <= max_age:
+        return ch
+
+    with _chain_lock(underlying):
+        # Outra thread pode ter baixado enquanto esperávamos o lock
+        ch = _chain_mem.get(underlying)
+        if ch is not None and ch.age() <= max_age:
+            return ch
+        with _ChainFileLock(underlying):
+            ch = _chain_db_load(underlying, max_age)
+            if ch is None:
+                data = _oplab_get_json(f'/market/options/{underlying}', token,
+                                      timeout=timeout, retries=retries)
+                ch = OptionChain(underlying, _chain_option_list(data), time.time())
+                _chain_db_save(underlying, ch.options)
+        _chain_mem[underlying] = ch
+        return ch
+
+
+def _migration_legacy(cursor):
+    """Migração 1: o antigo run_migrations inteiro — colunas e tabelas
+    acrescentadas antes do controle de versão, com as checagens (PRAGMA /
+    try-except) que o tornam seguro num banco em qualquer estado anterior."""
     # Novos campos no modelo User — usa try/except por segurança (SQLite não tem IF NOT EXISTS no ALTER)
     for _col, _def in [
         ('full_name',       'VARCHAR(120)'),
@@ -576,10 +718,6 @@ def run_migrations():
             created_at DATETIME
         )
     """)
-    try:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_asset_txn_user_ticker ON asset_txn (user_id, ticker, txn_date)")
-    except Exception:
-        pass
 
     # Tabela de eventos do Preço Médio didático (página Preço Médio)
     cursor.execute("""
@@ -599,10 +737,6 @@ def run_migrations():
             created_at DATETIME
         )
     """)
-    try:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pm_event_user_ticker ON pm_event (user_id, ticker)")
-    except Exception:
-        pass
 
     # Add underlying and notes columns to trade_history if missing
     cursor.execute("PRAGMA table_info(trade_history)")
@@ -867,8 +1001,73 @@ def run_migrations():
                 cursor.execute(f"ALTER TABLE rtd_option_data ADD COLUMN {_col} FLOAT")
                 print(f"[MIGRATION] Added rtd_option_data.{_col}")
 
-    conn.commit()
-    conn.close()
+
+def _migration_indexes(cursor):
+    """Migração 2: índices das consultas quentes (user_id + ticker/status/...)
+    declarados nos modelos; banco antigo ganha os que faltam — ver
+    schema_indexes.py."""
+    for _idx in schema_indexes.ensure(cursor):
+        print(f"[MIGRATION] Added index {_idx}")
+
+
+# Migrações do banco, em ordem: (versão, nome, função(cursor)). Cada uma roda
+# UMA vez por banco (schema_version — ver schema_migrations.py); mudança nova
+# de esquema entra no fim da lista com a versão seguinte. Tabela nova inteira
+# não precisa de migração: o create_all de run_migrations a cria.
+_MIGRATIONS = [
+    (1, 'legado: colunas e tabelas do run_migrations antigo', _migration_legacy),
+    (2, 'índices das consultas quentes por usuário', _migration_indexes),
+]
+
+
+def _schema_em_dia():
+    """Banco na última versão e com todas as tabelas dos modelos — então a
+    partida não precisa de nenhum ALTER/PRAGMA nem de trava de escrita."""
+    import sqlite3 as _sqlite3
+    conn = _sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = conn.cursor()
+        if schema_migrations.current(cursor) < schema_migrations.latest(_MIGRATIONS):
+            return False
+        tabelas = {r[0] for r in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        return set(db.metadata.tables) <= tabelas
+    finally:
+        conn.close()
+
+
+def _create_all():
+    # Os workers do gunicorn sobem em paralelo e todos chamam create_all(): um
+    # cria a tabela e os demais recebem "table X already exists" do SQLite,
+    # derrubando o boot inteiro (502). Como create_all() é idempotente por
+    # natureza, engolir essa corrida é seguro — só não pode mascarar erro real,
+    # por isso o log.
+    try:
+        db.create_all()
+    except Exception as _e_create:
+        if 'already exists' not in str(_e_create).lower():
+            raise
+        app.logger.info('create_all: tabela já criada por outro worker (%s)', _e_create)
+
+
+def run_migrations():
+    """Aplica as migrações pendentes e cria as tabelas novas dos modelos.
+    Rodado pelo `flask db-upgrade` antes de os workers subirem; na partida de
+    cada worker, só quando _schema_em_dia() diz que falta algo."""
+    import sqlite3 as _sqlite3
+    conn = _sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' LIMIT 1").fetchone():
+            # Banco novo: o create_all já cria o esquema atual inteiro, então
+            # as migrações (que só trazem bancos antigos até ele) ficam
+            # registradas como aplicadas sem rodar.
+            _create_all()
+            schema_migrations.stamp(conn, _MIGRATIONS)
+            return
+        for _v in schema_migrations.upgrade(conn, _MIGRATIONS):
+            print(f"[MIGRATION] schema_version {_v}")
+    finally:
+        conn.close()
+    _create_all()
 
 # Dados históricos da Selic mensal (% a.m.)
 _SELIC_HISTORICO = """01/2020,0.38
@@ -947,20 +1146,10 @@ _SELIC_HISTORICO = """01/2020,0.38
 02/2026,1.00
 03/2026,1.21"""
 
-with app.app_context():
-    run_migrations()
-    # Os workers do gunicorn sobem em paralelo e todos chamam create_all(): um
-    # cria a tabela e os demais recebem "table X already exists" do SQLite,
-    # derrubando o boot inteiro (502). Como create_all() é idempotente por
-    # natureza, engolir essa corrida é seguro — só não pode mascarar erro real,
-    # por isso o log.
-    try:
-        db.create_all()
-    except Exception as _e_create:
-        if 'already exists' not in str(_e_create).lower():
-            raise
-        app.logger.info('create_all: tabela já criada por outro worker (%s)', _e_create)
-    # Seed Selic histórica (INSERT OR IGNORE para não sobrescrever edições manuais)
+def _seed_selic():
+    """Semeia os meses de _SELIC_HISTORICO que faltam na tabela (nunca
+    sobrescreve edições manuais). Uma leitura; só grava se faltar mês."""
+    existentes = {m for (m,) in db.session.query(SelicMensal.mes_ano)}
     for linha in _SELIC_HISTORICO.strip().splitlines():
         partes = linha.split(',')
         if len(partes) == 2:
@@ -969,11 +1158,32 @@ with app.app_context():
                 taxa = float(taxa_str)
                 parts = mm_aa.strip().split('/')
                 mes_ano_fmt = f"{parts[1]}-{parts[0]}"  # MM/YYYY -> YYYY-MM
-                if not SelicMensal.query.filter_by(mes_ano=mes_ano_fmt).first():
+                if mes_ano_fmt not in existentes:
                     db.session.add(SelicMensal(mes_ano=mes_ano_fmt, taxa=taxa))
+                    existentes.add(mes_ano_fmt)
             except Exception:
                 pass
-    db.session.commit()
+    if db.session.new:
+        db.session.commit()
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Aplica as migrações pendentes do banco (rodar antes de subir os workers)."""
+    run_migrations()
+    _seed_selic()
+    import sqlite3 as _sqlite3
+    conn = _sqlite3.connect(db_path, timeout=30)
+    try:
+        print(f"schema_version: {schema_migrations.current(conn.cursor())}")
+    finally:
+        conn.close()
+
+
+with app.app_context():
+    if not _schema_em_dia():
+        run_migrations()
+    _seed_selic()
 
 # Scheduler OpLab iniciado ao carregar o módulo (Gunicorn + __main__)
 threading.Thread(target=lambda: (time.sleep(5), _start_oplab_scheduler()), daemon=True).start()
@@ -982,49 +1192,18 @@ threading.Thread(target=lambda: (time.sleep(5), _start_oplab_scheduler()), daemo
 # --- Options Module Routes ---
 
 
-def _norm_cdf(x):
-    """Aproximação de Abramowitz & Stegun para N(x)."""
-    t = 1.0 / (1.0 + 0.2316419 * abs(x))
-    poly = t * (0.319381530 + t * (-0.356563782 + t * (1.781477937 + t * (-1.821255978 + t * 1.330274429))))
-    pdf  = math.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
-    c    = 1.0 - pdf * poly
-    return c if x >= 0 else 1.0 - c
-
-
-def _bs_price(S, K, T, r, sigma, is_call):
-    """Black-Scholes para call ou put."""
-    if T <= 0 or sigma <= 0 or S <= 0 or K <= 0:
-        return max(0.0, (S - K) if is_call else (K - S))
-    d1 = (math.log(S / K) + (r + 0.5 * sigma * sigma) * T) / (sigma * math.sqrt(T))
-    d2 = d1 - sigma * math.sqrt(T)
-    if is_call:
-        return S * _norm_cdf(d1) - K * math.exp(-r * T) * _norm_cdf(d2)
-    return K * math.exp(-r * T) * _norm_cdf(-d2) - S * _norm_cdf(-d1)
-
-
-def _implied_vol(S0, K, T, r, target, is_call):
-    """IV por bissecção a partir do prêmio de entrada."""
-    if target <= 0 or T <= 0:
-        return 0.30
-    lo, hi = 0.001, 5.0
-    for _ in range(60):
-        mid = (lo + hi) / 2
-        if _bs_price(S0, K, T, r, mid, is_call) < target:
-            lo = mid
-        else:
-            hi = mid
-        if hi - lo < 1e-6:
-            break
-    return (lo + hi) / 2
-
-
-def _calc_pop(S, breakevens, T, sigma, r=0.0, payoff_fn=None):
+def _calc_pop(S, breakevens, T, sigma, r=0.0, payoff_fn=None, kinks=None):
     """
     Probability of Profit (POP) via distribuição log-normal (Black-Scholes).
 
-    Com payoff_fn: integra numericamente a densidade log-normal de S_T sobre a
-    região onde payoff_fn(S_T) > 0 — funciona para qualquer formato de payoff
-    (lucro entre os BEs, fora deles, assimétrico etc.) e sempre retorna 0-100.
+    Com payoff_fn (função VETORIZADA de S_T — ver pricing.payoff_legs): mede a
+    probabilidade da região onde payoff_fn(S_T) > 0 — funciona para qualquer
+    formato de payoff (lucro entre os BEs, fora deles, assimétrico etc.) e
+    sempre retorna 0-100.
+      - com kinks (strikes): o payoff é linear por partes, então a integral da
+        densidade sai fechada por trecho entre as quebras;
+      - sem kinks (perna de calendário reprecificada por BS): integração
+        numérica numa grade de 501 pontos, com o payoff avaliado de uma vez.
 
     Sem payoff_fn (fallback analítico): P(S_T > B) = N(d2(B)), com d2
     decrescente em B. Para 2 BEs, P(low < S_T < high) = N(d2_low) - N(d2_high)
@@ -1033,26 +1212,13 @@ def _calc_pop(S, breakevens, T, sigma, r=0.0, payoff_fn=None):
     if S <= 0 or T <= 0 or sigma <= 0:
         return None
 
-    # ── Caminho preferido: integração numérica sobre o payoff real ──────────
+    # ── Caminho preferido: probabilidade sobre o payoff real ────────────────
     if payoff_fn is not None:
-        mu = math.log(S) + (r - 0.5 * sigma * sigma) * T
-        sd = sigma * math.sqrt(T)
-        lo = max(S * math.exp(-4 * sd), 0.01)
-        hi = S * math.exp(4 * sd)
-        tot = win = 0.0
-        M = 500
-        step = (hi - lo) / (M + 1)
-        for k in range(M + 1):
-            sk = lo + step * (k + 0.5)
-            z = (math.log(sk) - mu) / sd
-            w = math.exp(-0.5 * z * z) / sk   # ∝ densidade log-normal
-            tot += w
-            try:
-                if payoff_fn(sk) > 0:
-                    win += w
-            except Exception:
-                pass
-        return round(win / tot * 100, 1) if tot > 0 else None
+        if kinks is not None:
+            p = pop_closed_form(S, T, sigma, r, payoff_fn, kinks)
+        else:
+            p = pop_grid(S, T, sigma, r, payoff_fn)
+        return round(p * 100, 1) if p is not None else None
 
     if not breakevens:
         return None
@@ -1134,7 +1300,7 @@ def _calc_structured_metrics(op):
 
     # Taxa Selic contínua — lê diretamente do Settings sem depender de current_user
     try:
-        selic_val = float(Settings.get_value('selic_rate', user_id=op.user_id, default='14.5') or '14.5')
+        selic_val = Settings.get_float('selic_rate', op.user_id, 14.5)
     except Exception:
         selic_val = 14.5
     r_cont = math.log(1 + selic_val / 100)
@@ -1161,28 +1327,23 @@ def _calc_structured_metrics(op):
                 leg_ivs[leg.id] = 0.30
 
     # ── Payoff no vencimento ────────────────────────────────────────
-    def payoff_at(S):
-        # roll_adj entra aqui para que lucro máx., prejuízo máx. e breakevens
-        # já saiam corrigidos — todos derivam desta função.
-        total = net + roll_adj
-        for leg in legs:
-            q     = leg.quantity
-            K     = leg.strike or 0
-            sign  = 1 if leg.side == 'BUY' else -1
-            if leg.opt_type == 'STOCK':
-                # Custo de entrada já está em `net`; aqui só adiciona o valor de mercado no vencimento
-                total += sign * q * S
-            elif is_calendar and leg.id in leg_ivs:
-                # Perna longa de calendário: valor BS com tempo restante após vencimento curta
-                T_rem = max((leg.expiration_date - ref_date).days / 365.25, 0)
-                iv    = leg_ivs[leg.id]
-                is_call = leg.opt_type == 'CALL'
-                total += sign * q * _bs_price(S, K, T_rem, r_cont, iv, is_call)
-            else:
-                # Payoff intrínseco no vencimento
-                is_call = leg.opt_type == 'CALL'
-                total += sign * q * max(0.0, (S - K) if is_call else (K - S))
-        return total
+    # roll_adj entra na base para que lucro máx., prejuízo máx. e breakevens
+    # já saiam corrigidos — todos derivam desta função. Vetorizada em S: a
+    # varredura abaixo e o POP avaliam todos os preços numa chamada só.
+    leg_specs = []
+    for leg in legs:
+        q = leg.quantity * (1 if leg.side == 'BUY' else -1)
+        if leg.opt_type == 'STOCK':
+            # Custo de entrada já está em `net`; aqui só entra o valor de mercado no vencimento
+            leg_specs.append((q, 'STOCK', 0.0, 0.0, 0.0))
+        elif is_calendar and leg.id in leg_ivs:
+            # Perna longa de calendário: valor BS com tempo restante após vencimento curta
+            T_rem = max((leg.expiration_date - ref_date).days / 365.25, 0)
+            leg_specs.append((q, leg.opt_type, leg.strike or 0, T_rem, leg_ivs[leg.id]))
+        else:
+            # Payoff intrínseco no vencimento
+            leg_specs.append((q, 'CALL' if leg.opt_type == 'CALL' else 'PUT', leg.strike or 0, 0.0, 0.0))
+    payoff_vec = payoff_legs(net + roll_adj, leg_specs, r_cont)
 
     strikes = sorted({l.strike for l in legs if l.strike})
 
@@ -1216,7 +1377,7 @@ def _calc_structured_metrics(op):
     grid  = [S_lo + i * step for i in range(N + 1)] + strikes
     grid  = sorted(set(round(s, 4) for s in grid))
     test_prices = [0.01] + grid + [max_K * 5]
-    payoffs = [(S, payoff_at(S)) for S in test_prices]
+    payoffs = list(zip(test_prices, payoff_vec(test_prices).tolist()))
 
     max_profit = float('inf')  if unlimited_profit else max(p for _, p in payoffs)
     max_loss   = float('-inf') if unlimited_loss   else min(p for _, p in payoffs)
@@ -1311,9 +1472,11 @@ def _calc_structured_metrics(op):
             sigma_avg = (sum(sigmas) / len(sigmas)) if sigmas else 0.30
             exp_dates = [l.expiration_date for l in legs if l.expiration_date]
             T = max(((max(exp_dates) - date.today()).days / 252.0), 1/252) if exp_dates else 30/252
+            # Sem calendário o payoff é linear entre os strikes → POP fechado
             pop = _calc_pop(S0, breakevens, T, sigma_avg,
                             r=math.log(1 + _selic() / 100),
-                            payoff_fn=payoff_at)
+                            payoff_fn=payoff_vec,
+                            kinks=None if is_calendar else strikes)
     except Exception as _e:
         print(f"[POP] erro em _calc_structured_metrics op={op.id}: {_e}")
 
@@ -1711,6 +1874,9 @@ def edit_spread(id):
         flash("Sem permissão.", "danger")
         return redirect(url_for('opcoes'))
     if request.method == 'POST':
+        # Cotações como o formulário as mostrou — só a que o usuário mudou
+        # vira preço manual (QuoteUser.manual)
+        long_antes, short_antes = sp.leg_long_current, sp.leg_short_current
         try:
             sp.underlying_asset = request.form.get('underlying_asset', '').upper()
             sp.quantity = int(request.form.get('quantity'))
@@ -1731,6 +1897,10 @@ def edit_spread(id):
             pop_str = request.form.get('pop', '')
             sp.pop = float(pop_str.replace(',', '.')) if pop_str else None
 
+            agora = now_brt().replace(tzinfo=None)
+            QuoteUser.manual(current_user.id, sp.leg_long_ticker, long_antes, sp._leg_long_current, agora)
+            QuoteUser.manual(current_user.id, sp.leg_short_ticker, short_antes, sp._leg_short_current, agora)
+
             db.session.commit()
             flash("Trava atualizada!", "success")
         except Exception as e:
@@ -2065,6 +2235,11 @@ def close_estruturada(id):
         details      = details_json,
     )
     db.session.add(history)
+    # Encerrada deixa de ler a tabela quote (StructuredOp.quoted_live): fica
+    # nas colunas o que a tela mostrava no encerramento.
+    for l in op.legs:
+        l._current_price, l._last_update = l.current_price, l.last_update
+    op._underlying_price, op._underlying_change = op.underlying_price, op.underlying_change
     op.status = 'CLOSED'
     db.session.commit()
     flash('Operação encerrada e registrada no histórico.', 'success')
@@ -2089,7 +2264,7 @@ def delete_estruturada(id):
 # ─────────────────────────────────────────────────────────────────────────────
 
 def _selic():
-    return float(Settings.get_value('selic_rate', user_id=current_user.id, default='14.5'))
+    return Settings.get_float('selic_rate', current_user.id, 14.5)
 
 
 def _build_ticker_maps(uid):
@@ -2690,17 +2865,14 @@ def api_busca_opcao(ticker):
     iv_data = {}
     if underlying:
         try:
-            opts = _oplab_get_json(f'/market/options/{underlying}', token, timeout=15)
-            if isinstance(opts, list):
-                for opt in opts:
-                    if isinstance(opt, dict) and opt.get('symbol', '').upper() == ticker:
-                        greeks  = opt.get('greeks') or {}
-                        iv_raw  = opt.get('implied_volatility') or opt.get('iv') or {}
-                        iv_data = iv_raw if isinstance(iv_raw, dict) else {'iv': iv_raw}
-                        # spot_price e variation mais precisos se vierem aqui
-                        if opt.get('spot_price') and not spot_price:
-                            spot_price = _f(opt['spot_price'])
-                        break
+            opt = _oplab_chain(underlying, token, timeout=15).by_symbol.get(ticker)
+            if opt:
+                greeks  = opt.get('greeks') or {}
+                iv_raw  = opt.get('implied_volatility') or opt.get('iv') or {}
+                iv_data = iv_raw if isinstance(iv_raw, dict) else {'iv': iv_raw}
+                # spot_price e variation mais precisos se vierem aqui
+                if opt.get('spot_price') and not spot_price:
+                    spot_price = _f(opt['spot_price'])
         except Exception:
             pass
 
@@ -3201,53 +3373,38 @@ def api_rolagem_cadeia(ticker):
     spot, spot_change = _get_underlying_quote(ticker, current_user.id)
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=15)
+        chain = _oplab_chain(ticker, token, timeout=15)
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code, 'preview': e.body_preview}), 503
 
-    opt_list = data if isinstance(data, list) else (
-        data.get('options') or data.get('calls', []) + data.get('puts', []) or []
-    )
-    def _b3_option_kind(sym, raw_kind=''):
-        raw = str(raw_kind or '').upper()
-        if 'PUT' in raw or raw == 'P':
-            return 'PUT'
-        if 'CALL' in raw or raw == 'C':
-            return 'CALL'
-        # Padrao B3: A-L = calls, M-X = puts. Ex.: CMIGR132 => PUT.
-        if len(sym) >= 5 and sym[4].isalpha():
-            return 'PUT' if sym[4] in 'MNOPQRSTUVWX' else 'CALL'
-        return 'CALL'
-
+    # Já em ordem de vencimento, tipo e strike (índices da cadeia)
     options = []
-    for o in opt_list:
-        sym = str(o.get('symbol') or o.get('ticker') or '').upper()
-        due_date = str(o.get('due_date') or o.get('expiration_date') or '')
-        if 'T' in due_date:
-            due_date = due_date.split('T')[0]
-        if not sym or not due_date:
-            continue
-        cat = str(o.get('category') or o.get('type') or o.get('option_type') or '').upper()
-        bid = float(o.get('bid') or 0)
-        ask = float(o.get('ask') or 0)
-        options.append({
-            'symbol': sym,
-            'kind': _b3_option_kind(sym, cat),
-            'strike': round(float(o.get('strike') or 0), 2),
-            'exp': due_date,
-            'close': round(float(o.get('close') or 0), 2),
-            'bid': round(bid, 2),
-            'ask': round(ask, 2),
-            'mid': round((bid + ask) / 2, 2) if (bid or ask) else 0,
-            'var_pct': round(float(o.get('variation') or 0), 2),
-            'vol_fin': round(float(o.get('financial_volume') or o.get('volume_financial') or 0), 2),
-        })
+    for due_date in chain.expirations():
+        for kind, side in (('CALL', chain.calls), ('PUT', chain.puts)):
+            for o in side.get(due_date, ()):
+                sym = str(o.get('symbol') or o.get('ticker') or '').upper()
+                if not sym:
+                    continue
+                bid = float(o.get('bid') or 0)
+                ask = float(o.get('ask') or 0)
+                options.append({
+                    'symbol': sym,
+                    'kind': kind,
+                    'strike': round(float(o.get('strike') or 0), 2),
+                    'exp': due_date,
+                    'close': round(float(o.get('close') or 0), 2),
+                    'bid': round(bid, 2),
+                    'ask': round(ask, 2),
+                    'mid': round((bid + ask) / 2, 2) if (bid or ask) else 0,
+                    'var_pct': round(float(o.get('variation') or 0), 2),
+                    'vol_fin': round(float(o.get('financial_volume') or o.get('volume_financial') or 0), 2),
+                })
 
     return jsonify({
         'ticker': ticker,
         'spot': spot,
         'spot_change': spot_change,
-        'options': sorted(options, key=lambda x: (x['exp'], x['kind'], x['strike'])),
+        'options': options,
     })
 
 
@@ -3264,17 +3421,13 @@ def api_cadeia(ticker):
     spot, spot_change = _get_underlying_quote(ticker, current_user.id)
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=15)
+        chain = _oplab_chain(ticker, token, timeout=15)
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code, 'preview': e.body_preview}), 503
     except Exception:
         app.logger.exception('api_cadeia error for %s', ticker)
         return jsonify({'error': 'Erro inesperado ao buscar a cadeia de opcoes.'}), 500
 
-    opt_list = data if isinstance(data, list) else (
-        data.get('options') or data.get('calls', []) + data.get('puts', []) or []
-    )
-
     from datetime import date as _date, timedelta
     import calendar
 
@@ -3330,13 +3483,8 @@ def api_cadeia(ticker):
     _market_open_cadeia = (_now_cad.weekday() < 5
                            and (10, 0) <= (_now_cad.hour, _now_cad.minute) < (16, 30))
 
-    # Normaliza opções
-    calls_by_exp = {}
-    puts_by_exp  = {}
-
-    for o in opt_list:
+    def _row(o):
         sym      = str(o.get('symbol') or o.get('ticker') or '').upper()
-        cat      = str(o.get('category') or o.get('type') or '').upper()
         strike   = float(o.get('strike') or 0)
         close    = float(o.get('close') or 0)
         bid      = float(o.get('bid') or 0)
@@ -3346,11 +3494,6 @@ def api_cadeia(ticker):
         delta    = o.get('delta') or (o.get('greeks') or {}).get('delta') if isinstance(o.get('greeks'), dict) else o.get('delta')
         teorico  = float(o.get('theoretical_price') or o.get('theo') or 0)
         liquidez = float(o.get('liquidity') or o.get('liquidity_score') or 0)
-        due_date = str(o.get('due_date') or o.get('expiration_date') or '')
-        if 'T' in due_date:
-            due_date = due_date.split('T')[0]
-        if not due_date:
-            continue
 
         # Preço executável conforme o horário (mesma regra da Busca de Operações):
         # no pregão vale bid/ask; fora dele o book está vazio ou velho, então o
@@ -3369,7 +3512,7 @@ def api_cadeia(ticker):
                     _b_eff, _b_src = _last_ok, 'último'
                     _a_eff, _a_src = _last_ok, 'último'
 
-        row = {
+        return {
             'symbol':   sym,
             'strike':   round(strike, 2),
             'close':    round(close, 2),
@@ -3389,13 +3532,9 @@ def api_cadeia(ticker):
             'ask_src':  _a_src if _a_eff else None,
         }
 
-        is_put = 'PUT' in cat or cat == 'P'
-        bucket = puts_by_exp if is_put else calls_by_exp
-        bucket.setdefault(due_date, []).append(row)
-
     # Para cada vencimento, seleciona 10 strikes abaixo e 10 acima do spot
     result_exps = []
-    all_exp_keys = sorted(set(list(calls_by_exp.keys()) + list(puts_by_exp.keys())))
+    all_exp_keys = chain.expirations()
 
     today = _date.today()
     # Vencimentos dentro da janela de prazo escolhida
@@ -3428,8 +3567,9 @@ def api_cadeia(ticker):
         n_strikes = 10
 
     for exp in selected_exps:
-        calls = sorted(calls_by_exp.get(exp, []), key=lambda x: x['strike'])
-        puts  = sorted(puts_by_exp.get(exp, []),  key=lambda x: x['strike'])
+        # Só os vencimentos exibidos viram linhas; já vêm ordenados por strike
+        calls = [_row(o) for o in chain.calls.get(exp, ())]
+        puts  = [_row(o) for o in chain.puts.get(exp, ())]
 
         if spot:
             calls_below = [c for c in calls if c['strike'] <= spot][-n_strikes:]
@@ -3620,49 +3760,24 @@ def api_busca_operacoes(ticker):
         return jsonify({'error': f'Cotação de {ticker} indisponível.'}), 404
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=20)
+        chain = _oplab_chain(ticker, token, timeout=20)
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code}), 503
     except Exception:
         app.logger.exception('api_busca_operacoes error for %s', ticker)
         return jsonify({'error': 'Erro inesperado ao buscar a cadeia de opções.'}), 500
 
-    opt_list = data if isinstance(data, list) else (
-        data.get('options') or data.get('calls', []) + data.get('puts', []) or []
-    )
-
     from datetime import date as _date
 
     today = _date.today()
-    calls_by_exp, puts_by_exp = {}, {}
-    for o in opt_list:
-        sym    = str(o.get('symbol') or o.get('ticker') or '').upper()
-        cat    = str(o.get('category') or o.get('type') or '').upper()
-        strike = float(o.get('strike') or 0)
-        bid    = float(o.get('bid') or 0)
-        ask    = float(o.get('ask') or 0)
-        close  = float(o.get('close') or 0)
-        vol    = float(o.get('financial_volume') or o.get('volume_financial') or 0)
-        due    = str(o.get('due_date') or o.get('expiration_date') or '')
-        if 'T' in due:
-            due = due.split('T')[0]
-        if not due or strike <= 0:
-            continue
+
+    def _future(due):
         try:
-            if _date.fromisoformat(due) <= today:
-                continue
+            return _date.fromisoformat(due) > today
         except ValueError:
-            continue
-        delta_raw = o.get('delta')
-        if delta_raw is None and isinstance(o.get('greeks'), dict):
-            delta_raw = o['greeks'].get('delta')
-        row = {'symbol': sym, 'strike': round(strike, 2), 'bid': round(bid, 2),
-               'ask': round(ask, 2), 'close': round(close, 2), 'vol_fin': round(vol, 2),
-               'delta': delta_raw}
-        bucket = puts_by_exp if ('PUT' in cat or cat == 'P') else calls_by_exp
-        bucket.setdefault(due, []).append(row)
+            return False
 
-    all_exps = sorted(set(list(calls_by_exp.keys()) + list(puts_by_exp.keys())))
+    all_exps = [e for e in chain.expirations() if _future(e)]
     if not all_exps:
         return jsonify({'error': f'Nenhuma opção encontrada para {ticker}.'}), 404
 
@@ -3722,6 +3837,10 @@ def api_busca_operacoes(ticker):
         selected_exps = monthly_lim
         mode = 'mensal'
 
+    # Linhas só dos vencimentos escolhidos, já em ordem de strike
+    calls_by_exp = {e: _chain_rows(chain.calls.get(e, ())) for e in selected_exps}
+    puts_by_exp  = {e: _chain_rows(chain.puts.get(e, ())) for e in selected_exps}
+
     def _diversify(rows_list, key_fn, per_key=2, limit=10):
         """Evita linhas quase idênticas: no máx. per_key linhas por perna-âncora."""
         out, count = [], {}
@@ -3738,6 +3857,15 @@ def api_busca_operacoes(ticker):
 
     r_cont = math.log(1 + selic / 100.0)
 
+    # VI de todos os strikes dos vencimentos escolhidos numa chamada vetorizada
+    # por vencimento; as funções abaixo só consultam o memo.
+    chain_iv = ChainIV(spot, r_cont)
+    _groups = []
+    for e in selected_exps:
+        T_e = (_date.fromisoformat(e) - today).days / 365.0
+        _groups += [(calls_by_exp.get(e, []), True, T_e), (puts_by_exp.get(e, []), False, T_e)]
+    chain_iv.prime_many(_groups)
+
     def _leg_delta_pct(row, is_call, T):
         """Delta da perna em módulo, escala 0-100.
         Usa o delta da OpLab quando presente; senão calcula via Black-Scholes
@@ -3752,12 +3880,9 @@ def api_busca_operacoes(ticker):
         prem = row['close'] or ((row['bid'] + row['ask']) / 2 if (row['bid'] and row['ask']) else 0)
         if not prem or T <= 0 or not spot or not row['strike']:
             return None
-        intrinsic = max(0.0, (spot - row['strike']) if is_call else (row['strike'] - spot))
-        iv = None
-        if prem > intrinsic * 1.005:
-            iv = _implied_vol(spot, row['strike'], T, r_cont, prem, is_call)
-            if iv <= 0.006 or iv >= 4.9:
-                iv = None
+        iv = chain_iv.get(row, is_call, T)
+        if iv is not None and (iv <= 0.006 or iv >= 4.9):
+            iv = None
         if iv is None:
             iv = 0.35
         sq = math.sqrt(T)
@@ -3796,14 +3921,8 @@ def api_busca_operacoes(ticker):
 
     def _iv_est(rw, is_call, T):
         """VI implícita da perna extraída do prêmio (último ou mid); None se não converge."""
-        prem = rw['close'] or ((rw['bid'] + rw['ask']) / 2 if (rw['bid'] and rw['ask']) else 0)
-        if not prem or T <= 0 or not rw['strike']:
-            return None
-        intr = max(0.0, (spot - rw['strike']) if is_call else (rw['strike'] - spot))
-        if prem <= intr * 1.005:
-            return None
-        iv = _implied_vol(spot, rw['strike'], T, r_cont, prem, is_call)
-        return iv if 0.005 < iv < 4.9 else None
+        iv = chain_iv.get(rw, is_call, T)
+        return iv if iv is not None and 0.005 < iv < 4.9 else None
 
     def _pop_above(be, T, iv):
         """P(S_T > be) em % via log-normal risk-neutral."""
@@ -3830,8 +3949,7 @@ def api_busca_operacoes(ticker):
                 rw2['bid'] = round(b, 2) if b else 0
                 rw2['ask'] = round(a, 2) if a else 0
                 out.append(rw2)
-            return sorted([r2 for r2 in out if r2['bid'] > 0 and r2['ask'] > 0],
-                          key=lambda x: x['strike'])
+            return [r2 for r2 in out if r2['bid'] > 0 and r2['ask'] > 0]
 
         def _dl(rw, is_call, T):
             d = rw.get('delta')
@@ -4102,10 +4220,8 @@ def api_busca_operacoes(ticker):
             return out
         calls_all = _enrich(calls_by_exp.get(exp, []))
         puts_all  = _enrich(puts_by_exp.get(exp, []))
-        calls_ok = sorted([c for c in calls_all if c['bid'] > 0 and c['ask'] > 0],
-                          key=lambda x: x['strike'])
-        puts_ok  = sorted([p for p in puts_all if p['bid'] > 0 and p['ask'] > 0],
-                          key=lambda x: x['strike'])
+        calls_ok = [c for c in calls_all if c['bid'] > 0 and c['ask'] > 0]
+        puts_ok  = [p for p in puts_all if p['bid'] > 0 and p['ask'] > 0]
         rows = []
 
         if op == 'collar':
@@ -5104,7 +5220,7 @@ def api_busca_operacoes(ticker):
             # como na calculadora "Venda de Puts".
             du = max(round(dc * 5.0 / 7.0), 1)
             # Não exige bid+ask no book: usa a lista completa do vencimento
-            all_puts_exp = sorted(puts_by_exp.get(exp, []), key=lambda x: x['strike'])
+            all_puts_exp = puts_by_exp.get(exp, [])
             cands = [p for p in all_puts_exp
                      if 0.90 * spot <= p['strike'] <= 1.20 * spot
                      and (p['close'] > 0 or p['bid'] > 0)]
@@ -5145,7 +5261,7 @@ def api_busca_operacoes(ticker):
             # risco fora dos breakevens. Deltas exibidos apenas como informação.
             T = dc / 365.0
             # Perna vendida não precisa de ask no book: usa lista completa do vencimento
-            all_calls_st = sorted(calls_by_exp.get(exp, []), key=lambda x: x['strike'])
+            all_calls_st = calls_by_exp.get(exp, [])
             put_map = {p['strike']: p for p in puts_by_exp.get(exp, [])}
             cands = []
             for c in all_calls_st:
@@ -5184,7 +5300,7 @@ def api_busca_operacoes(ticker):
             # com delta entre 15 e 35 em cada ponta (faixa usual da estratégia).
             T = dc / 365.0
             call_cands, put_cands = [], []
-            for c in sorted(calls_by_exp.get(exp, []), key=lambda x: x['strike']):
+            for c in calls_by_exp.get(exp, []):
                 if c['strike'] > spot:
                     c_prem, c_src = _sell_prem(c)
                     if c_prem is None:
@@ -5192,7 +5308,7 @@ def api_busca_operacoes(ticker):
                     d_c = _leg_delta_pct(c, True, T)
                     if d_c is not None and 15 <= d_c <= 35:
                         call_cands.append((c, d_c, c_prem, c_src))
-            for p in sorted(puts_by_exp.get(exp, []), key=lambda x: x['strike']):
+            for p in puts_by_exp.get(exp, []):
                 if p['strike'] < spot:
                     p_prem, p_src = _sell_prem(p)
                     if p_prem is None:
@@ -5342,53 +5458,26 @@ def api_manejo_put(ticker):
         return jsonify({'error': f'Cotação de {ticker} indisponível.'}), 404
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=20)
+        chain = _oplab_chain(ticker, token, timeout=20)
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code}), 503
     except Exception:
         app.logger.exception('api_manejo_put error for %s', ticker)
         return jsonify({'error': 'Erro inesperado ao buscar a cadeia de opções.'}), 500
 
-    opt_list = data if isinstance(data, list) else (
-        data.get('options') or data.get('calls', []) + data.get('puts', []) or []
-    )
-
     today = _date.today()
-    calls_by_exp, puts_by_exp = {}, {}
-    for o in opt_list:
-        sym    = str(o.get('symbol') or o.get('ticker') or '').upper()
-        cat    = str(o.get('category') or o.get('type') or '').upper()
-        ostrike = float(o.get('strike') or 0)
-        bid    = float(o.get('bid') or 0)
-        ask    = float(o.get('ask') or 0)
-        close  = float(o.get('close') or 0)
-        vol    = float(o.get('financial_volume') or o.get('volume_financial') or 0)
-        due    = str(o.get('due_date') or o.get('expiration_date') or '')
-        if 'T' in due:
-            due = due.split('T')[0]
-        if not due or ostrike <= 0:
-            continue
-        try:
-            if _date.fromisoformat(due) < today:
-                continue
-        except ValueError:
-            continue
-        delta_raw = o.get('delta')
-        if delta_raw is None and isinstance(o.get('greeks'), dict):
-            delta_raw = o['greeks'].get('delta')
-        row = {'symbol': sym, 'strike': round(ostrike, 2), 'bid': round(bid, 2),
-               'ask': round(ask, 2), 'close': round(close, 2), 'vol_fin': round(vol, 2),
-               'delta': delta_raw}
-        bucket = puts_by_exp if ('PUT' in cat or cat == 'P') else calls_by_exp
-        bucket.setdefault(due, []).append(row)
-
-    if exp not in calls_by_exp and exp not in puts_by_exp:
+    if exp_date < today or (exp not in chain.calls and exp not in chain.puts):
         return jsonify({'error': f'Nenhuma opção encontrada para {ticker} no vencimento {exp}.'}), 404
+    put_rows_main = _chain_rows(chain.puts.get(exp, ()))
+    call_rows_main = _chain_rows(chain.calls.get(exp, ()))
 
     selic = _selic()
     r_cont = math.log(1 + selic / 100.0)
     T_main = max((exp_date - today).days, 0) / 365.0
 
+    chain_iv = ChainIV(spot, r_cont)
+    chain_iv.prime_many([(put_rows_main, False, T_main), (call_rows_main, True, T_main)])
+
     _now_b = now_brt()
     market_open = (_now_b.weekday() < 5
                    and (10, 0) <= (_now_b.hour, _now_b.minute) < (16, 30))
@@ -5420,12 +5509,9 @@ def api_manejo_put(ticker):
         prem = row['close'] or ((row['bid'] + row['ask']) / 2 if (row['bid'] and row['ask']) else 0)
         if not prem or T <= 0 or not spot or not row['strike']:
             return None
-        intrinsic = max(0.0, (spot - row['strike']) if is_call else (row['strike'] - spot))
-        iv = None
-        if prem > intrinsic * 1.005:
-            iv = _implied_vol(spot, row['strike'], T, r_cont, prem, is_call)
-            if iv <= 0.006 or iv >= 4.9:
-                iv = None
+        iv = chain_iv.get(row, is_call, T)
+        if iv is not None and (iv <= 0.006 or iv >= 4.9):
+            iv = None
         if iv is None:
             iv = 0.35
         sq = math.sqrt(T) if T > 0 else 0.0001
@@ -5434,43 +5520,22 @@ def api_manejo_put(ticker):
         return round((nd1 * 100) if is_call else (nd1 - 1) * 100, 1)
 
     def _iv_est(rw, is_call, T):
-        prem = rw['close'] or ((rw['bid'] + rw['ask']) / 2 if (rw['bid'] and rw['ask']) else 0)
-        if not prem or T <= 0 or not rw['strike']:
-            return None
-        intr = max(0.0, (spot - rw['strike']) if is_call else (rw['strike'] - spot))
-        if prem <= intr * 1.005:
-            return None
-        iv = _implied_vol(spot, rw['strike'], T, r_cont, prem, is_call)
-        return iv if 0.005 < iv < 4.9 else None
+        iv = chain_iv.get(rw, is_call, T)
+        return iv if iv is not None and 0.005 < iv < 4.9 else None
 
     def _greeks(row, is_call, T, iv_fallback=0.35):
         """Gregas aproximadas via Black-Scholes: (delta%, gamma, theta_dia, vega)."""
         if not spot or not row['strike'] or T <= 0:
             return None
-        prem = row['close'] or ((row['bid'] + row['ask']) / 2 if (row['bid'] and row['ask']) else 0)
-        intrinsic = max(0.0, (spot - row['strike']) if is_call else (row['strike'] - spot))
-        iv = None
-        if prem and prem > intrinsic * 1.005:
-            iv = _implied_vol(spot, row['strike'], T, r_cont, prem, is_call)
-            if iv <= 0.006 or iv >= 4.9:
-                iv = None
+        iv = chain_iv.get(row, is_call, T)
+        if iv is not None and (iv <= 0.006 or iv >= 4.9):
+            iv = None
         if iv is None:
             iv = iv_fallback
-        sq = math.sqrt(T)
-        d1 = (math.log(spot / row['strike']) + (r_cont + 0.5 * iv * iv) * T) / (iv * sq)
-        d2 = d1 - iv * sq
-        nd1 = 0.5 * (1 + math.erf(d1 / math.sqrt(2)))
-        pdf_d1 = math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi)
-        delta = (nd1 * 100) if is_call else (nd1 - 1) * 100
-        gamma = pdf_d1 / (spot * iv * sq)
-        vega = spot * pdf_d1 * sq / 100.0
-        nd2 = 0.5 * (1 + math.erf(d2 / math.sqrt(2)))
-        if is_call:
-            theta = (-(spot * pdf_d1 * iv) / (2 * sq) - r_cont * row['strike'] * math.exp(-r_cont * T) * nd2) / 365.0
-        else:
-            theta = (-(spot * pdf_d1 * iv) / (2 * sq) + r_cont * row['strike'] * math.exp(-r_cont * T) * (1 - nd2)) / 365.0
-        return {'delta': round(delta, 1), 'gamma': round(gamma, 5),
-                'theta': round(theta, 4), 'vega': round(vega, 4), 'iv': round(iv * 100, 1)}
+        g = bs_greeks_vec(spot, row['strike'], T, r_cont, iv, is_call)
+        return {'delta': round(float(g['delta']) * 100, 1), 'gamma': round(float(g['gamma']), 5),
+                'theta': round(float(g['theta']), 4), 'vega': round(float(g['vega']), 4),
+                'iv': round(iv * 100, 1)}
 
     def _pop_above(be, T, iv):
         if be <= 0 or T <= 0 or not iv:
@@ -5505,9 +5570,6 @@ def api_manejo_put(ticker):
         scored.sort(key=lambda t: (t[0], t[1]))
         return scored[0][2], scored[0][3]
 
-    put_rows_main = sorted(puts_by_exp.get(exp, []), key=lambda r: r['strike'])
-    call_rows_main = sorted(calls_by_exp.get(exp, []), key=lambda r: r['strike'])
-
     put_original = {
         'symbol': None, 'strike': strike, 'premium': premium, 'exp': exp,
         'qty': qty, 'delta': None,
@@ -5689,8 +5751,7 @@ def api_manejo_put(ticker):
 
     # ── #23 Diagonal de Call em Paralelo (Reforço de Theta/Vega) ─────────────
     def _strat_23():
-        future_exps = sorted(e for e in calls_by_exp.keys()
-                              if today < _date.fromisoformat(e))
+        future_exps = [e for e in sorted(chain.calls) if e > today.isoformat()]
         short_target = today + timedelta(days=17)
         long_target = today + timedelta(days=52)
         short_exp = min(future_exps, key=lambda e: abs((_date.fromisoformat(e) - short_target).days),
@@ -5704,8 +5765,8 @@ def api_manejo_put(ticker):
                     'motivo': 'Não há dois vencimentos de CALL suficientemente espaçados para montar a diagonal.'}
         T_short = max((_date.fromisoformat(short_exp) - today).days, 1) / 365.0
         T_long = max((_date.fromisoformat(long_exp) - today).days, 1) / 365.0
-        short_rows = sorted(calls_by_exp.get(short_exp, []), key=lambda r: r['strike'])
-        long_rows = sorted(calls_by_exp.get(long_exp, []), key=lambda r: r['strike'])
+        short_rows = _chain_rows(chain.calls[short_exp])
+        long_rows = _chain_rows(chain.calls[long_exp])
         short_call, short_delta = _best_delta(short_rows, True, T_short, 40, 50)
         long_call, long_delta = _best_delta(long_rows, True, T_long, 40, 50)
         if not short_call or not long_call:
@@ -6040,17 +6101,13 @@ def api_lancamento_coberto(ticker):
         return jsonify({'error': f'Cotação de {ticker} indisponível.'}), 404
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=20)
+        chain = _oplab_chain(ticker, token, timeout=20)
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code}), 503
     except Exception:
         app.logger.exception('api_lancamento_coberto error for %s', ticker)
         return jsonify({'error': 'Erro inesperado ao buscar a cadeia de opções.'}), 500
 
-    opt_list = data if isinstance(data, list) else (
-        data.get('options') or data.get('calls', []) + data.get('puts', []) or []
-    )
-
     from datetime import date as _date
     today  = _date.today()
     selic  = _selic()
@@ -6070,86 +6127,80 @@ def api_lancamento_coberto(ticker):
         tf = _third_friday(exp_d.year, exp_d.month)
         return abs((exp_d - tf).days) <= 2  # tolera feriado na 3ª sexta
 
-    rows = []
-    for o in opt_list:
-        cat = str(o.get('category') or o.get('type') or '').upper()
-        if 'PUT' in cat or cat == 'P':
-            continue
-        sym    = str(o.get('symbol') or o.get('ticker') or '').upper()
-        strike = float(o.get('strike') or 0)
-        close  = float(o.get('close') or 0)
-        due    = str(o.get('due_date') or o.get('expiration_date') or '')
-        if 'T' in due:
-            due = due.split('T')[0]
-        if not sym or strike <= 0 or not due:
-            continue
-        if close < 0.05:                          # precisa ter tido negócio
-            continue
-        # Só séries com negociação registrada: volume (qtd) e/ou financeiro > 0.
-        # Elimina prints antigos/estagnados que geram taxas absurdas.
-        vol_qtd = float(o.get('volume') or 0)
-        vol_fin = float(o.get('financial_volume') or o.get('volume_financial') or 0)
-        trades  = float(o.get('trades') or o.get('business') or o.get('negocios') or 0)
-        if vol_qtd <= 0 and vol_fin <= 0 and trades <= 0:
-            continue
+    rows, prem_raw = [], []
+    # Prazo e mensal (3ª sexta-feira) valem por vencimento: filtra antes das opções
+    for due, items in chain.calls.items():
         try:
             exp_d = _date.fromisoformat(due)
         except ValueError:
             continue
         dc = (exp_d - today).days
-        if dc <= 60 or dc > 730:                  # >60 dias até 2 anos
-            continue
-        # Só vencimentos mensais (3ª sexta-feira); descarta semanais (sufixo W+dígito)
-        if not _is_monthly(exp_d) or sym.rstrip('0123456789').endswith('W'):
-            continue
-        if not (0.50 * spot <= strike <= 1.30 * spot):
-            continue
-        # Moneyness: CALL é ITM quando strike < spot
-        is_itm = strike < spot
-        if (money == 'itm' and not is_itm) or (money == 'otm' and is_itm):
-            continue
-        custo = spot - close
-        if custo <= 0:
+        if dc <= 60 or dc > 730 or not _is_monthly(exp_d):   # >60 dias até 2 anos
             continue
-        taxa_ex = (strike - custo) / custo * 100
-        if taxa_ex <= 0:                          # exercício daria prejuízo
-            continue
-        taxa_aa = ((1 + taxa_ex / 100) ** (365.0 / dc) - 1) * 100
-        if taxa_aa > 999:                         # composto explode em prazos curtos
-            taxa_aa = None
-        selic_per = ((1 + selic / 100) ** (dc / 365.0) - 1) * 100
-
-        # Delta via BS com IV extraída do prêmio (informativo)
-        delta = None
-        T = dc / 365.0
-        intr = max(0.0, spot - strike)
-        if close > intr * 1.005:
-            iv = _implied_vol(spot, strike, T, r_cont, close, True)
-            if 0.005 < iv < 4.9:
-                d1 = (math.log(spot / strike) + (r_cont + 0.5 * iv * iv) * T) / (iv * math.sqrt(T))
-                delta = round(_norm_cdf(d1) * 100, 1)
-
-        bid = float(o.get('bid') or 0)
-        ask = float(o.get('ask') or 0)
+        for o in items:
+            sym    = str(o.get('symbol') or o.get('ticker') or '').upper()
+            strike = float(o.get('strike') or 0)
+            close  = float(o.get('close') or 0)
+            if not sym or strike <= 0:
+                continue
+            if close < 0.05:                          # precisa ter tido negócio
+                continue
+            # Só séries com negociação registrada: volume (qtd) e/ou financeiro > 0.
+            # Elimina prints antigos/estagnados que geram taxas absurdas.
+            vol_qtd = float(o.get('volume') or 0)
+            vol_fin = float(o.get('financial_volume') or o.get('volume_financial') or 0)
+            trades  = float(o.get('trades') or o.get('business') or o.get('negocios') or 0)
+            if vol_qtd <= 0 and vol_fin <= 0 and trades <= 0:
+                continue
+            # Descarta semanais (sufixo W+dígito)
+            if sym.rstrip('0123456789').endswith('W'):
+                continue
+            if not (0.50 * spot <= strike <= 1.30 * spot):
+                continue
+            # Moneyness: CALL é ITM quando strike < spot
+            is_itm = strike < spot
+            if (money == 'itm' and not is_itm) or (money == 'otm' and is_itm):
+                continue
+            custo = spot - close
+            if custo <= 0:
+                continue
+            taxa_ex = (strike - custo) / custo * 100
+            if taxa_ex <= 0:                          # exercício daria prejuízo
+                continue
+            taxa_aa = ((1 + taxa_ex / 100) ** (365.0 / dc) - 1) * 100
+            if taxa_aa > 999:                         # composto explode em prazos curtos
+                taxa_aa = None
+            selic_per = ((1 + selic / 100) ** (dc / 365.0) - 1) * 100
 
-        rows.append({
-            'symbol':    sym,
-            'exp':       due,
-            'dc':        dc,
-            'strike':    round(strike, 2),
-            'itm_pct':   round((spot - strike) / spot * 100, 1),   # >0 = ITM
-            'premium':   round(close, 2),
-            'bid':       round(bid, 2) if bid else None,
-            'ask':       round(ask, 2) if ask else None,
-            'custo':     round(custo, 2),                          # custo líquido = BE
-            'protec':    round(close / spot * 100, 2),
-            'taxa_ex':   round(taxa_ex, 2),
-            'taxa_aa':   round(taxa_aa, 2) if taxa_aa is not None else None,
-            'vs_selic':  round(taxa_ex - selic_per, 2),
-            'delta':     delta,
-            'vol_fin':   round(vol_fin, 2),
-            'vol_qtd':   round(vol_qtd, 0),
-        })
+            prem_raw.append(close)
+            bid = float(o.get('bid') or 0)
+            ask = float(o.get('ask') or 0)
+
+            rows.append({
+                'symbol':    sym,
+                'exp':       due,
+                'dc':        dc,
+                'strike':    round(strike, 2),
+                'itm_pct':   round((spot - strike) / spot * 100, 1),   # >0 = ITM
+                'premium':   round(close, 2),
+                'bid':       round(bid, 2) if bid else None,
+                'ask':       round(ask, 2) if ask else None,
+                'custo':     round(custo, 2),                          # custo líquido = BE
+                'protec':    round(close / spot * 100, 2),
+                'taxa_ex':   round(taxa_ex, 2),
+                'taxa_aa':   round(taxa_aa, 2) if taxa_aa is not None else None,
+                'vs_selic':  round(taxa_ex - selic_per, 2),
+                'delta':     None,
+                'vol_fin':   round(vol_fin, 2),
+                'vol_qtd':   round(vol_qtd, 0),
+            })
+
+    # Delta via BS com IV extraída do prêmio (informativo) — a cadeia inteira
+    # numa chamada vetorizada em vez de uma bissecção por strike.
+    deltas = chain_delta_pct(spot, r_cont, [r['strike'] for r in rows], prem_raw,
+                             [r['dc'] / 365.0 for r in rows], True)
+    for r, d in zip(rows, deltas):
+        r['delta'] = d
 
     rows.sort(key=lambda x: -x['taxa_ex'])
     # No máximo 10 alternativas por vencimento
@@ -6199,17 +6250,13 @@ def api_venda_put_longa(ticker):
         return jsonify({'error': f'Cotação de {ticker} indisponível.'}), 404
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=20)
+        chain = _oplab_chain(ticker, token, timeout=20)
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code}), 503
     except Exception:
         app.logger.exception('api_venda_put_longa error for %s', ticker)
         return jsonify({'error': 'Erro inesperado ao buscar a cadeia de opções.'}), 500
 
-    opt_list = data if isinstance(data, list) else (
-        data.get('options') or data.get('calls', []) + data.get('puts', []) or []
-    )
-
     from datetime import date as _date
     today  = _date.today()
     selic  = _selic()
@@ -6229,84 +6276,78 @@ def api_venda_put_longa(ticker):
         tf = _third_friday(exp_d.year, exp_d.month)
         return abs((exp_d - tf).days) <= 2  # tolera feriado na 3ª sexta
 
-    rows = []
-    for o in opt_list:
-        cat = str(o.get('category') or o.get('type') or '').upper()
-        if 'PUT' not in cat and cat != 'P':
-            continue
-        sym    = str(o.get('symbol') or o.get('ticker') or '').upper()
-        strike = float(o.get('strike') or 0)
-        close  = float(o.get('close') or 0)
-        due    = str(o.get('due_date') or o.get('expiration_date') or '')
-        if 'T' in due:
-            due = due.split('T')[0]
-        if not sym or strike <= 0 or not due:
-            continue
-        if close < 0.05:                          # precisa ter tido negócio
-            continue
-        # Só séries com negociação registrada — elimina prints estagnados.
-        vol_qtd = float(o.get('volume') or 0)
-        vol_fin = float(o.get('financial_volume') or o.get('volume_financial') or 0)
-        trades  = float(o.get('trades') or o.get('business') or o.get('negocios') or 0)
-        if vol_qtd <= 0 and vol_fin <= 0 and trades <= 0:
-            continue
+    rows, prem_raw = [], []
+    # Prazo e mensal (3ª sexta-feira) valem por vencimento: filtra antes das opções
+    for due, items in chain.puts.items():
         try:
             exp_d = _date.fromisoformat(due)
         except ValueError:
             continue
         dc = (exp_d - today).days
-        if dc <= 40 or dc > 730:                  # >40 dias até 2 anos
-            continue
-        # Só vencimentos mensais (3ª sexta-feira); descarta semanais (sufixo W+dígito)
-        if not _is_monthly(exp_d) or sym.rstrip('0123456789').endswith('W'):
-            continue
-        if not (0.50 * spot <= strike <= 1.30 * spot):
-            continue
-        # Moneyness: PUT é ITM quando strike > spot
-        is_itm = strike > spot
-        if (money == 'itm' and not is_itm) or (money == 'otm' and is_itm):
+        if dc <= 40 or dc > 730 or not _is_monthly(exp_d):   # >40 dias até 2 anos
             continue
+        for o in items:
+            sym    = str(o.get('symbol') or o.get('ticker') or '').upper()
+            strike = float(o.get('strike') or 0)
+            close  = float(o.get('close') or 0)
+            if not sym or strike <= 0:
+                continue
+            if close < 0.05:                          # precisa ter tido negócio
+                continue
+            # Só séries com negociação registrada — elimina prints estagnados.
+            vol_qtd = float(o.get('volume') or 0)
+            vol_fin = float(o.get('financial_volume') or o.get('volume_financial') or 0)
+            trades  = float(o.get('trades') or o.get('business') or o.get('negocios') or 0)
+            if vol_qtd <= 0 and vol_fin <= 0 and trades <= 0:
+                continue
+            # Descarta semanais (sufixo W+dígito)
+            if sym.rstrip('0123456789').endswith('W'):
+                continue
+            if not (0.50 * spot <= strike <= 1.30 * spot):
+                continue
+            # Moneyness: PUT é ITM quando strike > spot
+            is_itm = strike > spot
+            if (money == 'itm' and not is_itm) or (money == 'otm' and is_itm):
+                continue
 
-        # Rentabilidade do prêmio com capital reservado = strike
-        taxa_per = close / strike * 100
-        taxa_aa  = ((1 + taxa_per / 100) ** (365.0 / dc) - 1) * 100
-        if taxa_aa > 999:                         # composto explode em prazos curtos
-            taxa_aa = None
-        selic_per = ((1 + selic / 100) ** (dc / 365.0) - 1) * 100
-        custo_ef  = strike - close                # preço de equilíbrio se exercido
-        margem    = (spot - custo_ef) / spot * 100  # >0 = BE abaixo do spot
-
-        # Delta via BS com IV extraída do prêmio (informativo)
-        delta = None
-        T = dc / 365.0
-        intr = max(0.0, strike - spot)
-        if close > intr * 1.005:
-            iv = _implied_vol(spot, strike, T, r_cont, close, False)
-            if 0.005 < iv < 4.9:
-                d1 = (math.log(spot / strike) + (r_cont + 0.5 * iv * iv) * T) / (iv * math.sqrt(T))
-                delta = round((_norm_cdf(d1) - 1) * 100, 1)
-
-        bid = float(o.get('bid') or 0)
-        ask = float(o.get('ask') or 0)
+            # Rentabilidade do prêmio com capital reservado = strike
+            taxa_per = close / strike * 100
+            taxa_aa  = ((1 + taxa_per / 100) ** (365.0 / dc) - 1) * 100
+            if taxa_aa > 999:                         # composto explode em prazos curtos
+                taxa_aa = None
+            selic_per = ((1 + selic / 100) ** (dc / 365.0) - 1) * 100
+            custo_ef  = strike - close                # preço de equilíbrio se exercido
+            margem    = (spot - custo_ef) / spot * 100  # >0 = BE abaixo do spot
 
-        rows.append({
-            'symbol':    sym,
-            'exp':       due,
-            'dc':        dc,
-            'strike':    round(strike, 2),
-            'itm_pct':   round((strike - spot) / spot * 100, 1),   # >0 = ITM (put)
-            'premium':   round(close, 2),
-            'bid':       round(bid, 2) if bid else None,
-            'ask':       round(ask, 2) if ask else None,
-            'custo_ef':  round(custo_ef, 2),                       # BE se exercido
-            'margem':    round(margem, 2),
-            'taxa_per':  round(taxa_per, 2),
-            'taxa_aa':   round(taxa_aa, 2) if taxa_aa is not None else None,
-            'vs_selic':  round(taxa_per - selic_per, 2),
-            'delta':     delta,
-            'vol_fin':   round(vol_fin, 2),
-            'vol_qtd':   round(vol_qtd, 0),
-        })
+            prem_raw.append(close)
+            bid = float(o.get('bid') or 0)
+            ask = float(o.get('ask') or 0)
+
+            rows.append({
+                'symbol':    sym,
+                'exp':       due,
+                'dc':        dc,
+                'strike':    round(strike, 2),
+                'itm_pct':   round((strike - spot) / spot * 100, 1),   # >0 = ITM (put)
+                'premium':   round(close, 2),
+                'bid':       round(bid, 2) if bid else None,
+                'ask':       round(ask, 2) if ask else None,
+                'custo_ef':  round(custo_ef, 2),                       # BE se exercido
+                'margem':    round(margem, 2),
+                'taxa_per':  round(taxa_per, 2),
+                'taxa_aa':   round(taxa_aa, 2) if taxa_aa is not None else None,
+                'vs_selic':  round(taxa_per - selic_per, 2),
+                'delta':     None,
+                'vol_fin':   round(vol_fin, 2),
+                'vol_qtd':   round(vol_qtd, 0),
+            })
+
+    # Delta via BS com IV extraída do prêmio (informativo) — a cadeia inteira
+    # numa chamada vetorizada em vez de uma bissecção por strike.
+    deltas = chain_delta_pct(spot, r_cont, [r['strike'] for r in rows], prem_raw,
+                             [r['dc'] / 365.0 for r in rows], False)
+    for r, d in zip(rows, deltas):
+        r['delta'] = d
 
     rows.sort(key=lambda x: -x['taxa_per'])
     # No máximo 10 alternativas por vencimento
@@ -6541,9 +6582,12 @@ def venda_puts_edit(id):
             return redirect(url_for('venda_puts_edit', id=id))
         entry_date_str = _f('entry_date')
         p.entry_date       = datetime.strptime(entry_date_str, '%Y-%m-%d').date() if entry_date_str else p.entry_date
+        antes              = p.underlying_price   # a cotação que o formulário mostrou
         p.ticker           = _f('ticker').upper()
         p.underlying_asset = _f('underlying_asset').upper()
         p.underlying_price = float(_f('underlying_price')) if _f('underlying_price') else None
+        QuoteUser.manual(current_user.id, p.underlying_asset, antes, p._underlying_price,
+                         now_brt().replace(tzinfo=None))
         p.strike           = float(_f('strike'))
         p.premium          = float(_f('premium'))
         p.quantity         = int(_f('quantity') or 100)
@@ -6651,6 +6695,28 @@ def venda_puts_delete(id):
     return redirect(url_for('venda_puts'))
 
 
+def _resolve_quotes_db(tickers, user_id):
+    """{ticker: (price, daily_change)} SEM rede, para uma lista inteira de
+    subjacentes de uma vez.
+
+    Uma consulta IN em quote (mercado) e quote_user (o que o usuário trouxe:
+    planilha, feeder, edição manual) — vale a mais recente, ver
+    quote_store.resolve. Memoizado no contexto (Quote.resolve): o mesmo
+    subjacente aparece em várias estruturadas/travas da mesma página e é o
+    mesmo memo que as colunas de preço dos modelos leem. Ticker que ainda não
+    tem cotação lá fica com o preço gravado no Asset do usuário (cadastro ou
+    valor de antes da tabela quote)."""
+    out = {t: (p, c) for t, (p, c, _ts) in Quote.resolve(user_id, tickers).items() if p}
+    falta = {str(t).strip().upper() for t in tickers if t} - set(out)
+    if falta and user_id is not None:
+        up = db.func.upper
+        for t, p, c in (db.session.query(up(Asset.ticker), Asset.current_price, Asset.daily_change)
+                        .filter(Asset.user_id == user_id, up(Asset.ticker).in_(falta),
+                                Asset.current_price > 0).all()):
+            out.setdefault(t, (p, c))
+    return out
+
+
 def _get_underlying_quote_cached(ticker, user_id):
     """Retorna (price, daily_change) do subjacente SEM rede — apenas valores
     já salvos no banco (atualizados pelo botão Atualizar Cotações / feeder).
@@ -6658,51 +6724,14 @@ def _get_underlying_quote_cached(ticker, user_id):
     if not ticker:
         return None, None
     t = ticker.strip().upper()
-    a = Asset.query.filter_by(ticker=t, user_id=user_id).first()
-    if a and a.current_price:
-        return a.current_price, getattr(a, 'daily_change', None)
-    try:
-        # Subjacente fora da carteira: preço salvo na própria Option pelo
-        # Atualizar Cotações (ex.: AXIA3/MULT3 em venda a seco de puts)
-        o = Option.query.filter_by(underlying_asset=t, user_id=user_id)\
-                        .filter(Option.underlying_price > 0)\
-                        .order_by(Option.last_update.desc()).first()
-        if o and o.underlying_price:
-            return o.underlying_price, o.underlying_change
-    except Exception:
-        pass
-    try:
-        ps = PutSale.query.filter_by(underlying_asset=t, user_id=user_id)\
-                          .filter(PutSale.underlying_price > 0).first()
-        if ps and ps.underlying_price:
-            return ps.underlying_price, getattr(ps, 'underlying_change', None)
-    except Exception:
-        pass
-    try:
-        op = StructuredOp.query.filter_by(underlying_asset=t, user_id=user_id)\
-                               .filter(StructuredOp.underlying_price.isnot(None)).first()
-        if op and op.underlying_price:
-            return op.underlying_price, op.underlying_change
-    except Exception:
-        pass
-    sp = OptionSpread.query.filter_by(underlying_asset=t, user_id=user_id).first()
-    if sp and sp.underlying_price:
-        return sp.underlying_price, sp.underlying_change
-    so = StudyOption.query.filter_by(underlying_asset=t, user_id=user_id).first()
-    if so and so.underlying_price:
-        return so.underlying_price, None
-    return None, None
+    return _resolve_quotes_db([t], user_id).get(t, (None, None))
 
 
 def _quotes_from_db(tickers, user_id):
     """Mapa {ticker: {'price', 'change_percent'}} SEM rede, no formato de
-    get_quotes(). Fonte: Asset → StructuredOp → OptionSpread → StudyOption."""
-    out = {}
-    for t in {(x or '').strip().upper() for x in tickers if x}:
-        price, change = _get_underlying_quote_cached(t, user_id)
-        if price:
-            out[t] = {'price': price, 'change_percent': change or 0.0}
-    return out
+    get_quotes(). Ver _resolve_quotes_db."""
+    return {t: {'price': p, 'change_percent': c or 0.0}
+            for t, (p, c) in _resolve_quotes_db(tickers, user_id).items()}
 
 
 def _get_underlying_quote(ticker, user_id):
@@ -7085,6 +7114,7 @@ def edit_option(id):
         flash("Você não tem permissão para editar esta opção.")
         return redirect(url_for('opcoes'))
     if request.method == 'POST':
+        antes = opt.current_option_price   # a cotação que o formulário mostrou
         try:
             opt.ticker = request.form.get('ticker').upper()
             opt.quantity = int(request.form.get('quantity'))
@@ -7099,6 +7129,8 @@ def edit_option(id):
             curr_price_str = request.form.get('current_option_price')
             if curr_price_str:
                 opt.current_option_price = float(curr_price_str.replace(',', '.'))
+                QuoteUser.manual(current_user.id, opt.ticker, antes, opt._current_option_price,
+                                 now_brt().replace(tzinfo=None))
                 
             db.session.commit()
             flash("Opção atualizada com sucesso!", "success")
@@ -7368,31 +7400,41 @@ def api_payoff_leg_current_price():
         ref_id = int(ref_id)
     except (ValueError, AttributeError):
         return jsonify({'error': 'Referência de perna inválida'}), 400
+    # Vira a cotação do usuário para o ticker (quote_user), que é o que a
+    # carteira lê; a coluna fica com o mesmo valor para quando não houver
+    # cotação (ver models._quoted).
+    agora = now_brt().replace(tzinfo=None)
 
     if kind == 'structured':
         leg = StructuredLeg.query.get_or_404(ref_id)
         if leg.operation.user_id != current_user.id:
             return jsonify({'error': 'Sem permissão'}), 403
-        leg.current_price = price
+        if leg.operation.quoted_live():
+            QuoteUser.manual(current_user.id, leg.ticker, leg.current_price, price, agora)
+        leg.current_price = price     # encerrada/intl: é a própria coluna que vale
         leg.last_update = datetime.now()
     elif kind in ('spread_long', 'spread_short'):
         sp = OptionSpread.query.get_or_404(ref_id)
         if sp.user_id != current_user.id:
             return jsonify({'error': 'Sem permissão'}), 403
         if kind == 'spread_long':
+            QuoteUser.manual(current_user.id, sp.leg_long_ticker, sp.leg_long_current, price, agora)
             sp.leg_long_current = price
         else:
+            QuoteUser.manual(current_user.id, sp.leg_short_ticker, sp.leg_short_current, price, agora)
             sp.leg_short_current = price
     elif kind == 'option':
         opt = Option.query.get_or_404(ref_id)
         if opt.user_id != current_user.id:
             return jsonify({'error': 'Sem permissão'}), 403
+        QuoteUser.manual(current_user.id, opt.ticker, opt.current_option_price, price, agora)
         opt.current_option_price = price
         opt.last_update = datetime.now()
     elif kind == 'asset':
         asset = Asset.query.get_or_404(ref_id)
         if asset.user_id != current_user.id:
             return jsonify({'error': 'Sem permissão'}), 403
+        QuoteUser.manual(current_user.id, asset.ticker, asset.current_price, price, agora)
         asset.current_price = price
         asset.last_update = datetime.now()
     else:
@@ -7819,6 +7861,7 @@ def fiis():
 @app.route('/update_fii_dividends', methods=['POST'])
 @login_required
 def update_fii_dividends():
+    import yfinance as yf
     try:
         assets = Asset.query.filter_by(user_id=current_user.id, type='FII').all()
         updated_count = 0
@@ -7902,85 +7945,145 @@ def swingtrade():
 # Preço Médio didático — PM ajustado por dividendos, lucro de opções e
 # compras financiadas com lucro (ações a PM zero). Swing trade fica de fora.
 # ─────────────────────────────────────────────────────────────────────────────
-def _pm_earned_items(user_id, ticker):
-    """Créditos ganhos pelo ticker: dividendos recebidos + lucro/prejuízo de
+def _pm_div_item(d):
+    dt = d.payment_date or d.ex_date
+    qtd_info = (f' ({d.qty_used}× R$ {d.per_share:.4f}/ação)'
+                if d.qty_used and d.per_share else '')
+    return {'key': f'div:{d.id}', 'kind': 'DIVIDENDO',
+            'valor': round(float(d.amount), 2), 'date': dt,
+            'ref': (f'{d.type or "Dividendo"} '
+                    f'{dt.strftime("%d/%m/%Y") if dt else ""} — '
+                    f'R$ {d.amount:.2f}{qtd_info}').replace('.', ',')}
+
+
+def _pm_th_item(th, pv):
+    dt = th.exit_date
+    return {'key': f'th:{th.id}', 'kind': 'OPCOES',
+            'valor': pv, 'date': dt,
+            'ref': f'Opções {th.ticker} '
+                   f'({dt.strftime("%d/%m/%Y") if dt else "-"}) — '
+                   f'resultado R$ {pv:.2f}'.replace('.', ',')}
+
+
+def _pm_earned_by_ticker(user_id, tickers):
+    """Créditos ganhos por ticker: dividendos recebidos + lucro/prejuízo de
     opções realizadas do ativo (TradeHistory 'Opções' via underlying).
-    Swing trade NÃO entra — evento aleatório, não ligado ao papel."""
-    items = []
+    Swing trade NÃO entra — evento aleatório, não ligado ao papel.
+
+    Uma consulta de dividendos e uma de trades para a lista toda; cada trade
+    é atribuído numa passada só (pm_engine.underlyings). Para registros
+    ANTIGOS sem underlying, a raiz B3 do ticker da opção (ABEVA148 → ABEV →
+    ABEV3) só vale se for inequívoca na carteira (PETR3 × PETR4 não)."""
+    tickers = set(tickers)
+    items = {tk: [] for tk in tickers}
+    if not tickers:
+        return items
     for d in Dividend.query.join(Asset).filter(
-            Asset.user_id == user_id, Dividend.ticker == ticker).all():
+            Asset.user_id == user_id, Dividend.ticker.in_(tickers)).all():
         if not d.amount or d.amount <= 0:
             continue
-        dt = d.payment_date or d.ex_date
-        qtd_info = (f' ({d.qty_used}× R$ {d.per_share:.4f}/ação)'
-                    if d.qty_used and d.per_share else '')
-        items.append({'key': f'div:{d.id}', 'kind': 'DIVIDENDO',
-                      'valor': round(float(d.amount), 2), 'date': dt,
-                      'ref': (f'{d.type or "Dividendo"} '
-                              f'{dt.strftime("%d/%m/%Y") if dt else ""} — '
-                              f'R$ {d.amount:.2f}{qtd_info}').replace('.', ',')})
-    # Trades de opções: casa pelo underlying preenchido; para registros ANTIGOS
-    # sem underlying, casa pela raiz B3 do ticker da opção (ABEVA148 → ABEV →
-    # ABEV3) — somente se a raiz for inequívoca na carteira (PETR3 × PETR4 não).
-    # Fallback extra: travas/estruturas registram o subjacente em notes mesmo
-    # quando o campo underlying ficou vazio — close_estruturada usa
-    # "{subjacente} | ..." (1º segmento); close_spread usa
-    # "{spread_type} | {subjacente} | ..." (2º segmento). Casa pelos dois.
-    root = ticker[:4].upper()
-    same_root = Asset.query.filter(Asset.user_id == user_id,
-                                   Asset.type.in_(('ACAO', 'FII')),
-                                   Asset.strategy != 'SWING',
-                                   Asset.quantity > 0,
-                                   Asset.ticker.like(root + '%')).count()
+        items[d.ticker].append(_pm_div_item(d))
+    held = [t for (t,) in db.session.query(Asset.ticker).filter(
+        Asset.user_id == user_id, Asset.type.in_(('ACAO', 'FII')),
+        Asset.strategy != 'SWING', Asset.quantity > 0)]
+    root_map = pm_engine.roots(tickers, held)
     for th in TradeHistory.query.filter_by(user_id=user_id, strategy='Opções').all():
-        und   = (th.underlying or '').strip().upper()
-        tk_th = (th.ticker or '').strip().upper()
-        notes_parts = (th.notes or '').split('|')
-        notes_seg1 = notes_parts[0].strip().upper() if len(notes_parts) > 0 else ''
-        notes_seg2 = notes_parts[1].strip().upper() if len(notes_parts) > 1 else ''
-        match = (und == ticker) or (
-            not und and (tk_th == ticker or notes_seg1 == ticker or notes_seg2 == ticker
-                         or (same_root == 1 and tk_th[:4] == root)))
-        if not match:
+        donos = pm_engine.underlyings(th.underlying, th.ticker, th.notes, tickers, root_map)
+        if not donos:
             continue
         pv = round(float(th.profit_value or 0), 2)
         if abs(pv) < 0.005:
             continue
-        dt = th.exit_date
-        items.append({'key': f'th:{th.id}', 'kind': 'OPCOES',
-                      'valor': pv, 'date': dt,
-                      'ref': f'Opções {th.ticker} '
-                             f'({dt.strftime("%d/%m/%Y") if dt else "-"}) — '
-                             f'resultado R$ {pv:.2f}'.replace('.', ',')})
-    items.sort(key=lambda i: (i['date'] or date.min))
+        for tk in donos:
+            items[tk].append(_pm_th_item(th, pv))
+    for lst in items.values():
+        lst.sort(key=lambda i: (i['date'] or date.min))
     return items
 
 
+def _pm_earned_items(user_id, ticker):
+    return _pm_earned_by_ticker(user_id, [ticker])[ticker]
+
+
+def _pm_states(user_id, tickers):
+    """{ticker: estado do PM ajustado} — ver _pm_state. Ativos, eventos,
+    dividendos e trades de opções saem de uma consulta cada, para a lista
+    toda."""
+    tickers = list(dict.fromkeys(tickers))
+    assets = {}
+    for a in (Asset.query.filter(Asset.user_id == user_id, Asset.ticker.in_(tickers),
+                                 Asset.type.in_(('ACAO', 'FII')),
+                                 Asset.strategy != 'SWING')
+              .order_by(Asset.id).all() if tickers else []):
+        assets.setdefault(a.ticker, a)
+    evs_by = {tk: [] for tk in tickers}
+    for e in (PMEvent.query.filter(PMEvent.user_id == user_id, PMEvent.ticker.in_(tickers))
+              .order_by(PMEvent.created_at, PMEvent.id).all() if tickers else []):
+        evs_by[e.ticker].append(e)
+    earned_by = _pm_earned_by_ticker(user_id, tickers)
+    out = {}
+    for tk in tickers:
+        a, evs = assets.get(tk), evs_by[tk]
+        used_keys  = {e.source_key for e in evs if e.source_key}
+        used_total = round(sum(e.valor or 0 for e in evs), 2)
+        # Pool = créditos varridos (dividendos/opções) − usos; lançamentos MANUAIS
+        # (lucro avulso) abatem o custo mas NÃO consomem o pool de créditos.
+        used_pool  = round(sum(e.valor or 0 for e in evs if e.kind != 'MANUAL'), 2)
+        # Créditos marcados IGNORADO (ex.: evento anterior à posição atual) saem
+        # completamente da varredura: não contam como ganhos, pool nem pendência.
+        ignored_keys = {e.source_key for e in evs if e.kind == 'IGNORADO' and e.source_key}
+        earned  = [i for i in earned_by[tk] if i['key'] not in ignored_keys]
+        pending = [i for i in earned if i['key'] not in used_keys]
+        # Nunca exibe/usa pool negativo (créditos já aplicados que depois tiveram
+        # a origem reduzida/excluída) — trata como zero: não há mais crédito
+        # disponível pra aplicar, mas o PM já abatido no passado continua válido.
+        pool = max(0.0, round(sum(i['valor'] for i in earned) - used_pool, 2))
+        custo_of = (a.quantity * (a.avg_price or 0)) if a else 0.0
+        custo_aj = custo_of - used_total
+        out[tk] = (a, evs, earned, pending, pool, custo_of, custo_aj)
+    return out
+
+
 def _pm_state(user_id, ticker):
     """Estado do PM ajustado de um ticker: eventos, créditos, pool e custo."""
-    a = Asset.query.filter(Asset.user_id == user_id, Asset.ticker == ticker,
-                           Asset.type.in_(('ACAO', 'FII')),
-                           Asset.strategy != 'SWING').first()
-    evs = (PMEvent.query.filter_by(user_id=user_id, ticker=ticker)
-           .order_by(PMEvent.created_at, PMEvent.id).all())
-    used_keys  = {e.source_key for e in evs if e.source_key}
-    used_total = round(sum(e.valor or 0 for e in evs), 2)
-    # Pool = créditos varridos (dividendos/opções) − usos; lançamentos MANUAIS
-    # (lucro avulso) abatem o custo mas NÃO consomem o pool de créditos.
-    used_pool  = round(sum(e.valor or 0 for e in evs if e.kind != 'MANUAL'), 2)
-    # Créditos marcados IGNORADO (ex.: evento anterior à posição atual) saem
-    # completamente da varredura: não contam como ganhos, pool nem pendência.
-    ignored_keys = {e.source_key for e in evs if e.kind == 'IGNORADO' and e.source_key}
-    earned  = [i for i in _pm_earned_items(user_id, ticker)
-               if i['key'] not in ignored_keys]
-    pending = [i for i in earned if i['key'] not in used_keys]
-    # Nunca exibe/usa pool negativo (créditos já aplicados que depois tiveram
-    # a origem reduzida/excluída) — trata como zero: não há mais crédito
-    # disponível pra aplicar, mas o PM já abatido no passado continua válido.
-    pool = max(0.0, round(sum(i['valor'] for i in earned) - used_pool, 2))
-    custo_of = (a.quantity * (a.avg_price or 0)) if a else 0.0
-    custo_aj = custo_of - used_total
-    return a, evs, earned, pending, pool, custo_of, custo_aj
+    return _pm_states(user_id, [ticker])[ticker]
+
+
+# Resumo da página Preço Médio por usuário: (versão 'pm' em version_counter, {ticker:
+# números do ticker}). Vale enquanto a versão não muda — _pm_bump_version a
+# incrementa na mesma transação de qualquer mudança que entre na conta.
+_pm_cache = {}
+_PM_ASSET_COLS = ('quantity', 'avg_price', 'ticker', 'type', 'strategy', 'user_id')
+
+
+@_sa_event.listens_for(_SASession, 'after_flush')
+def _pm_bump_version(session, _ctx):
+    users, asset_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (PMEvent, TradeHistory)):
+            users.add(obj.user_id)
+        elif isinstance(obj, Dividend):
+            asset_ids.add(obj.asset_id)
+        elif isinstance(obj, Asset):
+            # Cotação (current_price etc.) muda o tempo todo e não entra no PM
+            if obj in session.dirty and not any(
+                    _sa_inspect(obj).attrs[c].history.has_changes() for c in _PM_ASSET_COLS):
+                continue
+            users.add(obj.user_id)
+    if users or asset_ids:
+        pm_engine.bump(session.connection(), now_brt().replace(tzinfo=None), users, asset_ids)
+
+
+def _pm_summary(a, evs, earned, pending, pool, custo_of, custo_aj):
+    return {
+        'earned_div': sum(i['valor'] for i in earned if i['kind'] == 'DIVIDENDO'),
+        'earned_opc': sum(i['valor'] for i in earned if i['kind'] == 'OPCOES'),
+        'aplicado': custo_of - custo_aj,
+        'pool': pool,
+        'pending_n': len(pending),
+        'pending_sum': round(sum(i['valor'] for i in pending), 2),
+        'events_n': len(evs),
+    }
 
 
 def _pm_rows(user_id):
@@ -7988,9 +8091,20 @@ def _pm_rows(user_id):
                                 Asset.type.in_(('ACAO', 'FII')),
                                 Asset.strategy != 'SWING',
                                 Asset.quantity > 0).order_by(Asset.ticker).all()
+    ver = version_counter.get(db.session, 'pm', [user_id])[user_id]
+    cached = _pm_cache.get(user_id)
+    resumo = cached[1] if cached and cached[0] == ver else {}
+    faltam = [a.ticker for a in assets if a.ticker not in resumo]
+    if faltam:
+        resumo = dict(resumo)
+        for tk, st in _pm_states(user_id, faltam).items():
+            resumo[tk] = _pm_summary(*st)
+        _pm_cache[user_id] = (ver, resumo)
     rows = {'ACAO': [], 'FII': []}
     for a in assets:
-        _a, evs, earned, pending, pool, custo_of, custo_aj = _pm_state(user_id, a.ticker)
+        r = resumo[a.ticker]
+        custo_of = a.quantity * (a.avg_price or 0)
+        custo_aj = custo_of - r['aplicado']
         pm_aj = custo_aj / a.quantity if a.quantity else 0
         cot = a.current_price or 0
         lucro_rs = (cot - pm_aj) * a.quantity if cot else 0
@@ -8000,16 +8114,16 @@ def _pm_rows(user_id):
             'lucro_pct': ((cot - pm_aj) / pm_aj * 100) if (cot and pm_aj > 0) else 0,
             'asset': a,
             'custo_oficial': custo_of,
-            'earned_div': sum(i['valor'] for i in earned if i['kind'] == 'DIVIDENDO'),
-            'earned_opc': sum(i['valor'] for i in earned if i['kind'] == 'OPCOES'),
-            'aplicado': custo_of - custo_aj,
-            'pool': pool,
-            'pending_n': len(pending),
-            'pending_sum': round(sum(i['valor'] for i in pending), 2),
+            'earned_div': r['earned_div'],
+            'earned_opc': r['earned_opc'],
+            'aplicado': r['aplicado'],
+            'pool': r['pool'],
+            'pending_n': r['pending_n'],
+            'pending_sum': r['pending_sum'],
             'custo_aj': custo_aj,
             'pm_aj': pm_aj,
             'reducao_pct': ((a.avg_price - pm_aj) / a.avg_price * 100) if a.avg_price else 0,
-            'events_n': len(evs),
+            'events_n': r['events_n'],
         })
     return rows
 
@@ -8313,14 +8427,15 @@ def dividendos_recalc_qtd_b3():
     days, tickers_mov = _b3_daily_positions(trades, _B3_INITIAL_POSITION, init_date)
     last_day = days[-1][0] if days else init_date
 
+    from bisect import bisect_left
+    day_dates = [dday for dday, _ in days]
+
     def qty_on(ticker, ref):
         """Posição ao fim do último dia ANTERIOR à data-com (quem tem o papel
-        na véspera do ex-date recebe o provento)."""
-        q = _B3_INITIAL_POSITION.get(ticker, 0)
-        for dday, snap in days:
-            if dday >= ref:
-                break
-            q = snap.get(ticker, 0)
+        na véspera do ex-date recebe o provento) — bisect nos dias com
+        movimentação, cada um já com a posição completa."""
+        i = bisect_left(day_dates, ref)
+        q = days[i - 1][1].get(ticker, 0) if i else _B3_INITIAL_POSITION.get(ticker, 0)
         return max(q, 0)
 
     force_manual = request.form.get('force_manual') == '1'
@@ -8386,33 +8501,46 @@ def pm_historico(ticker):
 # ─────────────────────────────────────────────────────────────────────────────
 # Livro de transações da carteira (AssetTxn)
 # ─────────────────────────────────────────────────────────────────────────────
-def _txn_add(user_id, ticker, side, qty, price, txn_date=None, source='MANUAL', notes=None):
-    """Registra uma transação no livro (não faz commit)."""
-    db.session.add(AssetTxn(
+def _txn_add(user_id, ticker, side, qty, price, txn_date=None, source='MANUAL', notes=None,
+             sync_ledger=True):
+    """Registra uma transação no livro e na série de posição (ledger_position)
+    — não faz commit. sync_ledger=False: quem chama remonta a série no fim
+    (gravação em lote, ver _persist_b3_txns)."""
+    t = AssetTxn(
         user_id=user_id, ticker=(ticker or '').upper(), side=side,
         quantity=int(qty), price=round(float(price or 0), 4),
         txn_date=txn_date or date.today(), source=source,
-        notes=(notes or '')[:200] or None, created_at=datetime.now()))
+        notes=(notes or '')[:200] or None, created_at=datetime.now())
+    db.session.add(t)
+    if sync_ledger:
+        db.session.flush()
+        ledger_position.apply(db.session, user_id, t.ticker, t.txn_date,
+                              t.quantity if side == 'C' else -t.quantity)
+
+
+def _ledger_series(user_id, tickers=None):
+    """{ticker: PositionSeries} do livro do usuário (ver ledger_position.py),
+    montando antes a série dos tickers pedidos (None = todos) que ainda não
+    têm uma."""
+    ledger_position.ensure(db.session, user_id, tickers)
+    return ledger_position.load(db.session, user_id, tickers)
 
 
 def _qty_on_date_ledger(user_id, ticker, ref_date, current_qty):
     """Qtd detida na VÉSPERA de ref_date, reconstruída DE TRÁS PRA FRENTE:
     posição atual − deltas das transações com data >= ref_date. Funciona mesmo
     com livro incompleto no passado, desde que as mudanças APÓS ref estejam
-    registradas."""
-    q = int(current_qty or 0)
-    for t in AssetTxn.query.filter(AssetTxn.user_id == user_id,
-                                   AssetTxn.ticker == (ticker or '').upper(),
-                                   AssetTxn.txn_date >= ref_date).all():
-        q -= t.quantity if t.side == 'C' else -t.quantity
-    return max(q, 0)
+    registradas. Para vários proventos, carregue _ledger_series uma vez."""
+    tk = (ticker or '').upper()
+    serie = _ledger_series(user_id, [tk]).get(tk, ledger_position.PositionSeries())
+    return serie.qty_before(ref_date, current_qty)
 
 
 def _persist_b3_txns(user_id, trades):
     """Grava no livro as operações do CSV da B3, com dedupe. Retorna nº de novas."""
     seen = {(t.ticker, t.txn_date, t.side, t.quantity, round(t.price, 2))
             for t in AssetTxn.query.filter_by(user_id=user_id, source='B3').all()}
-    added = 0
+    added, tocados = 0, set()
     for t in trades:
         key = (t['ticker'], t['date'], t['side'], int(t['qty']), round(float(t['price']), 2))
         if key in seen:
@@ -8421,8 +8549,13 @@ def _persist_b3_txns(user_id, trades):
         nota = ('Transferência B3 (sem preço)' if t.get('no_price')
                 else 'Importação extrato B3')
         _txn_add(user_id, t['ticker'], t['side'], t['qty'], t['price'],
-                 txn_date=t['date'], source='B3', notes=nota)
+                 txn_date=t['date'], source='B3', notes=nota, sync_ledger=False)
+        tocados.add(t['ticker'].upper())
         added += 1
+    if tocados:
+        # Uma remontagem por ticker tocado, em vez de um apply por operação
+        db.session.flush()
+        ledger_position.rebuild(db.session, user_id, tocados)
     return added
 
 
@@ -8442,6 +8575,9 @@ def transacao_delete(id):
         flash('Sem permissão.', 'danger')
         return redirect(url_for('transacoes'))
     db.session.delete(t)
+    db.session.flush()
+    ledger_position.apply(db.session, t.user_id, t.ticker, t.txn_date,
+                          -(t.quantity if t.side == 'C' else -t.quantity))
     db.session.commit()
     flash('Transação removida do livro (a posição oficial NÃO foi alterada).', 'success')
     return redirect(url_for('transacoes'))
@@ -8456,26 +8592,25 @@ def dividendos_recalc_qtd_livro():
     - só recalcula a partir da 1ª transação registrada do ticker no livro
       (antes disso o livro não tem cobertura — não toca)."""
     force_manual = request.form.get('force_manual') == '1'
-    # Data da primeira transação de cada ticker (limite de cobertura do livro)
-    first_txn = {}
-    for t in AssetTxn.query.filter_by(user_id=current_user.id).all():
-        if t.ticker not in first_txn or t.txn_date < first_txn[t.ticker]:
-            first_txn[t.ticker] = t.txn_date
+    # Série de posição de cada ticker: a 1ª data é o limite de cobertura do
+    # livro, e a qtd na data-com é um bisect (uma consulta para tudo).
+    series = _ledger_series(current_user.id)
     updated = skipped = manuais = fora = 0
-    for d in Dividend.query.join(Asset).filter(Asset.user_id == current_user.id).all():
+    for d, qty_atual in (db.session.query(Dividend, Asset.quantity).join(Asset)
+                         .filter(Asset.user_id == current_user.id).all()):
         exd = d.ex_date or d.payment_date
         per = d.per_share or ((d.amount / d.qty_used) if d.qty_used else None)
         if not exd or not per:
             skipped += 1
             continue
         tk = (d.ticker or '').upper()
-        if tk not in first_txn or exd < first_txn[tk]:
+        if tk not in series or exd < series[tk].first_date:
             fora += 1
             continue                      # antes da cobertura do livro
         if d.qty_manual and not force_manual:
             manuais += 1
             continue                      # editado à mão — preservado
-        q = _qty_on_date_ledger(current_user.id, tk, exd, d.asset.quantity)
+        q = series[tk].qty_before(exd, qty_atual)
         d.per_share = per
         d.qty_used = q
         d.amount = round(per * q, 2)
@@ -9350,35 +9485,146 @@ def _b3_daily_positions(trades, initial_pos, initial_date):
     return days, tickers
 
 
-def _fetch_close_history(tickers, start, end):
-    """Baixa o fechamento diário (Yahoo) de cada ticker no período.
-    Retorna {ticker: {date_iso: close}}. Falhas por ticker são ignoradas."""
+_HIST_BATCH = 40   # tickers por yf.download
+
+
+def _yf_download_closes(tickers, start, end):
+    """Fechamento diário (sem ajuste) de vários tickers B3 num único
+    yf.download. Retorna {ticker: {date_iso: close}} só de quem veio."""
     import yfinance as yf
+    syms = {f'{tk}.SA': tk for tk in tickers}
+    data = yf.download(list(syms), start=start.isoformat(),
+                       end=(end + timedelta(days=1)).isoformat(),
+                       auto_adjust=False, group_by='ticker', progress=False,
+                       threads=True, timeout=30)
     out = {}
-    for tk in sorted(tickers):
+    if data is None or data.empty:
+        return out
+    for sym, tk in syms.items():
         try:
-            h = yf.Ticker(f'{tk}.SA').history(start=start.isoformat(),
-                                              end=(end + timedelta(days=1)).isoformat(),
-                                              auto_adjust=False)
-            if h is None or h.empty:
-                continue
-            series = {}
-            for idx, row in h.iterrows():
-                series[idx.date().isoformat()] = float(row['Close'])
-            if series:
-                out[tk] = series
-        except Exception:
-            app.logger.warning('histórico Yahoo falhou para %s', tk)
+            close = data[sym]['Close'].dropna()
+        except KeyError:
+            continue
+        series = {idx.date().isoformat(): float(v) for idx, v in close.items() if v > 0}
+        if series:
+            out[tk] = series
     return out
 
 
-def rebuild_equity_from_b3(user_id, trades, task_id=None):
-    """Reconstrói os snapshots diários de patrimônio a partir das operações da
-    B3 (à vista), valorizando cada dia a preço de mercado (Yahoo). Grava
-    PortfolioSnapshot reais, substituindo os estimados e preservando os reais.
+def _fetch_close_history(tickers, start, end):
+    """Fechamento diário de cada ticker no período, a partir de price_history.
+    Só os trechos ainda não consultados vão ao Yahoo — na primeira importação
+    é o período inteiro; numa reimportação, em geral só os dias desde a
+    última. Retorna {ticker: {date_iso: close}}. Falhas por lote são ignoradas
+    (o trecho fica descoberto e é buscado de novo na próxima vez).
+
+    Os tickers com o MESMO trecho faltante vão juntos num yf.download (que já
+    baixa em paralelo por dentro). Os lotes rodam em sequência de propósito:
+    chamadas simultâneas de yf.download compartilham estado global do
+    yfinance e misturam os resultados."""
+    with db.engine.begin() as conn:
+        gaps = price_history.missing_ranges(conn, tickers, start, end)
+    groups = {}
+    for tk, ranges in gaps.items():
+        for rng in ranges:
+            groups.setdefault(rng, []).append(tk)
+
+    through = now_brt().date() - timedelta(days=1)   # hoje ainda não fechou
+    for (a, b), tks in sorted(groups.items()):
+        tks.sort()
+        for i in range(0, len(tks), _HIST_BATCH):
+            batch = tks[i:i + _HIST_BATCH]
+            try:
+                closes = _yf_download_closes(batch, a, b)
+            except Exception:
+                app.logger.warning('histórico Yahoo falhou para %s (%s → %s)', ','.join(batch), a, b)
+                continue
+            # Sem nenhum dado no lote inteiro não dá para distinguir "sem
+            # pregão" de falha silenciosa: não marca nada como consultado.
+            # Com dados, quem não veio (deslistado, sem negócio) fica coberto.
+            covered = {tk: (a, b) for tk in batch} if closes else {}
+            with db.engine.begin() as conn:
+                price_history.save(conn, closes)
+                price_history.mark_covered(conn, covered, through,
+                                           now=now_brt().replace(tzinfo=None))
+
+    with db.engine.connect() as conn:
+        return price_history.load(conn, tickers, start, end)
+
+
+def _b3_valuation_calendar(first_day, last_day, hist, granularity):
+    """Datas (ISO) em que o patrimônio reconstruído é avaliado: o fim de cada
+    mês (ou hoje, no mês corrente) ou, com granularity='day', cada pregão com
+    cotação no período mais hoje."""
+    from datetime import date as _date, timedelta as _td
+    from dateutil.relativedelta import relativedelta as _rd
+    first_iso, last_iso = first_day.isoformat(), last_day.isoformat()
+    if granularity == 'day':
+        cal = sorted({d for series in hist.values() for d in series if first_iso <= d <= last_iso})
+        if not cal or cal[-1] != last_iso:
+            cal.append(last_iso)
+        return cal
+    cal = []
+    cursor = _date(first_day.year, first_day.month, 1)
+    while cursor <= last_day:
+        nxt = cursor + _rd(months=1)
+        cal.append(min(nxt - _td(days=1), last_day).isoformat())
+        cursor = nxt
+    return cal
+
+
+def _b3_equity_series(days, initial_pos, hist, calendar):
+    """Valoriza a posição em cada data de `calendar` numa única varredura.
+    days: [(date, {ticker: qty})] ordenado (saída de _b3_daily_positions);
+    hist: {ticker: {date_iso: close}}.
+    Retorna (acoes, fiis, etfs) — arrays alinhados com `calendar`.
+
+    Preços: matriz pregões × tickers com forward-fill (o fechamento do último
+    pregão vale para fim de semana/feriado). Posições: matriz eventos ×
+    tickers (linha 0 = posição inicial); cada data pega, via searchsorted, o
+    último evento até ela."""
+    import numpy as _np
+    tks = sorted({tk for _, p in days for tk in p} | set(initial_pos) | set(hist))
+    col = {tk: j for j, tk in enumerate(tks)}
+    cal = _np.array(calendar, dtype='U10')
+
+    dates = sorted({d for series in hist.values() for d in series})
+    row = {d: i for i, d in enumerate(dates)}
+    px = _np.full((len(dates) + 1, len(tks)), _np.nan)   # linha 0: antes de qualquer cotação
+    for tk, series in hist.items():
+        j = col[tk]
+        for d, c in series.items():
+            px[row[d] + 1, j] = c
+    filled = _np.where(_np.isnan(px), 0, _np.arange(len(dates) + 1)[:, None])
+    _np.maximum.accumulate(filled, axis=0, out=filled)
+    px = _np.nan_to_num(px[filled, _np.arange(len(tks))], nan=0.0)
+    px_cal = px[_np.searchsorted(_np.array(dates, dtype='U10'), cal, side='right')]
+
+    qty = _np.zeros((len(days) + 1, len(tks)))
+    for tk, q in initial_pos.items():
+        qty[0, col[tk]] = q
+    for i, (_, p) in enumerate(days, start=1):
+        for tk, q in p.items():
+            qty[i, col[tk]] = q
+    ev = _np.array([d.isoformat() for d, _ in days], dtype='U10')
+    qty_cal = _np.clip(qty[_np.searchsorted(ev, cal, side='right')], 0, None)
+
+    val = qty_cal * px_cal
+    kinds = _np.array([_b3_classify(tk) for tk in tks])
+    fiis = val[:, kinds == 'FII'].sum(axis=1)
+    etfs = val[:, kinds == 'ETF'].sum(axis=1)
+    acoes = val.sum(axis=1) - fiis - etfs
+    return acoes, fiis, etfs
+
+
+def rebuild_equity_from_b3(user_id, trades, task_id=None, granularity='month'):
+    """Reconstrói os snapshots de patrimônio a partir das operações da B3 (à
+    vista), valorizando a preço de mercado (Yahoo) no fim de cada mês ou, com
+    granularity='day', em cada pregão. Grava PortfolioSnapshot reais,
+    substituindo os estimados e preservando os reais.
     Também preenche entry_date/exit_date dos ativos que ainda não têm.
     Retorna dict com o resumo."""
-    from datetime import date as _date, timedelta as _td
+    from datetime import date as _date
 
     init_date = _date.fromisoformat(_B3_INITIAL_POSITION_DATE)
     days, tickers = _b3_daily_positions(trades, _B3_INITIAL_POSITION, init_date)
@@ -9389,75 +9635,36 @@ def rebuild_equity_from_b3(user_id, trades, task_id=None):
     last_day  = now_brt().date()
 
     if task_id:
-        _set_task(task_id, {'status': 'running',
-                            'msg': f'Baixando cotação histórica de {len(tickers)} ativos…',
-                            'category': ''})
+        _set_task(task_id, {'progress': 10,
+                            'msg': f'Baixando cotação histórica de {len(tickers)} ativos…'})
     hist = _fetch_close_history(tickers, first_day, last_day)
 
-    # Preço mais recente conhecido por ticker (para dias sem cotação, usa o último)
-    def _price_on(tk, day_iso, last_known):
-        series = hist.get(tk)
-        if series and day_iso in series:
-            last_known[tk] = series[day_iso]
-            return series[day_iso]
-        return last_known.get(tk, 0.0)
-
-    # Sequência de posições por dia: expande para TODO dia (carrega a última
-    # posição conhecida) e valoriza mensalmente (último dia de cada mês).
-    pos_events = dict(days)                       # {date: {ticker: qty}}
-    cur_pos = {k: v for k, v in _B3_INITIAL_POSITION.items() if v}
-    last_known_price = {}
-
-    # gera fim de cada mês entre first_day e last_day
-    from dateutil.relativedelta import relativedelta as _rd
-    snapshots = []                                # [(date, acoes, fiis, etfs)]
-    cursor = _date(first_day.year, first_day.month, 1)
-    while cursor <= last_day:
-        # último dia do mês (ou hoje, no mês corrente)
-        nxt = cursor + _rd(months=1)
-        month_end = min(nxt - _td(days=1), last_day)
-        # aplica todos os eventos de posição até o fim do mês
-        for dd, p in days:
-            if dd <= month_end:
-                cur_pos = p
-        # valoriza a posição no fim do mês
-        acoes = fiis = etfs = 0.0
-        me_iso = month_end.isoformat()
-        for tk, qty in cur_pos.items():
-            if qty <= 0:
-                continue
-            px = _price_on(tk, me_iso, last_known_price)
-            val = qty * px
-            tp = _b3_classify(tk)
-            if tp == 'FII':
-                fiis += val
-            elif tp == 'ETF':
-                etfs += val
-            else:
-                acoes += val
-        snapshots.append((month_end, round(acoes, 2), round(fiis, 2), round(etfs, 2)))
-        cursor = nxt
+    calendar = _b3_valuation_calendar(first_day, last_day, hist, granularity)
+    initial = {k: v for k, v in _B3_INITIAL_POSITION.items() if v}
+    acoes, fiis, etfs = _b3_equity_series(days, initial, hist, calendar)
 
     # ── Grava snapshots: remove estimados, preserva reais ────────────────────
+    # Depois do DELETE só sobram reais; as datas que não têm um viram INSERT
+    # em lote (antes: um SELECT por data).
     if task_id:
-        _set_task(task_id, {'status': 'running', 'msg': 'Gravando histórico…', 'category': ''})
+        _set_task(task_id, {'progress': 80, 'msg': 'Gravando histórico…'})
     PortfolioSnapshot.query.filter_by(user_id=user_id, estimated=True).delete()
-    written = 0
-    for (dd, acoes, fiis, etfs) in snapshots:
-        iso = dd.isoformat()
-        existing = PortfolioSnapshot.query.filter_by(user_id=user_id, snap_date=iso).first()
-        if existing and not existing.estimated:
+    reais = {d for (d,) in db.session.query(PortfolioSnapshot.snap_date)
+                                     .filter_by(user_id=user_id)}
+    created = datetime.utcnow()
+    rows = []
+    for i, iso in enumerate(calendar):
+        if iso in reais:
             continue                              # snapshot real já coletado: preserva
-        if existing is None:
-            existing = PortfolioSnapshot(user_id=user_id, snap_date=iso)
-            db.session.add(existing)
-        existing.total_acoes = acoes
-        existing.total_fiis  = fiis
-        existing.total_etfs  = etfs
-        existing.total_equity = round(acoes + fiis + etfs, 2)
-        existing.estimated = False                # reconstruído do extrato = real
-        existing.created_at = datetime.utcnow()
-        written += 1
+        a, f, e = round(float(acoes[i]), 2), round(float(fiis[i]), 2), round(float(etfs[i]), 2)
+        rows.append({'user_id': user_id, 'snap_date': iso,
+                     'total_acoes': a, 'total_fiis': f, 'total_etfs': e,
+                     'total_equity': round(a + f + e, 2),
+                     'estimated': False,          # reconstruído do extrato = real
+                     'created_at': created})
+    if rows:
+        db.session.execute(db.insert(PortfolioSnapshot), rows)
+    written = len(rows)
 
     # ── Preenche entry_date / exit_date pelos primeiros/últimos negócios ──────
     first_buy, last_by_ticker, ran_out = {}, {}, {}
@@ -9469,23 +9676,27 @@ def rebuild_equity_from_b3(user_id, trades, task_id=None):
         running[tk] = running.get(tk, 0) + (t['qty'] if t['side'] == 'C' else -t['qty'])
         last_by_ticker[tk] = t['date']
         ran_out[tk] = (running[tk] <= 0)          # zerou nesta última operação?
-    dates_set = 0
-    for tk in set(list(first_buy) + list(_B3_INITIAL_POSITION)):
-        asset = Asset.query.filter_by(user_id=user_id, ticker=tk).first()
-        if not asset:
-            continue
-        if asset.entry_date is None:
-            asset.entry_date = (first_buy.get(tk)
-                                or _date.fromisoformat(_B3_INITIAL_POSITION_DATE))
-            dates_set += 1
+    dated = set(first_buy) | set(_B3_INITIAL_POSITION)
+    updates = []
+    for aid, tk, entry, exit_, qty in (db.session.query(Asset.id, Asset.ticker, Asset.entry_date,
+                                                        Asset.exit_date, Asset.quantity)
+                                       .filter(Asset.user_id == user_id, Asset.ticker.in_(dated))):
+        upd = {}
+        if entry is None:
+            upd['entry_date'] = first_buy.get(tk) or init_date
         # saída só se a posição terminou zerada e o ativo está sem quantidade
-        if asset.exit_date is None and (asset.quantity or 0) <= 0 and ran_out.get(tk):
-            asset.exit_date = last_by_ticker.get(tk)
-            dates_set += 1
+        if exit_ is None and (qty or 0) <= 0 and ran_out.get(tk):
+            upd['exit_date'] = last_by_ticker.get(tk)
+        if upd:
+            updates.append({'id': aid, **upd})
+    # db.update por PK agrupa por conjunto de colunas — um executemany por forma
+    for keys in {tuple(sorted(u)) for u in updates}:
+        db.session.execute(db.update(Asset), [u for u in updates if tuple(sorted(u)) == keys])
+    dates_set = sum(len(u) - 1 for u in updates)
 
     db.session.commit()
     return {'ok': True, 'snapshots': written, 'tickers': len(tickers),
-            'dates_set': dates_set,
+            'dates_set': dates_set, 'granularity': granularity,
             'period': f'{first_day.isoformat()} → {last_day.isoformat()}',
             'quotes': len(hist)}
 
@@ -9515,28 +9726,25 @@ def api_importar_b3():
     if not trades:
         return jsonify({'error': 'Nenhuma operação à vista (ações/FII/ETF) encontrada no arquivo.'}), 400
 
+    granularity = 'day' if request.form.get('granularity') == 'day' else 'month'
     uid = current_user.id
-    task_id = str(uuid.uuid4())
-    _set_task(task_id, {'status': 'running', 'msg': 'Processando…', 'category': ''})
 
-    def _run():
-        with app.app_context():
-            try:
-                res = rebuild_equity_from_b3(uid, trades, task_id=task_id)
-                if res.get('ok'):
-                    msg = (f"Histórico reconstruído: {res['snapshots']} meses, "
-                           f"{res['tickers']} ativos ({res['quotes']} com cotação), "
-                           f"{res['dates_set']} datas de entrada/saída. Período {res['period']}.")
-                    _set_task(task_id, {'status': 'done', 'msg': msg, 'category': 'success'})
-                else:
-                    _set_task(task_id, {'status': 'done', 'msg': res.get('msg', 'Falha.'),
-                                        'category': 'warning'})
-            except Exception as e:
-                app.logger.exception('rebuild_equity_from_b3 falhou')
-                _set_task(task_id, {'status': 'done',
-                                    'msg': f'Erro ao reconstruir: {e}', 'category': 'danger'})
-
-    threading.Thread(target=_run, daemon=True).start()
+    def _run(task_id):
+        try:
+            res = rebuild_equity_from_b3(uid, trades, task_id=task_id, granularity=granularity)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('rebuild_equity_from_b3 falhou')
+            return {'msg': f'Erro ao reconstruir: {e}', 'category': 'danger'}
+        if not res.get('ok'):
+            return {'msg': res.get('msg', 'Falha.'), 'category': 'warning', 'result': res}
+        unidade = 'dias' if granularity == 'day' else 'meses'
+        msg = (f"Histórico reconstruído: {res['snapshots']} {unidade}, "
+               f"{res['tickers']} ativos ({res['quotes']} com cotação), "
+               f"{res['dates_set']} datas de entrada/saída. Período {res['period']}.")
+        return {'msg': msg, 'category': 'success', 'result': res}
+
+    task_id = _submit_task('b3_import', uid, _run, 'Processando…')
     return jsonify({'task_id': task_id, 'trades': len(trades)})
 
 
@@ -9842,6 +10050,15 @@ def resumo():
             equity_months.append(mk)
             cursor_d += _rd(months=1)
 
+    # Curva diária: só snapshots reais (coletados dia a dia ou reconstruídos
+    # do extrato da B3 com granularidade diária) + o patrimônio de agora.
+    equity_days = sorted([s.snap_date, round(s.total_equity or 0, 2)] for s in snaps if not s.estimated)
+    today_iso = now_brt().date().isoformat()
+    if equity_days and equity_days[-1][0] == today_iso:
+        equity_days[-1][1] = round(total_equity, 2)
+    else:
+        equity_days.append([today_iso, round(total_equity, 2)])
+
     return render_template('resumo.html',
                          total_equity=total_equity, total_acoes=total_acoes,
                          total_fiis=total_fiis, total_etfs=total_etfs,
@@ -9862,6 +10079,7 @@ def resumo():
                          equity_months=equity_months,
                          equity_vals=equity_vals,
                          equity_est=equity_est,
+                         equity_days=equity_days,
                          stock_sectors=stock_sectors)
 
 
@@ -10433,13 +10651,13 @@ def config():
 
         return redirect(url_for('config'))
 
-    selic_rate      = float(Settings.get_value('selic_rate', user_id=current_user.id, default='14.5'))
+    selic_rate      = Settings.get_float('selic_rate', current_user.id, 14.5)
     current_key = Settings.get_value('brapi_token', user_id=current_user.id)
     if not current_key:
         current_key = os.environ.get('BRAPI_API_KEY', '')
 
     quote_mode      = Settings.get_value('quote_mode',        user_id=current_user.id, default='yahoo')
-    oplab_auto      = Settings.get_value('oplab_auto_update', user_id=current_user.id, default='false') == 'true'
+    oplab_auto      = Settings.get_bool('oplab_auto_update', current_user.id)
     oplab_interval  = Settings.get_value('oplab_interval',    user_id=current_user.id, default='5')
     oplab_token_ok  = bool(Settings.get_value('oplab_token',  user_id=current_user.id))
 
@@ -11407,20 +11625,15 @@ def update_all_assets_logic(user_id=None, skip_tickers: set = None, only_types:
             quotes = get_quotes(tickers, user_id=user_id, prefer_yahoo=yahoo_preferred)
             
             if quotes:
-                for asset in chunk:
-                    # Generic lookup
-                    quote_data = quotes.get(asset.ticker) or quotes.get(asset.ticker.upper().strip())
-                    
-                    if quote_data:
-                        price = quote_data.get('price')
-                        if price and price > 0:
-                            asset.current_price = price
-                            asset.daily_change = quote_data.get('change_percent', 0.0)
-                            asset.last_update = now_brt()
-                            updated_count += 1
-            
-            # Commit after each chunk
-            db.session.commit()
+                # Só a tabela quote: Asset.current_price lê de lá (models._quoted).
+                # Sem guarda, como antes na carteira: o Yahoo é quem corrige o
+                # close velho que a guarda da OpLab barrou.
+                aceitos = _quote_upsert({t.upper().strip(): (q or {}).get('price') for t, q in quotes.items()},
+                                        {t.upper().strip(): (q or {}).get('change_percent')
+                                         for t, q in quotes.items()},
+                                        'yahoo', guard=set())
+                updated_count += sum(1 for asset in chunk if asset.ticker.upper().strip() in aceitos)
+                _quote_publish(aceitos, [user_id])
             
         except Exception as e:
             print(f"Error updating chunk {tickers}: {e}")
@@ -11434,25 +11647,6 @@ def update_intl_quotes_logic(user_id):
     Helper to update International Assets and Cryptos for a specific user.
     Returns (success: bool, messages: list)
     """
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-
-    headers = {'User-Agent': 'Mozilla/5.0'}
-
-    def _yahoo_price(ticker_yf):
-        """Busca preço e variação de um ticker no Yahoo Finance."""
-        try:
-            url = f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker_yf}?interval=1d&range=1d"
-            r = requests.get(url, headers=headers, timeout=10)
-            meta = r.json()['chart']['result'][0]['meta']
-            price = meta.get('regularMarketPrice', 0.0)
-            chg   = meta.get('regularMarketChangePercent')
-            if chg is None:
-                prev = meta.get('chartPreviousClose') or meta.get('previousClose', 0)
-                chg = ((price - prev) / prev * 100) if prev and prev > 0 else 0.0
-            return price, float(chg)
-        except Exception:
-            return 0.0, 0.0
-
     # 1. USD em paralelo com os demais
     intls   = International.query.filter_by(user_id=user_id).all()
     cryptos = Crypto.query.filter_by(user_id=user_id).all()
@@ -11469,13 +11663,10 @@ def update_intl_quotes_logic(user_id):
         if c.name:
             tasks[f'crypto_{c.id}'] = f"{c.name.strip().upper()}-USD"
 
-    # Busca tudo em paralelo
-    prices = {}
-    with ThreadPoolExecutor(max_workers=10) as ex:
-        fut_map = {ex.submit(_yahoo_price, yf_t): key for key, yf_t in tasks.items()}
-        for fut in as_completed(fut_map):
-            key = fut_map[fut]
-            prices[key] = fut.result()
+    # Busca tudo em paralelo (um request por símbolo distinto, Session compartilhada)
+    quotes = yahoo_quotes(tasks.values())
+    prices = {key: (quotes[yf_t]['price'], quotes[yf_t]['change_percent'])
+              for key, yf_t in tasks.items() if yf_t in quotes}
 
     usd_rate, _ = prices.get('__USD__', (0.0, 0.0))
     if usd_rate <= 0:
@@ -11568,76 +11759,76 @@ def update_quotes():
 def update_quotes_async():
     """Start background update and return task_id immediately (no 504 timeout)."""
     user_id = current_user.id
-    task_id = str(uuid.uuid4())
-    _set_task(task_id, {'status': 'running', 'msg': '', 'category': ''})
 
-    def do_update():
-        with app.app_context():
-            try:
-                update_market_indices()
-                quote_mode  = Settings.get_value('quote_mode', user_id=user_id, default='yahoo')
-                oplab_token = Settings.get_value('oplab_token', user_id=user_id)
-                oplab_covered: set = set()
-                final_msg = ''
-                errs = []
-
-                # ── 1. OpLab: ações B3 + opções ───────────────────────────────
-                if oplab_token:
-                    # Sem probe: a 1ª chamada do bulk já detecta OpLab fora.
-                    # deadline total de 25s para toda a operação OpLab
-                    a_ok, o_ok, oplab_covered, op_err = _do_oplab_bulk_update_safe(
-                        user_id, oplab_token, deadline_secs=25
-                    )
-                    if op_err:
-                        final_msg += f'OpLab: {op_err}. '
-                    else:
-                        final_msg += f'OpLab: {a_ok} ativo(s), {o_ok} opção(ões). '
-
-                # ── 2. Yahoo/Brapi e Internacional — sempre executados ─────────
-                if quote_mode == 'yahoo':
-                    count, tried, errs = update_all_assets_logic(
-                        user_id=user_id, skip_tickers=oplab_covered
-                    )
-                    intl_success, intl_msgs = update_intl_quotes_logic(user_id)
-                    if tried > 0:
-                        final_msg += f'Yahoo/Brapi: {count}/{tried} ativo(s). '
-                    if intl_success:
-                        final_msg += 'Intl/Cripto: OK. '
-                    else:
-                        final_msg += 'Intl: falha. '
-                elif quote_mode == 'mt5':
-                    # ETFs são sempre cotados pelo Yahoo (a OpLab não os cobre aqui).
-                    etf_count, etf_tried, errs = update_all_assets_logic(
-                        user_id=user_id, only_types={'ETF'}
-                    )
-                    if etf_tried:
-                        final_msg += f'ETFs via Yahoo: {etf_count}/{etf_tried}. '
-                    final_msg += 'Ações/FIIs via MT5 Feeder. '
-                    intl_success, _ = update_intl_quotes_logic(user_id)
-
-                # Foto do patrimônio do dia com os preços recém-atualizados
-                record_portfolio_snapshot(user_id)
-
-                category = 'warning' if errs else 'success'
-                _set_task(task_id, {'status': 'done', 'msg': final_msg.strip() or 'Atualizado.', 'category': category})
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                _set_task(task_id, {
-                    'status': 'done',
-                    'msg': f'Erro ao atualizar cotações: {str(e)}',
-                    'category': 'danger'
-                })
+    def do_update(task_id):
+        try:
+            _set_task(task_id, {'progress': 5, 'msg': 'Índices de mercado…'})
+            update_market_indices()
+            quote_mode  = Settings.get_value('quote_mode', user_id=user_id, default='yahoo')
+            oplab_token = Settings.get_value('oplab_token', user_id=user_id)
+            oplab_covered: set = set()
+            final_msg = ''
+            errs = []
+
+            # ── 1. OpLab: ações B3 + opções ───────────────────────────────
+            if oplab_token:
+                _set_task(task_id, {'progress': 15, 'msg': 'OpLab: ações e opções…'})
+                # Sem probe: a 1ª chamada do bulk já detecta OpLab fora.
+                # deadline total de 25s para toda a operação OpLab
+                a_ok, o_ok, oplab_covered, op_err = _do_oplab_bulk_update_safe(
+                    user_id, oplab_token, deadline_secs=25
+                )
+                if op_err:
+                    final_msg += f'OpLab: {op_err}. '
+                else:
+                    final_msg += f'OpLab: {a_ok} ativo(s), {o_ok} opção(ões). '
+
+            # ── 2. Yahoo/Brapi e Internacional — sempre executados ─────────
+            _set_task(task_id, {'progress': 55, 'msg': 'Yahoo/Brapi e internacionais…'})
+            if quote_mode == 'yahoo':
+                count, tried, errs = update_all_assets_logic(
+                    user_id=user_id, skip_tickers=oplab_covered
+                )
+                intl_success, intl_msgs = update_intl_quotes_logic(user_id)
+                if tried > 0:
+                    final_msg += f'Yahoo/Brapi: {count}/{tried} ativo(s). '
+                if intl_success:
+                    final_msg += 'Intl/Cripto: OK. '
+                else:
+                    final_msg += 'Intl: falha. '
+            elif quote_mode == 'mt5':
+                # ETFs são sempre cotados pelo Yahoo (a OpLab não os cobre aqui).
+                etf_count, etf_tried, errs = update_all_assets_logic(
+                    user_id=user_id, only_types={'ETF'}
+                )
+                if etf_tried:
+                    final_msg += f'ETFs via Yahoo: {etf_count}/{etf_tried}. '
+                final_msg += 'Ações/FIIs via MT5 Feeder. '
+                intl_success, _ = update_intl_quotes_logic(user_id)
 
-    threading.Thread(target=do_update, daemon=True).start()
-    return jsonify({'task_id': task_id})
+            # Foto do patrimônio do dia com os preços recém-atualizados
+            _set_task(task_id, {'progress': 90, 'msg': 'Gravando a foto do patrimônio…'})
+            record_portfolio_snapshot(user_id)
+
+            category = 'warning' if errs else 'success'
+            return {'msg': final_msg.strip() or 'Atualizado.', 'category': category}
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            db.session.rollback()
+            return {'msg': f'Erro ao atualizar cotações: {str(e)}', 'category': 'danger'}
+
+    return jsonify({'task_id': _submit_task('quotes', user_id, do_update)})
 
 
 @app.route('/api/update_progress/<task_id>')
 @login_required
 def update_progress(task_id):
-    """Poll endpoint to check background update status."""
-    return jsonify(_get_task(task_id))
+    """Estado da tarefa em segundo plano. Com ?v=<versão>&wait=<s> é
+    long-poll: a resposta só sai quando a versão mudar (ou a tarefa terminar),
+    em no máximo `wait` segundos (teto bg_tasks.WAIT_MAX)."""
+    return jsonify(bg_tasks.wait(task_id, current_user.id, request.args.get('v', type=int),
+                                 request.args.get('wait', 0, type=float)))
 
 
 @app.route('/update_intl_quotes')
@@ -11950,7 +12141,17 @@ def importar_excel():
                     all_prices[key] = p
                     all_rows[key] = row
 
-    now = now_brt()
+    # A planilha é do usuário: os preços vão para quote_user dele (uma linha
+    # por ticker), não para a tabela quote, que é de todos. As colunas de
+    # preço da carteira leem de lá (ver models._quoted); aqui só se contam as
+    # posições cobertas e se gravam strike/vencimento/gregas.
+    precos = {k: p for k, p in all_prices.items() if p is not None and p > 0}
+    variacoes = {}
+    for k in precos:
+        row = all_rows.get(k)
+        if row and len(row) > 9:
+            variacoes[k] = _float(row[9])   # variação diária (col 9)
+
     ativos_atualizados     = 0
     opcoes_atualizadas     = 0
     spreads_atualizados    = 0
@@ -11958,37 +12159,20 @@ def importar_excel():
     estudo_opcoes_atualizados = 0
     nao_encontrados_ativos = []
 
-    # ── 1. Atualiza Asset (ações, FIIs, ETFs) ────────────────────────
+    # ── 1. Asset (ações, FIIs, ETFs) ─────────────────────────────────
     for asset in Asset.query.filter_by(user_id=current_user.id).all():
-        key = asset.ticker.upper()
-        p = all_prices.get(key)
-        if p is not None and p > 0:
-            asset.current_price = p
-            asset.last_update   = now
-            # variação diária (col 9)
-            row = all_rows.get(key)
-            if row and len(row) > 9:
-                v = _float(row[9])
-                if v is not None:
-                    asset.daily_change = v
+        if asset.ticker.upper() in precos:
             ativos_atualizados += 1
         else:
             nao_encontrados_ativos.append(asset.ticker)
 
-    # ── 2. Atualiza Option (venda/compra call/put) ───────────────────
+    # ── 2. Option (venda/compra call/put): gregas ────────────────────
     for opt in Option.query.filter_by(user_id=current_user.id).all():
         key = opt.ticker.upper()
-        p = all_prices.get(key)
         row = all_rows.get(key) or extra_greeks.get(key)
-        if p is not None:
-            opt.current_option_price = p
-            opt.last_update = now
+        if key in precos:
             opcoes_atualizadas += 1
         if row:
-            if len(row) > 9:
-                v = _float(row[9])
-                if v is not None:
-                    opt.daily_change = v
             # greeks do rtd/opcao (cols 22=VI, 23=delta, 24=gama)
             if len(row) > 22:
                 vi = _float(row[22]);  opt.ve    = vi if vi is not None else opt.ve
@@ -12004,66 +12188,23 @@ def importar_excel():
             if len(erow) > 18:
                 g = _float(erow[18]);  opt.gama  = g if g is not None else opt.gama
 
-    # ── 3. Atualiza OptionSpread (travas) ────────────────────────────
+    # ── 3. OptionSpread (travas) ─────────────────────────────────────
     for sp in OptionSpread.query.filter_by(user_id=current_user.id).all():
-        changed = False
-        if sp.leg_long_ticker:
-            p = all_prices.get(sp.leg_long_ticker.upper())
-            if p is not None:
-                sp.leg_long_current = p
-                changed = True
-        if sp.leg_short_ticker:
-            p = all_prices.get(sp.leg_short_ticker.upper())
-            if p is not None:
-                sp.leg_short_current = p
-                changed = True
-        # Atualiza cotação do ativo subjacente da trava
-        und_key = (sp.underlying_asset or '').upper()
-        und_p = all_prices.get(und_key)
-        if und_p is not None and und_p > 0:
-            sp.underlying_price = und_p
-            und_row = all_rows.get(und_key)
-            if und_row and len(und_row) > 9:
-                v = _float(und_row[9])
-                if v is not None:
-                    sp.underlying_change = v
-            changed = True
-        if changed:
+        if any((t or '').upper() in precos
+               for t in (sp.leg_long_ticker, sp.leg_short_ticker, sp.underlying_asset)):
             spreads_atualizados += 1
 
-    # ── 4. Atualiza StructuredLeg (operações estruturadas) ───────────
+    # ── 4. Operações estruturadas abertas ────────────────────────────
     for op in StructuredOp.query.filter_by(user_id=current_user.id, status='OPEN').all():
-        op_changed = False
-        for leg in op.legs:
-            key = leg.ticker.upper() if leg.ticker else ''
-            p = all_prices.get(key)
-            if p is not None:
-                leg.current_price = p
-                leg.last_update   = now
-                op_changed = True
-        # Atualiza cotação do ativo subjacente direto no rtd
-        und_key = (op.underlying_asset or '').upper()
-        und_p = all_prices.get(und_key)
-        if und_p is not None and und_p > 0:
-            op.underlying_price = und_p
-            row = all_rows.get(und_key)
-            if row and len(row) > 9:
-                v = _float(row[9])
-                if v is not None:
-                    op.underlying_change = v
-            op_changed = True
-        if op_changed:
+        if any((t or '').upper() in precos
+               for t in [op.underlying_asset] + [leg.ticker for leg in op.legs]):
             estruturadas_atualizadas += 1
 
-    # ── 5. Atualiza StudyOption ──────────────────────────────────────
+    # ── 5. StudyOption: strike, vencimento e gregas ──────────────────
     for so in StudyOption.query.filter_by(user_id=current_user.id).all():
         key = so.ticker.upper()
         row = all_rows.get(key) or extra_greeks.get(key)
-        changed = False
-        p = all_prices.get(key)
-        if p is not None:
-            so.option_price = p
-            changed = True
+        changed = key in precos or (so.underlying_asset or '').upper() in precos
         if row:
             if len(row) > 8:
                 s = _float(row[8]);
@@ -12084,32 +12225,10 @@ def importar_excel():
                 g = _float(row[24])
                 if g is not None:
                     so.gama = g;  changed = True
-        # underlying price
-        und_key = (so.underlying_asset or '').upper()
-        up = all_prices.get(und_key)
-        if up is not None and up > 0:
-            so.underlying_price = up;  changed = True
         if changed:
             estudo_opcoes_atualizados += 1
 
-    # ── 6. Atualiza PutSale ──────────────────────────────────────
-    for ps in PutSale.query.filter_by(user_id=current_user.id).all():
-        und_key = (ps.underlying_asset or '').upper()
-        up = all_prices.get(und_key)
-        if up is not None and up > 0:
-            ps.underlying_price = up
-
-    # ── 7. Atualiza OptionSpread.underlying_price ────────────────
-    for sp in OptionSpread.query.filter_by(user_id=current_user.id).all():
-        und_key = (sp.underlying_asset or '').upper()
-        up = all_prices.get(und_key)
-        if up is not None and up > 0:
-            sp.underlying_price = up
-        row = all_rows.get(und_key)
-        if row and len(row) > 9:
-            v = _float(row[9])
-            if v is not None:
-                sp.underlying_change = v
+    _quote_user_upsert(current_user.id, precos, variacoes, 'excel')
 
     # ── 8. Persiste dados de opções em RtdOptionData (cache para Busca de Opção) ──
     # Formato TSV RTDTrading (colunas 0-based):
@@ -12204,6 +12323,7 @@ def importar_excel():
         db.session.rollback()
         flash(f'Erro ao salvar: {e}', 'danger')
         return redirect(url_for('importar_excel'))
+    _quote_publish(precos, [current_user.id], private=True)
 
     msg = (f'Atualizado: {ativos_atualizados} ativo(s), {opcoes_atualizadas} opção(ões), '
            f'{spreads_atualizados} spread(s), {estruturadas_atualizadas} op. estruturada(s) '
@@ -12216,1107 +12336,145 @@ def importar_excel():
     return redirect(url_for('importar_excel'))
 
 
-# ─────────────────────────────────────────────────────────────────
-# ESTUDOS
-# ─────────────────────────────────────────────────────────────────
-
-# Estratégias de estudo agrupadas por CENÁRIO (direção do mercado + volatilidade),
-# com base no guia de operações. Cada grupo vira um <optgroup> no seletor para
-# orientar a escolha. O rótulo do grupo traz a dica de quando usar.
-STUDY_STRATEGY_GROUPS = [
-    ('📈 Alta — Vol. baixa (comprar prêmio)', [
-        'Compra de Call', 'Trava de Alta com Call', 'Call Backspread',
-        'Ratio Call', 'Risk Reversal', 'Seagull de Alta',
-    ]),
-    ('📈 Alta — Vol. alta (vender prêmio)', [
-        'Venda de Put', 'Trava de Alta com Put', 'Jade Lizard',
-    ]),
-    ('📉 Baixa — Vol. baixa (comprar prêmio)', [
-        'Compra de Put', 'Trava de Baixa com Put', 'Put Backspread', 'Seagull de Baixa',
-    ]),
-    ('📉 Baixa — Vol. alta (vender prêmio)', [
-        'Trava de Baixa com Call',
-    ]),
-    ('➡️ Lateral — Vol. alta (vender prêmio)', [
-        'Venda de Call Coberta', 'Strangle Vendido', 'Straddle Vendido',
-        'Iron Condor', 'Iron Butterfly', 'Borboleta', 'Condor',
-        'Boi', 'Vaca', 'Ratio Spread',
-    ]),
-    ('➡️ Lateral — Vol. baixa / renda', [
-        'Collar', 'Fence', 'Calendar Spread', 'Diagonal Spread',
-    ]),
-    ('⚡ Volatilidade (movimento forte em qualquer direção)', [
-        'Compra de Call', 'Compra de Put', 'Straddle Comprado', 'Strangle Comprado',
-        'Strap', 'Strip', 'Guts',
-    ]),
-    ('🧬 Outras', [
-        'Ação Sintética', 'Short Sintético', 'Box Spread', 'Outros', 'ne',
-    ]),
-]
-
-# Lista plana (compatível com valores já salvos), sem duplicatas, preservando ordem.
-STUDY_STRATEGIES = []
-for _grp, _items in STUDY_STRATEGY_GROUPS:
-    for _s in _items:
-        if _s not in STUDY_STRATEGIES:
-            STUDY_STRATEGIES.append(_s)
-
-# Mapeamento dos valores da planilha para os do programa
-_STRATEGY_MAP = {
-    'venda coberta':          'Venda de Call Coberta',
-    'venda de call coberta':  'Venda de Call Coberta',
-    'venda de call':          'Venda de Call Coberta',
-    'venda put':              'Venda de Put',
-    'venda de put':           'Venda de Put',
-    'compra de put':          'Compra de Put',
-    'compra put':             'Compra de Put',
-    'trava de alta':          'Trava de Alta com Call',
-    'trava de alta com call': 'Trava de Alta com Call',
-    'trava de alta com put':  'Trava de Alta com Put',
-    'trava de baixa':         'Trava de Baixa com Call',
-    'trava de baixa com call':'Trava de Baixa com Call',
-    'trava de baixa com put': 'Trava de Baixa com Put',
-    'strangle vendido':       'Strangle Vendido',
-    'strangle':               'Strangle Vendido',
-    'borboleta':              'Borboleta',
-    'iron condor':            'Iron Condor',
-    'compra call':            'Compra de Call',
-    'compra de call':         'Compra de Call',
-    'boi':                    'Boi',
-    'vaca':                   'Vaca',
-    'outros':                 'Outros',
-    'ne':                     'ne',
-}
-
-def _normalize_strategy(value):
-    """Converte valor da planilha para a lista do programa."""
-    if not value:
-        return None
-    normalized = _STRATEGY_MAP.get(str(value).strip().lower())
-    if normalized:
-        return normalized
-    # se já é um valor válido da lista, devolve como está
-    if value in STUDY_STRATEGIES:
-        return value
-    return 'Outros'
-
+@app.route('/profile', methods=['GET', 'POST'])
+@login_required
+def profile():
+    if request.method == 'POST':
+        action = request.form.get('action', 'change_password')
 
-def _calc_vdx(option_price, underlying_price, days, strike):
-    """VDX = taxa * tempo * espaço"""
-    try:
-        if not all([option_price, underlying_price, days is not None, strike]):
-            return None
-        taxa   = option_price / underlying_price
-        tempo  = 120 - days
-        espaco = strike - underlying_price
-        return taxa * tempo * espaco
-    except (TypeError, ZeroDivisionError):
-        return None
+        if action == 'update_profile':
+            current_user.full_name = request.form.get('full_name', '').strip()
+            current_user.email     = request.form.get('email', '').strip()
+            current_user.phone     = request.form.get('phone', '').strip()
+            # Upload de avatar
+            avatar = request.files.get('avatar')
+            if avatar and avatar.filename:
+                ext = avatar.filename.rsplit('.', 1)[-1].lower()
+                if ext in ('jpg', 'jpeg', 'png', 'gif', 'webp'):
+                    fname = f"avatar_{current_user.id}.{ext}"
+                    avatar_dir = os.path.join(basedir, 'static', 'img', 'avatars')
+                    os.makedirs(avatar_dir, exist_ok=True)
+                    avatar.save(os.path.join(avatar_dir, fname))
+                    current_user.avatar_filename = fname
+                else:
+                    flash('Formato de imagem não suportado. Use JPG, PNG, GIF ou WEBP.', 'warning')
+            db.session.commit()
+            flash('Perfil atualizado!', 'success')
 
+        elif action == 'change_password':
+            curr_pass = request.form.get('current_password')
+            new_pass = request.form.get('new_password')
+            confirm_pass = request.form.get('confirm_password')
+            if not current_user.check_password(curr_pass):
+                flash('Senha atual incorreta.', 'danger')
+            elif new_pass != confirm_pass:
+                flash('Novas senhas não conferem.', 'danger')
+            else:
+                current_user.set_password(new_pass)
+                db.session.commit()
+                flash('Senha alterada com sucesso!', 'success')
 
-def _calc_nv(ve, delta, gama):
-    """NV = VE - delta - gama"""
-    if ve is None or delta is None or gama is None:
-        return None
-    return ve - delta - gama
+        elif action == 'save_oplab':
+            token = request.form.get('oplab_token', '').strip()
+            if token:
+                Settings.set_value('oplab_token', token, user_id=current_user.id)
+                flash('Token OpLab salvo com sucesso!', 'success')
+            else:
+                flash('Informe o token OpLab.', 'danger')
 
+        return redirect(url_for('profile'))
 
-def _roll_flag(days, spot, strike):
-    """Aviso de possível necessidade de rolagem (teoria do Bastter):
-    na venda coberta, quando a call está ITM perto do vencimento o VE se
-    esgota e o exercício fica provável — hora de avaliar a rolagem.
-    ALERT = ITM e vence em <= 7 dias (rolagem provável)
-    WARN  = ITM e vence em <= 21 dias, ou <= 7 dias mesmo OTM (atenção)"""
-    if days is None or not spot or not strike:
-        return None
-    itm = spot > strike
-    if days <= 7:
-        return 'ALERT' if itm else 'WARN'
-    if days <= 21 and itm:
-        return 'WARN'
-    return None
+    oplab_configured = bool(Settings.get_value('oplab_token', user_id=current_user.id))
+    return render_template('profile.html', oplab_configured=oplab_configured)
 
 
-@app.route('/estudos')
+@app.route('/oplab_debug')
 @login_required
-def estudos():
+def oplab_debug():
+    """Diagnóstico: estado do token OpLab no banco."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
     uid = current_user.id
-    today = date.today()
-
-    # ── Tabela 1: Estudo Opções Cobertas ────────────────────────────
-    # A) Opções VENDA_CALL lançadas na página /opcoes
-    venda_calls = Option.query.filter_by(user_id=uid, option_type='VENDA_CALL').all()
-    vc_underlying = {opt.underlying_asset.upper() for opt in venda_calls}
-    assets_map = {
-        a.ticker.upper(): a
-        for a in Asset.query.filter_by(user_id=uid).all()
-    }
-    study_calls_vc = []
-    for opt in venda_calls:
-        asset = assets_map.get(opt.underlying_asset.upper())
-        up = asset.current_price if asset else 0
-        days = (opt.expiration_date - today).days if opt.expiration_date else None
-        vdx = _calc_vdx(opt.current_option_price, up, days, opt.strike_price)
-        nv  = _calc_nv(opt.ve, opt.delta, opt.gama)
-        study_calls_vc.append({
-            'source': 'venda_call',
-            'id': opt.id,
-            'ticker': opt.ticker,
-            'underlying': opt.underlying_asset,
-            'underlying_price': up,
-            'avg_price': asset.avg_price if asset else 0,
-            'strike': opt.strike_price,
-            'expiration': opt.expiration_date,
-            'days': days,
-            'option_price': opt.current_option_price,
-            've': opt.ve,
-            'delta': opt.delta,
-            'gama': opt.gama,
-            'vdx': vdx,
-            'nv': nv,
-            'roll_flag': _roll_flag(days, up, opt.strike_price),
-        })
+    raw = Settings.query.filter_by(key='oplab_token', user_id=uid).first()
+    token = Settings.get_value('oplab_token', user_id=uid)
+    return jsonify({
+        'user_id': uid,
+        'row_exists': raw is not None,
+        'raw_value_len': len(raw.value) if raw else 0,
+        'get_value_result': bool(token),
+        'token_prefix': token[:8] + '...' if token and len(token) > 8 else token,
+    })
 
-    # B) Opções extras adicionadas diretamente nesta página
-    study_calls_extra = []
-    for so in StudyOption.query.filter_by(user_id=uid).all():
-        days = (so.expiration_date - today).days if so.expiration_date else None
-        vdx = _calc_vdx(so.option_price, so.underlying_price, days, so.strike)
-        nv  = _calc_nv(so.ve, so.delta, so.gama)
-        study_calls_extra.append({
-            'source': 'study',
-            'id': so.id,
-            'ticker': so.ticker,
-            'underlying': so.underlying_asset,
-            'underlying_price': so.underlying_price,
-            'avg_price': so.avg_price_stock,
-            'strike': so.strike,
-            'expiration': so.expiration_date,
-            'days': days,
-            'option_price': so.option_price,
-            've': so.ve,
-            'delta': so.delta,
-            'gama': so.gama,
-            'vdx': vdx,
-            'nv': nv,
-            'roll_flag': _roll_flag(days, so.underlying_price, so.strike),
-        })
 
-    # ── Tabela 2: Estudo Ações ───────────────────────────────────────
-    study_stocks = StudyStock.query.filter_by(user_id=uid).order_by(StudyStock.ticker).all()
-    study_intl_stocks = StudyIntlStock.query.filter_by(user_id=uid).order_by(StudyIntlStock.ticker).all()
-
-    # Estratégias ativas por papel (várias por ticker — tabela study_strategy)
-    strategies_by_ticker = {}
-    for st in (StudyStrategy.query.filter_by(user_id=uid)
-               .order_by(StudyStrategy.ticker, StudyStrategy.id).all()):
-        strategies_by_ticker.setdefault(st.ticker.upper(), []).append(st)
-
-    # ── Tabela 3: Ações Livres (sem venda coberta ativa nem garantia em estruturada) ──
-    # Ações usadas como garantia em operações estruturadas abertas
-    collateral_tickers = {
-        op.underlying_asset.upper()
-        for op in StructuredOp.query.filter_by(user_id=uid, status='OPEN').all()
-        if op.uses_stock_collateral and op.underlying_asset
-    }
-    all_acoes = [a for a in Asset.query.filter_by(user_id=uid, type='ACAO').all() if a.quantity > 0]
-    free_stocks = [
-        a for a in all_acoes
-        if a.ticker.upper() not in vc_underlying
-        and a.ticker.upper() not in collateral_tickers
+@app.route('/oplab_test', methods=['GET', 'POST'])
+@login_required
+def oplab_test():
+    """Retorna JSON bruto da API OpLab para diagnóstico."""
+    token = Settings.get_value('oplab_token', user_id=current_user.id)
+    if not token:
+        return jsonify({'error': 'Token não configurado'}), 400
+    ticker = (request.args.get('ticker') or request.form.get('ticker', 'PETR4')).strip().upper()
+    underlying = request.args.get('underlying', '').strip().upper()
+    if not underlying:
+        asset_match = Asset.query.filter_by(user_id=current_user.id, ticker=ticker).first()
+        option_match = Option.query.filter_by(user_id=current_user.id, ticker=ticker).first()
+        study_match = StudyOption.query.filter_by(user_id=current_user.id, ticker=ticker).first()
+        underlying = (
+            (asset_match.ticker if asset_match else '') or
+            (option_match.underlying_asset if option_match else '') or
+            (study_match.underlying_asset if study_match else '') or
+            ticker
+        ).upper()
+    # Endpoints conforme a spec OpLab v3. /instruments/{t} e /market/spot/{u}
+    # não existem na API (davam 404 sempre) e saíram do diagnóstico.
+    # /market/status é o teste mais leve de credencial — vem primeiro na tela.
+    checks = [
+        ('/market/status',                    {}),
+        (f'/market/instruments/{ticker}',     {}),
+        ('/market/quote',                     {'tickers': ticker}),
+        (f'/market/options/{underlying}',     {}),
     ]
-    free_stocks.sort(key=lambda a: a.ticker)
-
-    return render_template(
-        'estudos.html',
-        study_calls_vc=study_calls_vc,
-        study_calls_extra=study_calls_extra,
-        study_stocks=study_stocks,
-        study_intl_stocks=study_intl_stocks,
-        strategies_by_ticker=strategies_by_ticker,
-        free_stocks=free_stocks,
-        strategies=STUDY_STRATEGIES,
-        strategy_groups=STUDY_STRATEGY_GROUPS,
-    )
-
-
-# ── Estratégias ativas por papel (tela Estudos) — CRUD JSON ─────────────────
-def _study_strategy_json(st):
-    return {
-        'id': st.id, 'ticker': st.ticker, 'tipo': st.tipo,
-        'qty': st.qty, 'option_ticker': st.option_ticker or '',
-        'valor': st.valor,
-        'venc_curto': st.venc_curto.isoformat() if st.venc_curto else '',
-        'venc_longo': st.venc_longo.isoformat() if st.venc_longo else '',
-        'descricao': st.descricao or '', 'situacao': st.situacao or 'ATIVA',
-    }
 
-
-def _study_strategy_fill(st, data):
-    """Preenche um StudyStrategy a partir do JSON do modal (create/update)."""
-    def _d(k):
-        v = (data.get(k) or '').strip()
+    def _probe(item):
+        ep, prm = item
+        t0 = time.perf_counter()
         try:
-            return date.fromisoformat(v) if v else None
-        except ValueError:
-            return None
-    st.tipo = (data.get('tipo') or '').strip()[:60] or 'Outros'
-    try:
-        st.qty = int(data.get('qty')) if str(data.get('qty') or '').strip() else None
-    except (TypeError, ValueError):
-        st.qty = None
-    st.option_ticker = ((data.get('option_ticker') or '').strip().upper()[:20]) or None
-    try:
-        v = str(data.get('valor') or '').replace(',', '.').strip()
-        st.valor = float(v) if v else None
-    except (TypeError, ValueError):
-        st.valor = None
-    st.venc_curto = _d('venc_curto')
-    st.venc_longo = _d('venc_longo')
-    st.descricao = ((data.get('descricao') or '').strip()[:200]) or None
-    if (data.get('situacao') or '').upper() in ('ATIVA', 'DESATIVADA'):
-        st.situacao = data['situacao'].upper()
+            body = _oplab_get_json(ep, token, params=(prm or None), timeout=20)
+            return ep, {'ok': True, 'ms': int((time.perf_counter() - t0) * 1000), 'body': body}
+        except OplabApiError as e:
+            return ep, {'ok': False, 'ms': int((time.perf_counter() - t0) * 1000),
+                        'status': e.status_code, 'error': str(e), 'preview': e.body_preview}
 
+    # Em paralelo: o diagnóstico inteiro passa a custar o tempo do endpoint mais
+    # lento (a cadeia de opções), não a soma de todos.
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        results = dict(ex.map(_probe, checks))
 
-@app.route('/api/estudo-notas/<ticker>')
-@login_required
-def estudo_notas_get(ticker):
-    """Observações gerais do papel (não de uma estratégia específica) — uma
-    por ticker, compartilhada entre BR e internacional pelo mesmo modelo que
-    já guarda o estudo (StudyStock/StudyIntlStock)."""
-    ticker = ticker.strip().upper()
-    row = (StudyStock.query.filter_by(user_id=current_user.id, ticker=ticker).first()
-           or StudyIntlStock.query.filter_by(user_id=current_user.id, ticker=ticker).first())
-    return jsonify({'notes': (row.notes if row else '') or ''})
+    any_ok = any(v.get('ok') for v in results.values() if isinstance(v, dict))
+    return jsonify({'ok': any_ok, 'ticker': ticker, 'underlying': underlying, 'results': results})
 
 
-@app.route('/api/estudo-notas/<ticker>', methods=['POST'])
+@app.route('/api/liquidez/<ticker>')
 @login_required
-def estudo_notas_save(ticker):
+def api_liquidez(ticker):
+    """Retorna liquidez de opções de um ativo via OpLab /market/options/{ticker}."""
+    from flask import jsonify
     ticker = ticker.strip().upper()
-    notes = ((request.get_json(silent=True) or {}).get('notes') or '')[:4000]
-    row = (StudyStock.query.filter_by(user_id=current_user.id, ticker=ticker).first()
-           or StudyIntlStock.query.filter_by(user_id=current_user.id, ticker=ticker).first())
-    if not row:
-        # Sem estudo ainda para este papel: não há onde guardar a nota — o
-        # registro de estudo só existe quando o usuário roda a análise da
-        # tela Estudos. Cria um StudyStock mínimo pra não perder a anotação.
-        row = StudyStock(user_id=current_user.id, ticker=ticker)
-        db.session.add(row)
-    row.notes = notes
-    db.session.commit()
-    return jsonify({'ok': True})
-
-
-@app.route('/api/estudo-strategies/<ticker>')
-@login_required
-def estudo_strategies_list(ticker):
-    sts = (StudyStrategy.query
-           .filter_by(user_id=current_user.id, ticker=ticker.strip().upper())
-           .order_by(StudyStrategy.id).all())
-    return jsonify([_study_strategy_json(s) for s in sts])
-
-
-@app.route('/api/estudo-strategies', methods=['POST'])
-@login_required
-def estudo_strategies_create():
-    data = request.get_json(silent=True) or {}
-    ticker = (data.get('ticker') or '').strip().upper()
-    if not ticker:
-        return jsonify({'error': 'Ticker obrigatório.'}), 400
-    st = StudyStrategy(user_id=current_user.id, ticker=ticker,
-                       situacao='ATIVA', created_at=datetime.now())
-    _study_strategy_fill(st, data)
-    db.session.add(st)
-    db.session.commit()
-    return jsonify(_study_strategy_json(st))
-
-
-@app.route('/api/estudo-strategies/<int:sid>/update', methods=['POST'])
-@login_required
-def estudo_strategies_update(sid):
-    st = StudyStrategy.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    _study_strategy_fill(st, request.get_json(silent=True) or {})
-    db.session.commit()
-    return jsonify(_study_strategy_json(st))
-
-
-@app.route('/api/estudo-strategies/<int:sid>/toggle', methods=['POST'])
-@login_required
-def estudo_strategies_toggle(sid):
-    st = StudyStrategy.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    st.situacao = 'DESATIVADA' if (st.situacao or 'ATIVA') == 'ATIVA' else 'ATIVA'
-    db.session.commit()
-    return jsonify(_study_strategy_json(st))
-
-
-@app.route('/api/estudo-strategies/<int:sid>/delete', methods=['POST'])
-@login_required
-def estudo_strategies_delete(sid):
-    st = StudyStrategy.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    db.session.delete(st)
-    db.session.commit()
-    return jsonify({'ok': True})
-
-
-@app.route('/estudos/edit_vc_greeks/<int:opt_id>', methods=['POST'])
-@login_required
-def edit_vc_greeks(opt_id):
-    """Salva VE, Delta e Gama de uma VENDA_CALL na tabela de estudo."""
-    opt = Option.query.filter_by(id=opt_id, user_id=current_user.id, option_type='VENDA_CALL').first_or_404()
-    def _fl(k):
-        v = request.form.get(k, '').strip()
-        return float(v) if v else None
-    opt.ve    = _fl('ve')
-    opt.delta = _fl('delta')
-    opt.gama  = _fl('gama')
-    db.session.commit()
-    flash('VE/Delta/Gama atualizados.', 'success')
-    return redirect(url_for('estudos') + '#estudo-opcoes')
-
-
-@app.route('/estudos/add_study_option', methods=['POST'])
-@login_required
-def add_study_option():
-    def _f(k): return request.form.get(k, '').strip()
-    def _fl(k):
-        v = _f(k)
-        return float(v) if v else None
-    def _dt(k):
-        v = _f(k)
-        try:
-            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
-        except ValueError:
-            return None
-
-    so = StudyOption(
-        user_id=current_user.id,
-        ticker=_f('ticker').upper(),
-        underlying_asset=_f('underlying_asset').upper(),
-        underlying_price=_fl('underlying_price'),
-        avg_price_stock=_fl('avg_price_stock'),
-        strike=_fl('strike'),
-        expiration_date=_dt('expiration_date'),
-        option_price=_fl('option_price'),
-        ve=_fl('ve'),
-        delta=_fl('delta'),
-        gama=_fl('gama'),
-    )
-    db.session.add(so)
-    db.session.commit()
-    flash('Opção de estudo adicionada.', 'success')
-    return redirect(url_for('estudos') + '#estudo-opcoes')
-
-
-@app.route('/estudos/edit_study_option/<int:sid>', methods=['POST'])
-@login_required
-def edit_study_option(sid):
-    so = StudyOption.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    def _f(k): return request.form.get(k, '').strip()
-    def _fl(k):
-        v = _f(k)
-        return float(v) if v else None
-    def _dt(k):
-        v = _f(k)
-        try:
-            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
-        except ValueError:
-            return None
-
-    so.ticker = _f('ticker').upper()
-    so.underlying_asset = _f('underlying_asset').upper()
-    so.underlying_price = _fl('underlying_price')
-    so.avg_price_stock = _fl('avg_price_stock')
-    so.strike = _fl('strike')
-    so.expiration_date = _dt('expiration_date')
-    so.option_price = _fl('option_price')
-    so.ve    = _fl('ve')
-    so.delta = _fl('delta')
-    so.gama  = _fl('gama')
-    db.session.commit()
-    flash('Opção de estudo atualizada.', 'success')
-    return redirect(url_for('estudos') + '#estudo-opcoes')
-
-
-@app.route('/estudos/delete_study_option/<int:sid>', methods=['POST'])
-@login_required
-def delete_study_option(sid):
-    so = StudyOption.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    db.session.delete(so)
-    db.session.commit()
-    flash('Opção de estudo removida.', 'success')
-    return redirect(url_for('estudos') + '#estudo-opcoes')
-
-
-@app.route('/estudos/add_study_stock', methods=['POST'])
-@login_required
-def add_study_stock():
-    def _f(k): return request.form.get(k, '').strip()
-    def _fl(k):
-        v = _f(k)
-        return float(v) if v else None
-    def _dt(k):
-        v = _f(k)
-        try:
-            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
-        except ValueError:
-            return None
-
-    ss = StudyStock(
-        user_id=current_user.id,
-        ticker=_f('ticker').upper(),
-        trend=_f('trend') or None,
-        rsi=_fl('rsi'),
-        volatility=_f('volatility') or None,
-        ve=_fl('ve'),
-        strategy=_f('strategy') or None,
-        study_date=_dt('study_date'),
-        strategy_active=_f('strategy_active') or None,
-        entry_date=_dt('entry_date'),
-    )
-    db.session.add(ss)
-    db.session.commit()
-    flash('Ação de estudo adicionada.', 'success')
-    return redirect(url_for('estudos') + '#estudo-acoes')
-
-
-@app.route('/estudos/ir-para-estudo/<ticker>')
-@login_required
-def estudo_ir(ticker):
-    """Abre a tela Estudos já na edição da ação. Se ela ainda não estiver na
-    lista de Estudo de Ações, cria um registro em branco e abre a edição.
-    Usado pelo ícone de atalho no Ranking de Volatilidade."""
-    ticker = (ticker or '').strip().upper()
-    if not ticker:
-        return redirect(url_for('estudos') + '#estudo-acoes')
-    ss = StudyStock.query.filter_by(user_id=current_user.id, ticker=ticker).first()
-    if ss is None:
-        ss = StudyStock(user_id=current_user.id, ticker=ticker)
-        db.session.add(ss)
-        db.session.commit()
-    return redirect(url_for('estudos', edit_stock=ss.id) + '#estudo-acoes')
-
-
-@app.route('/estudos/edit_study_stock/<int:sid>', methods=['POST'])
-@login_required
-def edit_study_stock(sid):
-    ss = StudyStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    def _f(k): return request.form.get(k, '').strip()
-    def _fl(k):
-        v = _f(k)
-        return float(v) if v else None
-    def _dt(k):
-        v = _f(k)
-        try:
-            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
-        except ValueError:
-            return None
-
-    ss.ticker = _f('ticker').upper()
-    ss.trend = _f('trend') or None
-    ss.rsi = _fl('rsi')
-    ss.iv_rank = _fl('iv_rank')
-    ss.iv_percentil = _fl('iv_percentil')
-    ss.atr_pct = _fl('atr_pct')
-    ss.strategy = _f('strategy') or None
-    ss.study_date = date.today()
-    ss.strategy_active = _f('strategy_active') or None
-    ss.entry_date = _dt('entry_date')
-    db.session.commit()
-    flash('Ação de estudo atualizada.', 'success')
-    return redirect(url_for('estudos') + '#estudo-acoes')
-
-
-@app.route('/estudos/delete_study_stock/<int:sid>', methods=['POST'])
-@login_required
-def delete_study_stock(sid):
-    ss = StudyStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    db.session.delete(ss)
-    db.session.commit()
-    flash('Ação de estudo removida.', 'success')
-    return redirect(url_for('estudos') + '#estudo-acoes')
-
-
-@app.route('/estudos/add_study_intl_stock', methods=['POST'])
-@login_required
-def add_study_intl_stock():
-    def _f(k): return request.form.get(k, '').strip()
-    def _fl(k):
-        v = _f(k)
-        return float(v) if v else None
-    def _dt(k):
-        v = _f(k)
-        try:
-            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
-        except ValueError:
-            return None
-
-    ss = StudyIntlStock(
-        user_id=current_user.id,
-        ticker=_f('ticker').upper(),
-        trend=_f('trend') or None,
-        rsi=_fl('rsi'),
-        volatility=_f('volatility') or None,
-        ve=_fl('ve'),
-        strategy=_f('strategy') or None,
-        study_date=_dt('study_date'),
-        strategy_active=_f('strategy_active') or None,
-        entry_date=_dt('entry_date'),
-    )
-    db.session.add(ss)
-    db.session.commit()
-    flash('Ação internacional de estudo adicionada.', 'success')
-    return redirect(url_for('estudos') + '#estudo-acoes-intl')
-
-
-@app.route('/estudos/edit_study_intl_stock/<int:sid>', methods=['POST'])
-@login_required
-def edit_study_intl_stock(sid):
-    ss = StudyIntlStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    def _f(k): return request.form.get(k, '').strip()
-    def _fl(k):
-        v = _f(k)
-        return float(v) if v else None
-    def _dt(k):
-        v = _f(k)
-        try:
-            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
-        except ValueError:
-            return None
-
-    ss.ticker = _f('ticker').upper()
-    ss.trend = _f('trend') or None
-    ss.rsi = _fl('rsi')
-    ss.iv_rank = _fl('iv_rank')
-    ss.iv_percentil = _fl('iv_percentil')
-    ss.atr_pct = _fl('atr_pct')
-    ss.strategy = _f('strategy') or None
-    ss.study_date = date.today()
-    ss.strategy_active = _f('strategy_active') or None
-    ss.entry_date = _dt('entry_date')
-    db.session.commit()
-    flash('Ação internacional de estudo atualizada.', 'success')
-    return redirect(url_for('estudos') + '#estudo-acoes-intl')
-
-
-@app.route('/estudos/delete_study_intl_stock/<int:sid>', methods=['POST'])
-@login_required
-def delete_study_intl_stock(sid):
-    ss = StudyIntlStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
-    db.session.delete(ss)
-    db.session.commit()
-    flash('Ação internacional de estudo removida.', 'success')
-    return redirect(url_for('estudos') + '#estudo-acoes-intl')
-
-
-# ── Ranking Volatilidade ─────────────────────────────────────────
-
-# Lista "Geral" do Ranking de Volatilidade — ações/BDRs/ETFs com opções na B3
-RANKING_GERAL_TICKERS = [
-    # Principais
-    'BOVA11','VALE3','PETR4','PETR3','ITUB4','ITUB3','BBAS3','PRIO3','SMAL11','BBDC4','BBDC3',
-    'BRAV3','B3SA3','EGIE3','CSNA3','MGLU3','EMBJ3','SUZB3','BPAC11','ITSA4','WEGE3','CSAN3',
-    'NATU3','BBSE3','BRKM5','AXIA3','USIM5','MBRF3','ABEV3','BRAP4','SBSP3','CYRE3','AZZA3',
-    'RENT3','IBOV11','LREN3','ASAI3','MRVE3','CVCB3','BEEF3','ENEV3','GGBR4','CMIG4','CMIG3',
-    'HAPV3','EQTL3','ROXO34','KLBN11','COGN3','TAEE11','CMIN3','IRBR3','RAIL3','ABCB4','CXSE3',
-    'TOTS3','ALOS3','VAMO3','RADL3','GOAU4','JHSF3','SANB11','CEAB3','RDOR3','VBBR3','UGPA3',
-    'DIRR3','CSMG3','YDUQ3','VIVT3','ISAE4','BOVV11','HYPE3','VIVA3','CPLE3','POMO4','MULT3',
-    'SLCE3','TIMS3','CURY3','RECV3','IGTI11','PSSA3','SAPR11','BRSR6','XPBR31','MOTV3','GMAT3',
-    'RAIZ4','ENGI11','ALPA4','FLRY3','MOVI3','EZTC3','ECOR3','BHIA3','HASH11','TUPY3','CPFE3',
-    'JBSS32','SMFT3',
-    # Small caps e BDRs
-    'LWSA3','ANIM3','TEND3','PCAR3','WIZC3','SMTO3','VULC3','LJQQ3','NVDC34','INTB3','SIMH3',
-    'POSI3','AURE3','SEER3','KEPL3','QUAL3','RAPT4','BMGB4','MYPK3','TTEN3','CASH3','ALUP11',
-    'SAUD3','GRND3','UNIP6','LEVE3','MDNE3','AMBP3','BMOB3','INBR32','MDIA3','DXCO3','SBFG3',
-    'FESA4','PLPL3','RANI3','VLID3','IVVB11','GOGL34','AGRO3','GFSA3','M1TA34','HBOR3','CAML3',
-    'BLAU3','PNVL3','EVEN3','TRIS3','ROMI3','TASA4','SOJA3','LOGG3','AURA33','ONCO3','LAVV3',
-    'TSLA34','MLAS3','ORVR3','GGPS3','JALL3','AMZO34','VVEO3','MSFT34','MELI34','AMAR3','PGMN3',
-    'DASA3','MILS3','TSMC34','GOLD11','ARML3','BERK34','MTRE3','JPMC34','CBAV3','AAPL34',
-    'MCDC34','COCA34','HBSA3','NASD11',
-]
-
-
-def _seed_ranking_geral(uid):
-    """Garante que a lista GERAL do usuário contenha os tickers padrão."""
-    existentes = {rv.ticker for rv in RankingVol.query.filter_by(user_id=uid, grupo='GERAL').all()}
-    novos = [t for t in RANKING_GERAL_TICKERS if t not in existentes]
-    for t in novos:
-        db.session.add(RankingVol(user_id=uid, ticker=t, grupo='GERAL'))
-    if novos:
-        db.session.commit()
-
-
-def _ranking_liq_filter(query):
-    """Filtra apenas a lista 'Com liquidez' (linhas antigas têm grupo NULL)."""
-    return query.filter(db.or_(RankingVol.grupo == 'LIQ', RankingVol.grupo.is_(None)))
-
-
-@app.route('/ranking-volatilidade')
-@login_required
-def ranking_volatilidade():
-    lista = (request.args.get('lista') or 'liq').lower()
-    if lista == 'geral':
-        _seed_ranking_geral(current_user.id)
-        q = RankingVol.query.filter_by(user_id=current_user.id, grupo='GERAL')
-    else:
-        lista = 'liq'
-        q = _ranking_liq_filter(RankingVol.query.filter_by(user_id=current_user.id))
-    ranking_vol = q.order_by(RankingVol.ticker).all()
-    return render_template('ranking_vol.html', ranking_vol=ranking_vol, lista=lista)
-
-
-@app.route('/estudos/ranking_vol/add', methods=['POST'])
-@login_required
-def ranking_vol_add():
-    lista  = (request.form.get('lista') or 'liq').lower()
-    grupo  = 'GERAL' if lista == 'geral' else 'LIQ'
-    ticker = request.form.get('ticker', '').strip().upper()
-    if not ticker:
-        flash('Ticker obrigatório.', 'danger')
-        return redirect(url_for('ranking_volatilidade', lista=lista))
-    q = RankingVol.query.filter_by(user_id=current_user.id, ticker=ticker)
-    exists = (q.filter_by(grupo='GERAL') if grupo == 'GERAL' else _ranking_liq_filter(q)).first()
-    if exists:
-        flash(f'{ticker} já está no ranking.', 'warning')
-        return redirect(url_for('ranking_volatilidade', lista=lista))
-    db.session.add(RankingVol(user_id=current_user.id, ticker=ticker, grupo=grupo))
-    db.session.commit()
-    flash(f'{ticker} adicionado ao Ranking de Volatilidade.', 'success')
-    return redirect(url_for('ranking_volatilidade', lista=lista))
-
-
-@app.route('/estudos/ranking_vol/delete/<int:rid>', methods=['POST'])
-@login_required
-def ranking_vol_delete(rid):
-    rv = RankingVol.query.filter_by(id=rid, user_id=current_user.id).first_or_404()
-    lista = 'geral' if rv.grupo == 'GERAL' else 'liq'
-    db.session.delete(rv)
-    db.session.commit()
-    return redirect(url_for('ranking_volatilidade', lista=lista))
-
-
-@app.route('/api/ranking_vol/ticker', methods=['POST', 'DELETE'])
-@login_required
-def api_ranking_vol_ticker():
-    data = request.get_json(silent=True) or request.form
-    ticker = (data.get('ticker') or '').strip().upper()
-    if not ticker:
-        return jsonify({'error': 'Ticker obrigatório.'}), 400
-    # Este endpoint opera sempre sobre a lista "Com liquidez"
-    if request.method == 'DELETE':
-        rv = _ranking_liq_filter(RankingVol.query.filter_by(user_id=current_user.id, ticker=ticker)).first()
-        if rv:
-            db.session.delete(rv)
-            db.session.commit()
-        return jsonify({'ok': True, 'ticker': ticker})
-    exists = _ranking_liq_filter(RankingVol.query.filter_by(user_id=current_user.id, ticker=ticker)).first()
-    if not exists:
-        db.session.add(RankingVol(user_id=current_user.id, ticker=ticker, grupo='LIQ'))
-        db.session.commit()
-    return jsonify({'ok': True, 'ticker': ticker})
-
-
-@app.route('/api/ranking_vol/update', methods=['POST'])
-@login_required
-def api_ranking_vol_update():
-    """Atualiza todos os itens do Ranking de Volatilidade via OpLab + brapi."""
-    try:
-        return _api_ranking_vol_update_impl()
-    except Exception as e:
-        import traceback
-        app.logger.error('api_ranking_vol_update error: %s\n%s', e, traceback.format_exc())
-        return jsonify({'error': str(e)}), 500
-
-
-def _api_ranking_vol_update_impl():
-    from flask import jsonify
-    import requests as _req
-    from concurrent.futures import ThreadPoolExecutor
-
-    uid   = current_user.id
-    token = Settings.get_value('oplab_token', user_id=uid)
-    if not token:
-        return jsonify({'error': 'Token OpLab não configurado. Configure em Perfil → OpLab.'}), 400
-
-    # Atualiza somente a lista ativa (liq = com liquidez; geral = lista ampla)
-    lista = ((request.get_json(silent=True) or {}).get('lista')
-             or request.args.get('lista') or 'liq').lower()
-    q = RankingVol.query.filter_by(user_id=uid)
-    items = (q.filter_by(grupo='GERAL') if lista == 'geral' else _ranking_liq_filter(q)).all()
-    if not items:
-        return jsonify({'updated': 0, 'results': []})
-
-    now     = now_brt()
-    today_str = now.strftime('%d/%m')
-
-    def _extract_iv(d):
-        """Extrai (iv_rank, iv_percentil, vol_impl, vol_min, vol_max) do payload
-        de /market/instruments/{symbol}.
-
-        A OpLab devolve 0 (não null) para ativos sem opções líquidas — 0 aqui
-        significa "sem dado", não "volatilidade zero". Tratar 0 como válido
-        fazia o primeiro campo da lista vencer com 0 e nunca cair no fallback
-        EWMA, que é o que de fato tem valor para boa parte dos papéis."""
-        if not isinstance(d, dict):
-            return None, None, None, None, None
-        for sub in ('data', 'spot', 'summary', 'iv', 'implied_volatility', 'greeks'):
-            if isinstance(d.get(sub), dict):
-                d.update(d[sub])
-
-        def _pick(*keys):
-            for k in keys:
-                v = d.get(k)
-                if v is None:
-                    continue
-                try:
-                    f = float(v)
-                except (TypeError, ValueError):
-                    continue
-                if f == 0:          # 0 = sem dado na OpLab; tenta a próxima chave
-                    continue
-                # Campos vêm em % (ex.: 41.79). Frações (<=1) viram percentual.
-                return round(f * 100, 1) if f <= 1.0 else round(f, 1)
-            return None
-
-        # iv_* primeiro (volatilidade implícita); ewma_* como fallback para
-        # papéis sem opções líquidas, onde a OpLab só preenche o histórico.
-        ivr  = _pick('iv_1y_rank', 'ewma_1y_rank', 'iv_6m_rank', 'ewma_6m_rank',
-                     'iv_rank', 'ivRank')
-        ivp  = _pick('iv_1y_percentile', 'ewma_1y_percentile', 'iv_6m_percentile',
-                     'ewma_6m_percentile', 'iv_percentile', 'ivPercentile', 'iv_percentil')
-        vol  = _pick('iv_current', 'ewma_current', 'hv_current', 'historical_volatility',
-                     'implied_volatility_current', 'current_iv', 'close_iv', 'iv', 'vol_impl')
-        vmin = _pick('iv_1y_min', 'ewma_1y_min', 'iv_6m_min', 'ewma_6m_min', 'iv_min', 'ivMin')
-        vmax = _pick('iv_1y_max', 'ewma_1y_max', 'iv_6m_max', 'ewma_6m_max', 'iv_max', 'ivMax')
-        return ivr, ivp, vol, vmin, vmax
-
-    def _extract_price(d):
-        """Preço e variação % do mesmo payload de /market/instruments/{symbol}.
-        A OpLab já devolve a cotação aqui, então usá-la evita uma segunda fonte
-        (brapi/Yahoo) e mantém preço e IV coerentes entre si — vindos do mesmo
-        instante e do mesmo provedor."""
-        if not isinstance(d, dict):
-            return None, None
-        for sub in ('data', 'spot'):
-            if isinstance(d.get(sub), dict):
-                d = {**d, **d[sub]}
-
-        def _num(*keys, skip_zero=False):
-            for k in keys:
-                v = d.get(k)
-                if v is None:
-                    continue
-                try:
-                    f = float(v)
-                except (TypeError, ValueError):
-                    continue
-                # Preço 0 = papel sem negócio no dia, não cotação zero: tenta a
-                # próxima chave (o spot_price costuma estar preenchido).
-                if skip_zero and f == 0:
-                    continue
-                return f
-            return None
-
-        px  = _num('close', 'spot_price', 'last', 'price', 'adjusted_close', skip_zero=True)
-        var = _num('variation', 'change_percent', 'var_pct')
-        return px, var
-
-    from services import _brapi_quotes, _yf_fast_info
-    from concurrent.futures import as_completed as _as_completed, TimeoutError as _CFTimeoutError
-    brapi_token = Settings.get_value('brapi_token', user_id=uid)
-    tickers_list = [rv.ticker for rv in items]
-    price_map = {}      # ticker → {price, change} (fonte final)
-    oplab_prices = {}   # preenchido por _fetch_iv, junto com a IV
-
-    def _fetch_prices_yahoo(tks, budget):
-        """Yahoo ticker a ticker com teto de tempo. Sem esse teto, uma lista
-        'Geral' com 180+ tickers levava ~90s só aqui (≈500ms cada) e estourava
-        o gateway antes mesmo de chamar a OpLab. Quem não responder no orçamento
-        fica sem preço nesta rodada — o resto da tela continua atualizando."""
-        if not tks:
-            return
-        def _fetch(t):
-            return t, _yf_fast_info(f'{t}.SA' if '.' not in t else t, t)
-        ex = ThreadPoolExecutor(max_workers=8)
-        futs = {ex.submit(_fetch, t): t for t in tks}
-        try:
-            for fut in _as_completed(futs, timeout=budget):
-                t, d = fut.result()
-                if d:
-                    price_map[t] = {'price': d['price'], 'change': d['change_percent']}
-        except _CFTimeoutError:
-            pass
-        finally:
-            ex.shutdown(wait=False, cancel_futures=True)
-
-    # Busca de IV via OpLab: uma chamada por ticker (até 15s cada). Sequencial,
-    # uma lista "Geral" com 100+ tickers passa muito além do timeout do
-    # gateway (504 relatado) — paraleliza com um teto de tempo total, e
-    # aplica os resultados ao modelo depois, sequencialmente (sem rede).
-    iv_results: dict = {}   # ticker → (ivr, ivp, vol, error)
-
-    def _fetch_iv(ticker):
-        try:
-            d = _oplab_get_json(f'/market/instruments/{ticker}', token, timeout=15)
-            # Mesma resposta serve para IV e cotação — a OpLab é a fonte das duas.
-            px, var = _extract_price(d)
-            if px is not None:
-                oplab_prices[ticker] = {'price': px, 'change': var if var is not None else 0.0}
-            return ticker, (*_extract_iv(d), None)
-        except OplabApiError as e:
-            return ticker, (None, None, None, None, None, str(e))
-        except Exception as e:
-            return ticker, (None, None, None, None, None, str(e))
-
-    # 6 workers + o retry de _oplab_get_json: medido com 80 tickers, 8 workers
-    # sem retry dava 32% de 503 (o "N com falha" da tela); 6 workers com 2
-    # retries zera as falhas em 1,64s. Mais workers só aumenta o rate-limiting.
-    ex = ThreadPoolExecutor(max_workers=min(6, len(items)))
-    fut_map = {ex.submit(_fetch_iv, rv.ticker): rv.ticker for rv in items}
-    try:
-        for fut in _as_completed(fut_map, timeout=40):
-            ticker, res = fut.result()
-            iv_results[ticker] = res
-    except _CFTimeoutError:
-        pass  # aproveita o que já resolveu; o resto fica sem IV nesta rodada
-    finally:
-        ex.shutdown(wait=False, cancel_futures=True)
-
-    # A cotação da OpLab é a fonte principal: veio na mesma resposta da IV, então
-    # preço e volatilidade ficam do mesmo instante. brapi/Yahoo entram só para os
-    # papéis que a OpLab não cobriu (sem instrumento ou falha na chamada).
-    #
-    # Papéis pouco líquidos às vezes voltam com um close antigo (visto no LFTS11:
-    # R$ 103,10 com variação 0,00% quando valia R$ 158,19). Quando o preço destoa
-    # do último conhecido sem variação que o explique, descarta e deixa o fallback
-    # buscar — é dado obsoleto, não movimento de mercado.
-    anteriores = {rv.ticker: rv.last_price for rv in items}
-    for tk, d in oplab_prices.items():
-        ant, novo = anteriores.get(tk), d.get('price')
-        if ant and ant > 0 and novo and novo > 0:
-            desvio = abs(novo - ant) / ant
-            if desvio > 0.20 and abs(float(d.get('change') or 0)) < desvio * 100 * 0.5:
-                app.logger.warning('OpLab: cotacao suspeita de %s descartada no ranking '
-                                   '(%.2f vs %.2f anterior)', tk, novo, ant)
-                continue
-        price_map[tk] = d
-    faltando = [t for t in tickers_list if t not in price_map]
-    if faltando:
-        if brapi_token:
-            for t, d in _brapi_quotes(faltando, brapi_token).items():
-                price_map[t] = {'price': d['price'], 'change': d['change_percent']}
-            _fetch_prices_yahoo([t for t in faltando if t not in price_map], 25)
-        else:
-            _fetch_prices_yahoo(faltando, 25)
-
-    results = []
-    ok = 0
-    no_iv = 0          # consultados, mas a OpLab não tem IV para o papel
-    err_counts: dict = {}   # mensagem de erro → quantas vezes ocorreu
-    for rv in items:
-        row = {'ticker': rv.ticker, 'ok': False, 'error': None}
-        try:
-            # Ausente do dict = nunca chegou a rodar (estourou o teto de tempo)
-            if rv.ticker in iv_results:
-                ivr, ivp, vol, vmin, vmax, err = iv_results[rv.ticker]
-            else:
-                ivr = ivp = vol = vmin = vmax = None
-                err = 'sem resposta dentro do tempo limite'
-            if err:
-                row['error'] = err
-                err_counts[err] = err_counts.get(err, 0) + 1
-
-            pd = price_map.get(rv.ticker, {})
-            if pd.get('price', 0) > 0:
-                rv.last_price = round(pd['price'], 2)
-                rv.var_pct    = round(pd.get('change', 0), 2)
-                rv.last_date  = today_str
-            if ivr is not None: rv.iv_rank = ivr
-            if ivp is not None: rv.iv_percentil = ivp
-            if vol is not None: rv.vol_impl = vol
-            if vmin is not None: rv.vol_min = vmin
-            if vmax is not None: rv.vol_max = vmax
-            rv.updated_at = now
-            # "ok" = a consulta em si funcionou. Um papel sem IV na OpLab não é
-            # falha nossa; é contabilizado à parte para a tela poder distinguir
-            # "deu erro" de "a OpLab não tem esse dado".
-            if not err:
-                ok += 1
-                row['ok'] = True
-                if ivr is None and ivp is None:
-                    no_iv += 1
-                    row['no_iv'] = True
-            row['iv_rank'] = ivr; row['iv_percentil'] = ivp; row['vol_impl'] = vol
-            row['vol_min'] = vmin; row['vol_max'] = vmax
-            row['price'] = rv.last_price; row['change'] = rv.var_pct
-        except Exception as e:
-            row['error'] = str(e)
-            err_counts[str(e)] = err_counts.get(str(e), 0) + 1
-        results.append(row)
-
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
-
-    failed = sum(1 for row in results if row.get('error'))
-    # Erro mais frequente: sem isso a tela só dizia "N com falha" sem dizer por quê
-    top_error = max(err_counts.items(), key=lambda kv: kv[1])[0] if err_counts else None
-    return jsonify({'updated': ok, 'failed': failed, 'no_iv': no_iv,
-                    'total': len(items), 'top_error': top_error,
-                    'results': results})
-
-
-@app.route('/profile', methods=['GET', 'POST'])
-@login_required
-def profile():
-    if request.method == 'POST':
-        action = request.form.get('action', 'change_password')
-
-        if action == 'update_profile':
-            current_user.full_name = request.form.get('full_name', '').strip()
-            current_user.email     = request.form.get('email', '').strip()
-            current_user.phone     = request.form.get('phone', '').strip()
-            # Upload de avatar
-            avatar = request.files.get('avatar')
-            if avatar and avatar.filename:
-                ext = avatar.filename.rsplit('.', 1)[-1].lower()
-                if ext in ('jpg', 'jpeg', 'png', 'gif', 'webp'):
-                    fname = f"avatar_{current_user.id}.{ext}"
-                    avatar_dir = os.path.join(basedir, 'static', 'img', 'avatars')
-                    os.makedirs(avatar_dir, exist_ok=True)
-                    avatar.save(os.path.join(avatar_dir, fname))
-                    current_user.avatar_filename = fname
-                else:
-                    flash('Formato de imagem não suportado. Use JPG, PNG, GIF ou WEBP.', 'warning')
-            db.session.commit()
-            flash('Perfil atualizado!', 'success')
-
-        elif action == 'change_password':
-            curr_pass = request.form.get('current_password')
-            new_pass = request.form.get('new_password')
-            confirm_pass = request.form.get('confirm_password')
-            if not current_user.check_password(curr_pass):
-                flash('Senha atual incorreta.', 'danger')
-            elif new_pass != confirm_pass:
-                flash('Novas senhas não conferem.', 'danger')
-            else:
-                current_user.set_password(new_pass)
-                db.session.commit()
-                flash('Senha alterada com sucesso!', 'success')
-
-        elif action == 'save_oplab':
-            token = request.form.get('oplab_token', '').strip()
-            if token:
-                Settings.set_value('oplab_token', token, user_id=current_user.id)
-                flash('Token OpLab salvo com sucesso!', 'success')
-            else:
-                flash('Informe o token OpLab.', 'danger')
-
-        return redirect(url_for('profile'))
-
-    oplab_configured = bool(Settings.get_value('oplab_token', user_id=current_user.id))
-    return render_template('profile.html', oplab_configured=oplab_configured)
-
-
-@app.route('/oplab_debug')
-@login_required
-def oplab_debug():
-    """Diagnóstico: estado do token OpLab no banco."""
-    if not current_user.is_admin:
-        return jsonify({'error': 'Forbidden'}), 403
-    uid = current_user.id
-    raw = Settings.query.filter_by(key='oplab_token', user_id=uid).first()
-    token = Settings.get_value('oplab_token', user_id=uid)
-    return jsonify({
-        'user_id': uid,
-        'row_exists': raw is not None,
-        'raw_value_len': len(raw.value) if raw else 0,
-        'get_value_result': bool(token),
-        'token_prefix': token[:8] + '...' if token and len(token) > 8 else token,
-    })
-
-
-@app.route('/oplab_test', methods=['GET', 'POST'])
-@login_required
-def oplab_test():
-    """Retorna JSON bruto da API OpLab para diagnóstico."""
-    token = Settings.get_value('oplab_token', user_id=current_user.id)
-    if not token:
-        return jsonify({'error': 'Token não configurado'}), 400
-    ticker = (request.args.get('ticker') or request.form.get('ticker', 'PETR4')).strip().upper()
-    underlying = request.args.get('underlying', '').strip().upper()
-    if not underlying:
-        asset_match = Asset.query.filter_by(user_id=current_user.id, ticker=ticker).first()
-        option_match = Option.query.filter_by(user_id=current_user.id, ticker=ticker).first()
-        study_match = StudyOption.query.filter_by(user_id=current_user.id, ticker=ticker).first()
-        underlying = (
-            (asset_match.ticker if asset_match else '') or
-            (option_match.underlying_asset if option_match else '') or
-            (study_match.underlying_asset if study_match else '') or
-            ticker
-        ).upper()
-    # Endpoints conforme a spec OpLab v3. /instruments/{t} e /market/spot/{u}
-    # não existem na API (davam 404 sempre) e saíram do diagnóstico.
-    # /market/status é o teste mais leve de credencial — vem primeiro na tela.
-    checks = [
-        ('/market/status',                    {}),
-        (f'/market/instruments/{ticker}',     {}),
-        ('/market/quote',                     {'tickers': ticker}),
-        (f'/market/options/{underlying}',     {}),
-    ]
-
-    def _probe(item):
-        ep, prm = item
-        t0 = time.perf_counter()
-        try:
-            body = _oplab_get_json(ep, token, params=(prm or None), timeout=20)
-            return ep, {'ok': True, 'ms': int((time.perf_counter() - t0) * 1000), 'body': body}
-        except OplabApiError as e:
-            return ep, {'ok': False, 'ms': int((time.perf_counter() - t0) * 1000),
-                        'status': e.status_code, 'error': str(e), 'preview': e.body_preview}
-
-    # Em paralelo: o diagnóstico inteiro passa a custar o tempo do endpoint mais
-    # lento (a cadeia de opções), não a soma de todos.
-    from concurrent.futures import ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=4) as ex:
-        results = dict(ex.map(_probe, checks))
-
-    any_ok = any(v.get('ok') for v in results.values() if isinstance(v, dict))
-    return jsonify({'ok': any_ok, 'ticker': ticker, 'underlying': underlying, 'results': results})
-
-
-@app.route('/api/liquidez/<ticker>')
-@login_required
-def api_liquidez(ticker):
-    """Retorna liquidez de opções de um ativo via OpLab /market/options/{ticker}."""
-    from flask import jsonify
-    ticker = ticker.strip().upper()
-    limit = request.args.get('limit', default=30, type=int)
-    if limit not in (30, 40, 60):
-        limit = 30
-    expiry_filter = request.args.get('expiry', '').strip()
-    summary_only = request.args.get('summary') == '1'
-    token  = Settings.get_value('oplab_token', user_id=current_user.id)
-    if not token:
-        return jsonify({'error': 'Token OpLab não configurado. Configure em Perfil → OpLab.'}), 400
+    limit = request.args.get('limit', default=30, type=int)
+    if limit not in (30, 40, 60):
+        limit = 30
+    expiry_filter = request.args.get('expiry', '').strip()
+    summary_only = request.args.get('summary') == '1'
+    token  = Settings.get_value('oplab_token', user_id=current_user.id)
+    if not token:
+        return jsonify({'error': 'Token OpLab não configurado. Configure em Perfil → OpLab.'}), 400
 
     try:
-        data = _oplab_get_json(f'/market/options/{ticker}', token, timeout=15)
+        opt_list = _oplab_chain(ticker, token, timeout=15).options
     except OplabApiError as e:
         return jsonify({'error': str(e), 'status': e.status_code, 'preview': e.body_preview}), 503
 
-    # Normaliza — resposta pode ser lista ou dict com chave 'options'/'calls'/'puts'
-    if isinstance(data, list):
-        opt_list = data
-    elif isinstance(data, dict):
-        opt_list = (data.get('options') or
-                    data.get('calls', []) + data.get('puts', []) or
-                    [])
-    else:
-        opt_list = []
-
     calls, puts = [], []
     vol_total_call = vol_total_put = 0.0
 
@@ -13721,8 +12879,11 @@ def atualizar_oplab():
         flash('Token OpLab não configurado. Configure em Perfil.', 'danger')
         return redirect(url_for('profile'))
 
+    started, t0 = _sched_now(), time.time()
     ativos_ok, opcoes_ok, _covered = _do_oplab_bulk_update(current_user.id, token)
-    _oplab_last_update[current_user.id] = datetime.now()
+    # Conta como execução do job: o agendador empurra a próxima para depois
+    period = max(1, Settings.get_int('oplab_interval', current_user.id, 5)) * 60
+    _sched_record('oplab', current_user.id, started, time.time() - t0, 'manual', period)
 
     if (ativos_ok + opcoes_ok) > 0:
         flash(f'OpLab: {ativos_ok} ativo(s) e {opcoes_ok} opção(ões) atualizados.', 'success')
@@ -13832,85 +12993,131 @@ def dividendos():
 @app.route('/update_dividends', methods=['POST'])
 @login_required
 def update_dividends():
+    """Dispara a atualização dos dividendos (Yahoo) no pool de tarefas. A tela
+    pede JSON e acompanha por /api/update_progress; sem JS, volta para a
+    página com o aviso de que a atualização está em andamento."""
+    uid = current_user.id
+
+    def _run(task_id):
+        updated_count, error_count = _refresh_dividends(uid)
+        return {'msg': f'Dados atualizados! (Sucesso: {updated_count}, Erros: {error_count})',
+                'category': 'warning' if error_count > 0 else 'success',
+                'result': {'updated': updated_count, 'errors': error_count}}
+
+    task_id = _submit_task('dividends', uid, _run, 'Buscando dividendos…')
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'task_id': task_id})
+    flash('Atualização dos dividendos em andamento — recarregue a página em instantes.', 'info')
+    return redirect(url_for('dividendos'))
+
+
+_DIV_FRESH = timedelta(hours=12)   # ticker consultado há menos que isso (por qualquer usuário): não rebusca
+
+
+def _div_fetch(tk, last):
+    """Proventos de `tk` desde o dia seguinte à última data-com gravada `last`
+    (ou o histórico todo, na primeira vez): chart do Yahoo e, se ele falhar,
+    yfinance. None = falhou."""
+    start = date.fromisoformat(last) + timedelta(days=1) if last else None
+    sym = tk if tk.endswith('.SA') else f'{tk}.SA'
+    got = yahoo_dividends(sym, start=start)
+    if got is not None:
+        return got
     import yfinance as yf # Local import to prevent global crash
-    assets = Asset.query.filter_by(user_id=current_user.id).filter(Asset.type.in_(['ACAO', 'FII', 'ETF'])).all()
-    
-    updated_count = 0
-    error_count = 0
-    
+    hist = yf.Ticker(sym).dividends
+    return {ts.date().isoformat(): float(v) for ts, v in hist.items()
+            if start is None or ts.date() >= start}
+
+
+def _dividends_sync(tickers):
+    """Traz dividend_history até hoje para os tickers: só os não consultados
+    nas últimas _DIV_FRESH horas, em paralelo no pool de services, e só as
+    datas-com depois da última gravada. Devolve o conjunto dos que falharam."""
+    now = now_brt().replace(tzinfo=None)
+    with db.engine.connect() as conn:
+        st = dividend_history.state(conn, tickers)
+    stale = [tk for tk in tickers if tk not in st or now - st[tk][1] > _DIV_FRESH]
+    if not stale:
+        return set()
+    got = fetch_many(lambda tk: _div_fetch(tk, st.get(tk, (None,))[0]), stale)
+    with db.engine.begin() as conn:
+        dividend_history.save(conn, got, now)
+    return set(stale) - set(got)
+
+
+def _refresh_dividends(user_id):
+    """Grava os proventos dos ativos com posição do usuário a partir da
+    tabela compartilhada dividend_history (ver _dividends_sync). Por ativo, só
+    as datas-com a partir da última já gravada para ele (ela mesma é revista:
+    o valor pode ter sido corrigido), respeitando a data de entrada (ou 1 ano).
+    A quantidade na data-com vem da série de posição do livro
+    (_ledger_series), carregada uma vez. Devolve (sucessos, erros)."""
+    assets = (Asset.query.filter_by(user_id=user_id)
+              .filter(Asset.type.in_(['ACAO', 'FII', 'ETF']), Asset.quantity > 0).all())
+    if not assets:
+        return 0, 0
+    falhas = _dividends_sync(sorted({a.ticker.upper() for a in assets}))
+
+    existing = {}
+    for d in Dividend.query.filter(Dividend.asset_id.in_([a.id for a in assets])).all():
+        if d.ex_date:
+            existing.setdefault(d.asset_id, {})[d.ex_date] = d
+    um_ano = date.today().replace(year=date.today().year - 1)
+    inicio = {}
     for asset in assets:
-        # Skip assets with 0 quantity to preserve history and avoid overwriting with 0
-        if (asset.quantity or 0) <= 0:
-            continue
-
-        try:
-            ticker_sa = f"{asset.ticker}.SA" if not asset.ticker.endswith('.SA') else asset.ticker
-            yf_ticker = yf.Ticker(ticker_sa)
-            
-            # Fetch Dividends History
-            # If entry_date exists, fetch from that date. Else last 1 year.
-            start_date = asset.entry_date
-            if not start_date:
-                 # Default to 1 year ago if no entry date
-                 start_date = date.today().replace(year=date.today().year - 1)
-            
-            # YFinance expects string or datetime
-            history = yf_ticker.dividends
-            
-            # Atualiza SEM apagar tudo: casa por data e PRESERVA a qty_used
-            # (qtd de ações do cálculo, editável na página Dividendos) — os
-            # dividendos antigos não são recalculados com a quantidade atual.
-            existing = {d.ex_date: d for d in
-                        Dividend.query.filter_by(asset_id=asset.id).all()
-                        if d.ex_date}
-
-            for dt, amount in history.items():
-                # dt is Timestamp, convert to date
-                div_date = dt.date()
-
-                if div_date >= start_date:
-                    div_type = 'Dividendo'
-                    if asset.ticker.endswith('11') or asset.ticker.endswith('11B'):
-                        div_type = 'Rendimento'
-
-                    per = float(amount)
-                    old = existing.get(div_date)
-                    if old:
-                        old.per_share = per
-                        if not old.qty_used:
-                            old.qty_used = asset.quantity
-                        old.amount = round(per * old.qty_used, 2)
-                        old.type = div_type
-                    else:
-                        # Qtd na data-com reconstruída pelo LIVRO de transações
-                        # (sem livro após a data = quantidade atual, como antes)
-                        q_hist = _qty_on_date_ledger(asset.user_id, asset.ticker,
-                                                     div_date, asset.quantity)
-                        db.session.add(Dividend(
-                            asset_id=asset.id,
-                            ticker=asset.ticker,
-                            type=div_type,
-                            amount=round(per * q_hist, 2),
-                            per_share=per,
-                            qty_used=q_hist,
-                            payment_date=div_date,
-                            ex_date=div_date
-                        ))
-            
-            updated_count += 1
-            
-        except Exception as e:
-            print(f"Error fetching dividends for {asset.ticker}: {e}")
+        # If entry_date exists, start from that date. Else last 1 year.
+        ini = asset.entry_date or um_ano
+        if existing.get(asset.id):
+            ini = max(ini, max(existing[asset.id]))
+        inicio[asset.id] = ini
+    with db.engine.connect() as conn:
+        hist = dividend_history.load(conn, {a.ticker.upper() for a in assets},
+                                     since=min(inicio.values()).isoformat())
+
+    # Posição do livro por ticker: uma consulta (antes: uma por dividendo novo)
+    series = _ledger_series(user_id)
+    sem_livro = ledger_position.PositionSeries()
+
+    updated_count = error_count = 0
+    for asset in assets:
+        tk = asset.ticker.upper()
+        if tk in falhas:
+            print(f"Error fetching dividends for {asset.ticker}")
             error_count += 1
             continue
-            
+        novos = [(date.fromisoformat(d), v) for d, v in hist.get(tk, ())
+                 if date.fromisoformat(d) >= inicio[asset.id]]
+        div_type = 'Rendimento' if tk.endswith('11') or tk.endswith('11B') else 'Dividendo'
+        ja = existing.get(asset.id, {})
+        serie = series.get(tk, sem_livro)
+        for div_date, per in novos:
+            # Atualiza SEM apagar: casa por data e PRESERVA a qty_used (qtd de
+            # ações do cálculo, editável na página Dividendos).
+            old = ja.get(div_date)
+            if old:
+                old.per_share = per
+                if not old.qty_used:
+                    old.qty_used = asset.quantity
+                old.amount = round(per * old.qty_used, 2)
+                old.type = div_type
+            else:
+                # Qtd na data-com reconstruída pelo LIVRO de transações
+                # (sem livro após a data = quantidade atual, como antes)
+                q_hist = serie.qty_before(div_date, asset.quantity)
+                db.session.add(Dividend(
+                    asset_id=asset.id,
+                    ticker=asset.ticker,
+                    type=div_type,
+                    amount=round(per * q_hist, 2),
+                    per_share=per,
+                    qty_used=q_hist,
+                    payment_date=div_date,
+                    ex_date=div_date
+                ))
+        updated_count += 1
+
     db.session.commit()
-    msg = f'Dados atualizados! (Sucesso: {updated_count}, Erros: {error_count})'
-    if error_count > 0:
-        flash(msg, 'warning')
-    else:
-        flash(msg, 'success')
-    return redirect(url_for('dividendos'))
+    return updated_count, error_count
 
 @app.route('/update_asset_date/<int:id>', methods=['POST'])
 @login_required
@@ -14147,6 +13354,7 @@ def api_update_quotes():
         "changes": {"PETR4": 1.25, "VALE3": -0.80},        # daily change % (optional)
         "options": {"PETRA40": 0.45, "VALEF92": 1.20}      # option current prices (optional)
     }
+    Response includes "timing_ms": {"load", "write", "total"} for the push.
     """
     from flask import jsonify
 
@@ -14157,120 +13365,86 @@ def api_update_quotes():
     if not data or 'quotes' not in data:
         return jsonify({'error': 'Invalid payload — need at least quotes key'}), 400
 
+    _t0 = time.perf_counter()
     user_id = int(data.get('user_id', 1))
-    now = now_brt()
-
-    # ── Assets ────────────────────────────────────────────────────────────────
-    quotes  = data.get('quotes', {})
-    changes = data.get('changes', {})
-    updated_assets, not_found_assets = [], []
 
-    for ticker, price in quotes.items():
-        ticker = ticker.upper()
-        price_f  = float(price)
-        change_f = float(changes.get(ticker, changes.get(ticker.lower(), 0)))
-        found = False
-
-        # 1. Atualiza Asset em carteira
-        asset = Asset.query.filter_by(ticker=ticker, user_id=user_id).first()
-        if asset:
-            asset.current_price = price_f
-            asset.daily_change  = change_f
-            asset.last_update   = now
-            found = True
-
-        # 2. Atualiza underlying_price em StructuredOp (ativos subjacentes de estruturadas)
-        ops = StructuredOp.query.filter_by(underlying_asset=ticker, user_id=user_id, status='OPEN').all()
-        for op in ops:
-            op.underlying_price  = price_f
-            op.underlying_change = change_f
-            found = True
-
-        # 3. Atualiza StudyOption
-        sos = StudyOption.query.filter_by(underlying_asset=ticker, user_id=user_id).all()
-        for so in sos:
-            so.underlying_price = price_f
-            found = True
-
-        # 4. Atualiza PutSale
-        pss = PutSale.query.filter_by(underlying_asset=ticker, user_id=user_id).all()
-        for ps in pss:
-            ps.underlying_price = price_f
-            found = True
-
-        # 5. Atualiza OptionSpread (underlying das travas)
-        for sp in OptionSpread.query.filter_by(underlying_asset=ticker, user_id=user_id).all():
-            sp.underlying_price  = price_f
-            sp.underlying_change = float(changes.get(ticker, changes.get(ticker.lower(), 0)))
-            found = True
-
-        if found:
-            updated_assets.append(ticker)
-        else:
-            not_found_assets.append(ticker)
-
-    # ── Options ───────────────────────────────────────────────────────────────
-    options_prices = data.get('options', {})
-    updated_options, not_found_options = [], []
-
-    for ticker, price in options_prices.items():
-        ticker  = ticker.upper()
-        price_f = float(price)
-        found   = False
+    quotes  = {str(t).upper(): float(p) for t, p in (data.get('quotes') or {}).items()}
+    options = {str(t).upper(): float(p) for t, p in (data.get('options') or {}).items()}
+    changes = {str(t).upper(): float(v) for t, v in (data.get('changes') or {}).items() if v is not None}
+    # Push de um usuário: vai para quote_user dele, uma linha por ticker (nada
+    # na tabela quote, comum a todos) — publicado com private=True no fim. A
+    # carteira lê o preço de lá (ver models._quoted); as consultas abaixo só
+    # dizem quais tickers o usuário tem, para a resposta.
+    A_t, O_t = list(quotes), list(options)
+    up = db.func.upper
+    open_op = db.and_(StructuredOp.user_id == user_id, StructuredOp.status == 'OPEN')
+
+    def _tickers(*qs):
+        return {t for q in qs for (t,) in q.distinct().all() if t}
+
+    # Assets: Asset, underlying de StructuredOp/StudyOption/PutSale/OptionSpread
+    found_a = _tickers(
+        db.session.query(Asset.ticker).filter(Asset.user_id == user_id, Asset.ticker.in_(A_t)),
+        db.session.query(StructuredOp.underlying_asset).filter(open_op, StructuredOp.underlying_asset.in_(A_t)),
+        db.session.query(StudyOption.underlying_asset).filter(
+            StudyOption.user_id == user_id, StudyOption.underlying_asset.in_(A_t)),
+        db.session.query(PutSale.underlying_asset).filter(
+            PutSale.user_id == user_id, PutSale.underlying_asset.in_(A_t)),
+        db.session.query(OptionSpread.underlying_asset).filter(
+            OptionSpread.user_id == user_id, OptionSpread.underlying_asset.in_(A_t)),
+    )
+    # Options: Option, StructuredLeg, PutSale, StudyOption, pernas de OptionSpread
+    found_o = _tickers(
+        db.session.query(Option.ticker).filter(Option.user_id == user_id, Option.ticker.in_(O_t)),
+        db.session.query(StructuredLeg.ticker).join(StructuredOp, StructuredLeg.op_id == StructuredOp.id)
+        .filter(open_op, StructuredLeg.ticker.in_(O_t)),
+        db.session.query(PutSale.ticker).filter(PutSale.user_id == user_id, PutSale.ticker.in_(O_t)),
+        db.session.query(StudyOption.ticker).filter(StudyOption.user_id == user_id, StudyOption.ticker.in_(O_t)),
+        db.session.query(up(OptionSpread.leg_long_ticker)).filter(
+            OptionSpread.user_id == user_id, up(OptionSpread.leg_long_ticker).in_(O_t)),
+        db.session.query(up(OptionSpread.leg_short_ticker)).filter(
+            OptionSpread.user_id == user_id, up(OptionSpread.leg_short_ticker).in_(O_t)),
+    )
+    _t_load = time.perf_counter()
 
-        # 1. Tabela Option (venda coberta, etc.)
-        opt = Option.query.filter_by(ticker=ticker, user_id=user_id).first()
-        if opt:
-            opt.current_option_price = price_f
-            opt.last_update = now
-            found = True
-
-        # 2. StructuredLeg (pernas de estruturadas)
-        legs = StructuredLeg.query.join(StructuredOp).filter(
-            StructuredLeg.ticker == ticker,
-            StructuredOp.user_id == user_id,
-            StructuredOp.status  == 'OPEN'
-        ).all()
-        for leg in legs:
-            leg.current_price = price_f
-            leg.last_update   = now
-            found = True
-
-        # 3. PutSale
-        ps_opt = PutSale.query.filter_by(ticker=ticker, user_id=user_id).first()
-        if ps_opt:
-            found = True
-
-        # 4. StudyOption
-        for so in StudyOption.query.filter_by(ticker=ticker, user_id=user_id).all():
-            so.option_price = price_f
-            found = True
-
-        # 5. OptionSpread (travas) — perna comprada (long) ou vendida (short)
-        for sp in OptionSpread.query.filter_by(user_id=user_id).all():
-            if sp.leg_long_ticker and sp.leg_long_ticker.upper() == ticker:
-                sp.leg_long_current = price_f
-                found = True
-            if sp.leg_short_ticker and sp.leg_short_ticker.upper() == ticker:
-                sp.leg_short_current = price_f
-                found = True
-
-        if found:
-            updated_options.append(ticker)
-        else:
-            not_found_options.append(ticker)
+    try:
+        _quote_user_upsert(user_id, {**quotes, **options}, changes, 'feeder')
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('update_quotes: gravação em lote falhou')
+        return jsonify({'error': str(e)}), 500
+    _t_write = time.perf_counter()
 
-    db.session.commit()
+    updated_assets  = [t for t in quotes if t in found_a]
+    updated_options = [t for t in options if t in found_o]
+    _quote_publish(updated_assets + updated_options, [user_id], private=True)
 
     return jsonify({
         'status': 'ok',
         'updated_assets':  updated_assets,
         'updated_options': updated_options,
-        'not_found_assets':  not_found_assets,
-        'not_found_options': not_found_options,
+        'not_found_assets':  [t for t in quotes if t not in found_a],
+        'not_found_options': [t for t in options if t not in found_o],
+        'timing_ms': {
+            'load':  round((_t_load - _t0) * 1000, 1),
+            'write': round((_t_write - _t_load) * 1000, 1),
+            'total': round((time.perf_counter() - _t0) * 1000, 1),
+        },
     }), 200
 
 
+@app.route('/api/mt5_live/metrics')
+@login_required
+def api_mt5_live_metrics():
+    """Tempos de ciclo do atualizador MT5 do desktop (mt5_live.py). Fora do
+    desktop o módulo nem é carregado — responde running=false."""
+    mod = sys.modules.get('mt5_live')
+    if mod is None:
+        return jsonify({'running': False})
+    return jsonify(dict(mod.get_metrics(), running=True))
+
+
 _radar_mem = {}       # cache em memória por processo: {(ticker, analyzer): {'ts': float, 'data': {...}}}
 _RADAR_MEM_TTL = 600  # 10 minutos — os dados (RSI, fundamentos, IV) não mudam nesse intervalo,
                        # e evita bater na API externa a cada F5/reabertura do modal para o mesmo papel.
@@ -14479,6 +13653,7 @@ def api_radar_analise():
             fund = {}
         if not any(fund.get(k) not in (None, '', '-') for k in ('pl', 'pvp', 'dividend_yield', 'eps', 'sector', 'industry')):
             try:
+                import yfinance as yf
                 yf_ticker = ticker + '.SA' if _is_b3_yahoo_ticker(ticker) else ticker
                 info = yf.Ticker(yf_ticker).info or {}
                 fund = dict(fund)
@@ -14631,90 +13806,245 @@ def api_radar_analise():
         return jsonify({'error': str(e)}), 500
 
 
+def _etag_json(etag, build):
+    """Resposta JSON com ETag fraco: 304 sem corpo se o cliente já tem essa
+    versão (If-None-Match), senão jsonify(build()). `build` só roda quando
+    precisa — quem chama monta o ETag com algo barato (versão, tamanho).
+    no-cache faz o navegador guardar a resposta e revalidar a cada fetch, o
+    que já manda o If-None-Match sozinho, sem mudar o JS."""
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+
+def _quote_version(uid):
+    """Versão atual das cotações do usuário (0 = nada publicado ainda)."""
+    with db.engine.connect() as conn:
+        return version_counter.get(conn, 'quote', [uid])[uid]
+
+
+def _current_quotes_payload(uid, since=None, version=None):
+    """Corpo de /api/current_quotes e dos eventos do stream.
+
+    Sem `since` (ou com um `since` que não cabe — versão do futuro, banco
+    trocado) devolve o retrato completo. Com `since` válido devolve só os
+    tickers publicados depois dele (quote.seq > since, ou quote_user.seq >
+    since nos preços do usuário): em pregão parado, ou com o MT5 mexendo em três
+    papéis, o JSON cai de centenas de linhas para poucas ou nenhuma. A versão é lida ANTES dos dados — se uma publicação
+    entrar no meio, o cliente recebe o ticker agora e de novo na próxima vez,
+    nunca o perde."""
+    if version is None:
+        version = _quote_version(uid)
+    changed = None
+    if since is not None and 0 <= since <= version:
+        changed = {r[0] for r in db.session.query(Quote.ticker).filter(Quote.seq > since).all()}
+        # planilha/feeder/edição do usuário: publicados só para ele (quote_user)
+        changed |= {r[0] for r in db.session.query(QuoteUser.ticker)
+                    .filter(QuoteUser.user_id == uid, QuoteUser.seq > since).all()}
+
+    up = db.func.upper
+
+    def _only(q, *cols):
+        if changed is None:
+            return q
+        return q.filter(db.or_(*[up(c).in_(changed) for c in cols]))
+
+    assets_data = {}
+    options_data = {}
+    if changed is None or changed:
+        for a in _only(Asset.query.filter_by(user_id=uid), Asset.ticker).all():
+            assets_data[a.ticker] = {
+                'price':   round(a.current_price or 0, 2),
+                'change':  round(a.daily_change  or 0, 2),
+                'updated': a.last_update.strftime('%H:%M') if a.last_update else '-'
+            }
+
+        for o in _only(Option.query.filter_by(user_id=uid), Option.ticker).all():
+            options_data[o.ticker.upper()] = {
+                'price':   round(o.current_option_price or 0, 2),
+                'change':  round(o.daily_change or 0, 2),
+                'updated': o.last_update.strftime('%H:%M') if o.last_update else '-'
+            }
+
+        def _merge_option_quote(ticker, price, change=0, updated='-'):
+            key = (ticker or '').upper()
+            if not key or (changed is not None and key not in changed):
+                return
+            price = round(price or 0, 2)
+            if key not in options_data or price > 0:
+                options_data[key] = {
+                    'price':   price,
+                    'change':  round(change or 0, 2),
+                    'updated': updated,
+                }
+
+        for so in _only(StudyOption.query.filter_by(user_id=uid), StudyOption.ticker).all():
+            _merge_option_quote(so.ticker, so.option_price)
+        for sp in _only(OptionSpread.query.filter_by(user_id=uid),
+                        OptionSpread.leg_long_ticker, OptionSpread.leg_short_ticker).all():
+            _merge_option_quote(sp.leg_long_ticker, sp.leg_long_current)
+            _merge_option_quote(sp.leg_short_ticker, sp.leg_short_current)
+        for leg in _only(StructuredLeg.query
+                         .join(StructuredOp)
+                         .filter(StructuredOp.user_id == uid,
+                                 StructuredOp.status == 'OPEN'), StructuredLeg.ticker).all():
+            _merge_option_quote(
+                leg.ticker,
+                leg.current_price,
+                updated=leg.last_update.strftime('%H:%M') if leg.last_update else '-'
+            )
+
+    return {
+        'version': version,
+        'delta':   changed is not None,
+        'assets':  assets_data,
+        'options': options_data,
+    }
+
+
+def _since_arg(raw):
+    try:
+        return int(raw) if raw not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
 @app.route('/api/current_quotes')
 @login_required
 def api_current_quotes():
     """
     Returns current prices for all assets and options of the logged-in user.
-    Used by browser-side JS polling to update tables without page reload.
+    Used by browser-side JS (static/js/live_quotes.js) as the first snapshot
+    and as the polling fallback when the SSE stream is not available.
+    Query: ?since=<version> → only tickers published after that version.
+    ETag: with ?since= it comes from the user's version alone (checked before
+    any row is read); the full snapshot is hashed, since manual edits change
+    rows without publishing a new version.
     Response JSON:
     {
         "mode": "mt5",
+        "version": 1234, "delta": false,
         "assets":  {"PETR4": {"price": 38.50, "change": 1.25, "updated": "10:32"}},
         "options": {"PETRA40": {"price": 0.45, "updated": "10:32"}}
     }
     """
-    from flask import jsonify
-
     uid  = current_user.id
     mode = Settings.get_value('quote_mode',        user_id=uid, default='yahoo')
-    oplab_auto     = Settings.get_value('oplab_auto_update', user_id=uid, default='false') == 'true'
-    oplab_interval = int(Settings.get_value('oplab_interval', user_id=uid, default='5'))
-
-    assets_data = {}
-    for a in Asset.query.filter_by(user_id=uid).all():
-        assets_data[a.ticker] = {
-            'price':   round(a.current_price or 0, 2),
-            'change':  round(a.daily_change  or 0, 2),
-            'updated': a.last_update.strftime('%H:%M') if a.last_update else '-'
-        }
-
-    options_data = {}
-    for o in Option.query.filter_by(user_id=uid).all():
-        options_data[o.ticker.upper()] = {
-            'price':   round(o.current_option_price or 0, 2),
-            'change':  round(o.daily_change or 0, 2),
-            'updated': o.last_update.strftime('%H:%M') if o.last_update else '-'
-        }
+    oplab_auto     = Settings.get_bool('oplab_auto_update', uid)
+    oplab_interval = Settings.get_int('oplab_interval', uid, 5)
 
-    def _merge_option_quote(ticker, price, change=0, updated='-'):
-        key = (ticker or '').upper()
-        if not key:
-            return
-        price = round(price or 0, 2)
-        if key not in options_data or price > 0:
-            options_data[key] = {
-                'price':   price,
-                'change':  round(change or 0, 2),
-                'updated': updated,
-            }
-
-    for so in StudyOption.query.filter_by(user_id=uid).all():
-        _merge_option_quote(so.ticker, so.option_price)
-    for sp in OptionSpread.query.filter_by(user_id=uid).all():
-        _merge_option_quote(sp.leg_long_ticker, sp.leg_long_current)
-        _merge_option_quote(sp.leg_short_ticker, sp.leg_short_current)
-    for leg in (StructuredLeg.query
-                .join(StructuredOp)
-                .filter(StructuredOp.user_id == uid,
-                        StructuredOp.status == 'OPEN')
-                .all()):
-        _merge_option_quote(
-            leg.ticker,
-            leg.current_price,
-            updated=leg.last_update.strftime('%H:%M') if leg.last_update else '-'
-        )
-
-    return jsonify({
+    since   = _since_arg(request.args.get('since'))
+    version = _quote_version(uid)
+    meta = {
         'mode':              mode,
-        'assets':            assets_data,
-        'options':           options_data,
         'oplab_enabled':     oplab_auto,
         'oplab_interval_ms': oplab_interval * 60 * 1000,
-    })
+    }
+
+    def _build():
+        payload = _current_quotes_payload(uid, since, version)
+        payload.update(meta)
+        return payload
+
+    if since is not None and 0 <= since <= version:
+        return _etag_json(f'q{uid}.{version}.{since}.{mode}.{int(oplab_auto)}.{oplab_interval}', _build)
+    payload = _build()
+    digest = zlib.crc32(json.dumps(payload, sort_keys=True).encode())
+    return _etag_json(f'q{uid}.{version}.full.{digest:08x}', lambda: payload)
+
+
+# ── Stream de cotações (Server-Sent Events) ──────────────────────────────────
+# Cada aba aberta fazia polling de /api/current_quotes (5-15 s no modo MT5),
+# re-serializando a carteira inteira a cada vez. O stream mantém uma conexão
+# por aba e só envia algo quando a versão 'quote' do usuário muda —
+# e então só os tickers alterados. A checagem é uma leitura de PK por
+# segundo, que funciona entre workers (quem publica pode ser outro processo).
+#
+# Cada stream prende uma thread enquanto dura. Com worker síncrono (gunicorn
+# sem --threads) isso prenderia o worker inteiro, então nesse caso, ou quando
+# o limite por processo estoura, a rota responde 204 — o EventSource não
+# reconecta após 204 e o cliente cai no polling com ?since=.
+_SSE_POLL_SECS   = 1.0
+_SSE_HEARTBEAT   = 15       # s — comentário ": ping" para proxies não derrubarem
+_SSE_MAX_SECS    = 55       # s — encerra e o navegador reconecta com Last-Event-ID
+_SSE_MAX_STREAMS = int(os.environ.get('QUOTES_SSE_MAX_STREAMS', '4'))
+_sse_slots = threading.BoundedSemaphore(max(_SSE_MAX_STREAMS, 1))
+
+
+@app.route('/api/current_quotes/stream')
+@login_required
+def api_current_quotes_stream():
+    """Stream SSE das cotações do usuário: evento `quotes` com o mesmo corpo
+    de /api/current_quotes?since=<última versão>, `id:` = versão."""
+    if _SSE_MAX_STREAMS <= 0 or not request.environ.get('wsgi.multithread'):
+        return ('', 204)
+    if not _sse_slots.acquire(blocking=False):
+        return ('', 204)
+
+    uid = current_user.id
+    since = _since_arg(request.headers.get('Last-Event-ID'))
+    if since is None:
+        since = _since_arg(request.args.get('since'))
+
+    def _events():
+        last = since
+        t_end = time.monotonic() + _SSE_MAX_SECS
+        next_ping = time.monotonic() + _SSE_HEARTBEAT
+        try:
+            yield 'retry: 3000\n\n'
+            while time.monotonic() < t_end:
+                if last is None or _quote_version(uid) != last:
+                    payload = _current_quotes_payload(uid, last)
+                    db.session.remove()      # devolve a conexão ao pool entre eventos
+                    last = payload['version']
+                    if payload['assets'] or payload['options'] or not payload['delta']:
+                        yield (f"id: {last}\nevent: quotes\n"
+                               f"data: {json.dumps(payload, separators=(',', ':'))}\n\n")
+                        next_ping = time.monotonic() + _SSE_HEARTBEAT
+                elif time.monotonic() >= next_ping:
+                    yield ': ping\n\n'
+                    next_ping = time.monotonic() + _SSE_HEARTBEAT
+                time.sleep(_SSE_POLL_SECS)
+        finally:
+            db.session.remove()
+
+    resp = Response(stream_with_context(_events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # No close() da resposta, e não no finally do gerador: se o cliente cair
+    # antes do primeiro next(), o gerador nunca roda e o slot vazaria.
+    resp.call_on_close(_sse_slots.release)
+    return resp
 
 
-_chart_mem = {}  # cache em memória por processo: {ticker: {'ts': float, 'candles': [...]}}
+_chart_mem = {}  # cache em memória por processo: {ticker: {'ts': float, 'series': CandleSeries}}
 _CHART_MEM_TTL = 120  # segundos — evita hit no SQLite em acessos repetidos rápidos
+_CHART_MAX_CANDLES = 260  # ~1 ano de dias úteis (warm-up MM200 + 8 meses) servidos por request
+_PREGAO_FECHADO_AS = (18, 30)  # hora BRT a partir da qual o candle/VI do dia são definitivos
+                               # (B3 fecha ~18h com o call; NYSE às 17h/18h BRT)
+
+
+def _ultimo_pregao_fechado(now=None):
+    """Data do último dia útil cujo pregão já terminou (hora de Brasília).
+    Feriados não entram — no dia seguinte a um feriado o cache só parece
+    velho e é rebuscado, como antes."""
+    now = now or now_brt().replace(tzinfo=None)
+    d = now.date()
+    if (now.hour, now.minute) < _PREGAO_FECHADO_AS:
+        d -= timedelta(days=1)
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d
 
-_YF_HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
-    'Accept': 'application/json,text/plain,*/*',
-    'Accept-Language': 'pt-BR,pt;q=0.9,en-US;q=0.8',
-    'Origin': 'https://finance.yahoo.com',
-    'Referer': 'https://finance.yahoo.com/',
-}
-_YF_COOKIES = {'tbla_id': 'finan-web', 'GUC': 'AQEBCAFn', 'GUCS': 'AQEBCAFn'}
+
+def _pregao_fechado_em(d):
+    """Momento (BRT, sem tz) em que o pregão de `d` passa a valer como fechado."""
+    return datetime(d.year, d.month, d.day, *_PREGAO_FECHADO_AS)
+
+from services import YF_HEADERS as _YF_HEADERS, YF_COOKIES as _YF_COOKIES   # noqa: E402
 
 def _is_b3_yahoo_ticker(ticker):
     """Identifica tickers B3 que precisam do sufixo .SA no Yahoo, incluindo B3SA3."""
@@ -14843,8 +14173,11 @@ def _sanitize_chart_candles(candles):
     return robust
 
 
-def _vol_hist_series(ticker, token, meses=12):
-    """Série diária de volatilidade implícita (ATM) e histórica de um papel.
+_VOL_HIST_ALGO = 'v4'   # v4: VI ancorada no vencimento mais próximo
+
+
+def _vol_hist_fetch_iv(ticker, token, inicio, fim):
+    """VI ATM por dia entre `inicio` e `fim` (datas, inclusive).
 
     A OpLab devolve uma linha por opção por dia em
     /market/historical/options/{spot}/{from}/{to} (16k+ registros para um
@@ -14853,12 +14186,10 @@ def _vol_hist_series(ticker, token, meses=12):
     do Opções.Net. Usar a média de todas as opções distorceria a curva para
     cima, porque as muito fora do dinheiro têm VI inflada.
 
-    Retorna [{'d': 'YYYY-MM-DD', 'iv': float|None, 'hv': float|None}, ...].
-    """
-    from datetime import date as _date, timedelta as _td
+    Retorna ([{'d', 'iv', 'hv': None, 'dtm'}, ...], completo) — completo=False
+    quando algum bloco falhou na OpLab (a série pode ter buracos)."""
+    from datetime import timedelta as _td
     from concurrent.futures import ThreadPoolExecutor
-    hoje = _date.today()
-    inicio = hoje - _td(days=int(meses * 30.5))
 
     # Busca em blocos de ~30 dias em vez de um intervalo único: a resposta traz
     # uma linha por opção por dia e, num intervalo longo, a API trunca — a série
@@ -14866,8 +14197,8 @@ def _vol_hist_series(ticker, token, meses=12):
     # para vir completo, e os blocos rodam em paralelo para não ficar lento.
     blocos = []
     cursor = inicio
-    while cursor < hoje:
-        fim_bloco = min(cursor + _td(days=30), hoje)
+    while cursor <= fim:
+        fim_bloco = min(cursor + _td(days=30), fim)
         blocos.append((cursor.isoformat(), fim_bloco.isoformat()))
         cursor = fim_bloco + _td(days=1)
 
@@ -14878,14 +14209,16 @@ def _vol_hist_series(ticker, token, meses=12):
                                 token, timeout=45)
             return d if isinstance(d, list) else []
         except OplabApiError:
-            return []
+            return None
 
     raw = []
+    completo = True
     with ThreadPoolExecutor(max_workers=4) as _ex:
         for parte in _ex.map(_bloco, blocos):
-            raw.extend(parte)
-    if not raw:
-        return []
+            if parte is None:
+                completo = False
+            else:
+                raw.extend(parte)
 
     # Agrupa por dia, guardando (distância relativa ao dinheiro, VI)
     por_dia: dict = {}
@@ -14929,46 +14262,41 @@ def _vol_hist_series(ticker, token, meses=12):
         serie.append({'d': d, 'iv': round(sum(atm) / len(atm), 2), 'hv': None,
                       'dtm': venc})
 
+    return serie, completo
+
+
+def _vol_hist_hv(ticker, commit=True):
+    """{data_iso: HV} do ticker, dos candles da tabela candle. commit=False:
+    os candles buscados ficam pendentes na db.session (ver _vol_hist_update)."""
+    hv_por_data = {}
     # Vol. histórica (a linha azul): desvio-padrão anualizado dos retornos,
     # calculado dos candles — a OpLab não entrega essa série pronta por data.
-    # Reaproveita o mesmo cache OHLCV do gráfico de candles.
+    # Reaproveita o mesmo store de candles do gráfico (tabela candle).
     try:
-        import math as _math, gzip as _gzip2, json as _json2
-        from models import ChartCache
-        from datetime import date as _d2
-        candles = []
-        _cc = ChartCache.query.get(ticker)
-        if _cc:
-            candles = _json2.loads(_gzip2.decompress(_cc.candles_gz).decode())
-        # Cache ausente OU desatualizado: busca do Yahoo. Sem esta checagem, um
+        import numpy as _np
+        from datetime import date as _d2, timedelta as _td2
+        candles = _candles_load(ticker, commit=commit)
+        # Store ausente OU desatualizado: busca do Yahoo. Sem esta checagem, um
         # papel cujo gráfico de candles nunca foi aberto (ou foi há semanas)
         # ficava com a HV faltando justamente nos dias mais recentes — a linha
         # azul morria antes do fim do gráfico.
-        _ult = candles[-1]['t'] if candles else None
+        _ult = candles.last_date
         if (not _ult) or (_d2.today() - _d2.fromisoformat(_ult)).days > 4:
-            yf_t = ticker + '.SA' if _is_b3_yahoo_ticker(ticker) else ticker
-            frescos = _sanitize_chart_candles(_yahoo_fetch(yf_t)) or []
-            if frescos:
-                vistos = {c['t'] for c in frescos}
-                candles = [c for c in candles if c.get('t') not in vistos] + frescos
-                candles.sort(key=lambda c: c.get('t') or '')
-        closes = [(c.get('t'), float(c.get('c'))) for c in candles
-                  if c.get('t') and c.get('c')]
-        closes.sort()
+            _ini = (_d2.fromisoformat(_ult) - _td2(days=3)).isoformat() if _ult else None
+            candles = _candles_refresh(ticker, candles, _ini, commit=commit)
         # Janela de 25 pregões: calibrada contra 8 pontos de referência do
         # Opções.Net (B3SA3, BBDC4, BBAS3, PETR4, VALE3, BPAC11, CPFE3 ×2).
         # Erro médio de 1,17 p.p. contra 2,39 p.p. com 21 pregões, e melhor
         # em 6 dos 8 casos. Volatilidade histórica não tem definição única —
         # a janela é convenção, e esta é a que mais aproxima da referência.
         JAN = 25
-        hv_por_data = {}
-        import statistics as _stats
+        # Fechamentos direto do array da série (view), log-retornos de uma vez;
+        # cada janela abaixo é só um fatiamento de `lr`.
+        closes = candles.closes()
+        datas = candles.t
+        lr = _np.log(closes[1:] / closes[:-1]) if len(closes) > 1 else _np.empty(0)
         for i in range(JAN, len(closes)):
-            janela = closes[i - JAN:i + 1]
-            rets = [_math.log(janela[k][1] / janela[k - 1][1])
-                    for k in range(1, len(janela)) if janela[k - 1][1] > 0]
-            if len(rets) < 5:
-                continue
+            rets = lr[i - JAN:i]
             # Descarta saltos que não são volatilidade: na data-ex de um
             # provento (ou num desdobramento) o preço cai de uma vez, e a série
             # do Yahoo não vem ajustada. Sem isso, o salto entra como retorno
@@ -14979,49 +14307,136 @@ def _vol_hist_series(ticker, token, meses=12):
             # 44,2% cai para 22%, enquanto a mediana da série mal se move
             # (17,4% -> 17,2%), ou seja, corrige o artefato sem achatar os dias
             # normais.
-            med_abs = _stats.median([abs(x) for x in rets]) or 1e-9
-            limpos = [x for x in rets if abs(x) <= 5 * med_abs]
+            abs_r = _np.abs(rets)
+            med_abs = float(_np.median(abs_r)) or 1e-9
+            limpos = rets[abs_r <= 5 * med_abs]
             if len(limpos) >= 5:
                 rets = limpos
-            m = sum(rets) / len(rets)
-            var = sum((x - m) ** 2 for x in rets) / (len(rets) - 1)
-            hv_por_data[closes[i][0]] = round(_math.sqrt(var) * _math.sqrt(252) * 100, 2)
-        for p in serie:
-            p['hv'] = hv_por_data.get(p['d'])
+            m = rets.mean()
+            var = float(((rets - m) ** 2).sum()) / (len(rets) - 1)
+            hv_por_data[str(datas[i])] = round(math.sqrt(var) * math.sqrt(252) * 100, 2)
     except Exception:
         app.logger.exception('vol_hist: falha ao calcular HV de %s', ticker)
+    return hv_por_data
+
+
+def _vol_hist_series(ticker, token, meses=12):
+    """Série diária de volatilidade implícita (ATM) e histórica de um papel,
+    calculada na hora (sem o store) — usada pelos scripts de diagnóstico.
 
+    Retorna [{'d': 'YYYY-MM-DD', 'iv': float|None, 'hv': float|None, 'dtm'}, ...].
+    """
+    from datetime import date as _date, timedelta as _td
+    hoje = _date.today()
+    serie, _ = _vol_hist_fetch_iv(ticker, token, hoje - _td(days=int(meses * 30.5)), hoje)
+    if serie:
+        hv_por_data = _vol_hist_hv(ticker)
+        for p in serie:
+            p['hv'] = hv_por_data.get(p['d'])
     return serie
 
 
-def _vol_hist_stats(serie):
-    """Onde a VI de hoje está em relação ao próprio histórico do papel.
+def _vol_hist_update(ticker, token):
+    """Traz vol_hist_day do ticker até hoje, buscando na OpLab só a partir do
+    último dia gravado (inclusive: ele pode ter sido gravado com o pregão
+    ainda aberto). Os dias novos ganham HV e as estatísticas da janela móvel;
+    dias antigos sem HV (candles atrasados na época) são completados.
+    Retorna quantos pontos foram gravados.
 
-    É o que decide a estratégia: VI alta contra o histórico favorece montar
-    posições vendidas em volatilidade (condor, trava de crédito, straddle
-    vendido); VI baixa favorece as compradas.
+    Primeiro só lê e busca (OpLab, Yahoo); tudo o que grava — candles,
+    vol_hist_day, troca de algoritmo, blob legado, estado — vai na db.session
+    e sai num commit só no fim. Assim o lock de escrita do SQLite não fica
+    preso durante a rede, e uma falha no meio não deixa meia atualização
+    (ex.: o blob legado apagado sem a série nova gravada)."""
+    from models import VolHistCache, VolHistState
+    from datetime import date as _date, timedelta as _td
+    import gzip as _gzip
+    hoje = _date.today()
 
-    - percentil: % dos dias em que a VI ficou ABAIXO da atual. 80% = a VI só
-      esteve mais alta em 20% dos pregões do período.
-    - iv_rank: posição no intervalo min–max (o "IV Rank" usual do mercado).
-      Difere do percentil: é sensível a extremos isolados, enquanto o
-      percentil conta dias. Os dois juntos evitam leitura enganosa.
-    """
-    ivs = [p['iv'] for p in serie if p.get('iv') is not None]
-    if len(ivs) < 20:
+    state = VolHistState.query.get(ticker)
+    # Algoritmo mudou: a série gravada não serve nem de contexto — é apagada
+    # na gravação, abaixo.
+    refazer = state is not None and state.algo != _VOL_HIST_ALGO
+    with db.engine.connect() as conn:
+        ult = None if refazer else vol_hist_store.last_date(conn, ticker)
+
+    semente, legado = [], None
+    if ult is None:
+        # Formato antigo: o blob da mesma versão vira o ponto de partida e só
+        # os dias depois dele são buscados (em vez dos 12 meses inteiros).
+        legado = VolHistCache.query.get(ticker)
+        if legado and legado.last_date.endswith(f'|{_VOL_HIST_ALGO}'):
+            try:
+                semente = [{'d': p['d'], 'iv': p.get('iv'), 'hv': p.get('hv'), 'dtm': p.get('dtm')}
+                           for p in json.loads(_gzip.decompress(legado.series_gz))]
+            except Exception:
+                app.logger.exception('vol_hist: blob legado de %s ilegível', ticker)
+                semente = []
+        ult = semente[-1]['d'] if semente else None
+
+    inicio = _date.fromisoformat(ult) if ult else hoje - _td(days=vol_hist_store.WINDOW_DAYS)
+    novos, completo = _vol_hist_fetch_iv(ticker, token, inicio, hoje)
+    novos = {p['d']: p for p in semente + novos}
+
+    # Janela anterior ao 1º dia novo: contexto das estatísticas móveis.
+    primeiro = min(novos) if novos else hoje.isoformat()
+    ctx_ini = (_date.fromisoformat(primeiro) - _td(days=vol_hist_store.WINDOW_DAYS)).isoformat()
+    pontos = {}
+    if not refazer:
+        with db.engine.connect() as conn:
+            pontos = {p['d']: p for p in vol_hist_store.load(conn, ticker, since=ctx_ini)}
+    pontos.update(novos)
+    datas = sorted(pontos)
+    mudou = set(novos) | {d for d in datas if pontos[d]['hv'] is None}
+    if mudou:
+        hv_por_data = _vol_hist_hv(ticker, commit=False)
+        for d in mudou:
+            if pontos[d]['hv'] is None or d in novos:
+                pontos[d]['hv'] = hv_por_data.get(d, pontos[d]['hv'])
+    if novos:
+        i0 = datas.index(primeiro)
+        for d, st in zip(datas[i0:], vol_hist_store.rolling_stats(datas, [pontos[d]['iv'] for d in datas], i0)):
+            if d in novos:
+                pontos[d].update(st or dict.fromkeys(vol_hist_store.STATS))
+
+    gravar = [pontos[d] for d in datas if d in mudou]
+    conn = db.session.connection()
+    if refazer:
+        vol_hist_store.delete(conn, ticker)
+        state.algo, state.checked = _VOL_HIST_ALGO, ''
+    vol_hist_store.upsert(conn, ticker, gravar)
+    if legado:
+        db.session.delete(legado)
+    # Bloco com falha: não marca o dia como conferido — a próxima consulta
+    # tenta de novo a partir do último dia gravado.
+    if completo:
+        if state is None:
+            state = VolHistState(ticker=ticker, algo=_VOL_HIST_ALGO, checked='')
+            db.session.add(state)
+        state.checked, state.fetched_at = hoje.isoformat(), now_brt().replace(tzinfo=None)
+    db.session.commit()
+    return len(gravar)
+
+
+def _vol_hist_warm(state):
+    """True se a última busca completa do ticker foi depois do fechamento do
+    último pregão — nada novo para trazer até o próximo pregão fechar."""
+    return bool(state and state.checked and state.fetched_at
+                and state.fetched_at >= _pregao_fechado_em(_ultimo_pregao_fechado()))
+
+
+def _vol_hist_stats_row(p):
+    """Estatísticas já gravadas no ponto `p`, no formato que a tela consome."""
+    if not p or p.get('iv_rank') is None:
         return None
-    atual = ivs[-1]
-    lo, hi = min(ivs), max(ivs)
-    abaixo = sum(1 for v in ivs if v < atual)
-    rank = ((atual - lo) / (hi - lo) * 100) if hi > lo else 50.0
     return {
-        'iv_atual':  round(atual, 1),
-        'iv_min':    round(lo, 1),
-        'iv_max':    round(hi, 1),
-        'iv_media':  round(sum(ivs) / len(ivs), 1),
-        'percentil': round(abaixo / len(ivs) * 100, 1),
-        'iv_rank':   round(rank, 1),
-        'dias':      len(ivs),
+        'iv_atual':  round(p['iv'], 1),
+        'iv_min':    p['iv_min'],
+        'iv_max':    p['iv_max'],
+        'iv_media':  p['iv_avg'],
+        'percentil': p['iv_pct'],
+        'iv_rank':   p['iv_rank'],
+        'dias':      p['n'],
     }
 
 
@@ -15030,74 +14445,131 @@ def _vol_hist_stats(serie):
 def api_vol_hist(ticker):
     """Série histórica de volatilidade implícita (ATM) e histórica do papel.
 
-    Cache em SQLite por ticker, revalidado uma vez por dia — a série muda
-    só com o fechamento e a consulta bruta é cara (dezenas de milhares de
-    registros)."""
-    import gzip as _gzip, json as _json
-    from models import VolHistCache
-    from datetime import date as _date
-
-    # Versão do algoritmo: mudou o cálculo (janelas de busca, filtro de
-    # outliers), o cache anterior fica inválido. Sem isso, o gráfico
-    # continuaria servindo a série antiga — com o artefato — até o dia virar.
-    _ALGO = 'v4'   # v4: VI ancorada no vencimento mais próximo
+    Lida de vol_hist_day; a OpLab só é consultada uma vez por dia por ticker,
+    e só para os dias depois do último gravado."""
+    from models import VolHistState
+    from datetime import date as _date, timedelta as _td
 
     ticker = ticker.upper().strip()
     if not ticker.isalnum():
         return jsonify({'error': 'ticker inválido'}), 400
 
-    hoje = f'{_date.today().isoformat()}|{_ALGO}'
-    row = VolHistCache.query.get(ticker)
-    if row and row.last_date == hoje and not request.args.get('refresh'):
-        _s = _json.loads(_gzip.decompress(row.series_gz))
-        return jsonify({'ticker': ticker, 'cached': True, 'series': _s,
-                        'stats': _vol_hist_stats(_s)})
-
-    token = Settings.get_value('oplab_token', user_id=current_user.id)
-    if not token:
-        return jsonify({'error': 'Token OpLab não configurado.'}), 400
-
-    try:
-        serie = _vol_hist_series(ticker, token, meses=12)
-    except OplabApiError as e:
-        # Cache velho é melhor que erro na tela
-        if row:
-            _s = _json.loads(_gzip.decompress(row.series_gz))
-            return jsonify({'ticker': ticker, 'cached': True, 'stale': True,
-                            'series': _s, 'stats': _vol_hist_stats(_s)})
-        return jsonify({'error': f'OpLab: {e}'}), 502
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    hoje = _date.today()
+    state = VolHistState.query.get(ticker)
+    cached = (state is not None and state.algo == _VOL_HIST_ALGO and not request.args.get('refresh')
+              and (state.checked == hoje.isoformat() or _vol_hist_warm(state)))
+    stale = False
+    if not cached:
+        token = Settings.get_value('oplab_token', user_id=current_user.id)
+        if not token:
+            return jsonify({'error': 'Token OpLab não configurado.'}), 400
+        try:
+            _vol_hist_update(ticker, token)
+        except OplabApiError as e:
+            # Série velha é melhor que erro na tela
+            db.session.rollback()
+            stale = True
+            with db.engine.connect() as conn:
+                if vol_hist_store.last_date(conn, ticker) is None:
+                    return jsonify({'error': f'OpLab: {e}'}), 502
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('vol_hist: atualização de %s falhou', ticker)
+            return jsonify({'error': str(e)}), 500
 
-    if not serie:
+    with db.engine.connect() as conn:
+        pontos = vol_hist_store.load(conn, ticker,
+                                     since=(hoje - _td(days=vol_hist_store.WINDOW_DAYS)).isoformat())
+    if not pontos:
         return jsonify({'ticker': ticker, 'series': [],
                         'error': 'Sem histórico de opções para este ativo na OpLab.'})
 
-    blob = _gzip.compress(_json.dumps(serie).encode())
-    if row:
-        row.last_date, row.series_gz, row.fetched_at = hoje, blob, datetime.now()
-    else:
-        db.session.add(VolHistCache(ticker=ticker, last_date=hoje,
-                                    series_gz=blob, fetched_at=datetime.now()))
+    serie = [{'d': p['d'], 'iv': p['iv'], 'hv': p['hv'], 'dtm': p['dtm']} for p in pontos]
+    com_iv = [p for p in pontos if p['iv'] is not None]
+    resp = {'ticker': ticker, 'cached': cached or stale, 'series': serie,
+            'stats': _vol_hist_stats_row(com_iv[-1] if com_iv else None)}
+    if stale:
+        resp['stale'] = True
+    return jsonify(resp)
+
+
+def _candles_load(ticker, commit=True):
+    """Série do ticker na tabela candle. Ticker que ainda só existe no formato
+    antigo (blob em chart_cache) é convertido aqui, uma única vez. commit=False:
+    a conversão fica pendente na db.session, para quem chama gravar junto."""
+    from models import ChartCache
+    series = candle_store.load(db.session, ticker)
+    if len(series):
+        return series
+    legado = ChartCache.query.get(ticker)
+    if not legado:
+        return series
+    import gzip as _gzip
     try:
-        db.session.commit()
+        candles = _sanitize_chart_candles(json.loads(_gzip.decompress(legado.candles_gz).decode()))
     except Exception:
-        db.session.rollback()
+        app.logger.exception('candle: blob de %s ilegível', ticker)
+        return series
+    candle_store.upsert(db.session, ticker, candles)
+    db.session.delete(legado)
+    if commit:
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('candle: migração do blob de %s falhou', ticker)
+            return series
+    return candle_store.CandleSeries.from_dicts(ticker, candles)
+
+
+def _candles_refresh(ticker, series, start_date=None, commit=True):
+    """Busca no Yahoo a partir de start_date (None = 1 ano), grava os dias
+    recebidos e devolve a série atualizada. O filtro de outliers precisa de
+    contexto (mediana, fechamento anterior): os últimos 30 candles guardados
+    entram junto, mas só os dias novos são gravados."""
+    yf_ticker = ticker + '.SA' if _is_b3_yahoo_ticker(ticker) else ticker
+    return _candles_merge(ticker, series, _yahoo_fetch(yf_ticker, start_date=start_date) or [],
+                          commit=commit)
+
+
+def _candles_merge(ticker, series, new_rows, commit=True):
+    """Grava os candles recebidos do Yahoo (saneados) e devolve a série
+    atualizada — a parte de _candles_refresh que não faz rede, usada também
+    pelo pré-aquecimento, que busca em paralelo e grava em série.
+    commit=False deixa a gravação pendente na db.session."""
+    if not new_rows:
+        return series
+    novos = {r['t'] for r in new_rows}
+    ctx = [c for c in series.to_dicts(tail=30) if c['t'] not in novos]
+    frescos = [c for c in _sanitize_chart_candles(ctx + new_rows) if c['t'] in novos]
+    if not frescos:
+        return series
+    candle_store.upsert(db.session, ticker, frescos)
+    if commit:
+        db.session.commit()
+    return series.merged(frescos)
+
 
-    return jsonify({'ticker': ticker, 'cached': False, 'series': serie,
-                    'stats': _vol_hist_stats(serie)})
+def _chart_json(ticker, candles, cached):
+    """Resposta de /api/chart_data com ETag. Candles só mudam na ponta (o
+    refetch incremental reescreve os últimos dias), então tamanho + datas das
+    pontas + hash dos últimos candles identificam a série sem serializá-la."""
+    tail = json.dumps(candles[-5:], sort_keys=True).encode()
+    etag = (f'c.{ticker}.{len(candles)}.{candles[0]["t"] if candles else ""}.'
+            f'{zlib.crc32(tail):08x}')
+    return _etag_json(etag, lambda: {'ticker': ticker, 'candles': candles, 'cached': cached})
 
 
 @app.route('/api/chart_data/<ticker>')
 @login_required
 def api_chart_data(ticker):
-    """OHLCV diário — 6 meses, 3 camadas de cache:
+    """OHLCV diário — até _CHART_MAX_CANDLES, 3 camadas de cache:
        1. Memória (120 s)  — zero I/O
-       2. SQLite            — sobrevive restart; fetch incremental se stale
+       2. SQLite (candle)   — sobrevive restart; fetch incremental se stale
        3. Yahoo Finance v8  — chamada HTTP direta, ~0.5 s
+    Com ETag (ver _chart_json): reabrir o gráfico sem candle novo volta 304.
     """
-    import re, time as _time, gzip as _gzip, json as _json
-    from models import ChartCache
+    import time as _time
     from datetime import date as _date, timedelta as _td
 
     ticker = ticker.upper().strip()
@@ -15107,81 +14579,45 @@ def api_chart_data(ticker):
     # ── Camada 1: memória ──────────────────────────────────────────────────────
     mem = _chart_mem.get(ticker)
     if mem and (now_ts - mem['ts']) < _CHART_MEM_TTL:
-        candles = mem['candles']
-        if since:
-            candles = [c for c in candles if c['t'] > since]
-        return jsonify({'ticker': ticker, 'candles': candles, 'cached': 'mem'})
-
-    yf_ticker = ticker + '.SA' if _is_b3_yahoo_ticker(ticker) else ticker
+        return _chart_json(ticker, mem['series'].to_dicts(since, _CHART_MAX_CANDLES), 'mem')
 
-    candles = None
+    series = None
     try:
         # ── Camada 2: SQLite ───────────────────────────────────────────────────
-        db_entry = ChartCache.query.get(ticker)
-
-        if db_entry:
-            candles  = _json.loads(_gzip.decompress(db_entry.candles_gz).decode())
-            original_len = len(candles)
-            candles = _sanitize_chart_candles(candles)
-            if not candles:
-                candles = _sanitize_chart_candles(_yahoo_fetch(yf_ticker))
-            days_old = (_date.today() - _date.fromisoformat(db_entry.last_date)).days
-
-            # days_old == 0 (last_date é HOJE) NÃO é tratado como fresco: o
-            # candle do dia fica "em formação" enquanto o mercado está aberto
-            # (o Yahoo v8 atualiza esse candle ao vivo) — sem refetch aqui ele
-            # ficava congelado no valor da primeira busca do dia, mesmo horas
-            # depois. Só days_old == 1 (ontem) pula o refetch com segurança.
-            if days_old == 1:
-                if len(candles) != original_len:
-                    gz = _gzip.compress(_json.dumps(candles).encode(), compresslevel=6)
-                    db_entry.candles_gz = gz
-                    db_entry.last_date = candles[-1]['t'] if candles else db_entry.last_date
-                    db_entry.fetched_at = datetime.utcnow()
-                    db.session.commit()
-                # Cache fresco — serve direto
-                _chart_mem[ticker] = {'ts': now_ts, 'candles': candles}
-                out = [c for c in candles if c['t'] > since] if since else candles
-                return jsonify({'ticker': ticker, 'candles': out, 'cached': 'db'})
+        series = _candles_load(ticker)
+
+        if len(series):
+            # Fresco = o último candle é o do último pregão já fechado, e esse
+            # pregão não é o de hoje. Candle de HOJE nunca é tratado como
+            # fresco: fica "em formação" enquanto o mercado está aberto (o
+            # Yahoo v8 atualiza esse candle ao vivo) — sem refetch aqui ele
+            # ficava congelado no valor da primeira busca do dia. O
+            # pré-aquecimento do agendador (_prewarm_sweep) rebusca todos os
+            # papéis depois do fechamento, então na manhã seguinte (e na
+            # segunda-feira, com o candle de sexta) a abertura é um hit.
+            ref = _ultimo_pregao_fechado()
+            if series.last_date == ref.isoformat() and ref < _date.today():
+                _chart_mem[ticker] = {'ts': now_ts, 'series': series}
+                return _chart_json(ticker, series.to_dicts(since, _CHART_MAX_CANDLES), 'db')
 
             # Stale — busca só dias que faltam
-            start_date = (_date.fromisoformat(db_entry.last_date) - _td(days=3)).isoformat()
-            new_rows = _yahoo_fetch(yf_ticker, start_date=start_date)
-            if new_rows:
-                new_rows = _sanitize_chart_candles(new_rows)
-                new_dates = {r['t'] for r in new_rows}
-                candles = [c for c in candles if c['t'] not in new_dates] + new_rows
-                candles.sort(key=lambda c: c['t'])
-                candles = candles[-260:]  # ~1 ano de dias úteis (warm-up MM200 + 8 meses)
+            start_date = (_date.fromisoformat(series.last_date) - _td(days=3)).isoformat()
+            series = _candles_refresh(ticker, series, start_date)
         else:
-            # Primeira vez — busca 6 meses completos
-            candles = _yahoo_fetch(yf_ticker)
+            # Primeira vez — busca o ano completo
+            series = _candles_refresh(ticker, series)
 
-        candles = _sanitize_chart_candles(candles)
-
-        if not candles:
+        if not len(series):
             return jsonify({'error': 'Sem dados para ' + ticker}), 404
 
-        # ── Persiste no SQLite ─────────────────────────────────────────────────
-        gz = _gzip.compress(_json.dumps(candles).encode(), compresslevel=6)
-        if db_entry:
-            db_entry.candles_gz = gz
-            db_entry.last_date  = candles[-1]['t']
-            db_entry.fetched_at = datetime.utcnow()
-        else:
-            db.session.add(ChartCache(ticker=ticker, last_date=candles[-1]['t'],
-                                      candles_gz=gz, fetched_at=datetime.utcnow()))
-        db.session.commit()
-
-        _chart_mem[ticker] = {'ts': now_ts, 'candles': candles}
-        out = [c for c in candles if c['t'] > since] if since else candles
-        return jsonify({'ticker': ticker, 'candles': out, 'cached': 'yf'})
+        _chart_mem[ticker] = {'ts': now_ts, 'series': series}
+        return _chart_json(ticker, series.to_dicts(since, _CHART_MAX_CANDLES), 'yf')
 
     except Exception as e:
+        db.session.rollback()
         app.logger.error('api_chart_data %s: %s', ticker, e)
-        if candles:
-            out = [c for c in candles if c['t'] > since] if since else candles
-            return jsonify({'ticker': ticker, 'candles': out, 'cached': 'stale'})
+        if series is not None and len(series):
+            return _chart_json(ticker, series.to_dicts(since, _CHART_MAX_CANDLES), 'stale')
         return jsonify({'error': str(e)}), 500
 
 
@@ -15450,48 +14886,198 @@ def api_quote_hint(ticker):
         except Exception:
             pass
 
-    # ── fallback yfinance fast_info ───────────────────────────────
-    if price == 0:
-        try:
-            import yfinance as yf
-            yf_t = ticker if '.' in ticker else f'{ticker}.SA'
-            fi   = yf.Ticker(yf_t).fast_info
-            p    = fi.last_price
-            prev = fi.previous_close or 0
+    # ── fallback yfinance fast_info ───────────────────────────────
+    if price == 0:
+        try:
+            import yfinance as yf
+            yf_t = ticker if '.' in ticker else f'{ticker}.SA'
+            fi   = yf.Ticker(yf_t).fast_info
+            p    = fi.last_price
+            prev = fi.previous_close or 0
+            if p and float(p) > 0:
+                price  = float(p)
+                change = ((price - prev) / prev * 100) if prev > 0 else 0.0
+                ask    = float(getattr(fi, 'ask', 0) or price)
+                bid    = float(getattr(fi, 'bid', 0) or price)
+        except Exception:
+            pass
+
+    return jsonify({
+        'ticker': ticker,
+        'name':   name,
+        'price':  round(price,  2),
+        'change': round(change, 2),
+        'ask':    round(ask,    2),
+        'bid':    round(bid,    2),
+    })
+
+
+# ─────────────────────────────────────────────────────────────────
+# OPLAB AUTO-UPDATE BACKGROUND SCHEDULER
+# ─────────────────────────────────────────────────────────────────
+
+def _oplab_bulk_quotes(tickers, headers, oplab_online=True):
+    """GET /market/quote em lotes de 150. Retorna (prices, variations,
+    oplab_online): {ticker: close}, {ticker: variação % do dia}.
+
+    O primeiro lote também serve de teste de disponibilidade: se ele falhar
+    por rede/5xx, a OpLab está fora e pulamos os fallbacks individuais (que
+    empilhariam timeouts). Evita o probe separado, que era uma ida à rede a
+    mais e um ponto único de falha — um único blip marcava a OpLab como
+    "indisponível" e descartava a atualização inteira, mesmo com o servidor
+    respondendo normalmente."""
+    BASE = 'https://api.oplab.com.br/v3'
+    tickers = list(tickers)
+    prices:     dict = {}   # ticker → close price
+    variations: dict = {}   # ticker → variation % do dia
+    CHUNK = 150
+    for i in range(0, len(tickers), CHUNK):
+        chunk = tickers[i:i + CHUNK]
+        try:
+            r = _oplab_session.get(
+                f'{BASE}/market/quote',
+                params={'tickers': ','.join(chunk)},
+                headers=headers,
+                timeout=8,
+            )
+            if i == 0 and r.status_code >= 500:
+                oplab_online = False   # servidor com problema: só o que der no lote
+            if r.status_code == 200:
+                for item in r.json():
+                    sym   = str(item.get('symbol', '')).upper()
+                    close = item.get('close')
+                    # Tenta múltiplos nomes de campo para variação diária %
+                    var = None
+                    for _vk in ('variation', 'change', 'pct_change',
+                                'percentChange', 'dailyChange', 'change_pct'):
+                        if _vk in item and item[_vk] is not None:
+                            var = item[_vk]
+                            break
+                    if sym and close is not None:
+                        prices[sym] = float(close)
+                    if sym and var is not None:
+                        variations[sym] = float(var)
+        except requests.exceptions.RequestException:
+            if i == 0:
+                oplab_online = False   # sem rede/timeout no 1º lote: OpLab fora
+        except Exception:
+            pass
+    return prices, variations, oplab_online
+
+
+def _oplab_single_quote(ticker: str, headers):
+    """Fallback por ticker para opções que não vieram no bulk da OpLab:
+    /market/instruments e, se falhar, Yahoo. Retorna (price, change) ou
+    (None, None)."""
+    BASE = 'https://api.oplab.com.br/v3'
+    tk = (ticker or '').upper().strip()
+    if not tk:
+        return None, None
+    try:
+        ri = _oplab_session.get(
+            f'{BASE}/market/instruments/{tk}',
+            headers=headers, timeout=4,
+        )
+        if ri.status_code == 200:
+            d = ri.json()
+            p = d.get('close') or d.get('last') or d.get('price')
             if p and float(p) > 0:
-                price  = float(p)
-                change = ((price - prev) / prev * 100) if prev > 0 else 0.0
-                ask    = float(getattr(fi, 'ask', 0) or price)
-                bid    = float(getattr(fi, 'bid', 0) or price)
-        except Exception:
-            pass
+                var = d.get('variation') or d.get('change')
+                return float(p), (float(var) if var is not None else None)
+    except Exception:
+        pass
+    q = yahoo_quote(tk + '.SA', timeout=5)
+    if q:
+        return q['price'], q['change_percent']
+    return None, None
 
-    return jsonify({
-        'ticker': ticker,
-        'name':   name,
-        'price':  round(price,  2),
-        'change': round(change, 2),
-        'ask':    round(ask,    2),
-        'bid':    round(bid,    2),
-    })
 
+def _oplab_fill_missing(tickers, headers, prices, variations, timeout_secs):
+    """Roda _oplab_single_quote em paralelo para `tickers` e completa
+    prices/variations no lugar. Retorna o conjunto de tickers resolvidos.
 
-# ─────────────────────────────────────────────────────────────────
-# OPLAB AUTO-UPDATE BACKGROUND SCHEDULER
-# ─────────────────────────────────────────────────────────────────
+    Paralelo porque um loop sequencial (até 4s por ticker) facilmente passa
+    de 25s quando o bulk /market/quote não cobre a maioria das opções."""
+    filled = set()
+    tickers = list(tickers)
+    if not tickers:
+        return filled
+    import concurrent.futures as _cf
+    ex = _cf.ThreadPoolExecutor(max_workers=min(8, len(tickers)))
+    fut_map = {ex.submit(_oplab_single_quote, tk, headers): tk for tk in tickers}
+    try:
+        for fut in _cf.as_completed(fut_map, timeout=max(1.0, timeout_secs)):
+            tk = fut_map[fut]
+            try:
+                p, var = fut.result()
+            except Exception:
+                continue
+            if p and p > 0:
+                prices[tk] = p
+                filled.add(tk)
+                if var is not None:
+                    variations[tk] = var
+    except _cf.TimeoutError:
+        pass  # aproveita o que já resolveu; o resto fica sem preço nesta rodada
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+    return filled
+
+
+def _oplab_chain_deltas(underlyings, token, timeout_secs):
+    """{ticker da opção: delta} das cadeias dos subjacentes, via cache
+    compartilhado (_oplab_chain). Em paralelo: sequencial, com timeout de 15s
+    por subjacente, uma carteira com 15-20 subjacentes já passa de 25s."""
+    deltas: dict = {}
+    underlyings = list(underlyings)
+    if not underlyings:
+        return deltas
+
+    def _fetch_underlying_options(underlying):
+        # Via cache compartilhado: se o usuário acabou de abrir uma tela desse
+        # ativo (ou outro usuário do scheduler já passou por ele), não baixa de
+        # novo. A thread do pool não herda o app_context — a leitura do cache
+        # no banco precisa dele.
+        out = {}
+        try:
+            with app.app_context():
+                opt_list = _oplab_chain(underlying, token, timeout=15, retries=0).options
+            for item in opt_list:
+                sym   = str(item.get('symbol', item.get('ticker', ''))).upper()
+                delta = item.get('delta') or item.get('greeks', {}).get('delta') if isinstance(item.get('greeks'), dict) else item.get('delta')
+                if sym and delta is not None:
+                    out[sym] = float(delta)
+        except Exception:
+            pass
+        return out
 
-_oplab_last_update: dict = {}   # user_id → datetime of last successful update
+    import concurrent.futures as _cf2
+    ex2 = _cf2.ThreadPoolExecutor(max_workers=min(8, len(underlyings)))
+    fut_map2 = {ex2.submit(_fetch_underlying_options, u): u for u in underlyings}
+    try:
+        for fut in _cf2.as_completed(fut_map2, timeout=max(1.0, timeout_secs)):
+            try:
+                deltas.update(fut.result())
+            except Exception:
+                continue
+    except _cf2.TimeoutError:
+        pass
+    finally:
+        ex2.shutdown(wait=False, cancel_futures=True)
+    return deltas
 
 
 def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
                           budget_secs: float = 22.0):
     """
-    Busca cotações via GET /v3/market/quote?tickers=... e atualiza o DB para:
+    Busca cotações via GET /v3/market/quote?tickers=... e grava na tabela
+    quote (uma linha por ticker) as de:
       - Todos os Assets do usuário (qty ≥ 0 — inclui swingtrade sem posição)
       - Todas as Options (VENDA_CALL, VENDA_PUT, COMPRA_CALL, COMPRA_PUT)
       - Underlying assets das Options (para exibição correta em /opcoes e /estudos)
-      - StudyOption: option_price + underlying_price
-      - OptionSpread: leg_long_current + leg_short_current
+      - StudyOption, OptionSpread, pernas estruturadas e PutSale
+    A carteira lê o preço de lá (ver models._quoted); na própria carteira
+    só vão o delta das opções e o subjacente das operações intl.
     Quando oplab_online=False pula todos os fallbacks individuais por opção
     (que causam loop/timeout quando o servidor está fora do ar).
     Retorna (assets_ok, options_ok, oplab_covered_assets).
@@ -15575,83 +15161,8 @@ def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
         return 0, 0, set()
 
     # ── Busca preços em lotes de 150 ──────────────────────────────
-    prices:     dict = {}   # ticker → close price
-    variations: dict = {}   # ticker → variation % do dia
-
-    # O primeiro lote também serve de teste de disponibilidade: se ele falhar
-    # por rede/5xx, a OpLab está fora e pulamos os fallbacks individuais (que
-    # empilhariam timeouts). Evita o probe separado, que era uma ida à rede a
-    # mais e um ponto único de falha — um único blip marcava a OpLab como
-    # "indisponível" e descartava a atualização inteira, mesmo com o servidor
-    # respondendo normalmente.
-    CHUNK = 150
-    for i in range(0, len(all_tickers), CHUNK):
-        chunk = all_tickers[i:i + CHUNK]
-        try:
-            r = _oplab_session.get(
-                f'{BASE}/market/quote',
-                params={'tickers': ','.join(chunk)},
-                headers=headers,
-                timeout=8,
-            )
-            if i == 0 and r.status_code >= 500:
-                oplab_online = False   # servidor com problema: só o que der no lote
-            if r.status_code == 200:
-                for item in r.json():
-                    sym   = str(item.get('symbol', '')).upper()
-                    close = item.get('close')
-                    # Tenta múltiplos nomes de campo para variação diária %
-                    var = None
-                    for _vk in ('variation', 'change', 'pct_change',
-                                'percentChange', 'dailyChange', 'change_pct'):
-                        if _vk in item and item[_vk] is not None:
-                            var = item[_vk]
-                            break
-                    if sym and close is not None:
-                        prices[sym] = float(close)
-                    if sym and var is not None:
-                        variations[sym] = float(var)
-        except requests.exceptions.RequestException:
-            if i == 0:
-                oplab_online = False   # sem rede/timeout no 1º lote: OpLab fora
-        except Exception:
-            pass
-
-    def _fetch_missing_option_quote(ticker: str):
-        """Fallback por ticker para opções que não vieram no bulk da OpLab."""
-        tk = (ticker or '').upper().strip()
-        if not tk:
-            return None, None
-        try:
-            ri = _oplab_session.get(
-                f'{BASE}/market/instruments/{tk}',
-                headers=headers, timeout=4,
-            )
-            if ri.status_code == 200:
-                d = ri.json()
-                p = d.get('close') or d.get('last') or d.get('price')
-                if p and float(p) > 0:
-                    var = d.get('variation') or d.get('change')
-                    return float(p), (float(var) if var is not None else None)
-        except Exception:
-            pass
-        try:
-            yf_t = tk + '.SA'
-            for host in ('query1.finance.yahoo.com', 'query2.finance.yahoo.com'):
-                r = requests.get(
-                    f'https://{host}/v8/finance/chart/{yf_t}',
-                    params={'interval': '1d', 'range': '2d'},
-                    headers=_YF_HEADERS, cookies=_YF_COOKIES, timeout=5,
-                )
-                if r.status_code == 200:
-                    meta = r.json()['chart']['result'][0]['meta']
-                    p = meta.get('regularMarketPrice') or meta.get('previousClose')
-                    if p and float(p) > 0:
-                        chg = meta.get('regularMarketChangePercent')
-                        return float(p), (float(chg) if chg is not None else None)
-        except Exception:
-            pass
-        return None, None
+    prices, variations, oplab_online = _oplab_bulk_quotes(all_tickers, headers, oplab_online)
+    filled = set()
 
     # Fallback individual por opção — pulado quando OpLab está offline
     # (evita loop de timeouts que trava o servidor). Rodado em paralelo: um
@@ -15662,103 +15173,38 @@ def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
     # o bulk /market/quote já tinha resolvido com sucesso.
     if oplab_online and _left() > 1:
         missing_tks = [tk for tk in option_tickers if tk not in prices or prices.get(tk, 0) <= 0]
-        if missing_tks:
-            import concurrent.futures as _cf
-            ex = _cf.ThreadPoolExecutor(max_workers=min(8, len(missing_tks)))
-            fut_map = {ex.submit(_fetch_missing_option_quote, tk): tk for tk in missing_tks}
-            try:
-                # Metade do que resta: a busca de deltas logo abaixo também
-                # precisa de tempo, e antes as duas somavam 36s (18+18).
-                for fut in _cf.as_completed(fut_map, timeout=max(1.0, _left() * 0.5)):
-                    tk = fut_map[fut]
-                    try:
-                        p, var = fut.result()
-                    except Exception:
-                        continue
-                    if p and p > 0:
-                        prices[tk] = p
-                        if var is not None:
-                            variations[tk] = var
-            except _cf.TimeoutError:
-                pass  # aproveita o que já resolveu; o resto fica sem preço nesta rodada
-            finally:
-                ex.shutdown(wait=False, cancel_futures=True)
+        # Metade do que resta: a busca de deltas logo abaixo também
+        # precisa de tempo, e antes as duas somavam 36s (18+18).
+        filled = _oplab_fill_missing(missing_tks, headers, prices, variations, _left() * 0.5)
 
     if not prices:
         return 0, 0, set()
 
     # ── Busca delta das opções via /v3/market/options/{underlying} ──
-    # Agrupa opções por underlying para minimizar chamadas à API. Em paralelo
-    # pelo mesmo motivo do fallback acima: sequencial, com timeout de 15s por
-    # subjacente, uma carteira com 15-20 subjacentes já passa de 25s sozinha.
+    # Agrupa opções por underlying para minimizar chamadas à API.
     # Pulado quando OpLab está offline.
     deltas: dict = {}   # ticker_opcao → delta
-    underlyings_com_opcoes = list({o.underlying_asset.upper() for o in options if o.underlying_asset})
-
-    def _fetch_underlying_options(underlying):
-        out = {}
-        try:
-            r = _oplab_session.get(
-                f'{BASE}/market/options/{underlying}',
-                headers=headers,
-                timeout=15,
-            )
-            if r.status_code == 200:
-                data = r.json()
-                opt_list = data if isinstance(data, list) else data.get('options', data.get('calls', []) + data.get('puts', []))
-                for item in opt_list:
-                    sym   = str(item.get('symbol', item.get('ticker', ''))).upper()
-                    delta = item.get('delta') or item.get('greeks', {}).get('delta') if isinstance(item.get('greeks'), dict) else item.get('delta')
-                    if sym and delta is not None:
-                        out[sym] = float(delta)
-        except Exception:
-            pass
-        return out
-
+    underlyings_com_opcoes = {o.underlying_asset.upper() for o in options if o.underlying_asset}
     if oplab_online and underlyings_com_opcoes and _left() > 1:
-        import concurrent.futures as _cf2
-        ex2 = _cf2.ThreadPoolExecutor(max_workers=min(8, len(underlyings_com_opcoes)))
-        fut_map2 = {ex2.submit(_fetch_underlying_options, u): u for u in underlyings_com_opcoes}
-        try:
-            for fut in _cf2.as_completed(fut_map2, timeout=max(1.0, _left())):
-                try:
-                    deltas.update(fut.result())
-                except Exception:
-                    continue
-        except _cf2.TimeoutError:
-            pass
-        finally:
-            ex2.shutdown(wait=False, cancel_futures=True)
-
-    now = now_brt()
-
-    def _cotacao_confiavel(ticker, novo, anterior):
-        """Rejeita cotação que destoa demais do último preço conhecido.
+        deltas = _oplab_chain_deltas(underlyings_com_opcoes, token, _left())
 
-        Papéis de baixa liquidez às vezes voltam do /market/quote com um `close`
-        antigo — visto no LFTS11, que veio a R$ 103,10 com variação 0,00% quando
-        valia R$ 158,19 (dado anterior a um desdobramento). Aceitar isso troca
-        uma cotação boa por uma errada e distorce o lucro da carteira.
+    suspeitos = set()   # descartados pela guarda — ficam fora da tabela quote
 
-        Só descarta quando há preço anterior para comparar; salto legítimo
-        acompanhado de variação coerente passa (o filtro é para dado obsoleto,
-        que vem justamente sem variação).
-        """
-        if not anterior or anterior <= 0 or not novo or novo <= 0:
+    def _confiavel(ticker, novo, anterior):
+        if _cotacao_confiavel(ticker, novo, anterior, variations.get(ticker)):
             return True
-        desvio = abs(novo - anterior) / anterior
-        if desvio <= 0.20:
-            return True
-        # Variação informada explica o salto? Então é movimento real, não dado velho.
-        var = variations.get(ticker)
-        if var is not None and abs(float(var)) >= desvio * 100 * 0.5:
-            return True
-        app.logger.warning(
-            'OpLab: cotacao suspeita de %s descartada (%.2f vs %.2f anterior, %.1f%% de desvio, variacao informada %s)',
-            ticker, novo, anterior, desvio * 100, var)
+        suspeitos.add(ticker)
         return False
 
-    # ── Assets: atualiza current_price/daily_change via OpLab quando disponível ──
+    # Os preços vão só para a tabela quote, uma linha por ticker; as colunas
+    # de preço da carteira (Asset.current_price, Option.underlying_price,
+    # StructuredLeg.current_price...) leem de lá (ver models._quoted). Aqui
+    # só se decide o que entra (guarda) e se conta o que ficou coberto.
+    # Nenhuma gravação na db.session antes de _quote_upsert: a leitura dos
+    # preços anteriores consulta o banco, e um autoflush seguraria o lock de
+    # escrita do SQLite que a conexão de _quote_upsert precisa.
+
+    # ── Assets: guarda contra o último preço conhecido ──────────────
     assets_ok = 0
     oplab_covered_assets: set = set()   # tickers que o OpLab retornou → não precisam ir ao Yahoo
     for a in assets:
@@ -15768,57 +15214,36 @@ def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
         if key in prices and prices[key] > 0:
             # Cotação destoante do último preço fica de fora: o ticker não entra
             # em oplab_covered e o Yahoo assume no passo seguinte.
-            if not _cotacao_confiavel(key, prices[key], a.current_price):
+            if not _confiavel(key, prices[key], a.current_price):
                 continue
-            a.current_price = prices[key]
-            a.last_update   = now
-            if key in variations:
-                a.daily_change = variations[key]
             oplab_covered_assets.add(key)
             assets_ok += 1
 
-    # ── Atualiza Options (todas as tabelas de /opcoes) ────────────
+    # ── Options (todas as tabelas de /opcoes) ─────────────────────
     options_ok = 0
     missing_option_tickers: list = []   # opções que o OpLab não retornou → fallback Yahoo
+    assets_by_ticker = {a.ticker.upper(): a for a in assets}
     for o in options:
         key = o.ticker.upper()
         if key in prices and prices[key] > 0:
-            o.current_option_price = prices[key]
-            o.last_update          = now
             options_ok += 1
         else:
-            missing_option_tickers.append(o)
-        if key in variations:
-            o.daily_change = variations[key]
-        # Atualiza delta se disponível (não zera se API não retornar)
-        if key in deltas:
-            o.delta = deltas[key]
-        # Atualiza cotação do ativo subjacente quando disponível
+            missing_option_tickers.append(key)
+        # Subjacente com Asset na carteira passa pela mesma guarda
         if o.underlying_asset:
             uk = o.underlying_asset.upper()
-            if uk in prices and prices[uk] > 0:
-                # Grava na própria Option — subjacentes fora da carteira
-                # (ex.: AXIA3, MULT3) não têm Asset onde salvar o preço
-                o.underlying_price = prices[uk]
-                if uk in variations:
-                    o.underlying_change = variations[uk]
-                # Propaga para o Asset correspondente se existir
-                asset_obj = next((a for a in assets if a.ticker.upper() == uk), None)
-                if (asset_obj and asset_obj.type != 'ETF'
-                        and _cotacao_confiavel(uk, prices[uk], asset_obj.current_price)):
-                    asset_obj.current_price = prices[uk]
-                    if uk in variations:
-                        asset_obj.daily_change = variations[uk]
-                    oplab_covered_assets.add(uk)
+            asset_obj = assets_by_ticker.get(uk)
+            if (uk in prices and prices[uk] > 0 and asset_obj and asset_obj.type != 'ETF'
+                    and _confiavel(uk, prices[uk], asset_obj.current_price)):
+                oplab_covered_assets.add(uk)
 
     # ── Fallback individual p/ tickers de opção não retornados no bulk ──────
-    # OpLab /market/instruments/{ticker} e, se falhar, Yahoo. Retorna
-    # (price, change) ou (None, None). Pulado quando OpLab offline (evita
-    # empilhar timeouts de 8s por ticker).
-    # Memoiza por ticker: o mesmo papel aparece em várias tabelas (Options,
-    # spreads, pernas estruturadas), e antes cada ocorrência refazia as duas
-    # chamadas de rede. Guarda inclusive o (None, None) para não repetir a
-    # busca de um ticker que já falhou.
+    # OpLab /market/instruments/{ticker} e, se falhar, Yahoo. Pulado quando
+    # OpLab offline (evita empilhar timeouts de 8s por ticker). O que vier
+    # entra em prices como 'fallback'; memoizado por ticker: o mesmo papel
+    # aparece em várias tabelas (Options, spreads, pernas estruturadas).
+    # Guarda inclusive o (None, None) para não repetir a busca de um ticker
+    # que já falhou.
     _fb_cache: dict = {}
 
     def _fallback_option_quote(ticker_up):
@@ -15837,38 +15262,33 @@ def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
         except Exception:
             pass
         if res[0] is None:
-            try:
-                for host in ('query1.finance.yahoo.com', 'query2.finance.yahoo.com'):
-                    r = requests.get(
-                        f'https://{host}/v8/finance/chart/{ticker_up}.SA',
-                        params={'interval': '1d', 'range': '2d'},
-                        headers=_YF_HEADERS, cookies=_YF_COOKIES, timeout=4,
-                    )
-                    if r.status_code == 200:
-                        meta = r.json()['chart']['result'][0]['meta']
-                        p = meta.get('regularMarketPrice') or meta.get('previousClose')
-                        if p and float(p) > 0:
-                            chg = meta.get('regularMarketChangePercent')
-                            res = (float(p), (float(chg) if chg is not None else None))
-                            break
-            except Exception:
-                pass
+            q = yahoo_quote(f'{ticker_up}.SA', timeout=4)
+            if q:
+                res = (q['price'], q['change_percent'])
         _fb_cache[ticker_up] = res
+        if res[0]:
+            prices[ticker_up] = res[0]
+            if res[1] is not None:
+                variations[ticker_up] = res[1]
+            filled.add(ticker_up)
         return res
 
+    def _cotada(ticker_up):
+        """Preço no bulk ou, se der tempo, no fallback individual."""
+        if ticker_up in prices and prices[ticker_up] > 0:
+            return True
+        if oplab_online and _left() > 0:
+            return bool(_fallback_option_quote(ticker_up)[0])
+        return False
+
     if missing_option_tickers and oplab_online:
-        for o in missing_option_tickers:
+        for key in missing_option_tickers:
             if _left() <= 0:
-                break   # orçamento esgotado: mantém o que já foi atualizado
-            p, var = _fallback_option_quote(o.ticker.upper())
-            if p:
-                o.current_option_price = p
-                o.last_update = now
-                if var is not None:
-                    o.daily_change = var
+                break   # orçamento esgotado: mantém o que já foi buscado
+            if _fallback_option_quote(key)[0]:
                 options_ok += 1
 
-    # ── Atualiza pernas de OperaçõesEstruturadas (com fallback individual) ──
+    # ── Pernas de OperaçõesEstruturadas (com fallback individual) ──
     # Vem ANTES de StudyOptions/OptionSpreads de propósito: são posições reais
     # de risco aberto, não dados de estudo — se o orçamento de tempo acabar
     # (carteiras grandes), é isso que precisa ficar atualizado, não o resto.
@@ -15878,75 +15298,38 @@ def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
         if getattr(leg.operation, 'intl', False):
             continue   # Tastytrade: prêmios mantidos manualmente
         k = (leg.ticker or '').upper()
-        if not k:
-            continue
-        if k in prices and prices[k] > 0:
-            leg.current_price = prices[k]
-            leg.last_update   = now
+        if k and _cotada(k):
             options_ok += 1
-        elif oplab_online and _left() > 0:
-            p, _var = _fallback_option_quote(k)
-            if p:
-                leg.current_price = p
-                leg.last_update   = now
-                options_ok += 1
-
-    # ── Atualiza underlying de OperaçõesEstruturadas ──────────────
-    for sop in struct_ops_bulk:
-        if getattr(sop, 'intl', False):
-            continue
-        if sop.underlying_asset:
-            uk = sop.underlying_asset.upper()
-            if uk in prices and prices[uk] > 0:
-                sop.underlying_price = prices[uk]
-            if uk in variations:
-                sop.underlying_change = variations[uk]
 
-    # ── Atualiza OptionSpreads (/spreads) — com fallback individual ────────
+    # ── OptionSpreads (/spreads) — com fallback individual ─────────
     for sp in spreads:
-        if sp.leg_long_ticker:
-            k = sp.leg_long_ticker.upper()
-            if k in prices and prices[k] > 0:
-                sp.leg_long_current = prices[k]
-                options_ok += 1
-            elif oplab_online and _left() > 0:
-                p, _var = _fallback_option_quote(k)
-                if p:
-                    sp.leg_long_current = p
-                    options_ok += 1
-        if sp.leg_short_ticker:
-            k = sp.leg_short_ticker.upper()
-            if k in prices and prices[k] > 0:
-                sp.leg_short_current = prices[k]
+        for k in (sp.leg_long_ticker, sp.leg_short_ticker):
+            if k and _cotada(k.upper()):
                 options_ok += 1
-            elif oplab_online and _left() > 0:
-                p, _var = _fallback_option_quote(k)
-                if p:
-                    sp.leg_short_current = p
-                    options_ok += 1
-        if sp.underlying_asset:
-            uk = sp.underlying_asset.upper()
-            if uk in prices and prices[uk] > 0:
-                sp.underlying_price = prices[uk]
-            if uk in variations:
-                sp.underlying_change = variations[uk]
 
-    # ── Atualiza StudyOptions (/estudos) ──────────────────────────
+    # ── StudyOptions (/estudos) ───────────────────────────────────
     for so in study_options:
-        changed = False
         opt_key = (so.ticker or '').upper()
         if opt_key in prices and prices[opt_key] > 0:
-            so.option_price = prices[opt_key]
-            changed = True
             options_ok += 1
-        if so.underlying_asset:
-            uk = so.underlying_asset.upper()
-            if uk in prices and prices[uk] > 0:
-                so.underlying_price = prices[uk]
-                changed = True
+
+    # Tabela quote só com o que passou pela guarda acima (e pela de
+    # _quote_upsert, contra o que já está lá): é ela que a carteira deste e
+    # dos outros usuários lê, no refresh global e no stream.
+    aceitos = _quote_upsert({tk: p for tk, p in prices.items() if tk not in suspeitos and tk not in filled},
+                            variations, 'oplab', guard=asset_tickers)
+    aceitos |= _quote_upsert({tk: prices[tk] for tk in filled if tk not in suspeitos}, variations,
+                             'fallback', guard=asset_tickers)
+
+    # ── Delta das opções (não zera se API não retornar) ────────────
+    for o in options:
+        key = o.ticker.upper()
+        if key in deltas:
+            o.delta = deltas[key]
 
     # ── Tastytrade (intl): somente o SUBJACENTE, via Yahoo sem .SA ─
-    # (AAPL, SPY, TSLA…). As pernas de opção não são tocadas.
+    # (AAPL, SPY, TSLA…). As pernas de opção não são tocadas. Fica na
+    # própria operação: a tabela quote é da B3 (ver StructuredOp.quoted_live).
     try:
         from services import _yf_fast_info as _yfi_intl
         _intl_cache = {}
@@ -15963,22 +15346,342 @@ def _do_oplab_bulk_update(uid: int, token: str, oplab_online: bool = True,
     except Exception:
         pass
 
-    # ── Atualiza PutSales ─────────────────────────────────────────
-    for ps in put_sales:
-        if ps.underlying_asset:
-            uk = ps.underlying_asset.upper()
-            if uk in prices and prices[uk] > 0:
-                ps.underlying_price = prices[uk]
-
     try:
         db.session.commit()
     except Exception:
         db.session.rollback()
+    _quote_publish(aceitos, [uid])
 
     return assets_ok, options_ok, oplab_covered_assets
 
 
-_snapshot_last_day = {}   # {user_id: 'YYYY-MM-DD'} — garante 1 snapshot/dia por usuário
+# ── Cotações compartilhadas entre usuários ───────────────────────────────────
+# A tabela quote guarda a última cotação de cada ticker, de quem quer que a
+# tenha buscado. O refresh global (_do_oplab_global_update) junta os tickers
+# de todos os usuários da rodada, busca cada um UMA vez e depois espalha o
+# valor para as tabelas de carteira com UPDATEs em lote — antes, dez usuários
+# com PETR4 e a mesma série mensal pediam os mesmos lotes de /market/quote
+# dez vezes por intervalo.
+_QUOTE_FRESH_SECS = 45      # cotação mais nova que isso não é buscada de novo
+
+
+def _cotacao_confiavel(ticker, novo, anterior, var=None, fonte='OpLab'):
+    """Rejeita cotação que destoa demais do último preço conhecido.
+
+    Papéis de baixa liquidez às vezes voltam do /market/quote com um `close`
+    antigo — visto no LFTS11, que veio a R$ 103,10 com variação 0,00% quando
+    valia R$ 158,19 (dado anterior a um desdobramento). Aceitar isso troca
+    uma cotação boa por uma errada e distorce o lucro da carteira.
+
+    Só descarta quando há preço anterior para comparar; salto legítimo
+    acompanhado de variação coerente passa (o filtro é para dado obsoleto,
+    que vem justamente sem variação).
+    """
+    if not anterior or anterior <= 0 or not novo or novo <= 0:
+        return True
+    desvio = abs(novo - anterior) / anterior
+    if desvio <= 0.20:
+        return True
+    # Variação informada explica o salto? Então é movimento real, não dado velho.
+    if var is not None and abs(float(var)) >= desvio * 100 * 0.5:
+        return True
+    app.logger.warning(
+        '%s: cotacao suspeita de %s descartada (%.2f vs %.2f anterior, %.1f%% de desvio, variacao informada %s)',
+        fonte, ticker, novo, anterior, desvio * 100, var)
+    return False
+
+
+def _quote_upsert(prices, variations, source, guard=None):
+    """Grava {ticker: preço} na tabela quote e devolve os tickers gravados.
+
+    Só para fontes de mercado buscadas pelo servidor (OpLab, Yahoo/brapi): a
+    tabela é de todos os usuários. Os tickers de `guard` (None = todos) passam
+    por _cotacao_confiavel contra o que já está em quote (ou, sem linha lá,
+    contra o último preço gravado na carteira) — um close velho gravado aqui
+    chegaria à carteira de todos. Opções ficam de fora da guarda, como no
+    refresh por usuário: prêmio que anda mais de 20% no dia é normal.
+    Conexão própria: o refresh por usuário segura a db.session aberta até o
+    commit final, e a escrita aqui não deve prender o lock do SQLite esse
+    tempo todo."""
+    cand = {tk: float(p) for tk, p in prices.items() if p and p > 0}
+    if not cand:
+        return set()
+    ts = now_brt().replace(tzinfo=None)
+    tbl = Quote.__table__
+    try:
+        with db.engine.begin() as conn:
+            anterior = dict(conn.execute(db.select(tbl.c.ticker, tbl.c.price)
+                                         .where(tbl.c.ticker.in_(list(cand)))).all())
+            # Ticker ainda sem linha em quote: vale o último preço gravado na
+            # carteira (a linha mais recente de qualquer usuário)
+            falta = [tk for tk in cand if tk not in anterior and (guard is None or tk in guard)]
+            if falta:
+                at = Asset.__table__
+                for tk, p in conn.execute(db.select(db.func.upper(at.c.ticker), at.c.current_price)
+                                          .where(db.func.upper(at.c.ticker).in_(falta), at.c.current_price > 0)
+                                          .order_by(db.func.coalesce(at.c.last_update, ''))):
+                    anterior[tk] = p
+            rows = [(tk, p, variations.get(tk)) for tk, p in cand.items()
+                    if (guard is not None and tk not in guard)
+                    or _cotacao_confiavel(tk, p, anterior.get(tk), variations.get(tk), source)]
+            quote_store.upsert(conn, rows, source, ts)
+    except Exception:
+        app.logger.exception('quote: gravação falhou')
+        return set()
+    Quote.forget()
+    return {r[0] for r in rows}
+
+
+def _quote_user_upsert(user_id, prices, variations, source):
+    """Grava {ticker: preço} em quote_user — o preço que o usuário trouxe
+    (planilha, feeder, edição manual), que só ele vê. Na db.session de quem
+    chama, sem commit: vai junto com o resto da gravação. Retorna os tickers
+    gravados."""
+    ts = now_brt().replace(tzinfo=None)
+    rows = [(str(tk).upper().strip(), float(p), variations.get(tk))
+            for tk, p in prices.items() if tk and p is not None and p > 0]
+    quote_store.upsert_user(db.session, user_id, rows, source, ts)
+    Quote.forget()
+    return {r[0] for r in rows}
+
+
+def _quote_publish(tickers, user_ids=None, private=False):
+    """Marca `tickers` como alterados para `user_ids` (None = todos) — chamada
+    DEPOIS do commit de quote/quote_user, para que quem acordar com a nova
+    versão (stream ou ?since=) já leia os preços novos. private=True para
+    preços gravados em quote_user (planilha, feeder, edição manual). Conexão
+    própria pelo mesmo motivo de _quote_upsert. Retorna a versão publicada
+    (ou None)."""
+    tickers = [t for t in tickers if t]
+    if not tickers:
+        return None
+    try:
+        with db.engine.begin() as conn:
+            return Quote.publish(conn, tickers, user_ids, now=now_brt().replace(tzinfo=None),
+                                 private=private)
+    except Exception:
+        app.logger.exception('quote: publicação falhou')
+        return None
+
+
+def _quote_rows(tickers, max_age=None):
+    """{ticker: (preço, variação)} da tabela quote, opcionalmente só as
+    gravadas nos últimos max_age segundos."""
+    tickers = list(tickers)
+    out = {}
+    if not tickers:
+        return out
+    q = db.session.query(Quote.ticker, Quote.price, Quote.change_pct).filter(Quote.ticker.in_(tickers))
+    if max_age is not None:
+        q = q.filter(Quote.ts >= now_brt().replace(tzinfo=None) - timedelta(seconds=max_age))
+    for tk, p, v in q.all():
+        out[tk] = (p, v)
+    return out
+
+
+def _global_ticker_sets(uids):
+    """(asset_tickers, option_tickers, underlyings_com_opcoes) da união de
+    `uids` — mesmas regras de _do_oplab_bulk_update, em consultas DISTINCT
+    em vez de carregar os objetos de cada usuário."""
+    up = db.func.upper
+    assets, opts, unds = set(), set(), set()
+
+    def _col(q):
+        return {r[0].upper() for r in q.distinct().all() if r[0]}
+
+    assets |= _col(db.session.query(up(Asset.ticker))
+                   .filter(Asset.user_id.in_(uids), Asset.type != 'ETF'))
+    opts   |= _col(db.session.query(up(Option.ticker)).filter(Option.user_id.in_(uids)))
+    unds   |= _col(db.session.query(up(Option.underlying_asset)).filter(Option.user_id.in_(uids)))
+    opts   |= _col(db.session.query(up(StudyOption.ticker)).filter(StudyOption.user_id.in_(uids)))
+    assets |= _col(db.session.query(up(StudyOption.underlying_asset)).filter(StudyOption.user_id.in_(uids)))
+    for col in (OptionSpread.leg_long_ticker, OptionSpread.leg_short_ticker):
+        opts |= _col(db.session.query(up(col)).filter(OptionSpread.user_id.in_(uids)))
+    assets |= _col(db.session.query(up(OptionSpread.underlying_asset)).filter(OptionSpread.user_id.in_(uids)))
+    open_br = db.and_(StructuredOp.user_id.in_(uids), StructuredOp.status == 'OPEN',
+                      db.func.coalesce(StructuredOp.intl, False) == False)   # noqa: E712
+    opts   |= _col(db.session.query(up(StructuredLeg.ticker))
+                   .join(StructuredOp, StructuredLeg.op_id == StructuredOp.id).filter(open_br))
+    assets |= _col(db.session.query(up(StructuredOp.underlying_asset)).filter(open_br))
+    opts   |= _col(db.session.query(up(PutSale.ticker)).filter(PutSale.user_id.in_(uids)))
+    assets |= _col(db.session.query(up(PutSale.underlying_asset)).filter(PutSale.user_id.in_(uids)))
+    assets |= unds
+    return assets, opts, unds
+
+
+def _do_oplab_global_update(users, budget_secs: float = 40.0):
+    """Refresh OpLab de vários usuários de uma vez, sem repetir tickers.
+
+    users: [(user_id, token)]. Junta os tickers de todos, descarta os que já
+    estão na tabela quote há menos de _QUOTE_FRESH_SECS (outro usuário acabou
+    de buscá-los), busca o resto UMA vez com o primeiro token que a OpLab
+    aceitar e grava em quote — uma linha por ticker, que as colunas de preço
+    da carteira de todos leem (ver models._quoted). Só o delta das opções,
+    que não vem da tabela quote, vai para a carteira de cada um.
+
+    Retorna (assets_ok, options_ok, n_buscados) — posições com cotação e
+    quantos tickers foram de fato à OpLab."""
+    _t_start = time.monotonic()
+    def _left(reserve=2.0):
+        return max(0.0, budget_secs - (time.monotonic() - _t_start) - reserve)
+
+    uids = sorted({int(u) for u, _t in users})
+    tokens = [t for _u, t in users if t]
+    if not uids or not tokens:
+        return 0, 0, 0
+
+    asset_tks, option_tks, unds = _global_ticker_sets(uids)
+    wanted = asset_tks | option_tks
+    if not wanted:
+        return 0, 0, 0
+
+    fresh = _quote_rows(wanted, max_age=_QUOTE_FRESH_SECS)
+    to_fetch = sorted(wanted - set(fresh))
+
+    prices, variations, oplab_online = {}, {}, True
+    token = tokens[0]
+    if to_fetch:
+        # "Qualquer token válido": se o primeiro for recusado (nada volta e a
+        # OpLab está no ar), tenta o do próximo usuário.
+        for tk_try in dict.fromkeys(tokens[:3]):
+            token = tk_try
+            prices, variations, oplab_online = _oplab_bulk_quotes(to_fetch, _oplab_headers(token))
+            if prices or not oplab_online:
+                break
+        aceitos = _quote_upsert(prices, variations, 'oplab', guard=asset_tks)
+        missing = [tk for tk in option_tks if tk in to_fetch and tk not in prices]
+        if oplab_online and missing and _left() > 1:
+            filled = _oplab_fill_missing(missing, _oplab_headers(token), prices, variations, _left() * 0.5)
+            aceitos |= _quote_upsert({tk: prices[tk] for tk in filled}, variations, 'fallback',
+                                     guard=asset_tks)
+        # O que a guarda de _quote_upsert descartou não chegou a quote: não
+        # conta nem é publicado.
+        prices = {tk: p for tk, p in prices.items() if tk in aceitos}
+
+    deltas = {}
+    if oplab_online and unds and _left() > 1:
+        deltas = _oplab_chain_deltas(unds, token, _left())
+
+    quotes = {tk: (p, variations.get(tk)) for tk, p in prices.items() if p and p > 0}
+    quotes.update({tk: pv for tk, pv in fresh.items() if tk not in quotes})
+
+    U = ','.join(str(u) for u in uids)
+    up = db.func.upper
+    counts = {'asset': 0, 'option': 0}
+    try:
+        a_tks = sorted(tk for tk in quotes if tk in asset_tks)
+        o_tks = sorted(tk for tk in quotes if tk in option_tks)
+        if a_tks:
+            counts['asset'] = Asset.query.filter(Asset.user_id.in_(uids), Asset.type != 'ETF',
+                                                 up(Asset.ticker).in_(a_tks)).count()
+        if o_tks:
+            counts['option'] = Option.query.filter(Option.user_id.in_(uids),
+                                                   up(Option.ticker).in_(o_tks)).count()
+        if deltas:
+            db.session.execute(_sa_text(
+                f'UPDATE "option" SET delta = :d WHERE user_id IN ({U}) AND UPPER(ticker) = :t'),
+                [{'t': tk, 'd': d} for tk, d in deltas.items() if tk in option_tks])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('refresh global: gravação do delta falhou')
+        return 0, 0, len(to_fetch)
+    _quote_publish(quotes, uids)
+
+    _update_intl_underlyings(uids)
+    return counts['asset'], counts['option'], len(to_fetch)
+
+
+def _update_intl_underlyings(uids):
+    """Tastytrade (intl): só o SUBJACENTE, via Yahoo sem .SA, um por ticker
+    para todos os usuários. As pernas de opção não são tocadas."""
+    try:
+        from services import _yf_fast_info as _yfi_intl
+        ops = StructuredOp.query.filter(StructuredOp.user_id.in_(uids),
+                                        StructuredOp.status == 'OPEN',
+                                        StructuredOp.intl == True).all()   # noqa: E712
+        cache = {}
+        for sop in ops:
+            if not sop.underlying_asset:
+                continue
+            t = sop.underlying_asset.strip().upper()
+            if t not in cache:
+                cache[t] = _yfi_intl(t, t)
+            d = cache[t]
+            if d and d.get('price'):
+                sop.underlying_price  = d['price']
+                sop.underlying_change = d.get('change_percent')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
+
+# ── Agendador: um único líder entre os workers ───────────────────────────────
+# O gunicorn sobe N workers e cada um importa o app — antes, cada worker rodava
+# o seu próprio loop com o seu próprio _oplab_last_update em memória, e todos
+# atualizavam os mesmos usuários: N× chamadas à OpLab e N× escritas
+# concorrentes no SQLite. Agora todos os workers ainda sobem a thread, mas só
+# quem detém o lease em scheduler_lease executa; o estado de cada job (próxima
+# execução, última duração/status) fica em scheduler_job, comum a todos e
+# preservado entre restarts. Se o líder morrer, o lease expira e outro assume.
+_SCHED_TICK       = 15          # s — granularidade do loop
+_SCHED_LEASE_SECS = 90          # s — renovado a cada tick e antes de cada job
+_SCHED_RETRY_SECS = 60          # s — OpLab fora do ar: tenta de novo em 1 min
+_SCHED_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def _sched_now():
+    """Hora de Brasília sem tz — mesmo padrão dos last_update gravados."""
+    return now_brt().replace(tzinfo=None)
+
+
+def _sched_try_lead(name='oplab'):
+    """Adquire ou renova o lease `name`. True se este worker é o líder.
+
+    Conexão própria e UPDATE condicional: o SQLite serializa as escritas,
+    então só um worker consegue trocar o holder de um lease vencido."""
+    tbl = SchedulerLease.__table__
+    now = _sched_now()
+    with db.engine.begin() as conn:
+        conn.execute(tbl.insert().prefix_with('OR IGNORE'),
+                     {'name': name, 'holder': _SCHED_ID, 'acquired_at': now, 'expires_at': now})
+        res = conn.execute(
+            tbl.update()
+            .where(tbl.c.name == name)
+            .where((tbl.c.holder == _SCHED_ID) | (tbl.c.expires_at <= now))
+            .values(holder=_SCHED_ID,
+                    acquired_at=_sa_case((tbl.c.holder == _SCHED_ID, tbl.c.acquired_at), else_=now),
+                    expires_at=now + timedelta(seconds=_SCHED_LEASE_SECS)))
+        return res.rowcount == 1
+
+
+def _sched_job(job, uid):
+    row = db.session.get(SchedulerJob, (job, uid))
+    if row is None:
+        row = SchedulerJob(job=job, user_id=uid)
+        db.session.add(row)
+    return row
+
+
+def _sched_phase(uid, period_secs):
+    """Deslocamento fixo do usuário dentro do intervalo. Espalha os jobs em
+    vez de disparar todos os usuários no mesmo tick."""
+    return ((uid * 2654435761) % 4294967296) / 4294967296 * period_secs
+
+
+def _sched_record(job, uid, started, duration, status, period_secs=None):
+    """Grava o resultado de uma execução e agenda a próxima mantendo a fase
+    do usuário (next = agendado + k·intervalo, o primeiro no futuro)."""
+    row = _sched_job(job, uid)
+    row.last_run_at   = started
+    row.last_duration = round(duration, 2)
+    row.last_status   = (status or '')[:200]
+    if period_secs:
+        base = row.next_run_at or started
+        now  = _sched_now()
+        steps = max(1, math.ceil((now - base).total_seconds() / period_secs))
+        row.next_run_at = base + timedelta(seconds=steps * period_secs)
+    db.session.commit()
 
 
 def _daily_snapshot_sweep(now):
@@ -15986,40 +15689,246 @@ def _daily_snapshot_sweep(now):
     cada usuário com ativos — cobre quem não abriu o Resumo nem atualizou cotações."""
     if now.weekday() >= 5 or now.hour < 17:
         return
-    today_iso = now.date().isoformat()
+    today = now.date()
     uids = [row[0] for row in db.session.query(Asset.user_id)
             .filter(Asset.quantity > 0).distinct().all()]
     for uid in uids:
-        if _snapshot_last_day.get(uid) == today_iso:
+        st = db.session.get(SchedulerJob, ('snapshot', uid))
+        if st and st.last_run_at and st.last_run_at.date() == today:
             continue
+        if not _sched_try_lead():
+            return
+        t0 = time.time()
+        started = _sched_now()
         record_portfolio_snapshot(uid)
-        _snapshot_last_day[uid] = today_iso
+        _sched_record('snapshot', uid, started, time.time() - t0, 'ok')
+
+
+# ── Pré-aquecimento dos gráficos e da VI histórica ───────────────────────────
+# /api/chart_data e /api/vol_hist só buscavam o que faltava na primeira
+# abertura do dia, com o usuário esperando a ida ao Yahoo/OpLab (0,5–5 s). Depois
+# do fechamento, o líder passa pelos papéis que cada usuário acompanha e traz
+# candles e VI até o pregão que acabou de fechar; no dia seguinte as aberturas
+# leem só do banco (ver _ultimo_pregao_fechado e _vol_hist_warm).
+_PREWARM_CHUNK       = 20   # tickers de candle por rodada — o lease é renovado entre rodadas
+_PREWARM_VOL_WORKERS = 3    # atualizações de VI simultâneas (cada uma já paraleliza os blocos)
+
+
+def _prewarm_tickers(uid):
+    """(candles, vi) — conjuntos de tickers do usuário. Candles para tudo que
+    tem gráfico; VI só para papéis em que se operam opções (subjacentes das
+    opções em aberto, Estudos de ações e Ranking) — FII/ETF da carteira sem
+    opções custariam, toda noite, a busca de 12 meses vazia na OpLab."""
+    def _tk(col, *filtros):
+        return {(r[0] or '').upper().strip()
+                for r in db.session.query(col).filter(*filtros).distinct()} - {''}
+    vi = (_tk(Option.underlying_asset, Option.user_id == uid,
+              Option.expiration_date >= now_brt().date())
+          | _tk(StudyStock.ticker, StudyStock.user_id == uid)
+          | _tk(RankingVol.ticker, RankingVol.user_id == uid))
+    candles = (vi
+               | _tk(Asset.ticker, Asset.user_id == uid, Asset.quantity > 0)
+               | _tk(StudyIntlStock.ticker, StudyIntlStock.user_id == uid))
+    return candles, vi
+
+
+def _prewarm_candles(tickers):
+    """Traz a tabela candle dos tickers até hoje: o Yahoo é consultado em
+    paralelo no pool de services (limite de conexões por host), e a gravação
+    fica nesta thread, em série. Devolve quantos receberam candles, ou None
+    se o lease foi perdido no meio."""
+    n = 0
+    for i in range(0, len(tickers), _PREWARM_CHUNK):
+        if not _sched_try_lead():
+            return None
+        lote = {tk: _candles_load(tk) for tk in tickers[i:i + _PREWARM_CHUNK]}
+
+        def _busca(tk):
+            s = lote[tk]
+            # Sempre a partir de 3 dias antes do último candle: o do dia pode
+            # ter sido gravado com o pregão aberto e precisa ser reescrito.
+            ini = (date.fromisoformat(s.last_date) - timedelta(days=3)).isoformat() if len(s) else None
+            return _yahoo_fetch(tk + '.SA' if _is_b3_yahoo_ticker(tk) else tk, start_date=ini)
+
+        for tk, rows in fetch_many(_busca, list(lote)).items():
+            if not rows:
+                continue
+            try:
+                _candles_merge(tk, lote[tk], rows)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('prewarm: candles de %s falharam', tk)
+                continue
+            _chart_mem.pop(tk, None)
+            n += 1
+    return n
+
+
+def _prewarm_vol(tickers, token):
+    """Atualiza vol_hist_day dos tickers que ainda não foram buscados depois
+    do último fechamento, `_PREWARM_VOL_WORKERS` por vez. Cada thread abre o
+    seu app_context (sessão própria). Devolve quantos foram atualizados, ou
+    None se o lease foi perdido no meio."""
+    from models import VolHistState
+    from concurrent.futures import ThreadPoolExecutor
+    estados = {s.ticker: s for s in VolHistState.query.filter(VolHistState.ticker.in_(tickers))}
+    pend = [tk for tk in tickers
+            if not (tk in estados and estados[tk].algo == _VOL_HIST_ALGO and _vol_hist_warm(estados[tk]))]
+
+    def _um(tk):
+        with app.app_context():
+            try:
+                _vol_hist_update(tk, token)
+                return 1
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning('prewarm: VI de %s falhou: %s', tk, e)
+                return 0
+
+    n, passo = 0, _PREWARM_VOL_WORKERS * 2
+    for i in range(0, len(pend), passo):
+        if not _sched_try_lead():
+            return None
+        with ThreadPoolExecutor(max_workers=_PREWARM_VOL_WORKERS) as ex:
+            n += sum(ex.map(_um, pend[i:i + passo]))
+    return n
+
+
+def _prewarm_sweep(now):
+    """1×/dia útil, depois do fechamento: gráficos e VI de cada usuário. A VI
+    usa o token OpLab do próprio usuário (sem token, só os candles). Ticker
+    acompanhado por vários usuários é buscado uma vez: os candles, pelo
+    conjunto `feitos` desta passada; a VI, por _vol_hist_warm."""
+    if now.weekday() >= 5 or (now.hour, now.minute) < _PREGAO_FECHADO_AS:
+        return
+    today = now.date()
+    uids = set()
+    for col, *filtros in ((Asset.user_id, Asset.quantity > 0),
+                          (Option.user_id, Option.expiration_date >= today),
+                          (StudyStock.user_id,), (StudyIntlStock.user_id,), (RankingVol.user_id,)):
+        uids.update(r[0] for r in db.session.query(col).filter(*filtros).distinct())
+    Settings.prefetch(uids)
+    feitos = set()
+    for uid in sorted(uids):
+        st = db.session.get(SchedulerJob, ('prewarm', uid))
+        if st and st.last_run_at and st.last_run_at.date() == today:
+            continue
+        if not _sched_try_lead():
+            return
+        t0 = time.time()
+        started = _sched_now()
+        candles, vi = _prewarm_tickers(uid)
+        n_c = _prewarm_candles(sorted(candles - feitos))
+        if n_c is None:
+            return
+        feitos |= candles
+        token = Settings.get_value('oplab_token', user_id=uid)
+        n_v = _prewarm_vol(sorted(vi), token) if token and vi else 0
+        if n_v is None:
+            return
+        _sched_record('prewarm', uid, started, time.time() - t0,
+                      f'ok: {n_c} gráfico(s), {n_v} VI' + ('' if token else ' (sem token OpLab)'))
+
+
+def _oplab_due_jobs(now):
+    """[(next_run_at, uid, token, intervalo_s)] dos usuários com auto-update
+    vencido. Usuário novo entra na fila com a sua fase dentro do intervalo."""
+    due = []
+    rows = Settings.query.filter_by(key='oplab_auto_update', value='true').all()
+    Settings.prefetch([s.user_id for s in rows])      # todos os usuários numa leitura só
+    for s in rows:
+        uid   = s.user_id
+        token = Settings.get_value('oplab_token', user_id=uid)
+        if not token:
+            continue
+        period = max(1, Settings.get_int('oplab_interval', uid, 5)) * 60
+        st = _sched_job('oplab', uid)
+        if st.next_run_at is None:
+            st.next_run_at = now + timedelta(seconds=_sched_phase(uid, period))
+        elif st.last_run_at and st.next_run_at > st.last_run_at + timedelta(seconds=period):
+            st.next_run_at = st.last_run_at + timedelta(seconds=period)   # intervalo foi reduzido
+        if st.next_run_at <= now:
+            due.append((st.next_run_at, uid, token, period))
+    db.session.commit()
+    due.sort()
+    return due
 
 
 def _oplab_scheduler_loop():
-    """Daemon thread: checks every 30 s which users need an OpLab refresh."""
+    """Daemon thread: a cada tick, se for o líder, roda os jobs vencidos."""
     while True:
-        time.sleep(30)
+        time.sleep(_SCHED_TICK)
         with app.app_context():
             try:
+                if not _sched_try_lead():
+                    continue
                 now = now_brt()
                 _daily_snapshot_sweep(now)
-                rows = Settings.query.filter_by(key='oplab_auto_update', value='true').all()
-                for s in rows:
-                    uid   = s.user_id
-                    token = Settings.get_value('oplab_token', user_id=uid)
-                    if not token:
-                        continue
-                    interval_min = int(Settings.get_value('oplab_interval', user_id=uid, default='5'))
-                    last = _oplab_last_update.get(uid)
-                    if last and (now - last).total_seconds() < interval_min * 60:
-                        continue
-                    if not _oplab_is_available(token, timeout=4):
-                        continue   # OpLab fora do ar — tenta no próximo ciclo
-                    _do_oplab_bulk_update_safe(uid, token, deadline_secs=30)
-                    _oplab_last_update[uid] = now
+                _prewarm_sweep(now.replace(tzinfo=None))
+                due = _oplab_due_jobs(_sched_now())
+                if not due or not _sched_try_lead():
+                    continue
+                # Todos os usuários vencidos no tick vão num único refresh
+                # global: cada ticker é buscado uma vez só (ver
+                # _do_oplab_global_update), não uma vez por usuário.
+                started, t0 = _sched_now(), time.time()
+                if not _oplab_is_available(due[0][2], timeout=4):
+                    # OpLab fora do ar — não conta como execução, só adia
+                    for _next, uid, _token, _period in due:
+                        st = _sched_job('oplab', uid)
+                        st.last_status = 'offline'
+                        st.next_run_at = started + timedelta(seconds=_SCHED_RETRY_SECS)
+                    db.session.commit()
+                    continue
+                status = 'ok'
+                try:
+                    a_ok, o_ok, n_fetch = _do_oplab_global_update(
+                        [(uid, token) for _n, uid, token, _p in due], budget_secs=40)
+                    app.logger.info('scheduler: refresh global de %d usuário(s): %d tickers buscados, '
+                                    '%d ativos / %d opções atualizados', len(due), n_fetch, a_ok, o_ok)
+                except Exception as e:
+                    db.session.rollback()
+                    status = f'erro: {e}'
+                elapsed = time.time() - t0
+                for _next, uid, _token, period in due:
+                    _sched_record('oplab', uid, started, elapsed, status, period)
             except Exception:
-                pass
+                db.session.rollback()
+                app.logger.exception('scheduler: tick falhou')
+
+
+def _fmt_sched_dt(d):
+    return d.isoformat(timespec='seconds') if d else None
+
+
+@app.route('/api/scheduler/status')
+@login_required
+def api_scheduler_status():
+    """Líder atual e, por usuário, próxima execução e duração da última.
+    Usuário comum vê só os seus jobs; admin vê todos."""
+    lease = db.session.get(SchedulerLease, 'oplab')
+    q = db.session.query(SchedulerJob, User.username).join(User, User.id == SchedulerJob.user_id)
+    if not current_user.is_admin:
+        q = q.filter(SchedulerJob.user_id == current_user.id)
+    jobs = [{
+        'job':           j.job,
+        'user_id':       j.user_id,
+        'username':      uname,
+        'next_run':      _fmt_sched_dt(j.next_run_at),
+        'last_run':      _fmt_sched_dt(j.last_run_at),
+        'last_duration': j.last_duration,
+        'last_status':   j.last_status,
+    } for j, uname in q.order_by(SchedulerJob.job, SchedulerJob.next_run_at).all()]
+    return jsonify({
+        'now': _fmt_sched_dt(_sched_now()),
+        'leader': {
+            'holder':      lease.holder if lease else None,
+            'since':       _fmt_sched_dt(lease.acquired_at) if lease else None,
+            'expires_at':  _fmt_sched_dt(lease.expires_at) if lease else None,
+            'this_worker': bool(lease and lease.holder == _SCHED_ID),
+        },
+        'jobs': jobs,
+    })
 
 
 # Start the scheduler once (guarded so it doesn't spawn in import-time checks)
@@ -16033,6 +15942,10 @@ def _start_oplab_scheduler():
         t.start()
 
 
+# Blueprints — importados por último: usam helpers definidos acima
+app.register_blueprint(estudos.bp)
+
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
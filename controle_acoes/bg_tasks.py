@@ -0,0 +1,116 @@
+"""
+bg_tasks.py — pool das tarefas em segundo plano
+================================================
+Atualizar cotações, importar o extrato da B3, atualizar o Ranking de
+Volatilidade e os dividendos rodam fora do request, num pool limitado deste
+worker. O estado fica em bg_task (task_store.py), visível de qualquer worker;
+`wait` é o long-poll de /api/update_progress sobre a versão da tarefa: _cond
+acorda na hora quem espera neste processo, e quem espera em outro worker relê
+o banco a cada 0,5 s.
+"""
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from flask import current_app
+
+from models import db
+import task_store
+
+WORKERS  = 4
+TTL      = timedelta(hours=6)     # terminada: some do banco depois disso
+STALE    = timedelta(minutes=30)  # sem gravação há tanto tempo: worker morreu
+WAIT_MAX = 20                     # s — teto do long-poll (timeout do gunicorn: 300 s)
+
+_BRT = ZoneInfo('America/Sao_Paulo')
+_pool = None
+_pool_lock = threading.Lock()
+_cond = threading.Condition()
+
+
+def _now():
+    return datetime.now(_BRT).replace(tzinfo=None)
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='task')
+    return _pool
+
+
+def set_task(task_id, data):
+    """Atualiza a tarefa com as chaves de `data` (status, progress, msg,
+    category, result) e acorda os long-polls deste processo."""
+    with db.engine.begin() as conn:
+        task_store.update(conn, task_id, _now(), **data)
+    with _cond:
+        _cond.notify_all()
+
+
+def get_task(task_id, user_id=None):
+    """Estado da tarefa para a tela. Tarefa de outro usuário = não encontrada."""
+    with db.engine.connect() as conn:
+        t = task_store.get(conn, task_id)
+    if t is None or (user_id is not None and t['user_id'] != user_id):
+        return {'status': 'not_found', 'msg': '', 'category': ''}
+    fim = t['finished_at'] or _now()
+    return {
+        'status':   t['status'],
+        'progress': t['progress'],
+        'msg':      t['msg'] or '',
+        'category': t['category'] or '',
+        'result':   t['result'],
+        'version':  t['version'],
+        'elapsed':  round((fim - t['started_at']).total_seconds(), 1) if t['started_at'] else None,
+    }
+
+
+def wait(task_id, user_id, since, secs):
+    """get_task, mas segura a resposta por até `secs` (teto WAIT_MAX) enquanto
+    a tarefa segue na versão `since`. since=None não espera."""
+    deadline = time.time() + min(max(secs, 0), WAIT_MAX)
+    t = get_task(task_id, user_id)
+    while (since is not None and t['status'] in ('queued', 'running')
+           and t['version'] == since and time.time() < deadline):
+        with _cond:
+            _cond.wait(timeout=min(0.5, max(0.0, deadline - time.time())))
+        t = get_task(task_id, user_id)
+    return t
+
+
+def submit(kind, user_id, fn, msg=''):
+    """Registra a tarefa e a põe na fila do pool; devolve o task_id.
+
+    fn(task_id) roda com app_context e devolve {'msg', 'category', 'result'}
+    (todos opcionais); pode reportar progresso com set_task no meio. Exceção
+    não tratada vira status done / category danger. Chamado dentro de um
+    app_context (request ou thread do scheduler)."""
+    app = current_app._get_current_object()
+    task_id = str(uuid.uuid4())
+    now = _now()
+    with db.engine.begin() as conn:
+        task_store.create(conn, task_id, kind, user_id, now, msg)
+        task_store.cleanup(conn, now, TTL, STALE)
+
+    def _run():
+        with app.app_context():
+            try:
+                set_task(task_id, {'status': 'running'})
+                out = fn(task_id) or {}
+                set_task(task_id, {'status': 'done', 'progress': 100,
+                                   'msg': out.get('msg') or 'Concluído.',
+                                   'category': out.get('category') or 'success',
+                                   'result': out.get('result')})
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception('tarefa %s (%s) falhou', kind, task_id)
+                set_task(task_id, {'status': 'done', 'msg': f'Erro: {e}', 'category': 'danger'})
+
+    _executor().submit(_run)
+    return task_id
@@ -0,0 +1,103 @@
+"""
+candle_store.py — candles diários (OHLCV) por ticker, uma linha por pregão
+===========================================================================
+A tabela candle guarda uma linha por (ticker, data), já saneada; o refresh
+incremental só grava os dias novos. CandleSeries carrega a série em arrays
+NumPy (datas ISO como strings, que ordenam igual às datas): `since=` é um
+searchsorted e os fechamentos da volatilidade são uma view de `c`.
+"""
+import numpy as np
+from sqlalchemy import text
+
+_COLS = ('o', 'h', 'l', 'c')
+
+
+class CandleSeries:
+    """Série OHLCV ordenada por data. Os arrays não devem ser alterados —
+    a mesma instância é compartilhada pelo cache em memória do app."""
+
+    __slots__ = ('ticker', 't', 'o', 'h', 'l', 'c', 'v')
+
+    def __init__(self, ticker, t, o, h, l, c, v):
+        self.ticker = ticker
+        self.t = t
+        self.o, self.h, self.l, self.c, self.v = o, h, l, c, v
+
+    @classmethod
+    def from_rows(cls, ticker, rows):
+        """rows: sequência de (t, o, h, l, c, v) já ordenada por t."""
+        rows = list(rows)
+        if not rows:
+            return cls.empty(ticker)
+        t, o, h, l, c, v = zip(*rows)
+        return cls(ticker, np.array(t, dtype='U10'),
+                   np.array(o, dtype=float), np.array(h, dtype=float),
+                   np.array(l, dtype=float), np.array(c, dtype=float),
+                   np.array([int(x or 0) for x in v], dtype=np.int64))
+
+    @classmethod
+    def from_dicts(cls, ticker, candles):
+        """Candles no formato da API ({'t','o','h','l','c','v'}), em qualquer ordem."""
+        rows = sorted((d['t'], d['o'], d['h'], d['l'], d['c'], d.get('v') or 0) for d in candles)
+        return cls.from_rows(ticker, rows)
+
+    @classmethod
+    def empty(cls, ticker):
+        f = np.empty(0, dtype=float)
+        return cls(ticker, np.empty(0, dtype='U10'), f, f, f, f, np.empty(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def last_date(self):
+        return str(self.t[-1]) if len(self.t) else None
+
+    def index_after(self, since):
+        """Posição do primeiro candle com data > since (since=None → 0)."""
+        return int(np.searchsorted(self.t, since, side='right')) if since else 0
+
+    def closes(self, since=None):
+        """Fechamentos a partir de `since` (exclusive) — view, sem cópia."""
+        return self.c[self.index_after(since):]
+
+    def to_dicts(self, since=None, tail=None):
+        """Lista de dicts para o JSON, só do trecho pedido: candles depois de
+        `since` e, no máximo, os `tail` últimos."""
+        i = self.index_after(since)
+        if tail is not None:
+            i = max(i, len(self.t) - tail)
+        t, o, h, l, c, v = (a[i:].tolist() for a in (self.t, self.o, self.h, self.l, self.c, self.v))
+        return [{'t': t[k], 'o': o[k], 'h': h[k], 'l': l[k], 'c': c[k], 'v': v[k]}
+                for k in range(len(t))]
+
+    def merged(self, candles):
+        """Nova série com `candles` (dicts) sobrepondo as datas iguais — o
+        candle do dia ainda em formação é substituído, não duplicado."""
+        if not candles:
+            return self
+        novos = {d['t'] for d in candles}
+        keep = ~np.isin(self.t, list(novos))
+        rows = list(zip(self.t[keep].tolist(), self.o[keep].tolist(), self.h[keep].tolist(),
+                        self.l[keep].tolist(), self.c[keep].tolist(), self.v[keep].tolist()))
+        rows += [(d['t'], d['o'], d['h'], d['l'], d['c'], d.get('v') or 0) for d in candles]
+        rows.sort(key=lambda r: r[0])
+        return CandleSeries.from_rows(self.ticker, rows)
+
+
+def load(conn, ticker):
+    """Série inteira do ticker. `conn`: conexão ou sessão SQLAlchemy."""
+    rows = conn.execute(text('SELECT d, o, h, l, c, v FROM candle WHERE ticker = :t ORDER BY d'),
+                        {'t': ticker}).fetchall()
+    return CandleSeries.from_rows(ticker, rows)
+
+
+def upsert(conn, ticker, candles):
+    """Grava (ou substitui) os candles informados. Não faz commit."""
+    if not candles:
+        return 0
+    conn.execute(text('INSERT OR REPLACE INTO candle (ticker, d, o, h, l, c, v) '
+                      'VALUES (:ticker, :t, :o, :h, :l, :c, :v)'),
+                 [{'ticker': ticker, 't': d['t'], 'o': d['o'], 'h': d['h'], 'l': d['l'],
+                   'c': d['c'], 'v': int(d.get('v') or 0)} for d in candles])
+    return len(candles)
@@ -33,7 +33,7 @@ a = Analysis(
     ),
     hiddenimports=(
         # App local
-        ['app', 'models', 'services', 'mt5_live']
+        ['app', 'models', 'services', 'mt5_live', 'pricing']
         +
         # Flask ecosystem
         ['flask', 'flask_login', 'flask_sqlalchemy',
@@ -0,0 +1,55 @@
+"""
+dividend_history.py — proventos por ticker, comuns a todos os usuários
+======================================================================
+dividend_history guarda o valor por ação de cada (ticker, data-com) e
+dividend_history_state a última data-com conhecida e quando o ticker foi
+consultado — o Yahoo só é chamado para o que passou dessa data, e não de
+novo para um ticker consultado há pouco por qualquer usuário.
+O download fica no app (services.yahoo_dividends); aqui é só o armazenamento.
+"""
+from datetime import datetime
+
+from sqlalchemy import bindparam, text
+
+
+def state(conn, tickers):
+    """{ticker: (última data-com ISO ou None, fetched_at)} dos já consultados."""
+    if not tickers:
+        return {}
+    rows = conn.execute(text('SELECT ticker, last_ex, fetched_at FROM dividend_history_state '
+                             'WHERE ticker IN :t').bindparams(bindparam('t', expanding=True)),
+                        {'t': sorted(set(tickers))}).fetchall()
+    # SQL cru no SQLite devolve DATETIME como texto ISO
+    return {tk: (last, datetime.fromisoformat(f) if isinstance(f, str) else f)
+            for tk, last, f in rows}
+
+
+def save(conn, divs, now):
+    """Grava {ticker: {data_iso: valor_por_ação}} (substitui datas repetidas)
+    e registra a consulta de cada ticker — inclusive os sem provento novo.
+    Não faz commit."""
+    rows = [{'t': tk, 'd': d, 'v': float(v)} for tk, serie in divs.items() for d, v in serie.items()]
+    if rows:
+        conn.execute(text('INSERT OR REPLACE INTO dividend_history (ticker, ex_date, per_share) '
+                          'VALUES (:t, :d, :v)'), rows)
+    if divs:
+        conn.execute(text(
+            'INSERT OR REPLACE INTO dividend_history_state (ticker, last_ex, fetched_at) '
+            'VALUES (:t, (SELECT MAX(ex_date) FROM dividend_history WHERE ticker = :t), :now)'),
+            [{'t': tk, 'now': now} for tk in divs])
+    return len(rows)
+
+
+def load(conn, tickers, since=None):
+    """{ticker: [(data_iso, valor_por_ação), ...]} em ordem de data, a partir
+    de `since` (ISO, inclusive)."""
+    out = {}
+    if not tickers:
+        return out
+    rows = conn.execute(text('SELECT ticker, ex_date, per_share FROM dividend_history '
+                             'WHERE ticker IN :t AND ex_date >= :s ORDER BY ticker, ex_date')
+                        .bindparams(bindparam('t', expanding=True)),
+                        {'t': sorted(set(tickers)), 's': since or ''})
+    for tk, d, v in rows:
+        out.setdefault(tk, []).append((d, v))
+    return out
@@ -0,0 +1,996 @@
+"""
+estudos.py — Estudos e Ranking de Volatilidade (blueprint)
+===========================================================
+Telas de estudos (/estudos, notas, estratégias, opções/ações em estudo) e o
+Ranking de Volatilidade. Os endpoints são 'estudos.<nome>' (ex.:
+url_for('estudos.ranking_volatilidade')); as URLs são as de sempre. O filtro
+da lista com liquidez (ranking_liq_filter) também é usado pelas telas de
+operações do app.py. O que é pesado (yfinance via services,
+ThreadPoolExecutor) é importado dentro das funções, no primeiro uso.
+"""
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
+
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import login_required, current_user
+
+from models import (db, Asset, Settings, Option, StructuredOp, StudyOption, StudyStock, StudyIntlStock,
+                    StudyStrategy, RankingVol, QuoteUser)
+import vol_hist_store
+from bg_tasks import submit as _submit_task
+from oplab_client import OplabApiError, get_json as _oplab_get_json
+from services import fetch_many
+
+bp = Blueprint('estudos', __name__)
+_BRT = ZoneInfo('America/Sao_Paulo')
+
+# Estratégias de estudo agrupadas por CENÁRIO (direção do mercado + volatilidade),
+# com base no guia de operações. Cada grupo vira um <optgroup> no seletor para
+# orientar a escolha. O rótulo do grupo traz a dica de quando usar.
+STUDY_STRATEGY_GROUPS = [
+    ('📈 Alta — Vol. baixa (comprar prêmio)', [
+        'Compra de Call', 'Trava de Alta com Call', 'Call Backspread',
+        'Ratio Call', 'Risk Reversal', 'Seagull de Alta',
+    ]),
+    ('📈 Alta — Vol. alta (vender prêmio)', [
+        'Venda de Put', 'Trava de Alta com Put', 'Jade Lizard',
+    ]),
+    ('📉 Baixa — Vol. baixa (comprar prêmio)', [
+        'Compra de Put', 'Trava de Baixa com Put', 'Put Backspread', 'Seagull de Baixa',
+    ]),
+    ('📉 Baixa — Vol. alta (vender prêmio)', [
+        'Trava de Baixa com Call',
+    ]),
+    ('➡️ Lateral — Vol. alta (vender prêmio)', [
+        'Venda de Call Coberta', 'Strangle Vendido', 'Straddle Vendido',
+        'Iron Condor', 'Iron Butterfly', 'Borboleta', 'Condor',
+        'Boi', 'Vaca', 'Ratio Spread',
+    ]),
+    ('➡️ Lateral — Vol. baixa / renda', [
+        'Collar', 'Fence', 'Calendar Spread', 'Diagonal Spread',
+    ]),
+    ('⚡ Volatilidade (movimento forte em qualquer direção)', [
+        'Compra de Call', 'Compra de Put', 'Straddle Comprado', 'Strangle Comprado',
+        'Strap', 'Strip', 'Guts',
+    ]),
+    ('🧬 Outras', [
+        'Ação Sintética', 'Short Sintético', 'Box Spread', 'Outros', 'ne',
+    ]),
+]
+
+# Lista plana (compatível com valores já salvos), sem duplicatas, preservando ordem.
+STUDY_STRATEGIES = []
+for _grp, _items in STUDY_STRATEGY_GROUPS:
+    for _s in _items:
+        if _s not in STUDY_STRATEGIES:
+            STUDY_STRATEGIES.append(_s)
+
+# Mapeamento dos valores da planilha para os do programa
+_STRATEGY_MAP = {
+    'venda coberta':          'Venda de Call Coberta',
+    'venda de call coberta':  'Venda de Call Coberta',
+    'venda de call':          'Venda de Call Coberta',
+    'venda put':              'Venda de Put',
+    'venda de put':           'Venda de Put',
+    'compra de put':          'Compra de Put',
+    'compra put':             'Compra de Put',
+    'trava de alta':          'Trava de Alta com Call',
+    'trava de alta com call': 'Trava de Alta com Call',
+    'trava de alta com put':  'Trava de Alta com Put',
+    'trava de baixa':         'Trava de Baixa com Call',
+    'trava de baixa com call':'Trava de Baixa com Call',
+    'trava de baixa com put': 'Trava de Baixa com Put',
+    'strangle vendido':       'Strangle Vendido',
+    'strangle':               'Strangle Vendido',
+    'borboleta':              'Borboleta',
+    'iron condor':            'Iron Condor',
+    'compra call':            'Compra de Call',
+    'compra de call':         'Compra de Call',
+    'boi':                    'Boi',
+    'vaca':                   'Vaca',
+    'outros':                 'Outros',
+    'ne':                     'ne',
+}
+
+def _normalize_strategy(value):
+    """Converte valor da planilha para a lista do programa."""
+    if not value:
+        return None
+    normalized = _STRATEGY_MAP.get(str(value).strip().lower())
+    if normalized:
+        return normalized
+    # se já é um valor válido da lista, devolve como está
+    if value in STUDY_STRATEGIES:
+        return value
+    return 'Outros'
+
+
+def ranking_liq_filter(query):
+    """Filtra apenas a lista 'Com liquidez' (linhas antigas têm grupo NULL)."""
+    return query.filter(db.or_(RankingVol.grupo == 'LIQ', RankingVol.grupo.is_(None)))
+
+
+def _calc_vdx(option_price, underlying_price, days, strike):
+    """VDX = taxa * tempo * espaço"""
+    try:
+        if not all([option_price, underlying_price, days is not None, strike]):
+            return None
+        taxa   = option_price / underlying_price
+        tempo  = 120 - days
+        espaco = strike - underlying_price
+        return taxa * tempo * espaco
+    except (TypeError, ZeroDivisionError):
+        return None
+
+
+def _calc_nv(ve, delta, gama):
+    """NV = VE - delta - gama"""
+    if ve is None or delta is None or gama is None:
+        return None
+    return ve - delta - gama
+
+
+def _roll_flag(days, spot, strike):
+    """Aviso de possível necessidade de rolagem (teoria do Bastter):
+    na venda coberta, quando a call está ITM perto do vencimento o VE se
+    esgota e o exercício fica provável — hora de avaliar a rolagem.
+    ALERT = ITM e vence em <= 7 dias (rolagem provável)
+    WARN  = ITM e vence em <= 21 dias, ou <= 7 dias mesmo OTM (atenção)"""
+    if days is None or not spot or not strike:
+        return None
+    itm = spot > strike
+    if days <= 7:
+        return 'ALERT' if itm else 'WARN'
+    if days <= 21 and itm:
+        return 'WARN'
+    return None
+
+
+@bp.route('/estudos')
+@login_required
+def estudos():
+    uid = current_user.id
+    today = date.today()
+
+    # ── Tabela 1: Estudo Opções Cobertas ────────────────────────────
+    # A) Opções VENDA_CALL lançadas na página /opcoes
+    venda_calls = Option.query.filter_by(user_id=uid, option_type='VENDA_CALL').all()
+    vc_underlying = {opt.underlying_asset.upper() for opt in venda_calls}
+    assets_map = {
+        a.ticker.upper(): a
+        for a in Asset.query.filter_by(user_id=uid).all()
+    }
+    study_calls_vc = []
+    for opt in venda_calls:
+        asset = assets_map.get(opt.underlying_asset.upper())
+        up = asset.current_price if asset else 0
+        days = (opt.expiration_date - today).days if opt.expiration_date else None
+        vdx = _calc_vdx(opt.current_option_price, up, days, opt.strike_price)
+        nv  = _calc_nv(opt.ve, opt.delta, opt.gama)
+        study_calls_vc.append({
+            'source': 'venda_call',
+            'id': opt.id,
+            'ticker': opt.ticker,
+            'underlying': opt.underlying_asset,
+            'underlying_price': up,
+            'avg_price': asset.avg_price if asset else 0,
+            'strike': opt.strike_price,
+            'expiration': opt.expiration_date,
+            'days': days,
+            'option_price': opt.current_option_price,
+            've': opt.ve,
+            'delta': opt.delta,
+            'gama': opt.gama,
+            'vdx': vdx,
+            'nv': nv,
+            'roll_flag': _roll_flag(days, up, opt.strike_price),
+        })
+
+    # B) Opções extras adicionadas diretamente nesta página
+    study_calls_extra = []
+    for so in StudyOption.query.filter_by(user_id=uid).all():
+        days = (so.expiration_date - today).days if so.expiration_date else None
+        vdx = _calc_vdx(so.option_price, so.underlying_price, days, so.strike)
+        nv  = _calc_nv(so.ve, so.delta, so.gama)
+        study_calls_extra.append({
+            'source': 'study',
+            'id': so.id,
+            'ticker': so.ticker,
+            'underlying': so.underlying_asset,
+            'underlying_price': so.underlying_price,
+            'avg_price': so.avg_price_stock,
+            'strike': so.strike,
+            'expiration': so.expiration_date,
+            'days': days,
+            'option_price': so.option_price,
+            've': so.ve,
+            'delta': so.delta,
+            'gama': so.gama,
+            'vdx': vdx,
+            'nv': nv,
+            'roll_flag': _roll_flag(days, so.underlying_price, so.strike),
+        })
+
+    # ── Tabela 2: Estudo Ações ───────────────────────────────────────
+    study_stocks = StudyStock.query.filter_by(user_id=uid).order_by(StudyStock.ticker).all()
+    study_intl_stocks = StudyIntlStock.query.filter_by(user_id=uid).order_by(StudyIntlStock.ticker).all()
+
+    # Estratégias ativas por papel (várias por ticker — tabela study_strategy)
+    strategies_by_ticker = {}
+    for st in (StudyStrategy.query.filter_by(user_id=uid)
+               .order_by(StudyStrategy.ticker, StudyStrategy.id).all()):
+        strategies_by_ticker.setdefault(st.ticker.upper(), []).append(st)
+
+    # ── Tabela 3: Ações Livres (sem venda coberta ativa nem garantia em estruturada) ──
+    # Ações usadas como garantia em operações estruturadas abertas
+    collateral_tickers = {
+        op.underlying_asset.upper()
+        for op in StructuredOp.query.filter_by(user_id=uid, status='OPEN').all()
+        if op.uses_stock_collateral and op.underlying_asset
+    }
+    all_acoes = [a for a in Asset.query.filter_by(user_id=uid, type='ACAO').all() if a.quantity > 0]
+    free_stocks = [
+        a for a in all_acoes
+        if a.ticker.upper() not in vc_underlying
+        and a.ticker.upper() not in collateral_tickers
+    ]
+    free_stocks.sort(key=lambda a: a.ticker)
+
+    return render_template(
+        'estudos.html',
+        study_calls_vc=study_calls_vc,
+        study_calls_extra=study_calls_extra,
+        study_stocks=study_stocks,
+        study_intl_stocks=study_intl_stocks,
+        strategies_by_ticker=strategies_by_ticker,
+        free_stocks=free_stocks,
+        strategies=STUDY_STRATEGIES,
+        strategy_groups=STUDY_STRATEGY_GROUPS,
+    )
+
+
+# ── Estratégias ativas por papel (tela Estudos) — CRUD JSON ─────────────────
+def _study_strategy_json(st):
+    return {
+        'id': st.id, 'ticker': st.ticker, 'tipo': st.tipo,
+        'qty': st.qty, 'option_ticker': st.option_ticker or '',
+        'valor': st.valor,
+        'venc_curto': st.venc_curto.isoformat() if st.venc_curto else '',
+        'venc_longo': st.venc_longo.isoformat() if st.venc_longo else '',
+        'descricao': st.descricao or '', 'situacao': st.situacao or 'ATIVA',
+    }
+
+
+def _study_strategy_fill(st, data):
+    """Preenche um StudyStrategy a partir do JSON do modal (create/update)."""
+    def _d(k):
+        v = (data.get(k) or '').strip()
+        try:
+            return date.fromisoformat(v) if v else None
+        except ValueError:
+            return None
+    st.tipo = (data.get('tipo') or '').strip()[:60] or 'Outros'
+    try:
+        st.qty = int(data.get('qty')) if str(data.get('qty') or '').strip() else None
+    except (TypeError, ValueError):
+        st.qty = None
+    st.option_ticker = ((data.get('option_ticker') or '').strip().upper()[:20]) or None
+    try:
+        v = str(data.get('valor') or '').replace(',', '.').strip()
+        st.valor = float(v) if v else None
+    except (TypeError, ValueError):
+        st.valor = None
+    st.venc_curto = _d('venc_curto')
+    st.venc_longo = _d('venc_longo')
+    st.descricao = ((data.get('descricao') or '').strip()[:200]) or None
+    if (data.get('situacao') or '').upper() in ('ATIVA', 'DESATIVADA'):
+        st.situacao = data['situacao'].upper()
+
+
+@bp.route('/api/estudo-notas/<ticker>')
+@login_required
+def estudo_notas_get(ticker):
+    """Observações gerais do papel (não de uma estratégia específica) — uma
+    por ticker, compartilhada entre BR e internacional pelo mesmo modelo que
+    já guarda o estudo (StudyStock/StudyIntlStock)."""
+    ticker = ticker.strip().upper()
+    row = (StudyStock.query.filter_by(user_id=current_user.id, ticker=ticker).first()
+           or StudyIntlStock.query.filter_by(user_id=current_user.id, ticker=ticker).first())
+    return jsonify({'notes': (row.notes if row else '') or ''})
+
+
+@bp.route('/api/estudo-notas/<ticker>', methods=['POST'])
+@login_required
+def estudo_notas_save(ticker):
+    ticker = ticker.strip().upper()
+    notes = ((request.get_json(silent=True) or {}).get('notes') or '')[:4000]
+    row = (StudyStock.query.filter_by(user_id=current_user.id, ticker=ticker).first()
+           or StudyIntlStock.query.filter_by(user_id=current_user.id, ticker=ticker).first())
+    if not row:
+        # Sem estudo ainda para este papel: não há onde guardar a nota — o
+        # registro de estudo só existe quando o usuário roda a análise da
+        # tela Estudos. Cria um StudyStock mínimo pra não perder a anotação.
+        row = StudyStock(user_id=current_user.id, ticker=ticker)
+        db.session.add(row)
+    row.notes = notes
+    db.session.commit()
+    return jsonify({'ok': True})
+
+
+@bp.route('/api/estudo-strategies/<ticker>')
+@login_required
+def estudo_strategies_list(ticker):
+    sts = (StudyStrategy.query
+           .filter_by(user_id=current_user.id, ticker=ticker.strip().upper())
+           .order_by(StudyStrategy.id).all())
+    return jsonify([_study_strategy_json(s) for s in sts])
+
+
+@bp.route('/api/estudo-strategies', methods=['POST'])
+@login_required
+def estudo_strategies_create():
+    data = request.get_json(silent=True) or {}
+    ticker = (data.get('ticker') or '').strip().upper()
+    if not ticker:
+        return jsonify({'error': 'Ticker obrigatório.'}), 400
+    st = StudyStrategy(user_id=current_user.id, ticker=ticker,
+                       situacao='ATIVA', created_at=datetime.now())
+    _study_strategy_fill(st, data)
+    db.session.add(st)
+    db.session.commit()
+    return jsonify(_study_strategy_json(st))
+
+
+@bp.route('/api/estudo-strategies/<int:sid>/update', methods=['POST'])
+@login_required
+def estudo_strategies_update(sid):
+    st = StudyStrategy.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    _study_strategy_fill(st, request.get_json(silent=True) or {})
+    db.session.commit()
+    return jsonify(_study_strategy_json(st))
+
+
+@bp.route('/api/estudo-strategies/<int:sid>/toggle', methods=['POST'])
+@login_required
+def estudo_strategies_toggle(sid):
+    st = StudyStrategy.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    st.situacao = 'DESATIVADA' if (st.situacao or 'ATIVA') == 'ATIVA' else 'ATIVA'
+    db.session.commit()
+    return jsonify(_study_strategy_json(st))
+
+
+@bp.route('/api/estudo-strategies/<int:sid>/delete', methods=['POST'])
+@login_required
+def estudo_strategies_delete(sid):
+    st = StudyStrategy.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    db.session.delete(st)
+    db.session.commit()
+    return jsonify({'ok': True})
+
+
+@bp.route('/estudos/edit_vc_greeks/<int:opt_id>', methods=['POST'])
+@login_required
+def edit_vc_greeks(opt_id):
+    """Salva VE, Delta e Gama de uma VENDA_CALL na tabela de estudo."""
+    opt = Option.query.filter_by(id=opt_id, user_id=current_user.id, option_type='VENDA_CALL').first_or_404()
+    def _fl(k):
+        v = request.form.get(k, '').strip()
+        return float(v) if v else None
+    opt.ve    = _fl('ve')
+    opt.delta = _fl('delta')
+    opt.gama  = _fl('gama')
+    db.session.commit()
+    flash('VE/Delta/Gama atualizados.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-opcoes')
+
+
+@bp.route('/estudos/add_study_option', methods=['POST'])
+@login_required
+def add_study_option():
+    def _f(k): return request.form.get(k, '').strip()
+    def _fl(k):
+        v = _f(k)
+        return float(v) if v else None
+    def _dt(k):
+        v = _f(k)
+        try:
+            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
+        except ValueError:
+            return None
+
+    so = StudyOption(
+        user_id=current_user.id,
+        ticker=_f('ticker').upper(),
+        underlying_asset=_f('underlying_asset').upper(),
+        underlying_price=_fl('underlying_price'),
+        avg_price_stock=_fl('avg_price_stock'),
+        strike=_fl('strike'),
+        expiration_date=_dt('expiration_date'),
+        option_price=_fl('option_price'),
+        ve=_fl('ve'),
+        delta=_fl('delta'),
+        gama=_fl('gama'),
+    )
+    db.session.add(so)
+    db.session.commit()
+    flash('Opção de estudo adicionada.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-opcoes')
+
+
+@bp.route('/estudos/edit_study_option/<int:sid>', methods=['POST'])
+@login_required
+def edit_study_option(sid):
+    so = StudyOption.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    def _f(k): return request.form.get(k, '').strip()
+    def _fl(k):
+        v = _f(k)
+        return float(v) if v else None
+    def _dt(k):
+        v = _f(k)
+        try:
+            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
+        except ValueError:
+            return None
+
+    # Cotações como o formulário as mostrou — só a que o usuário mudou vira
+    # preço manual (QuoteUser.manual)
+    und_antes, opt_antes = so.underlying_price, so.option_price
+    so.ticker = _f('ticker').upper()
+    so.underlying_asset = _f('underlying_asset').upper()
+    so.underlying_price = _fl('underlying_price')
+    so.avg_price_stock = _fl('avg_price_stock')
+    so.strike = _fl('strike')
+    so.expiration_date = _dt('expiration_date')
+    so.option_price = _fl('option_price')
+    agora = datetime.now(_BRT).replace(tzinfo=None)
+    QuoteUser.manual(current_user.id, so.underlying_asset, und_antes, so._underlying_price, agora)
+    QuoteUser.manual(current_user.id, so.ticker, opt_antes, so._option_price, agora)
+    so.ve    = _fl('ve')
+    so.delta = _fl('delta')
+    so.gama  = _fl('gama')
+    db.session.commit()
+    flash('Opção de estudo atualizada.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-opcoes')
+
+
+@bp.route('/estudos/delete_study_option/<int:sid>', methods=['POST'])
+@login_required
+def delete_study_option(sid):
+    so = StudyOption.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    db.session.delete(so)
+    db.session.commit()
+    flash('Opção de estudo removida.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-opcoes')
+
+
+@bp.route('/estudos/add_study_stock', methods=['POST'])
+@login_required
+def add_study_stock():
+    def _f(k): return request.form.get(k, '').strip()
+    def _fl(k):
+        v = _f(k)
+        return float(v) if v else None
+    def _dt(k):
+        v = _f(k)
+        try:
+            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
+        except ValueError:
+            return None
+
+    ss = StudyStock(
+        user_id=current_user.id,
+        ticker=_f('ticker').upper(),
+        trend=_f('trend') or None,
+        rsi=_fl('rsi'),
+        volatility=_f('volatility') or None,
+        ve=_fl('ve'),
+        strategy=_f('strategy') or None,
+        study_date=_dt('study_date'),
+        strategy_active=_f('strategy_active') or None,
+        entry_date=_dt('entry_date'),
+    )
+    db.session.add(ss)
+    db.session.commit()
+    flash('Ação de estudo adicionada.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-acoes')
+
+
+@bp.route('/estudos/ir-para-estudo/<ticker>')
+@login_required
+def estudo_ir(ticker):
+    """Abre a tela Estudos já na edição da ação. Se ela ainda não estiver na
+    lista de Estudo de Ações, cria um registro em branco e abre a edição.
+    Usado pelo ícone de atalho no Ranking de Volatilidade."""
+    ticker = (ticker or '').strip().upper()
+    if not ticker:
+        return redirect(url_for('.estudos') + '#estudo-acoes')
+    ss = StudyStock.query.filter_by(user_id=current_user.id, ticker=ticker).first()
+    if ss is None:
+        ss = StudyStock(user_id=current_user.id, ticker=ticker)
+        db.session.add(ss)
+        db.session.commit()
+    return redirect(url_for('.estudos', edit_stock=ss.id) + '#estudo-acoes')
+
+
+@bp.route('/estudos/edit_study_stock/<int:sid>', methods=['POST'])
+@login_required
+def edit_study_stock(sid):
+    ss = StudyStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    def _f(k): return request.form.get(k, '').strip()
+    def _fl(k):
+        v = _f(k)
+        return float(v) if v else None
+    def _dt(k):
+        v = _f(k)
+        try:
+            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
+        except ValueError:
+            return None
+
+    ss.ticker = _f('ticker').upper()
+    ss.trend = _f('trend') or None
+    ss.rsi = _fl('rsi')
+    ss.iv_rank = _fl('iv_rank')
+    ss.iv_percentil = _fl('iv_percentil')
+    ss.atr_pct = _fl('atr_pct')
+    ss.strategy = _f('strategy') or None
+    ss.study_date = date.today()
+    ss.strategy_active = _f('strategy_active') or None
+    ss.entry_date = _dt('entry_date')
+    db.session.commit()
+    flash('Ação de estudo atualizada.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-acoes')
+
+
+@bp.route('/estudos/delete_study_stock/<int:sid>', methods=['POST'])
+@login_required
+def delete_study_stock(sid):
+    ss = StudyStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    db.session.delete(ss)
+    db.session.commit()
+    flash('Ação de estudo removida.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-acoes')
+
+
+@bp.route('/estudos/add_study_intl_stock', methods=['POST'])
+@login_required
+def add_study_intl_stock():
+    def _f(k): return request.form.get(k, '').strip()
+    def _fl(k):
+        v = _f(k)
+        return float(v) if v else None
+    def _dt(k):
+        v = _f(k)
+        try:
+            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
+        except ValueError:
+            return None
+
+    ss = StudyIntlStock(
+        user_id=current_user.id,
+        ticker=_f('ticker').upper(),
+        trend=_f('trend') or None,
+        rsi=_fl('rsi'),
+        volatility=_f('volatility') or None,
+        ve=_fl('ve'),
+        strategy=_f('strategy') or None,
+        study_date=_dt('study_date'),
+        strategy_active=_f('strategy_active') or None,
+        entry_date=_dt('entry_date'),
+    )
+    db.session.add(ss)
+    db.session.commit()
+    flash('Ação internacional de estudo adicionada.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-acoes-intl')
+
+
+@bp.route('/estudos/edit_study_intl_stock/<int:sid>', methods=['POST'])
+@login_required
+def edit_study_intl_stock(sid):
+    ss = StudyIntlStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    def _f(k): return request.form.get(k, '').strip()
+    def _fl(k):
+        v = _f(k)
+        return float(v) if v else None
+    def _dt(k):
+        v = _f(k)
+        try:
+            return datetime.strptime(v, '%Y-%m-%d').date() if v else None
+        except ValueError:
+            return None
+
+    ss.ticker = _f('ticker').upper()
+    ss.trend = _f('trend') or None
+    ss.rsi = _fl('rsi')
+    ss.iv_rank = _fl('iv_rank')
+    ss.iv_percentil = _fl('iv_percentil')
+    ss.atr_pct = _fl('atr_pct')
+    ss.strategy = _f('strategy') or None
+    ss.study_date = date.today()
+    ss.strategy_active = _f('strategy_active') or None
+    ss.entry_date = _dt('entry_date')
+    db.session.commit()
+    flash('Ação internacional de estudo atualizada.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-acoes-intl')
+
+
+@bp.route('/estudos/delete_study_intl_stock/<int:sid>', methods=['POST'])
+@login_required
+def delete_study_intl_stock(sid):
+    ss = StudyIntlStock.query.filter_by(id=sid, user_id=current_user.id).first_or_404()
+    db.session.delete(ss)
+    db.session.commit()
+    flash('Ação internacional de estudo removida.', 'success')
+    return redirect(url_for('.estudos') + '#estudo-acoes-intl')
+
+
+# ── Ranking Volatilidade ─────────────────────────────────────────
+
+# Lista "Geral" do Ranking de Volatilidade — ações/BDRs/ETFs com opções na B3
+RANKING_GERAL_TICKERS = [
+    # Principais
+    'BOVA11','VALE3','PETR4','PETR3','ITUB4','ITUB3','BBAS3','PRIO3','SMAL11','BBDC4','BBDC3',
+    'BRAV3','B3SA3','EGIE3','CSNA3','MGLU3','EMBJ3','SUZB3','BPAC11','ITSA4','WEGE3','CSAN3',
+    'NATU3','BBSE3','BRKM5','AXIA3','USIM5','MBRF3','ABEV3','BRAP4','SBSP3','CYRE3','AZZA3',
+    'RENT3','IBOV11','LREN3','ASAI3','MRVE3','CVCB3','BEEF3','ENEV3','GGBR4','CMIG4','CMIG3',
+    'HAPV3','EQTL3','ROXO34','KLBN11','COGN3','TAEE11','CMIN3','IRBR3','RAIL3','ABCB4','CXSE3',
+    'TOTS3','ALOS3','VAMO3','RADL3','GOAU4','JHSF3','SANB11','CEAB3','RDOR3','VBBR3','UGPA3',
+    'DIRR3','CSMG3','YDUQ3','VIVT3','ISAE4','BOVV11','HYPE3','VIVA3','CPLE3','POMO4','MULT3',
+    'SLCE3','TIMS3','CURY3','RECV3','IGTI11','PSSA3','SAPR11','BRSR6','XPBR31','MOTV3','GMAT3',
+    'RAIZ4','ENGI11','ALPA4','FLRY3','MOVI3','EZTC3','ECOR3','BHIA3','HASH11','TUPY3','CPFE3',
+    'JBSS32','SMFT3',
+    # Small caps e BDRs
+    'LWSA3','ANIM3','TEND3','PCAR3','WIZC3','SMTO3','VULC3','LJQQ3','NVDC34','INTB3','SIMH3',
+    'POSI3','AURE3','SEER3','KEPL3','QUAL3','RAPT4','BMGB4','MYPK3','TTEN3','CASH3','ALUP11',
+    'SAUD3','GRND3','UNIP6','LEVE3','MDNE3','AMBP3','BMOB3','INBR32','MDIA3','DXCO3','SBFG3',
+    'FESA4','PLPL3','RANI3','VLID3','IVVB11','GOGL34','AGRO3','GFSA3','M1TA34','HBOR3','CAML3',
+    'BLAU3','PNVL3','EVEN3','TRIS3','ROMI3','TASA4','SOJA3','LOGG3','AURA33','ONCO3','LAVV3',
+    'TSLA34','MLAS3','ORVR3','GGPS3','JALL3','AMZO34','VVEO3','MSFT34','MELI34','AMAR3','PGMN3',
+    'DASA3','MILS3','TSMC34','GOLD11','ARML3','BERK34','MTRE3','JPMC34','CBAV3','AAPL34',
+    'MCDC34','COCA34','HBSA3','NASD11',
+]
+
+
+def _seed_ranking_geral(uid):
+    """Garante que a lista GERAL do usuário contenha os tickers padrão."""
+    existentes = {rv.ticker for rv in RankingVol.query.filter_by(user_id=uid, grupo='GERAL').all()}
+    novos = [t for t in RANKING_GERAL_TICKERS if t not in existentes]
+    for t in novos:
+        db.session.add(RankingVol(user_id=uid, ticker=t, grupo='GERAL'))
+    if novos:
+        db.session.commit()
+
+
+
+@bp.route('/ranking-volatilidade')
+@login_required
+def ranking_volatilidade():
+    lista = (request.args.get('lista') or 'liq').lower()
+    if lista == 'geral':
+        _seed_ranking_geral(current_user.id)
+        q = RankingVol.query.filter_by(user_id=current_user.id, grupo='GERAL')
+    else:
+        lista = 'liq'
+        q = ranking_liq_filter(RankingVol.query.filter_by(user_id=current_user.id))
+    ranking_vol = q.order_by(RankingVol.ticker).all()
+    return render_template('ranking_vol.html', ranking_vol=ranking_vol, lista=lista)
+
+
+@bp.route('/estudos/ranking_vol/add', methods=['POST'])
+@login_required
+def ranking_vol_add():
+    lista  = (request.form.get('lista') or 'liq').lower()
+    grupo  = 'GERAL' if lista == 'geral' else 'LIQ'
+    ticker = request.form.get('ticker', '').strip().upper()
+    if not ticker:
+        flash('Ticker obrigatório.', 'danger')
+        return redirect(url_for('.ranking_volatilidade', lista=lista))
+    q = RankingVol.query.filter_by(user_id=current_user.id, ticker=ticker)
+    exists = (q.filter_by(grupo='GERAL') if grupo == 'GERAL' else ranking_liq_filter(q)).first()
+    if exists:
+        flash(f'{ticker} já está no ranking.', 'warning')
+        return redirect(url_for('.ranking_volatilidade', lista=lista))
+    db.session.add(RankingVol(user_id=current_user.id, ticker=ticker, grupo=grupo))
+    db.session.commit()
+    flash(f'{ticker} adicionado ao Ranking de Volatilidade.', 'success')
+    return redirect(url_for('.ranking_volatilidade', lista=lista))
+
+
+@bp.route('/estudos/ranking_vol/delete/<int:rid>', methods=['POST'])
+@login_required
+def ranking_vol_delete(rid):
+    rv = RankingVol.query.filter_by(id=rid, user_id=current_user.id).first_or_404()
+    lista = 'geral' if rv.grupo == 'GERAL' else 'liq'
+    db.session.delete(rv)
+    db.session.commit()
+    return redirect(url_for('.ranking_volatilidade', lista=lista))
+
+
+@bp.route('/api/ranking_vol/ticker', methods=['POST', 'DELETE'])
+@login_required
+def api_ranking_vol_ticker():
+    data = request.get_json(silent=True) or request.form
+    ticker = (data.get('ticker') or '').strip().upper()
+    if not ticker:
+        return jsonify({'error': 'Ticker obrigatório.'}), 400
+    # Este endpoint opera sempre sobre a lista "Com liquidez"
+    if request.method == 'DELETE':
+        rv = ranking_liq_filter(RankingVol.query.filter_by(user_id=current_user.id, ticker=ticker)).first()
+        if rv:
+            db.session.delete(rv)
+            db.session.commit()
+        return jsonify({'ok': True, 'ticker': ticker})
+    exists = ranking_liq_filter(RankingVol.query.filter_by(user_id=current_user.id, ticker=ticker)).first()
+    if not exists:
+        db.session.add(RankingVol(user_id=current_user.id, ticker=ticker, grupo='LIQ'))
+        db.session.commit()
+    return jsonify({'ok': True, 'ticker': ticker})
+
+
+@bp.route('/api/ranking_vol/update', methods=['POST'])
+@login_required
+def api_ranking_vol_update():
+    """Atualiza todos os itens do Ranking de Volatilidade via OpLab + brapi.
+
+    Com ?async=1 roda no pool de tarefas e devolve {task_id}; o JSON da
+    versão síncrona vem em `result` de /api/update_progress/<task_id>."""
+    uid   = current_user.id
+    token = Settings.get_value('oplab_token', user_id=uid)
+    if not token:
+        return jsonify({'error': 'Token OpLab não configurado. Configure em Perfil → OpLab.'}), 400
+
+    # Atualiza somente a lista ativa (liq = com liquidez; geral = lista ampla)
+    lista = ((request.get_json(silent=True) or {}).get('lista')
+             or request.args.get('lista') or 'liq').lower()
+
+    if request.args.get('async'):
+        def _run(task_id):
+            body, status = _api_ranking_vol_update_impl(uid, token, lista)
+            if status != 200:
+                return {'msg': body.get('error') or 'Falha.', 'category': 'danger', 'result': body}
+            return {'msg': f"{body['updated']}/{body.get('total', 0)} atualizados",
+                    'category': 'warning' if body.get('failed') else 'success', 'result': body}
+        return jsonify({'task_id': _submit_task('ranking_vol', uid, _run, 'Atualizando o ranking…')})
+
+    try:
+        body, status = _api_ranking_vol_update_impl(uid, token, lista)
+        return jsonify(body), status
+    except Exception as e:
+        import traceback
+        current_app.logger.error('api_ranking_vol_update error: %s\n%s', e, traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+
+def _api_ranking_vol_update_impl(uid, token, lista):
+    """(corpo, status HTTP) da atualização — sem request: roda também no pool
+    de tarefas."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    q = RankingVol.query.filter_by(user_id=uid)
+    items = (q.filter_by(grupo='GERAL') if lista == 'geral' else ranking_liq_filter(q)).all()
+    if not items:
+        return {'updated': 0, 'results': []}, 200
+
+    now     = datetime.now(_BRT)
+    today_str = now.strftime('%d/%m')
+
+    def _extract_iv(d):
+        """Extrai (iv_rank, iv_percentil, vol_impl, vol_min, vol_max) do payload
+        de /market/instruments/{symbol}.
+
+        A OpLab devolve 0 (não null) para ativos sem opções líquidas — 0 aqui
+        significa "sem dado", não "volatilidade zero". Tratar 0 como válido
+        fazia o primeiro campo da lista vencer com 0 e nunca cair no fallback
+        EWMA, que é o que de fato tem valor para boa parte dos papéis."""
+        if not isinstance(d, dict):
+            return None, None, None, None, None
+        for sub in ('data', 'spot', 'summary', 'iv', 'implied_volatility', 'greeks'):
+            if isinstance(d.get(sub), dict):
+                d.update(d[sub])
+
+        def _pick(*keys):
+            for k in keys:
+                v = d.get(k)
+                if v is None:
+                    continue
+                try:
+                    f = float(v)
+                except (TypeError, ValueError):
+                    continue
+                if f == 0:          # 0 = sem dado na OpLab; tenta a próxima chave
+                    continue
+                # Campos vêm em % (ex.: 41.79). Frações (<=1) viram percentual.
+                return round(f * 100, 1) if f <= 1.0 else round(f, 1)
+            return None
+
+        # iv_* primeiro (volatilidade implícita); ewma_* como fallback para
+        # papéis sem opções líquidas, onde a OpLab só preenche o histórico.
+        ivr  = _pick('iv_1y_rank', 'ewma_1y_rank', 'iv_6m_rank', 'ewma_6m_rank',
+                     'iv_rank', 'ivRank')
+        ivp  = _pick('iv_1y_percentile', 'ewma_1y_percentile', 'iv_6m_percentile',
+                     'ewma_6m_percentile', 'iv_percentile', 'ivPercentile', 'iv_percentil')
+        vol  = _pick('iv_current', 'ewma_current', 'hv_current', 'historical_volatility',
+                     'implied_volatility_current', 'current_iv', 'close_iv', 'iv', 'vol_impl')
+        vmin = _pick('iv_1y_min', 'ewma_1y_min', 'iv_6m_min', 'ewma_6m_min', 'iv_min', 'ivMin')
+        vmax = _pick('iv_1y_max', 'ewma_1y_max', 'iv_6m_max', 'ewma_6m_max', 'iv_max', 'ivMax')
+        return ivr, ivp, vol, vmin, vmax
+
+    def _extract_price(d):
+        """Preço e variação % do mesmo payload de /market/instruments/{symbol}.
+        A OpLab já devolve a cotação aqui, então usá-la evita uma segunda fonte
+        (brapi/Yahoo) e mantém preço e IV coerentes entre si — vindos do mesmo
+        instante e do mesmo provedor."""
+        if not isinstance(d, dict):
+            return None, None
+        for sub in ('data', 'spot'):
+            if isinstance(d.get(sub), dict):
+                d = {**d, **d[sub]}
+
+        def _num(*keys, skip_zero=False):
+            for k in keys:
+                v = d.get(k)
+                if v is None:
+                    continue
+                try:
+                    f = float(v)
+                except (TypeError, ValueError):
+                    continue
+                # Preço 0 = papel sem negócio no dia, não cotação zero: tenta a
+                # próxima chave (o spot_price costuma estar preenchido).
+                if skip_zero and f == 0:
+                    continue
+                return f
+            return None
+
+        px  = _num('close', 'spot_price', 'last', 'price', 'adjusted_close', skip_zero=True)
+        var = _num('variation', 'change_percent', 'var_pct')
+        return px, var
+
+    from services import _brapi_quotes, _yf_fast_info
+    from concurrent.futures import as_completed as _as_completed, TimeoutError as _CFTimeoutError
+    brapi_token = Settings.get_value('brapi_token', user_id=uid)
+    tickers_list = [rv.ticker for rv in items]
+    price_map = {}      # ticker → {price, change} (fonte final)
+    oplab_prices = {}   # preenchido por _fetch_iv, junto com a IV
+
+    def _fetch_prices_yahoo(tks, budget):
+        """Yahoo ticker a ticker com teto de tempo. Sem esse teto, uma lista
+        'Geral' com 180+ tickers levava ~90s só aqui (≈500ms cada) e estourava
+        o gateway antes mesmo de chamar a OpLab. Quem não responder no orçamento
+        fica sem preço nesta rodada — o resto da tela continua atualizando."""
+        if not tks:
+            return
+        got = fetch_many(lambda t: _yf_fast_info(f'{t}.SA' if '.' not in t else t, t), tks, timeout=budget)
+        for t, d in got.items():
+            price_map[t] = {'price': d['price'], 'change': d['change_percent']}
+
+    # Busca de IV via OpLab: uma chamada por ticker (até 15s cada). Sequencial,
+    # uma lista "Geral" com 100+ tickers passa muito além do timeout do
+    # gateway (504 relatado) — paraleliza com um teto de tempo total, e
+    # aplica os resultados ao modelo depois, sequencialmente (sem rede).
+    iv_results: dict = {}   # ticker → (ivr, ivp, vol, error)
+
+    def _fetch_iv(ticker):
+        try:
+            d = _oplab_get_json(f'/market/instruments/{ticker}', token, timeout=15)
+            # Mesma resposta serve para IV e cotação — a OpLab é a fonte das duas.
+            px, var = _extract_price(d)
+            if px is not None:
+                oplab_prices[ticker] = {'price': px, 'change': var if var is not None else 0.0}
+            return ticker, (*_extract_iv(d), None)
+        except OplabApiError as e:
+            return ticker, (None, None, None, None, None, str(e))
+        except Exception as e:
+            return ticker, (None, None, None, None, None, str(e))
+
+    # 6 workers + o retry de _oplab_get_json: medido com 80 tickers, 8 workers
+    # sem retry dava 32% de 503 (o "N com falha" da tela); 6 workers com 2
+    # retries zera as falhas em 1,64s. Mais workers só aumenta o rate-limiting.
+    ex = ThreadPoolExecutor(max_workers=min(6, len(items)))
+    fut_map = {ex.submit(_fetch_iv, rv.ticker): rv.ticker for rv in items}
+    try:
+        for fut in _as_completed(fut_map, timeout=40):
+            ticker, res = fut.result()
+            iv_results[ticker] = res
+    except _CFTimeoutError:
+        pass  # aproveita o que já resolveu; o resto fica sem IV nesta rodada
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    # A cotação da OpLab é a fonte principal: veio na mesma resposta da IV, então
+    # preço e volatilidade ficam do mesmo instante. brapi/Yahoo entram só para os
+    # papéis que a OpLab não cobriu (sem instrumento ou falha na chamada).
+    #
+    # Papéis pouco líquidos às vezes voltam com um close antigo (visto no LFTS11:
+    # R$ 103,10 com variação 0,00% quando valia R$ 158,19). Quando o preço destoa
+    # do último conhecido sem variação que o explique, descarta e deixa o fallback
+    # buscar — é dado obsoleto, não movimento de mercado.
+    anteriores = {rv.ticker: rv.last_price for rv in items}
+    for tk, d in oplab_prices.items():
+        ant, novo = anteriores.get(tk), d.get('price')
+        if ant and ant > 0 and novo and novo > 0:
+            desvio = abs(novo - ant) / ant
+            if desvio > 0.20 and abs(float(d.get('change') or 0)) < desvio * 100 * 0.5:
+                current_app.logger.warning('OpLab: cotacao suspeita de %s descartada no ranking '
+                                   '(%.2f vs %.2f anterior)', tk, novo, ant)
+                continue
+        price_map[tk] = d
+    faltando = [t for t in tickers_list if t not in price_map]
+    if faltando:
+        if brapi_token:
+            for t, d in _brapi_quotes(faltando, brapi_token).items():
+                price_map[t] = {'price': d['price'], 'change': d['change_percent']}
+            _fetch_prices_yahoo([t for t in faltando if t not in price_map], 25)
+        else:
+            _fetch_prices_yahoo(faltando, 25)
+
+    # Papel sem IV Rank/percentil na OpLab: usa as estatísticas já gravadas
+    # em vol_hist_day (a série do gráfico de Vol. Histórica), se o último ponto
+    # for recente — números prontos, sem voltar às linhas de opção.
+    with db.engine.connect() as conn:
+        vh_stats = vol_hist_store.latest(conn, tickers_list)
+    vh_limite = (now.date() - timedelta(days=7)).isoformat()
+
+    results = []
+    ok = 0
+    no_iv = 0          # consultados, mas a OpLab não tem IV para o papel
+    err_counts: dict = {}   # mensagem de erro → quantas vezes ocorreu
+    for rv in items:
+        row = {'ticker': rv.ticker, 'ok': False, 'error': None}
+        try:
+            # Ausente do dict = nunca chegou a rodar (estourou o teto de tempo)
+            if rv.ticker in iv_results:
+                ivr, ivp, vol, vmin, vmax, err = iv_results[rv.ticker]
+            else:
+                ivr = ivp = vol = vmin = vmax = None
+                err = 'sem resposta dentro do tempo limite'
+            vh = vh_stats.get(rv.ticker)
+            if ivr is None and ivp is None and vh and vh['d'] >= vh_limite:
+                ivr, ivp = vh['iv_rank'], vh['iv_pct']
+                vol  = vol  if vol  is not None else vh['iv']
+                vmin = vmin if vmin is not None else vh['iv_min']
+                vmax = vmax if vmax is not None else vh['iv_max']
+            if err:
+                row['error'] = err
+                err_counts[err] = err_counts.get(err, 0) + 1
+
+            pd = price_map.get(rv.ticker, {})
+            if pd.get('price', 0) > 0:
+                rv.last_price = round(pd['price'], 2)
+                rv.var_pct    = round(pd.get('change', 0), 2)
+                rv.last_date  = today_str
+            if ivr is not None: rv.iv_rank = ivr
+            if ivp is not None: rv.iv_percentil = ivp
+            if vol is not None: rv.vol_impl = vol
+            if vmin is not None: rv.vol_min = vmin
+            if vmax is not None: rv.vol_max = vmax
+            rv.updated_at = now
+            # "ok" = a consulta em si funcionou. Um papel sem IV na OpLab não é
+            # falha nossa; é contabilizado à parte para a tela poder distinguir
+            # "deu erro" de "a OpLab não tem esse dado".
+            if not err:
+                ok += 1
+                row['ok'] = True
+                if ivr is None and ivp is None:
+                    no_iv += 1
+                    row['no_iv'] = True
+            row['iv_rank'] = ivr; row['iv_percentil'] = ivp; row['vol_impl'] = vol
+            row['vol_min'] = vmin; row['vol_max'] = vmax
+            row['price'] = rv.last_price; row['change'] = rv.var_pct
+        except Exception as e:
+            row['error'] = str(e)
+            err_counts[str(e)] = err_counts.get(str(e), 0) + 1
+        results.append(row)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return {'error': str(e)}, 500
+
+    failed = sum(1 for row in results if row.get('error'))
+    # Erro mais frequente: sem isso a tela só dizia "N com falha" sem dizer por quê
+    top_error = max(err_counts.items(), key=lambda kv: kv[1])[0] if err_counts else None
+    return {'updated': ok, 'failed': failed, 'no_iv': no_iv,
+            'total': len(items), 'top_error': top_error,
+            'results': results}, 200
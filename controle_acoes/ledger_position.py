@@ -0,0 +1,129 @@
+"""
+ledger_position.py — posição acumulada do livro de transações
+=============================================================
+Por (usuário, ticker), uma linha por data com transação e o saldo ACUMULADO
+até ela (compra +, venda −). A soma das transações a partir de uma data é
+total − acumulado da data anterior: um bisect em PositionSeries.
+
+_txn_add e a remoção de transação chamam apply na mesma transação do banco;
+ticker sem série é montado do asset_txn inteiro (rebuild) no primeiro uso.
+"""
+from bisect import bisect_left
+from datetime import date
+
+from sqlalchemy import bindparam, text
+
+
+def _iso(d):
+    return d.isoformat() if isinstance(d, date) else d
+
+
+def _sql(sql, tickers):
+    """text() de `sql` com {f} trocado por ' AND ticker IN :t' (ou nada, se
+    `tickers` é None)."""
+    if tickers is None:
+        return text(sql.format(f=''))
+    return text(sql.format(f=' AND ticker IN :t')).bindparams(bindparam('t', expanding=True))
+
+
+def _params(user_id, tickers):
+    return {'u': user_id} if tickers is None else {'u': user_id, 't': sorted(set(tickers))}
+
+
+class PositionSeries:
+    """Saldo acumulado de um (usuário, ticker) em ordem de data."""
+
+    __slots__ = ('dates', 'cum')
+
+    def __init__(self, dates=(), cum=()):
+        self.dates = list(dates)     # ISO, crescente
+        self.cum = list(cum)         # saldo das transações até a data (inclusive)
+
+    @property
+    def first_date(self):
+        return date.fromisoformat(self.dates[0]) if self.dates else None
+
+    @property
+    def total(self):
+        return self.cum[-1] if self.cum else 0
+
+    def delta_since(self, ref):
+        """Soma das transações com data >= ref."""
+        i = bisect_left(self.dates, _iso(ref))
+        return self.total - (self.cum[i - 1] if i else 0)
+
+    def qty_before(self, ref, current_qty):
+        """Qtd detida na VÉSPERA de ref, de trás para frente a partir da
+        posição atual: atual − transações com data >= ref (nunca negativa)."""
+        return max(int(current_qty or 0) - self.delta_since(ref), 0)
+
+
+def load(conn, user_id, tickers=None):
+    """{ticker: PositionSeries} do usuário (só os `tickers` pedidos, se dados)."""
+    if tickers is not None and not tickers:
+        return {}
+    rows = conn.execute(_sql('SELECT ticker, d, cum FROM ledger_position WHERE user_id = :u{f} ORDER BY ticker, d',
+                             tickers), _params(user_id, tickers))
+    out = {}
+    for tk, d, cum in rows:
+        s = out.setdefault(tk, PositionSeries())
+        s.dates.append(d)
+        s.cum.append(cum)
+    return out
+
+
+def rebuild(conn, user_id, tickers=None):
+    """Remonta a série a partir do asset_txn (todos os tickers do usuário, ou
+    só os informados). Não faz commit."""
+    if tickers is not None and not tickers:
+        return 0
+    params = _params(user_id, tickers)
+    conn.execute(_sql('DELETE FROM ledger_position WHERE user_id = :u{f}', tickers), params)
+    rows = conn.execute(_sql(
+        "SELECT ticker, txn_date, SUM(CASE WHEN side = 'C' THEN quantity ELSE -quantity END) "
+        'FROM asset_txn WHERE user_id = :u{f} GROUP BY ticker, txn_date ORDER BY ticker, txn_date', tickers),
+        params).fetchall()
+    out, tk_ant, acc = [], None, 0
+    for tk, d, delta in rows:
+        if tk != tk_ant:
+            tk_ant, acc = tk, 0
+        acc += int(delta or 0)
+        out.append({'u': user_id, 't': tk, 'd': _iso(d), 'c': acc})
+    if out:
+        conn.execute(text('INSERT INTO ledger_position (user_id, ticker, d, cum) VALUES (:u, :t, :d, :c)'), out)
+    return len(out)
+
+
+def ensure(conn, user_id, tickers=None):
+    """Monta a série dos tickers do livro que ainda não têm uma — todos os do
+    usuário, ou só os `tickers` informados (consulta de um papel não varre o
+    livro inteiro). Não faz commit."""
+    if tickers is not None and not tickers:
+        return 0
+    faltam = [r[0] for r in conn.execute(_sql(
+        'SELECT DISTINCT ticker FROM asset_txn WHERE user_id = :u{f} AND ticker NOT IN '
+        '(SELECT DISTINCT ticker FROM ledger_position WHERE user_id = :u{f})', tickers),
+        _params(user_id, tickers))]
+    return rebuild(conn, user_id, faltam) if faltam else 0
+
+
+def apply(conn, user_id, ticker, d, delta):
+    """Reflete na série uma transação de `delta` (compra +, venda −; remoção
+    de transação = delta com sinal trocado) na data `d`. A transação já deve
+    estar gravada/removida no asset_txn da mesma conexão (flush): se o ticker
+    ainda não tem série, ela é montada do livro inteiro. Não faz commit."""
+    p = {'u': user_id, 't': ticker, 'd': _iso(d), 'x': int(delta)}
+    existe = conn.execute(text('SELECT 1 FROM ledger_position WHERE user_id = :u AND ticker = :t LIMIT 1'),
+                          p).first()
+    if not existe:
+        return rebuild(conn, user_id, [ticker])
+    ins = conn.execute(text(
+        'INSERT OR IGNORE INTO ledger_position (user_id, ticker, d, cum) VALUES (:u, :t, :d, '
+        'COALESCE((SELECT cum FROM ledger_position WHERE user_id = :u AND ticker = :t AND d < :d '
+        'ORDER BY d DESC LIMIT 1), 0) + :x)'), p).rowcount
+    # Linha nova já nasceu com o delta; as datas seguintes (e a própria, se
+    # já existia) acumulam o delta.
+    op = '>' if ins else '>='
+    conn.execute(text(f'UPDATE ledger_position SET cum = cum + :x WHERE user_id = :u AND ticker = :t AND d {op} :d'),
+                 p)
+    return 1
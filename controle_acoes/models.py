@@ -1,11 +1,20 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from cryptography.fernet import Fernet
 import os
 import base64
 from datetime import datetime
 
+import quote_store
+import schema_indexes
+import settings_store
+import version_counter
+
 db = SQLAlchemy()
 
 # Helper for Encryption
@@ -14,6 +23,25 @@ def get_cipher_suite():
     key = secret.ljust(32)[:32].encode() 
     return Fernet(base64.urlsafe_b64encode(key))
 
+
+def _quoted(column, ticker, field=0, user=lambda o: o.user_id, live=None):
+    """Atributo de cotação lido de quote/quote_user (ver Quote.lookup) para
+    o ticker em `ticker`: field 0 = preço, 1 = variação %, 2 = hora. Sem
+    cotação (ou com live(obj) falso), vale a coluna `column` — valor de
+    entrada, edição manual ou o último gravado antes da tabela quote. Gravar
+    no atributo grava só a coluna; em consultas ele é a própria coluna."""
+    def fget(self):
+        if live is None or live(self):
+            q = Quote.lookup(user(self), getattr(self, ticker))
+            if q is not None and q[field] is not None:
+                return q[field]
+        return getattr(self, column)
+
+    def fset(self, value):
+        setattr(self, column, value)
+
+    return hybrid_property(fget, fset, expr=lambda cls: getattr(cls, column))
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -56,10 +84,14 @@ class Asset(db.Model):
     gain2 = db.Column(db.Float, nullable=True)
     recommendation = db.Column(db.String(50), nullable=True)
     
-    # Cached Quote Data
-    current_price = db.Column(db.Float, default=0.0)
-    daily_change = db.Column(db.Float, default=0.0)
-    last_update = db.Column(db.DateTime,  nullable=True)
+    # Cached Quote Data — lidos da tabela quote (ver _quoted)
+    _current_price = db.Column('current_price', db.Float, default=0.0)
+    _daily_change = db.Column('daily_change', db.Float, default=0.0)
+    _last_update = db.Column('last_update', db.DateTime,  nullable=True)
+    current_price = _quoted('_current_price', 'ticker')
+    daily_change = _quoted('_daily_change', 'ticker', 1)
+    last_update = _quoted('_last_update', 'ticker', 2)
+    _quote_tickers = ('ticker',)   # lidos de quote (ver _watch_quotes)
     
     # Dividend Data (New)
     last_dividend = db.Column(db.Float, nullable=True)
@@ -80,6 +112,7 @@ class Asset(db.Model):
     # Continua sendo type='ETF' (mesma cotação/lógica), só muda a classificação
     # no Balanceamento, que soma como Renda Variável Internacional.
     is_intl = db.Column(db.Boolean, nullable=False, default=False)
+    __table_args__ = schema_indexes.table_args('asset')
 
     def to_dict(self):
         return {
@@ -114,6 +147,7 @@ class TradeHistory(db.Model):
     #    "events": [{data, ticker, tipo, side, qty, entrada, saida, novo,
     #                novo_premio, pnl, saldo}, ...]}   ← rolagens e manejos
     details = db.Column(db.Text, nullable=True)
+    __table_args__ = schema_indexes.table_args('trade_history')
 
 class Option(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -127,18 +161,24 @@ class Option(db.Model):
     sale_price = db.Column(db.Float, nullable=False) # Premium received per share
     
     # Manual update field
-    current_option_price = db.Column(db.Float, default=0.0)
-    daily_change         = db.Column(db.Float, nullable=True)  # variação % no dia
+    _current_option_price = db.Column('current_option_price', db.Float, default=0.0)
+    _daily_change         = db.Column('daily_change', db.Float, nullable=True)  # variação % no dia
+    current_option_price  = _quoted('_current_option_price', 'ticker')
+    daily_change          = _quoted('_daily_change', 'ticker', 1)
 
     # Entry Date (Requested Feature)
     entry_date = db.Column(db.Date, nullable=True)
     
     # Calculated/Fetched on fly, but maybe store last fetch for underlying?
-    last_update = db.Column(db.DateTime, nullable=True)
+    _last_update = db.Column('last_update', db.DateTime, nullable=True)
+    last_update  = _quoted('_last_update', 'ticker', 2)
 
     # Cotação do ativo subjacente (p/ opções cujo ativo não está na carteira)
-    underlying_price  = db.Column(db.Float, nullable=True)
-    underlying_change = db.Column(db.Float, nullable=True)
+    _underlying_price  = db.Column('underlying_price', db.Float, nullable=True)
+    _underlying_change = db.Column('underlying_change', db.Float, nullable=True)
+    underlying_price   = _quoted('_underlying_price', 'underlying_asset')
+    underlying_change  = _quoted('_underlying_change', 'underlying_asset', 1)
+    _quote_tickers     = ('ticker', 'underlying_asset')   # lidos de quote (ver _watch_quotes)
 
     # Study fields
     vdx   = db.Column(db.Float, nullable=True)   # calculado
@@ -149,6 +189,7 @@ class Option(db.Model):
 
     # Histórico de rolagens (JSON array)
     roll_history = db.Column(db.Text, nullable=True)
+    __table_args__ = schema_indexes.table_args('option')
 
     def to_dict(self):
         return {
@@ -174,20 +215,25 @@ class OptionSpread(db.Model):
     leg_long_ticker = db.Column(db.String(20), nullable=False)
     leg_long_strike = db.Column(db.Float, nullable=False)
     leg_long_price = db.Column(db.Float, nullable=False)   # prêmio pago
-    leg_long_current = db.Column(db.Float, default=0.0)
+    _leg_long_current = db.Column('leg_long_current', db.Float, default=0.0)
+    leg_long_current = _quoted('_leg_long_current', 'leg_long_ticker')
 
     # Leg Venda (Short)
     leg_short_ticker = db.Column(db.String(20), nullable=False)
     leg_short_strike = db.Column(db.Float, nullable=False)
     leg_short_price = db.Column(db.Float, nullable=False)  # prêmio recebido
-    leg_short_current = db.Column(db.Float, default=0.0)
+    _leg_short_current = db.Column('leg_short_current', db.Float, default=0.0)
+    leg_short_current = _quoted('_leg_short_current', 'leg_short_ticker')
 
     # Probability of Profit informado na montagem
     pop = db.Column(db.Float, nullable=True)
 
     # Cotação do ativo subjacente (atualizado via MT5/Excel/Yahoo)
-    underlying_price  = db.Column(db.Float, nullable=True)
-    underlying_change = db.Column(db.Float, nullable=True)
+    _underlying_price  = db.Column('underlying_price', db.Float, nullable=True)
+    _underlying_change = db.Column('underlying_change', db.Float, nullable=True)
+    underlying_price   = _quoted('_underlying_price', 'underlying_asset')
+    underlying_change  = _quoted('_underlying_change', 'underlying_asset', 1)
+    _quote_tickers     = ('leg_long_ticker', 'leg_short_ticker', 'underlying_asset')
 
     # Histórico de rolagens (JSON array)
     roll_history = db.Column(db.Text, nullable=True)
@@ -198,25 +244,74 @@ class Settings(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, default=1)
     key = db.Column(db.String(50), nullable=False) # Removed unique constraint here, handled by (user_id, key) if possible or logic
     value = db.Column(db.String(255), nullable=True)
+    __table_args__ = schema_indexes.table_args('settings')
     
     # Unique constraint combo ideally: (user_id, key)
 
     _ENCRYPTED_KEYS = {'brapi_token', 'oplab_token'}
 
+    # Chaves de cada usuário, já decifradas: {user_id: (versão, {chave: valor})}.
+    # Vale enquanto a versão 'settings' do usuário não muda (version_counter); dentro
+    # do mesmo contexto do app (requisição, tick do scheduler, tarefa)
+    # g._settings evita até a releitura da versão.
+    _cache = {}
+
+    @staticmethod
+    def _decode(key, raw):
+        if key in Settings._ENCRYPTED_KEYS:
+            try:
+                cipher = get_cipher_suite()
+                return cipher.decrypt(raw.encode()).decode()
+            except Exception:
+                # Valor salvo antes da criptografia — retorna como texto plano
+                # e re-salva criptografado para migrações futuras
+                return raw
+        return raw
+
+    @staticmethod
+    def prefetch(user_ids):
+        """Carrega no contexto atual as chaves de `user_ids`: uma consulta às
+        versões e, só para quem mudou desde o cache, uma às chaves."""
+        memo = g.setdefault('_settings', {}) if has_app_context() else {}
+        faltam = {u for u in user_ids if u not in memo}
+        if faltam:
+            vers = version_counter.get(db.session, 'settings', faltam)
+            atual = {u: Settings._cache.get(u) for u in faltam}
+            mudou = [u for u, c in atual.items() if c is None or c[0] != vers[u]]
+            for u, vals in settings_store.load(db.session, mudou).items():
+                atual[u] = Settings._cache[u] = (vers[u], {k: Settings._decode(k, v) for k, v in vals.items()})
+            for u in faltam:
+                memo[u] = atual[u][1]
+        return memo
+
+    @staticmethod
+    def all_for(user_id):
+        """{chave: valor} do usuário (não alterar o dict devolvido)."""
+        return Settings.prefetch([user_id])[user_id]
+
     @staticmethod
     def get_value(key, user_id, default=None):
-        setting = Settings.query.filter_by(key=key, user_id=user_id).first()
-        if setting:
-            if key in Settings._ENCRYPTED_KEYS:
-                try:
-                    cipher = get_cipher_suite()
-                    return cipher.decrypt(setting.value.encode()).decode()
-                except Exception:
-                    # Valor salvo antes da criptografia — retorna como texto plano
-                    # e re-salva criptografado para migrações futuras
-                    return setting.value
-            return setting.value
-        return default
+        vals = Settings.all_for(user_id)
+        return vals[key] if key in vals else default
+
+    @staticmethod
+    def get_int(key, user_id, default=0):
+        try:
+            return int(Settings.get_value(key, user_id))
+        except (TypeError, ValueError):
+            return default
+
+    @staticmethod
+    def get_float(key, user_id, default=0.0):
+        try:
+            return float(Settings.get_value(key, user_id))
+        except (TypeError, ValueError):
+            return default
+
+    @staticmethod
+    def get_bool(key, user_id, default=False):
+        raw = Settings.get_value(key, user_id)
+        return default if raw is None else raw == 'true'
 
     @staticmethod
     def set_value(key, value, user_id):
@@ -234,6 +329,20 @@ class Settings(db.Model):
         db.session.commit()
 
 
+@event.listens_for(Session, 'after_flush')
+def _settings_bump_version(session, _ctx):
+    """Toda gravação em settings (set_value ou direto pelo ORM) incrementa a
+    versão do usuário na mesma transação e derruba o cache local dele."""
+    users = {o.user_id for o in (*session.new, *session.dirty, *session.deleted) if isinstance(o, Settings)}
+    if not users:
+        return
+    version_counter.bump(session.connection(), 'settings', users, datetime.now())
+    memo = g.get('_settings', {}) if has_app_context() else {}
+    for u in users:
+        memo.pop(u, None)
+        Settings._cache.pop(u, None)
+
+
 class FixedIncome(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, default=1)
@@ -300,11 +409,14 @@ class StudyOption(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     ticker = db.Column(db.String(20), nullable=False)          # ticker da opção
     underlying_asset = db.Column(db.String(15), nullable=False)
-    underlying_price = db.Column(db.Float, nullable=True)      # cotação do ativo
+    _underlying_price = db.Column('underlying_price', db.Float, nullable=True)   # cotação do ativo
+    underlying_price = _quoted('_underlying_price', 'underlying_asset')
     avg_price_stock = db.Column(db.Float, nullable=True)       # preço médio da ação
     strike = db.Column(db.Float, nullable=True)
     expiration_date = db.Column(db.Date, nullable=True)
-    option_price = db.Column(db.Float, nullable=True)          # cotação da opção
+    _option_price = db.Column('option_price', db.Float, nullable=True)           # cotação da opção
+    option_price = _quoted('_option_price', 'ticker')
+    _quote_tickers = ('ticker', 'underlying_asset')
     vdx   = db.Column(db.Float, nullable=True)   # calculado
     nv    = db.Column(db.Float, nullable=True)   # calculado
     ve    = db.Column(db.Float, nullable=True)   # informado manualmente
@@ -396,18 +508,28 @@ class StructuredOp(db.Model):
     user_id       = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name                  = db.Column(db.String(100), default='')
     underlying_asset      = db.Column(db.String(15), default='')
-    underlying_price      = db.Column(db.Float, nullable=True)
-    underlying_change     = db.Column(db.Float, nullable=True)
+    _underlying_price     = db.Column('underlying_price', db.Float, nullable=True)
+    _underlying_change    = db.Column('underlying_change', db.Float, nullable=True)
     uses_stock_collateral = db.Column(db.Boolean, default=False)  # ação em carteira como garantia
     status                = db.Column(db.String(10), default='OPEN')   # OPEN | CLOSED
     pop                   = db.Column(db.Float, nullable=True)  # POP salvo ao abrir o payoff
     intl                  = db.Column(db.Boolean, default=False)  # Tastytrade: opções internacionais (atualização manual)
     created_at    = db.Column(db.DateTime, default=datetime.now)
     roll_history  = db.Column(db.Text, nullable=True)  # JSON array de rolagens
+    __table_args__ = schema_indexes.table_args('structured_op')
     legs = db.relationship('StructuredLeg', backref='operation', lazy=True,
                            cascade='all, delete-orphan',
                            order_by='StructuredLeg.id')
 
+    def quoted_live(self):
+        """Aberta e da B3: preços vêm de quote. Encerrada fica com o que foi
+        gravado no fechamento; Tastytrade (intl), com a atualização manual."""
+        return self.status in (None, 'OPEN') and not self.intl
+
+    underlying_price  = _quoted('_underlying_price', 'underlying_asset', live=quoted_live)
+    underlying_change = _quoted('_underlying_change', 'underlying_asset', 1, live=quoted_live)
+    _quote_tickers    = ('underlying_asset',)
+
 
 class StructuredLeg(db.Model):
     """Uma perna de uma operação estruturada."""
@@ -421,8 +543,15 @@ class StructuredLeg(db.Model):
     strike         = db.Column(db.Float, default=0.0)
     expiration_date = db.Column(db.Date, nullable=True)
     entry_price    = db.Column(db.Float, default=0.0)
-    current_price  = db.Column(db.Float, default=0.0)
-    last_update    = db.Column(db.DateTime, nullable=True)
+    _current_price = db.Column('current_price', db.Float, default=0.0)
+    _last_update   = db.Column('last_update', db.DateTime, nullable=True)
+    __table_args__ = schema_indexes.table_args('structured_leg')
+
+    current_price = _quoted('_current_price', 'ticker', user=lambda l: l.operation and l.operation.user_id,
+                            live=lambda l: l.operation is not None and l.operation.quoted_live())
+    last_update   = _quoted('_last_update', 'ticker', 2, user=lambda l: l.operation and l.operation.user_id,
+                            live=lambda l: l.operation is not None and l.operation.quoted_live())
+    _quote_tickers = ('ticker',)
 
 
 class SimulacaoOpcoes(db.Model):
@@ -473,7 +602,9 @@ class PutSale(db.Model):
     user_id           = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     ticker            = db.Column(db.String(20), nullable=False)
     underlying_asset  = db.Column(db.String(15), nullable=False, default='')
-    underlying_price  = db.Column(db.Float, nullable=True)      # cotação do ativo
+    _underlying_price = db.Column('underlying_price', db.Float, nullable=True)   # cotação do ativo
+    underlying_price  = _quoted('_underlying_price', 'underlying_asset')
+    _quote_tickers    = ('underlying_asset',)
     strike            = db.Column(db.Float, nullable=False)
     expiration_date   = db.Column(db.Date, nullable=False)
     premium           = db.Column(db.Float, nullable=False)     # prêmio recebido por ação
@@ -524,9 +655,26 @@ class Dividend(db.Model):
     per_share = db.Column(db.Float, nullable=True)        # valor por ação (do provento)
     qty_used  = db.Column(db.Integer, nullable=True)      # qtd de ações usada no cálculo (editável)
     qty_manual = db.Column(db.Boolean, default=False)     # qtd editada à mão — recálculos preservam
+    __table_args__ = schema_indexes.table_args('dividend')
 
     asset = db.relationship('Asset', backref=db.backref('dividends', lazy=True, cascade="all, delete-orphan"))
 
+class DividendHistory(db.Model):
+    """Provento por ação de um ticker numa data-com (Yahoo), comum a todos os
+    usuários — ver dividend_history.py."""
+    __tablename__ = 'dividend_history'
+    ticker    = db.Column(db.String(20), primary_key=True)
+    ex_date   = db.Column(db.String(10), primary_key=True)     # YYYY-MM-DD
+    per_share = db.Column(db.Float, nullable=False)
+
+
+class DividendHistoryState(db.Model):
+    """Última data-com conhecida do ticker e quando o Yahoo foi consultado."""
+    __tablename__ = 'dividend_history_state'
+    ticker     = db.Column(db.String(20), primary_key=True)
+    last_ex    = db.Column(db.String(10), nullable=True)       # None = consultado, sem proventos
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
 class AssetTxn(db.Model):
     """Livro de transações da carteira: cada compra/venda com data, qtd e
     preço. Fontes: MANUAL (botões Comprar/Vender), INICIAL (Adicionar Ativo),
@@ -544,6 +692,17 @@ class AssetTxn(db.Model):
     source     = db.Column(db.String(12), default='MANUAL')  # MANUAL | INICIAL | B3 | PM_LUCRO
     notes      = db.Column(db.String(200), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    __table_args__ = schema_indexes.table_args('asset_txn')
+
+
+class LedgerPosition(db.Model):
+    """Saldo acumulado das transações do livro por (usuário, ticker) até cada
+    data com transação — ver ledger_position.py."""
+    __tablename__ = 'ledger_position'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    ticker  = db.Column(db.String(10), primary_key=True)
+    d       = db.Column(db.String(10), primary_key=True)        # YYYY-MM-DD
+    cum     = db.Column(db.Integer, nullable=False)             # Σ compras − vendas até d (inclusive)
 
 
 class PMEvent(db.Model):
@@ -566,6 +725,7 @@ class PMEvent(db.Model):
     pm_before  = db.Column(db.Float, nullable=True)
     pm_after   = db.Column(db.Float, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    __table_args__ = schema_indexes.table_args('pm_event')
 
 
 class MarketIndex(db.Model):
@@ -598,7 +758,8 @@ class PortfolioSnapshot(db.Model):
 
 
 class ChartCache(db.Model):
-    """Cache persistente de OHLCV por ticker (sobrevive restart do servidor)."""
+    """Formato antigo do cache de OHLCV (um blob JSON gzip por ticker). Só é
+    lido para migrar para a tabela candle na primeira consulta do ticker."""
     __tablename__ = 'chart_cache'
     ticker     = db.Column(db.String(20), primary_key=True)
     last_date  = db.Column(db.String(12), nullable=False)   # último candle: YYYY-MM-DD
@@ -606,8 +767,188 @@ class ChartCache(db.Model):
     candles_gz = db.Column(db.LargeBinary, nullable=False)   # JSON gzip dos candles
 
 
+class Candle(db.Model):
+    """Candle diário por (ticker, data), já saneado — ver candle_store.py."""
+    __tablename__ = 'candle'
+    ticker = db.Column(db.String(20), primary_key=True)
+    d      = db.Column(db.String(10), primary_key=True)        # YYYY-MM-DD
+    o      = db.Column(db.Float, nullable=False)
+    h      = db.Column(db.Float, nullable=False)
+    l      = db.Column(db.Float, nullable=False)
+    c      = db.Column(db.Float, nullable=False)
+    v      = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PriceHistory(db.Model):
+    """Fechamento diário (Yahoo, sem ajuste) por (ticker, data), comum a todos
+    os usuários — base da reconstrução de patrimônio. Ver price_history.py."""
+    __tablename__ = 'price_history'
+    ticker = db.Column(db.String(20), primary_key=True)
+    d      = db.Column(db.String(10), primary_key=True)        # YYYY-MM-DD
+    close  = db.Column(db.Float, nullable=False)
+
+
+class PriceHistoryRange(db.Model):
+    """Intervalo [d_from, d_to] já consultado no Yahoo para o ticker, com ou
+    sem pregão — o que está dentro dele não é buscado de novo."""
+    __tablename__ = 'price_history_range'
+    ticker     = db.Column(db.String(20), primary_key=True)
+    d_from     = db.Column(db.String(10), nullable=False)      # YYYY-MM-DD
+    d_to       = db.Column(db.String(10), nullable=False)      # YYYY-MM-DD
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
+class Quote(db.Model):
+    """Última cotação de mercado de cada ticker, comum a todos os usuários —
+    uma linha por ticker, gravada pelas fontes que o servidor consulta
+    (OpLab, Yahoo/brapi, MT5 local). O preço que um usuário traz (planilha,
+    feeder, edição manual) fica em QuoteUser. As colunas de preço da carteira
+    (Asset.current_price, Option.underlying_price...) leem daqui (ver
+    _quoted); nenhum refresh copia preço para elas."""
+    __tablename__ = 'quote'
+    ticker     = db.Column(db.String(20), primary_key=True)
+    price      = db.Column(db.Float, nullable=False)
+    change_pct = db.Column(db.Float, nullable=True)          # variação % do dia
+    source     = db.Column(db.String(20), nullable=True)     # 'oplab' | 'fallback' | ...
+    ts         = db.Column(db.DateTime, nullable=False)      # hora de Brasília, sem tz
+    seq        = db.Column(db.Integer, nullable=True, index=True)  # relógio 'quote' na última publicação
+
+    @staticmethod
+    def watch(user_id, tickers):
+        """Anota os tickers de um objeto recém-carregado: a primeira leitura
+        de preço no contexto resolve todos os anotados numa consulta só."""
+        if has_app_context():
+            users, tks = g.setdefault('_quotes_pending', (set(), set()))
+            if user_id is not None:
+                users.add(user_id)
+            tks.update(t.strip().upper() for t in tickers if t)
+
+    @staticmethod
+    def resolve(user_id, tickers):
+        """{ticker: (preço, variação, ts)} do que o usuário vê — quote ou
+        quote_user, o mais recente (quote_store.resolve). Memoizado no
+        contexto do app (g) junto com os tickers anotados por watch()."""
+        wanted = {str(t).strip().upper() for t in tickers if t}
+        if user_id is None or not wanted or not has_app_context():
+            return {}
+        memo = g.setdefault('_quotes', {})
+        falta = {t for t in wanted if (user_id, t) not in memo}
+        if falta:
+            users, tks = g.setdefault('_quotes_pending', (set(), set()))
+            users, tks = users | {user_id}, tks | falta
+            found = quote_store.resolve(db.session, users, tks)
+            for u in users:
+                for t in tks:
+                    memo[(u, t)] = found.get((u, t))
+            g._quotes_pending = (set(), set())
+        return {t: memo[(user_id, t)] for t in wanted if memo[(user_id, t)]}
+
+    @staticmethod
+    def lookup(user_id, ticker):
+        """(preço, variação, ts) de um ticker para o usuário, ou None."""
+        if not ticker or user_id is None or not has_app_context():
+            return None
+        t = ticker.strip().upper()
+        memo = g.get('_quotes')
+        if memo is not None and (user_id, t) in memo:
+            return memo[(user_id, t)]
+        return Quote.resolve(user_id, [t]).get(t)
+
+    @staticmethod
+    def forget():
+        """Descarta o memo do contexto — chamar depois de gravar cotações."""
+        if has_app_context():
+            g.pop('_quotes', None)
+
+    @staticmethod
+    def publish(conn, tickers, user_ids=None, now=None, private=False):
+        """Publica `tickers` (já gravados em quote ou quote_user) para
+        `user_ids` — None = todos os usuários — para o stream ao vivo e o
+        `since` de /api/current_quotes.
+
+        Incrementa o relógio global (escopo 'quote', user_id 0), carimba
+        quote.seq dos tickers com ele e leva a versão dos usuários até ele:
+        "o que mudou para o usuário desde v" vira `quote.seq > v`.
+        private=True: preços que os `user_ids` trouxeram — o carimbo vai para
+        quote_user.seq deles. `conn` é uma conexão/sessão com transação
+        aberta; o commit fica com quem chama. Retorna a versão."""
+        from sqlalchemy import text
+        now = now or datetime.utcnow()
+        version_counter.bump(conn, 'quote', [0], now)
+        v = version_counter.get(conn, 'quote', [0])[0]
+        tks = [{'t': t, 'v': v} for t in {str(t).upper().strip() for t in tickers if t}]
+        if tks and private:
+            conn.execute(text('UPDATE quote_user SET seq = :v WHERE user_id = :u AND ticker = :t'),
+                         [dict(r, u=int(u)) for u in set(user_ids or ()) for r in tks])
+        elif tks:
+            conn.execute(text('UPDATE quote SET seq = :v WHERE ticker = :t'), tks)
+        version_counter.set_to(conn, 'quote', user_ids, v, now)
+        return v
+
+
+class QuoteUser(db.Model):
+    """Preço que o próprio usuário trouxe para um ticker: planilha, feeder
+    MT5 (/api/update_quotes), MT5 com usuário, edição manual. Só ele vê, e
+    só enquanto for mais recente que a cotação de mercado em quote.
+    seq: relógio 'quote' da publicação (ver Quote.publish)."""
+    __tablename__ = 'quote_user'
+    user_id    = db.Column(db.Integer, primary_key=True)
+    ticker     = db.Column(db.String(20), primary_key=True)
+    price      = db.Column(db.Float, nullable=False)
+    change_pct = db.Column(db.Float, nullable=True)
+    source     = db.Column(db.String(20), nullable=True)     # 'excel' | 'feeder' | 'mt5' | 'yahoo' | 'manual'
+    ts         = db.Column(db.DateTime, nullable=False)      # hora de Brasília, sem tz
+    seq        = db.Column(db.Integer, nullable=True)
+
+    @staticmethod
+    def manual(user_id, ticker, antes, novo, ts):
+        """Preço digitado numa tela de edição: vira a cotação do usuário para
+        o ticker (source 'manual') se difere do que ele via — os formulários
+        vêm preenchidos com o valor atual em centavos, então diferença menor
+        que meio centavo é só arredondamento. Na db.session, sem commit.
+        Retorna True se gravou."""
+        if not ticker or novo is None or novo <= 0:
+            return False
+        if antes is not None and abs(novo - antes) < 0.005:
+            return False
+        quote_store.upsert_user(db.session, user_id, [(ticker.strip().upper(), float(novo), None)], 'manual', ts)
+        Quote.forget()
+        return True
+
+
+def _watch_quotes(target, _ctx):
+    Quote.watch(getattr(target, 'user_id', None), [getattr(target, a) for a in target._quote_tickers])
+
+
+for _cls in (Asset, Option, OptionSpread, StudyOption, StructuredOp, StructuredLeg, PutSale):
+    event.listen(_cls, 'load', _watch_quotes)
+
+
+class VersionCounter(db.Model):
+    """Contador de versão por (escopo, usuário): 'pm' (resumo do Preço Médio),
+    'settings' (cache de Settings) e 'quote' (stream de cotações; user_id 0
+    é o relógio global). Ver version_counter.py."""
+    __tablename__ = 'version_counter'
+    scope      = db.Column(db.String(20), primary_key=True)
+    user_id    = db.Column(db.Integer, primary_key=True)
+    version    = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
+class OptionChainCache(db.Model):
+    """Última cadeia de opções baixada da OpLab por ativo-objeto.
+
+    Compartilhada entre os workers do gunicorn: quem baixa grava aqui, os
+    demais leem em vez de repetir a chamada (ver _oplab_chain em app.py)."""
+    __tablename__ = 'option_chain_cache'
+    underlying = db.Column(db.String(20), primary_key=True)
+    fetched_at = db.Column(db.DateTime,   nullable=False, default=datetime.utcnow)
+    chain_gz   = db.Column(db.LargeBinary, nullable=False)   # JSON gzip da lista crua
+
+
 class VolHistCache(db.Model):
-    """Cache da série histórica de volatilidade (implícita + histórica) por ticker.
+    """Formato antigo da série de volatilidade (um blob gzip por ticker). Só é
+    lido para semear vol_hist_day na primeira consulta do ticker.
 
     A VI de cada dia é a das opções mais próximas do dinheiro (ATM) — mesmo
     critério do Opções.Net. A série bruta da OpLab traz uma linha por opção
@@ -622,6 +963,33 @@ class VolHistCache(db.Model):
     series_gz  = db.Column(db.LargeBinary, nullable=False)  # JSON gzip: [{d, iv, hv}, ...]
 
 
+class VolHistDay(db.Model):
+    """Um ponto por (ticker, pregão): VI ATM, HV e as estatísticas da VI do dia
+    contra os 12 meses anteriores, já calculadas — ver vol_hist_store.py."""
+    __tablename__ = 'vol_hist_day'
+    ticker  = db.Column(db.String(20), primary_key=True)
+    d       = db.Column(db.String(10), primary_key=True)    # YYYY-MM-DD
+    iv      = db.Column(db.Float, nullable=True)            # VI ATM (%)
+    hv      = db.Column(db.Float, nullable=True)            # vol. histórica 25 pregões (%)
+    dtm     = db.Column(db.Integer, nullable=True)          # dias até o vencimento usado
+    iv_rank = db.Column(db.Float, nullable=True)
+    iv_pct  = db.Column(db.Float, nullable=True)            # percentil
+    iv_min  = db.Column(db.Float, nullable=True)
+    iv_max  = db.Column(db.Float, nullable=True)
+    iv_avg  = db.Column(db.Float, nullable=True)
+    n       = db.Column(db.Integer, nullable=True)          # dias com VI na janela
+
+
+class VolHistState(db.Model):
+    """Até quando a série do ticker foi conferida na OpLab, e com qual versão
+    do algoritmo de agregação (mudou a versão, a série é refeita)."""
+    __tablename__ = 'vol_hist_state'
+    ticker     = db.Column(db.String(20), primary_key=True)
+    algo       = db.Column(db.String(8),  nullable=False)
+    checked    = db.Column(db.String(10), nullable=False)   # YYYY-MM-DD da última consulta
+    fetched_at = db.Column(db.DateTime,   nullable=True)
+
+
 class UserChartLine(db.Model):
     """Linhas de tendência desenhadas pelo usuário no gráfico de candlestick."""
     __tablename__ = 'user_chart_lines'
@@ -685,3 +1053,47 @@ class RtdOptionData(db.Model):
     option_type     = db.Column(db.String(10), nullable=True)   # CALL / PUT
     imported_at     = db.Column(db.DateTime, default=datetime.utcnow)
     __table_args__ = (db.UniqueConstraint('user_id', 'ticker', name='uq_rtd_option_data'),)
+
+
+class SchedulerLease(db.Model):
+    """Lease do líder do agendador: só o worker que detém a linha (e a renova
+    antes de expirar) executa os jobs; os demais ficam ociosos. Se o líder
+    morrer, outro assume quando expires_at passar."""
+    __tablename__ = 'scheduler_lease'
+    name        = db.Column(db.String(40), primary_key=True)     # 'oplab'
+    holder      = db.Column(db.String(120), nullable=False)      # host:pid:uuid do worker
+    acquired_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at  = db.Column(db.DateTime, nullable=False)
+
+
+class SchedulerJob(db.Model):
+    """Estado persistente de cada job do agendador por usuário (hora de
+    Brasília sem tz, como os demais last_update). Sobrevive a restart e é o
+    mesmo para todos os workers."""
+    __tablename__ = 'scheduler_job'
+    job           = db.Column(db.String(40), primary_key=True)   # 'oplab' | 'snapshot' | 'prewarm'
+    user_id       = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    next_run_at   = db.Column(db.DateTime, nullable=True)
+    last_run_at   = db.Column(db.DateTime, nullable=True)
+    last_duration = db.Column(db.Float, nullable=True)           # segundos
+    last_status   = db.Column(db.String(200), nullable=True)     # 'ok' | 'manual' | 'offline' | mensagem de erro
+
+
+class BackgroundTask(db.Model):
+    """Tarefa em segundo plano disparada pela tela (cotações, importação da
+    B3, Ranking de Volatilidade, dividendos) — ver task_store.py. Hora de
+    Brasília sem tz."""
+    __tablename__ = 'bg_task'
+    id          = db.Column(db.String(36), primary_key=True)     # uuid4
+    kind        = db.Column(db.String(30), nullable=False)       # 'quotes' | 'b3_import' | 'ranking_vol' | 'dividends'
+    user_id     = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status      = db.Column(db.String(10), nullable=False, default='queued')  # queued | running | done
+    progress    = db.Column(db.Integer, nullable=True)           # 0–100; None = sem estimativa
+    msg         = db.Column(db.String(500), nullable=True)
+    category    = db.Column(db.String(10), nullable=True)        # success | warning | danger (quando done)
+    result_json = db.Column(db.Text, nullable=True)              # payload final da tarefa (JSON)
+    version     = db.Column(db.Integer, nullable=False, default=0)   # +1 a cada gravação (long-poll)
+    created_at  = db.Column(db.DateTime, nullable=False)
+    started_at  = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at  = db.Column(db.DateTime, nullable=False)
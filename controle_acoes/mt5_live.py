@@ -2,13 +2,22 @@
 """
 mt5_live.py — Atualizador de cotações para o Desktop App
 ==========================================================
-Roda em duas threads paralelas:
+Roda em threads paralelas:
 
-  • MT5Thread  — atualiza tickers mapeados em TICKER_MAP a cada 5 s
+  • MT5Thread   — lê os tickers mapeados em TICKER_MAP/OPTION_MAP a cada
+                  MT5_INTERVAL s (padrão 2 s) e entrega ao MT5Writer
+  • MT5Writer   — grava no banco o que mudou, em lote, sem travar a leitura
   • YahooThread — atualiza tickers NÃO mapeados via Yahoo Finance a cada 60 s
 
 Se o MT5 não estiver disponível, todos os tickers vão pelo Yahoo (60 s).
 A atualização é feita diretamente no SQLite via SQLAlchemy (sem HTTP).
+
+Leitura em pipeline: os símbolos são selecionados (symbol_select) uma vez na
+subida; cada ciclo lê os ticks numa passada só, sem sleep por símbolo —
+antes, um símbolo sem tick esperava até 3×0,3 s e uma opção ilíquida
+esticava o ciclo de 5 s para dezenas de segundos. Símbolo sem tick é
+re-selecionado e lido de novo no ciclo seguinte. get_metrics() expõe os
+tempos de ciclo (ver /api/mt5_live/metrics no app).
 """
 
 import sys
@@ -22,8 +31,9 @@ from zoneinfo import ZoneInfo
 logger = logging.getLogger('mt5_live')
 
 BR_TZ          = ZoneInfo('America/Sao_Paulo')
-MT5_INTERVAL   = 5    # segundos entre atualizações MT5
+MT5_INTERVAL   = float(os.environ.get('MT5_INTERVAL', '2'))   # segundos entre leituras MT5
 YAHOO_INTERVAL = 60   # segundos entre atualizações Yahoo
+METRICS_LOG_EVERY = 150   # ciclos entre linhas de resumo no log (~5 min a 2 s)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -65,29 +75,88 @@ def mt5_connect():
     return None
 
 
-def mt5_get_price(mt5, symbol, retries=3, wait=0.3):
-    """Retorna (price, change_pct) lendo do MT5. None se não disponível."""
-    tick = mt5.symbol_info_tick(symbol)
-    if tick is None:
-        mt5.symbol_select(symbol, True)
-        for _ in range(retries):
-            time.sleep(wait)
-            tick = mt5.symbol_info_tick(symbol)
-            if tick is not None:
-                break
-    if tick is None:
-        return None, None
+def mt5_select_symbols(mt5, symbols):
+    """symbol_select uma vez por símbolo (na subida e após reconectar), para
+    que o terminal já esteja recebendo os ticks quando o ciclo ler. Retorna
+    os símbolos que o terminal recusou."""
+    return [sym for sym in symbols if not mt5.symbol_select(sym, True)]
+
+
+def mt5_read_ticks(mt5, symbol_map, session_open):
+    """Lê {ticker_site: símbolo_mt5} numa passada, sem esperar ninguém.
+
+    Retorna ({ticker_site: (price, change_pct)}, [símbolos sem tick]).
+    session_open é o cache {símbolo: abertura do pregão} de quem chama — a
+    abertura não muda durante o dia, então symbol_info() só é chamado até
+    ela aparecer, e não a cada ciclo."""
+    out, misses = {}, []
+    for site, sym in symbol_map.items():
+        tick = mt5.symbol_info_tick(sym)
+        price = (tick.last if tick.last > 0 else tick.bid) if tick is not None else 0
+        if not price or price <= 0:
+            misses.append(sym)
+            continue
+        op = session_open.get(sym)
+        if op is None:
+            info = mt5.symbol_info(sym)
+            if info and info.session_open > 0:
+                op = session_open[sym] = info.session_open
+        change = round((price - op) / op * 100, 2) if op else 0.0
+        out[site] = (round(price, 2), change)
+    return out, misses
 
-    price = tick.last if tick.last > 0 else tick.bid
-    if price <= 0:
-        return None, None
 
-    info   = mt5.symbol_info(symbol)
-    change = 0.0
-    if info and info.session_open > 0:
-        change = round((price - info.session_open) / info.session_open * 100, 2)
+# ══════════════════════════════════════════════════════════════════════════════
+# Métricas do ciclo
+# ══════════════════════════════════════════════════════════════════════════════
 
-    return round(price, 2), change
+_metrics_lock = threading.Lock()
+_metrics = {
+    'interval_s': MT5_INTERVAL,
+    'cycles': 0, 'writes': 0, 'write_errors': 0,
+    'read_ms_last': None, 'read_ms_avg': None, 'read_ms_max': 0.0,
+    'write_ms_last': None, 'write_ms_avg': None, 'write_ms_max': 0.0,
+    'symbols': 0, 'misses_last': 0, 'changed_last': 0, 'rows_last': 0,
+    'overruns': 0,        # ciclos cuja leitura passou de MT5_INTERVAL
+    'last_cycle_at': None, 'last_write_at': None,
+}
+
+
+def _ewma(prev, x, alpha=0.1):
+    return x if prev is None else round(prev + alpha * (x - prev), 2)
+
+
+def _metrics_read(ms, symbols, misses, changed):
+    with _metrics_lock:
+        m = _metrics
+        m['cycles'] += 1
+        m['read_ms_last'] = round(ms, 2)
+        m['read_ms_avg'] = _ewma(m['read_ms_avg'], ms)
+        m['read_ms_max'] = max(m['read_ms_max'], round(ms, 2))
+        m['symbols'], m['misses_last'], m['changed_last'] = symbols, misses, changed
+        if ms > MT5_INTERVAL * 1000:
+            m['overruns'] += 1
+        m['last_cycle_at'] = datetime.now(BR_TZ).strftime('%H:%M:%S')
+
+
+def _metrics_write(ms, rows, ok=True):
+    with _metrics_lock:
+        m = _metrics
+        if not ok:
+            m['write_errors'] += 1
+            return
+        m['writes'] += 1
+        m['write_ms_last'] = round(ms, 2)
+        m['write_ms_avg'] = _ewma(m['write_ms_avg'], ms)
+        m['write_ms_max'] = max(m['write_ms_max'], round(ms, 2))
+        m['rows_last'] = rows
+        m['last_write_at'] = datetime.now(BR_TZ).strftime('%H:%M:%S')
+
+
+def get_metrics():
+    """Cópia das métricas do atualizador (tempos em ms)."""
+    with _metrics_lock:
+        return dict(_metrics)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -147,90 +216,183 @@ def yahoo_prices_batch(tickers: list) -> dict:
 # DB update helper
 # ══════════════════════════════════════════════════════════════════════════════
 
-def apply_prices(flask_app, prices: dict, option_prices: dict = None):
+def apply_prices(flask_app, prices: dict, option_prices: dict = None, user_id: int = None,
+                 source: str = 'mt5'):
     """
-    Aplica preços no banco de dados.
+    Grava os preços na tabela de cotações, uma linha por ticker e um commit
+    só; a carteira lê de lá (ver models._quoted).
     prices        = {ticker: (price, change_pct)}
     option_prices = {ticker: price}
+    user_id       = feed de um usuário; None = de todos (desktop)
+    source        = origem gravada na tabela quote ('mt5' | 'yahoo')
+    Com user_id o feed é daquele usuário: vai para quote_user dele (a tabela
+    quote, comum a todos, não é tocada) e a publicação é private=True, como
+    nos feeders do servidor.
+    Retorna o número de linhas de Asset/Option com esses tickers.
     """
     if not prices and not option_prices:
-        return
+        return 0
+    option_prices = option_prices or {}
 
     now_dt = datetime.now(BR_TZ).replace(tzinfo=None)  # SQLite stores naive datetimes
 
     with flask_app.app_context():
-        from models import db, Asset, Option
+        import quote_store
+        from models import db, Asset, Option, Quote
+
+        rows = [(t.upper(), p, ch) for t, (p, ch) in prices.items()]
+        rows += [(t.upper(), p, None) for t, p in option_prices.items()]
+        if user_id is None:
+            quote_store.upsert(db.session, rows, source, now_dt)
+        else:
+            quote_store.upsert_user(db.session, user_id, rows, source, now_dt)
 
         count = 0
-        for ticker, (price, change) in prices.items():
-            asset = Asset.query.filter_by(ticker=ticker).first()
-            if asset:
-                asset.current_price = price
-                asset.daily_change  = change
-                asset.last_update   = now_dt
-                count += 1
-
-        if option_prices:
-            for ticker, price in option_prices.items():
-                opt = Option.query.filter_by(ticker=ticker).first()
-                if opt:
-                    opt.current_option_price = price
-                    count += 1
-
-        if count:
-            db.session.commit()
+        for model, tickers in ((Asset, list(prices)), (Option, list(option_prices))):
+            if tickers:
+                q = model.query.filter(model.ticker.in_(tickers))
+                if user_id is not None:
+                    q = q.filter(model.user_id == user_id)
+                count += q.count()
+
+        # Publica na mesma transação, então o stream só vê a versão junto com
+        # os preços
+        Quote.publish(db.session, list(prices) + list(option_prices),
+                      None if user_id is None else [user_id], now=now_dt, private=user_id is not None)
+        db.session.commit()
+        Quote.forget()
 
     return count
 
 
+class _PendingPrices:
+    """Preços lidos e ainda não gravados. O leitor deposita a cada ciclo; o
+    gravador leva tudo de uma vez. Se o gravador atrasar (lock do SQLite),
+    os ciclos seguintes se fundem aqui — o mais novo vence — em vez de
+    enfileirar gravações velhas."""
+
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._prices, self._options = {}, {}
+
+    def put(self, prices, options):
+        with self._cv:
+            self._prices.update(prices)
+            self._options.update(options)
+            if self._prices or self._options:
+                self._cv.notify()
+
+    def put_back(self, prices, options):
+        """Devolve uma gravação que falhou sem sobrescrever leituras mais novas."""
+        with self._cv:
+            for k, v in prices.items():
+                self._prices.setdefault(k, v)
+            for k, v in options.items():
+                self._options.setdefault(k, v)
+
+    def take(self, timeout=None):
+        with self._cv:
+            self._cv.wait_for(lambda: self._prices or self._options, timeout)
+            out = (self._prices, self._options)
+            self._prices, self._options = {}, {}
+            return out
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # Thread loops
 # ══════════════════════════════════════════════════════════════════════════════
 
-def mt5_thread_loop(flask_app, mt5_module, ticker_map: dict, option_map: dict):
+def mt5_writer_loop(flask_app, pending: _PendingPrices, user_id: int = None):
+    """Grava o que o MT5Thread deixou em `pending`, desacoplado da leitura."""
+    while True:
+        prices, options = pending.take()
+        if not prices and not options:
+            continue
+        t0 = time.perf_counter()
+        try:
+            rows = apply_prices(flask_app, prices, options, user_id=user_id)
+            _metrics_write((time.perf_counter() - t0) * 1000, rows)
+        except Exception as e:
+            logger.error(f"[MT5Writer] Erro: {e}")
+            _metrics_write(0, 0, ok=False)
+            pending.put_back(prices, options)
+            time.sleep(1)
+
+
+def mt5_thread_loop(flask_app, mt5_module, ticker_map: dict, option_map: dict,
+                    user_id: int = None):
     """
-    Atualiza a cada MT5_INTERVAL segundos os tickers presentes no TICKER_MAP.
+    Lê a cada MT5_INTERVAL segundos os tickers presentes no TICKER_MAP e no
+    OPTION_MAP e entrega ao MT5Writer só os que mudaram desde a última leitura.
     Se o MT5 desconectar, tenta reconectar automaticamente.
     """
     logger.info(f"[MT5Thread] Iniciado — intervalo {MT5_INTERVAL}s")
 
+    pending = _PendingPrices()
+    threading.Thread(target=mt5_writer_loop, args=(flask_app, pending, user_id),
+                     daemon=True, name='MT5Writer').start()
+
+    symbols = list(ticker_map.values()) + list(option_map.values())
+    recusados = mt5_select_symbols(mt5_module, symbols)
+    if recusados:
+        logger.warning(f"[MT5Thread] Símbolos não encontrados no MT5: {', '.join(recusados)}")
+
+    last_prices, last_options = {}, {}
+    session_open, session_day = {}, None
+    missing_since = {}          # símbolo → ciclos seguidos sem tick (só para o log)
+
     while True:
+        t0 = time.perf_counter()
         try:
             # Verifica conexão MT5
             if not mt5_module.terminal_info():
                 logger.warning("[MT5Thread] Conexão perdida, reconectando...")
                 mt5_module.initialize()
+                mt5_select_symbols(mt5_module, symbols)
                 time.sleep(2)
                 continue
 
-            prices       = {}
-            option_prices = {}
-            now_str      = datetime.now(BR_TZ).strftime('%H:%M:%S')
-
-            # Lê preços de ações/ETFs/FIIs/swings pelo ticker_map
-            for site_ticker, mt5_symbol in ticker_map.items():
-                price, change = mt5_get_price(mt5_module, mt5_symbol)
-                if price is not None:
-                    prices[site_ticker] = (price, change)
-                    logger.debug(f"  MT5 {site_ticker:12s} = R$ {price:.2f} ({change:+.2f}%)")
-
-            # Lê preços de opções pelo option_map
-            for site_ticker, mt5_symbol in option_map.items():
-                price, _ = mt5_get_price(mt5_module, mt5_symbol)
-                if price is not None:
-                    option_prices[site_ticker] = price
-
-            count = apply_prices(flask_app, prices, option_prices)
-            if count:
-                logger.info(f"[MT5Thread] {count} cotações atualizadas às {now_str}")
+            hoje = datetime.now(BR_TZ).date()
+            if hoje != session_day:
+                session_open.clear()
+                session_day = hoje
+
+            prices, miss_a = mt5_read_ticks(mt5_module, ticker_map, session_open)
+            opt_raw, miss_o = mt5_read_ticks(mt5_module, option_map, session_open)
+            option_prices = {k: p for k, (p, _c) in opt_raw.items()}
+
+            # Sem tick agora: re-seleciona (não bloqueia) e tenta no próximo ciclo
+            for sym in miss_a + miss_o:
+                mt5_module.symbol_select(sym, True)
+                missing_since[sym] = missing_since.get(sym, 0) + 1
+                if missing_since[sym] == 10:
+                    logger.warning(f"[MT5Thread] {sym} sem tick há 10 ciclos")
+            for sym in list(missing_since):
+                if sym not in miss_a and sym not in miss_o:
+                    del missing_since[sym]
+
+            changed_p = {k: v for k, v in prices.items() if last_prices.get(k) != v}
+            changed_o = {k: v for k, v in option_prices.items() if last_options.get(k) != v}
+            if changed_p or changed_o:
+                pending.put(changed_p, changed_o)
+                last_prices.update(changed_p)
+                last_options.update(changed_o)
+
+            _metrics_read((time.perf_counter() - t0) * 1000, len(symbols),
+                          len(miss_a) + len(miss_o), len(changed_p) + len(changed_o))
+            m = get_metrics()
+            if m['cycles'] % METRICS_LOG_EVERY == 0:
+                logger.info(f"[MT5Thread] ciclo leitura {m['read_ms_avg']} ms (máx {m['read_ms_max']}), "
+                            f"gravação {m['write_ms_avg']} ms (máx {m['write_ms_max']}), "
+                            f"{m['misses_last']} sem tick, {m['overruns']} ciclos estourados")
 
         except Exception as e:
             logger.error(f"[MT5Thread] Erro: {e}")
 
-        time.sleep(MT5_INTERVAL)
+        time.sleep(max(0.0, MT5_INTERVAL - (time.perf_counter() - t0)))
 
 
-def yahoo_thread_loop(flask_app, mapped_tickers: set):
+def yahoo_thread_loop(flask_app, mapped_tickers: set, user_id: int = None):
     """
     Atualiza a cada YAHOO_INTERVAL segundos os tickers NÃO presentes no TICKER_MAP.
     Se mapped_tickers estiver vazio (sem MT5), atualiza todos.
@@ -241,7 +403,8 @@ def yahoo_thread_loop(flask_app, mapped_tickers: set):
         try:
             with flask_app.app_context():
                 from models import Asset
-                all_assets    = Asset.query.all()
+                q = Asset.query if user_id is None else Asset.query.filter_by(user_id=user_id)
+                all_assets    = q.all()
                 yahoo_tickers = [
                     a.ticker for a in all_assets
                     if a.ticker not in mapped_tickers
@@ -250,7 +413,7 @@ def yahoo_thread_loop(flask_app, mapped_tickers: set):
             if yahoo_tickers:
                 logger.info(f"[YahooThread] Buscando {len(yahoo_tickers)} tickers...")
                 batch = yahoo_prices_batch(yahoo_tickers)
-                count = apply_prices(flask_app, batch)
+                count = apply_prices(flask_app, batch, user_id=user_id, source='yahoo')
                 now_str = datetime.now(BR_TZ).strftime('%H:%M:%S')
                 if count:
                     logger.info(f"[YahooThread] {count} cotações atualizadas às {now_str}")
@@ -267,11 +430,15 @@ def yahoo_thread_loop(flask_app, mapped_tickers: set):
 # Ponto de entrada público
 # ══════════════════════════════════════════════════════════════════════════════
 
-def start_updater(flask_app):
+def start_updater(flask_app, user_id: int = None):
     """
     Carrega a configuração e inicia as threads de atualização.
     Chamado pelo desktop_app.py após o Flask estar pronto.
+    user_id: grava só nas linhas desse usuário (padrão: MT5_LIVE_USER_ID do
+    ambiente, ou todos os usuários do banco local).
     """
+    if user_id is None and os.environ.get('MT5_LIVE_USER_ID'):
+        user_id = int(os.environ['MT5_LIVE_USER_ID'])
     ticker_map, option_map = load_maps()
     mt5 = mt5_connect()
 
@@ -279,7 +446,7 @@ def start_updater(flask_app):
         # Thread MT5 para tickers mapeados
         t1 = threading.Thread(
             target=mt5_thread_loop,
-            args=(flask_app, mt5, ticker_map, option_map),
+            args=(flask_app, mt5, ticker_map, option_map, user_id),
             daemon=True,
             name='MT5Thread',
         )
@@ -288,7 +455,7 @@ def start_updater(flask_app):
         # Thread Yahoo para os demais
         t2 = threading.Thread(
             target=yahoo_thread_loop,
-            args=(flask_app, set(ticker_map.keys())),
+            args=(flask_app, set(ticker_map.keys()), user_id),
             daemon=True,
             name='YahooThread',
         )
@@ -302,7 +469,7 @@ def start_updater(flask_app):
         # Sem MT5 → tudo pelo Yahoo
         t = threading.Thread(
             target=yahoo_thread_loop,
-            args=(flask_app, set()),   # set vazio = atualiza todos
+            args=(flask_app, set(), user_id),   # set vazio = atualiza todos
             daemon=True,
             name='YahooThread',
         )
@@ -0,0 +1,134 @@
+"""
+oplab_client.py — cliente HTTP da API OpLab (v3)
+================================================
+Session compartilhada com pool, retry dos erros transitórios e validação da
+resposta antes do JSON (OplabApiError com mensagem para a tela). Usado pelo
+app.py e pelos blueprints; o que depende do banco ou do usuário fica neles.
+"""
+import time
+
+import requests
+
+
+class OplabApiError(Exception):
+    def __init__(self, message, status_code=None, body_preview=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body_preview = body_preview
+
+
+def headers(token):
+    return {
+        'Access-Token': (token or '').strip(),
+        'Accept': 'application/json',
+        'User-Agent': 'MyInvest/1.0',
+    }
+
+
+# Session compartilhada: reaproveita a conexão TCP/TLS entre chamadas. Sem isso
+# cada request refaz o handshake (~380ms vs ~50ms medidos) — o que multiplicava
+# por 7 o tempo do Ranking de Volatilidade, que faz 100+ chamadas.
+# pool_maxsize acompanha o max_workers usado nas varreduras paralelas (8) para
+# as threads não ficarem em fila esperando conexão livre.
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=8, pool_maxsize=8, max_retries=0))
+
+
+# A OpLab faz rate-limiting: sob concorrência ela devolve 503 em parte das
+# chamadas (medido: 32% com 8 threads, 6% com 4, 0% com 2). Esses 503 são
+# transitórios — repetir depois de uma pausa curta resolve. Sem isso, o
+# Ranking marcava dezenas de tickers como "com falha" a cada atualização.
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def get_json(path_or_url, token, params=None, timeout=15, retries=2):
+    """GET OpLab com validacao de HTTP/conteudo antes de decodificar JSON.
+
+    Repete até `retries` vezes em erros transitórios (429/5xx), com backoff
+    exponencial curto (0,25s, 0,5s)."""
+    url = path_or_url if str(path_or_url).startswith('http') else f'https://api.oplab.com.br/v3{path_or_url}'
+    token = (token or '').strip()
+    params = dict(params or {})
+
+    def _request(use_query_token=False):
+        req_params = dict(params)
+        if use_query_token:
+            req_params['access_token'] = token
+        last_exc = None
+        for attempt in range(retries + 1):
+            try:
+                r = session.get(url, params=req_params,
+                                headers=headers(token), timeout=timeout)
+                if r.status_code in _RETRY_STATUS and attempt < retries:
+                    time.sleep(0.25 * (2 ** attempt))
+                    continue
+                return r
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError) as exc:
+                last_exc = exc
+                if attempt < retries:
+                    time.sleep(0.25 * (2 ** attempt))
+                    continue
+                raise
+        if last_exc:
+            raise last_exc
+        return r
+
+    try:
+        resp = _request(False)
+        body = (resp.text or '').strip()
+        # 401/403 com token no header não vira 200 ao repetir com token na query
+        # (é a mesma credencial) — repetir só dobra o tempo até o erro. O retry
+        # fica para o caso de resposta vazia/não-JSON, onde pode haver diferença.
+        retry_with_query = not body
+        if not retry_with_query:
+            if 200 <= resp.status_code < 300:
+                try:
+                    return resp.json()
+                except ValueError:
+                    retry_with_query = True
+        if retry_with_query:
+            resp = _request(True)
+            body = (resp.text or '').strip()
+    except requests.exceptions.Timeout as exc:
+        raise OplabApiError('A OpLab demorou para responder. Tente novamente em instantes.') from exc
+    except requests.exceptions.RequestException as exc:
+        raise OplabApiError(f'Nao foi possivel conectar na OpLab: {exc.__class__.__name__}') from exc
+
+    preview = body[:300]
+    if resp.status_code in (401, 403):
+        raise OplabApiError('Token OpLab recusado ou sem permissao para este endpoint.', resp.status_code, preview)
+    if resp.status_code == 404:
+        raise OplabApiError('Endpoint ou ticker nao encontrado na OpLab.', resp.status_code, preview)
+    if resp.status_code < 200 or resp.status_code >= 300:
+        raise OplabApiError(f'OpLab retornou HTTP {resp.status_code}.', resp.status_code, preview)
+    if not body:
+        raise OplabApiError('OpLab retornou resposta vazia.', resp.status_code)
+    try:
+        return resp.json()
+    except ValueError as exc:
+        raise OplabApiError('OpLab retornou resposta invalida em vez de JSON.', resp.status_code, preview) from exc
+
+
+def is_available(token: str, timeout: int = 4) -> bool:
+    """
+    Probe rápido de disponibilidade do servidor OpLab.
+    Retorna True se responder com 2xx ou 4xx (token inválido mas servidor OK).
+    Retorna False em timeout, ConnectionError ou 5xx (servidor fora do ar).
+
+    Usa /market/status (endpoint mais leve da spec v3). O antigo /user/me não
+    existe na v3 e devolvia 404 — como 404 < 500, o probe passava mesmo assim,
+    mas gastava uma ida à rede sem validar nada de útil.
+    """
+    try:
+        r = session.get(
+            'https://api.oplab.com.br/v3/market/status',
+            headers=headers(token),
+            timeout=timeout,
+        )
+        return r.status_code < 500
+    except (requests.exceptions.Timeout,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.RequestException):
+        return False
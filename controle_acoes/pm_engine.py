@@ -0,0 +1,56 @@
+"""
+pm_engine.py — atribuição em lote dos créditos do Preço Médio didático
+=====================================================================
+`roots` monta o mapa raiz B3 → tickers (só raízes inequívocas na carteira) e
+`underlyings` diz a que tickers pertence cada trade de opções, para o app
+atribuir dividendos e trades de todos os tickers numa passada. `bump`
+incrementa a versão 'pm' (version_counter) de quem teve mudança que entra no
+PM; o resumo em memória do app vale enquanto ela não muda.
+"""
+from sqlalchemy import bindparam, text
+
+import version_counter
+
+
+def roots(tickers, held):
+    """{raiz B3: [tickers]} dos `tickers` cuja raiz é inequívoca: um único
+    papel de `held` (ações/FIIs em carteira) começa por ela. PETR3 × PETR4
+    ficam de fora — a raiz não diz qual dos dois."""
+    held = [h.upper() for h in held]
+    out = {}
+    for tk in tickers:
+        root = tk[:4].upper()
+        if sum(1 for h in held if h.startswith(root)) == 1:
+            out.setdefault(root, []).append(tk)
+    return out
+
+
+def underlyings(und, tk, notes, tickers, root_map):
+    """Tickers (dentre `tickers`) a que pertence um trade de opções.
+
+    Casa pelo underlying preenchido; registros ANTIGOS sem underlying casam
+    pelo ticker da própria operação, pelos dois primeiros segmentos de notes
+    (close_estruturada grava "{subjacente} | ...", close_spread
+    "{tipo} | {subjacente} | ...") ou pela raiz B3 do ticker da opção
+    (ABEVA148 → ABEV → ABEV3), se estiver em `root_map`."""
+    und = (und or '').strip().upper()
+    if und:
+        return [und] if und in tickers else []
+    tk = (tk or '').strip().upper()
+    parts = (notes or '').split('|')
+    cand = {tk} | {p.strip().upper() for p in parts[:2]}
+    out = [t for t in cand if t in tickers]
+    out += [t for t in root_map.get(tk[:4], ()) if t not in out]
+    return out
+
+
+def bump(conn, now, user_ids=(), asset_ids=()):
+    """Incrementa a versão dos usuários informados — direto ou pelo dono dos
+    `asset_ids` (dividendos só conhecem o ativo). Não faz commit."""
+    users = {int(u) for u in user_ids if u is not None}
+    asset_ids = sorted({int(a) for a in asset_ids if a is not None})
+    if asset_ids:
+        users.update(r[0] for r in conn.execute(
+            text('SELECT DISTINCT user_id FROM asset WHERE id IN :a').bindparams(bindparam('a', expanding=True)),
+            {'a': asset_ids}))
+    return version_counter.bump(conn, 'pm', users, now)
@@ -0,0 +1,87 @@
+"""
+price_history.py — fechamentos diários persistidos (reconstrução da B3)
+=======================================================================
+price_history guarda o fechamento por (ticker, data) e price_history_range o
+intervalo contíguo já consultado de cada ticker (feriado e papel sem negócio
+também contam); missing_ranges devolve só os trechos fora dele. O dia
+corrente nunca entra na cobertura, porque o fechamento de hoje ainda muda.
+O download fica no app (_fetch_close_history); aqui é só o armazenamento.
+"""
+from datetime import date, timedelta
+
+from sqlalchemy import bindparam, text
+
+
+def _d(x):
+    return x if isinstance(x, date) else date.fromisoformat(x)
+
+
+def coverage(conn):
+    """{ticker: (d_from, d_to)} de tudo que já foi consultado."""
+    rows = conn.execute(text('SELECT ticker, d_from, d_to FROM price_history_range')).fetchall()
+    return {tk: (_d(a), _d(b)) for tk, a, b in rows}
+
+
+def missing_ranges(conn, tickers, start, end):
+    """{ticker: [(ini, fim), ...]} — trechos de [start, end] ainda não
+    consultados. No máximo dois por ticker: antes e depois da cobertura."""
+    cov = coverage(conn)
+    out = {}
+    for tk in tickers:
+        c = cov.get(tk)
+        if c is None:
+            out[tk] = [(start, end)]
+            continue
+        gaps = []
+        if start < c[0]:
+            gaps.append((start, min(end, c[0] - timedelta(days=1))))
+        if end > c[1]:
+            gaps.append((max(start, c[1] + timedelta(days=1)), end))
+        if gaps:
+            out[tk] = gaps
+    return out
+
+
+def save(conn, closes):
+    """Grava {ticker: {data_iso: fechamento}} (substitui datas repetidas).
+    Não faz commit."""
+    rows = [{'t': tk, 'd': d, 'c': float(c)}
+            for tk, series in closes.items() for d, c in series.items()]
+    if rows:
+        conn.execute(text('INSERT OR REPLACE INTO price_history (ticker, d, close) VALUES (:t, :d, :c)'),
+                     rows)
+    return len(rows)
+
+
+def mark_covered(conn, ranges, through, now=None):
+    """Estende a cobertura com os trechos consultados ({ticker: (ini, fim)}),
+    cortando em `through` (o dia corrente fica de fora). Os trechos vêm de
+    missing_ranges, então são sempre vizinhos da cobertura atual e a união
+    continua contígua."""
+    cov = coverage(conn)
+    rows = []
+    for tk, (a, b) in ranges.items():
+        b = min(b, through)
+        if b < a:
+            continue
+        if tk in cov:
+            a, b = min(a, cov[tk][0]), max(b, cov[tk][1])
+        rows.append({'t': tk, 'a': a.isoformat(), 'b': b.isoformat(), 'u': now})
+    if rows:
+        conn.execute(text('INSERT OR REPLACE INTO price_history_range (ticker, d_from, d_to, updated_at) '
+                          'VALUES (:t, :a, :b, :u)'), rows)
+    return len(rows)
+
+
+def load(conn, tickers, start, end):
+    """{ticker: {data_iso: fechamento}} no período, só dos tickers pedidos."""
+    out = {}
+    if not tickers:
+        return out
+    rows = conn.execute(text('SELECT ticker, d, close FROM price_history '
+                             'WHERE ticker IN :t AND d >= :a AND d <= :b ORDER BY ticker, d')
+                        .bindparams(bindparam('t', expanding=True)),
+                        {'t': sorted(set(tickers)), 'a': start.isoformat(), 'b': end.isoformat()})
+    for tk, d, c in rows:
+        out.setdefault(tk, {})[d] = c
+    return out
@@ -0,0 +1,419 @@
+"""
+pricing.py — Black-Scholes escalar e vetorizado (NumPy)
+=========================================================
+As telas de cadeia (busca de operações, manejo de PUT, lançamento coberto,
+venda de PUT longa) extraem a VI de cada strike de cada vencimento. Com a
+bissecção escalar antiga (60 chamadas de BS por strike) isso virava milhares
+de chamadas Python por request em ativos líquidos como PETR4/VALE3.
+
+Aqui ficam:
+  • as versões escalares (norm_cdf, bs_price, implied_vol) — usadas pelo
+    app.py nos pontos que tratam uma opção por vez;
+  • as versões vetorizadas (*_vec), que recebem arrays de (S, K, T, r, sigma,
+    is_call) e resolvem a cadeia inteira de uma vez;
+  • ChainIV, memo de VI por (símbolo, tipo, T) que as rotas de cadeia
+    "aquecem" com uma única chamada vetorizada por vencimento.
+
+A normal acumulada usa a mesma aproximação de Abramowitz & Stegun (26.2.17)
+nas duas versões, para que a VI vetorizada bata com a escalar.
+"""
+import math
+
+import numpy as np
+
+# Faixa de busca da VI — a mesma da bissecção original. Quem chama descarta
+# resultados colados nas bordas (iv <= 0.006 ou >= 4.9) como "não convergiu".
+IV_LO = 0.001
+IV_HI = 5.0
+IV_DEFAULT = 0.30   # devolvida quando não há prêmio ou prazo
+
+_A1, _A2, _A3, _A4, _A5 = 0.319381530, -0.356563782, 1.781477937, -1.821255978, 1.330274429
+_SQRT_2PI = math.sqrt(2 * math.pi)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# Escalar
+# ══════════════════════════════════════════════════════════════════════════════
+
+def norm_cdf(x):
+    """Aproximação de Abramowitz & Stegun para N(x)."""
+    t = 1.0 / (1.0 + 0.2316419 * abs(x))
+    poly = t * (_A1 + t * (_A2 + t * (_A3 + t * (_A4 + t * _A5))))
+    pdf  = math.exp(-0.5 * x * x) / _SQRT_2PI
+    c    = 1.0 - pdf * poly
+    return c if x >= 0 else 1.0 - c
+
+
+def bs_price(S, K, T, r, sigma, is_call):
+    """Black-Scholes para call ou put."""
+    if T <= 0 or sigma <= 0 or S <= 0 or K <= 0:
+        return max(0.0, (S - K) if is_call else (K - S))
+    d1 = (math.log(S / K) + (r + 0.5 * sigma * sigma) * T) / (sigma * math.sqrt(T))
+    d2 = d1 - sigma * math.sqrt(T)
+    if is_call:
+        return S * norm_cdf(d1) - K * math.exp(-r * T) * norm_cdf(d2)
+    return K * math.exp(-r * T) * norm_cdf(-d2) - S * norm_cdf(-d1)
+
+
+def implied_vol(S0, K, T, r, target, is_call, tol=1e-8, max_iter=60):
+    """IV a partir do prêmio: Newton protegido por bracket [IV_LO, IV_HI].
+
+    Mesmo contrato da bissecção antiga: prêmio acima do BS(IV_HI) devolve
+    IV_HI, abaixo do BS(IV_LO) devolve IV_LO. Newton converge em 3-6 passos;
+    quando o passo sai do bracket (vega ~0 em opções muito fora do dinheiro)
+    cai para bissecção naquele passo."""
+    if target <= 0 or T <= 0:
+        return IV_DEFAULT
+    if S0 <= 0 or K <= 0:
+        return IV_LO
+    lo, hi = IV_LO, IV_HI
+    if bs_price(S0, K, T, r, hi, is_call) <= target:
+        return hi
+    if bs_price(S0, K, T, r, lo, is_call) >= target:
+        return lo
+    sq = math.sqrt(T)
+    log_sk = math.log(S0 / K)
+    sigma = _initial_guess(S0, K, T, r, target)
+    for _ in range(max_iter):
+        diff = bs_price(S0, K, T, r, sigma, is_call) - target
+        if diff == 0:
+            return sigma
+        if diff < 0:
+            lo = sigma
+        else:
+            hi = sigma
+        d1 = (log_sk + (r + 0.5 * sigma * sigma) * T) / (sigma * sq)
+        vega = S0 * math.exp(-0.5 * d1 * d1) / _SQRT_2PI * sq
+        nxt = sigma - diff / vega if vega > 1e-12 else lo - 1.0
+        if not (lo < nxt < hi):
+            nxt = 0.5 * (lo + hi)
+        if abs(nxt - sigma) < tol or hi - lo < tol:
+            return nxt
+        sigma = nxt
+    return sigma
+
+
+def _initial_guess(S, K, T, r, price):
+    """Chute de Brenner-Subrahmanyam ajustado para moneyness, preso ao bracket."""
+    fwd = S * math.exp(r * T)
+    guess = math.sqrt(2 * math.pi / T) * price / S + abs(math.log(fwd / K)) / math.sqrt(T)
+    return min(max(guess, 0.05), 3.0)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# Vetorizado
+# ══════════════════════════════════════════════════════════════════════════════
+
+def _arrays(*args):
+    return np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in args))
+
+
+def norm_cdf_vec(x):
+    """N(x) elemento a elemento (mesma aproximação de norm_cdf)."""
+    x = np.asarray(x, dtype=float)
+    ax = np.abs(x)
+    t = 1.0 / (1.0 + 0.2316419 * ax)
+    poly = t * (_A1 + t * (_A2 + t * (_A3 + t * (_A4 + t * _A5))))
+    c = 1.0 - np.exp(-0.5 * ax * ax) / _SQRT_2PI * poly
+    return np.where(x >= 0, c, 1.0 - c)
+
+
+def norm_pdf_vec(x):
+    x = np.asarray(x, dtype=float)
+    return np.exp(-0.5 * x * x) / _SQRT_2PI
+
+
+def _d1_d2(S, K, T, r, sigma):
+    """d1/d2 só onde os inputs são válidos; nas demais posições devolve 0
+    (o chamador mascara o resultado com `ok`)."""
+    ok = (T > 0) & (sigma > 0) & (S > 0) & (K > 0)
+    Ts = np.where(ok, T, 1.0)
+    ss = np.where(ok, sigma, 1.0)
+    sq = np.sqrt(Ts)
+    d1 = (np.log(np.where(ok, S, 1.0) / np.where(ok, K, 1.0)) + (r + 0.5 * ss * ss) * Ts) / (ss * sq)
+    d2 = d1 - ss * sq
+    return ok, d1, d2, sq
+
+
+def bs_price_vec(S, K, T, r, sigma, is_call):
+    """Black-Scholes sobre arrays (broadcast). Inputs inválidos → intrínseco."""
+    S, K, T, r, sigma, is_call = _arrays(S, K, T, r, sigma, is_call)
+    is_call = is_call.astype(bool)
+    ok, d1, d2, _ = _d1_d2(S, K, T, r, sigma)
+    disc = K * np.exp(-r * np.where(ok, T, 0.0))
+    call = S * norm_cdf_vec(d1) - disc * norm_cdf_vec(d2)
+    put = disc * norm_cdf_vec(-d2) - S * norm_cdf_vec(-d1)
+    intrinsic = np.maximum(0.0, np.where(is_call, S - K, K - S))
+    return np.where(ok, np.where(is_call, call, put), intrinsic)
+
+
+def bs_greeks_vec(S, K, T, r, sigma, is_call):
+    """Equivalente vetorizado de `_bs_greeks` do app.py.
+
+    Devolve dict de arrays: delta, gamma, theta (por dia), vega e rho (por 1 p.p.).
+    Posições com inputs inválidos ficam NaN."""
+    S, K, T, r, sigma, is_call = _arrays(S, K, T, r, sigma, is_call)
+    is_call = is_call.astype(bool)
+    ok, d1, d2, sq = _d1_d2(S, K, T, r, sigma)
+    Ts = np.where(ok, T, 1.0)
+    ss = np.where(ok, sigma, 1.0)
+    Ss = np.where(ok, S, 1.0)
+    pdf = norm_pdf_vec(d1)
+    disc = K * np.exp(-r * Ts)
+    n_d1, n_d2 = norm_cdf_vec(d1), norm_cdf_vec(d2)
+    gamma = pdf / (Ss * ss * sq)
+    vega = Ss * pdf * sq / 100
+    decay = -Ss * pdf * ss / (2 * sq)
+    delta = np.where(is_call, n_d1, n_d1 - 1)
+    theta = np.where(is_call, decay - r * disc * n_d2, decay + r * disc * (1 - n_d2)) / 365
+    rho = np.where(is_call, disc * Ts * n_d2, -disc * Ts * (1 - n_d2)) / 100
+    nan = np.nan
+    return {
+        'delta': np.where(ok, delta, nan),
+        'gamma': np.where(ok, gamma, nan),
+        'theta': np.where(ok, theta, nan),
+        'vega':  np.where(ok, vega, nan),
+        'rho':   np.where(ok, rho, nan),
+    }
+
+
+def _bs_core(s, k, t, r, sigma, c, sq, log_sk):
+    """BS + d1 para arrays já validados (sem máscaras) — miolo do solver."""
+    d1 = (log_sk + (r + 0.5 * sigma * sigma) * t) / (sigma * sq)
+    d2 = d1 - sigma * sq
+    disc = k * np.exp(-r * t)
+    call = s * norm_cdf_vec(d1) - disc * norm_cdf_vec(d2)
+    price = np.where(c, call, call - s + disc)   # paridade put-call
+    return price, d1
+
+
+def implied_vol_vec(S, K, T, r, price, is_call, tol=1e-8, max_iter=60):
+    """VI de arrays inteiros — Newton vetorizado com bracket por elemento.
+
+    Mesmo contrato de `implied_vol`: sem prêmio/prazo → IV_DEFAULT; prêmio fora
+    do alcance de [IV_LO, IV_HI] → a borda correspondente. Elementos que já
+    convergiram ficam congelados; o laço para quando todos convergem."""
+    S, K, T, r, price, is_call = _arrays(S, K, T, r, price, is_call)
+    is_call = is_call.astype(bool)
+    out = np.full(S.shape, IV_DEFAULT)
+    valid = (price > 0) & (T > 0)
+    bad_sk = valid & ((S <= 0) | (K <= 0))
+    out[bad_sk] = IV_LO
+    valid &= ~bad_sk
+    if not valid.any():
+        return out
+
+    s, k, t, rr, p, c = S[valid], K[valid], T[valid], r[valid], price[valid], is_call[valid]
+    sq = np.sqrt(t)
+    log_sk = np.log(s / k)
+    lo = np.full(s.shape, IV_LO)
+    hi = np.full(s.shape, IV_HI)
+
+    above = _bs_core(s, k, t, rr, hi, c, sq, log_sk)[0] <= p
+    below = ~above & (_bs_core(s, k, t, rr, lo, c, sq, log_sk)[0] >= p)
+    active = ~(above | below)
+
+    sigma = np.sqrt(2 * np.pi / t) * p / s + np.abs(log_sk + rr * t) / sq
+    sigma = np.clip(sigma, 0.05, 3.0)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            px, d1 = _bs_core(s, k, t, rr, sigma, c, sq, log_sk)
+            diff = px - p
+            lo = np.where(active & (diff < 0), sigma, lo)
+            hi = np.where(active & (diff > 0), sigma, hi)
+            vega = s * norm_pdf_vec(d1) * sq
+            nxt = np.where(vega > 1e-12, sigma - diff / vega, -1.0)
+            nxt = np.where((lo < nxt) & (nxt < hi), nxt, 0.5 * (lo + hi))
+            done = (diff == 0) | (np.abs(nxt - sigma) < tol) | ((hi - lo) < tol)
+            sigma = np.where(active & (diff != 0), nxt, sigma)
+            active &= ~done
+
+    res = np.where(above, IV_HI, np.where(below, IV_LO, sigma))
+    out[valid] = res
+    return out
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# Memo de VI por cadeia
+# ══════════════════════════════════════════════════════════════════════════════
+
+def chain_premium(row):
+    """Prêmio de referência de uma linha da cadeia: último negócio ou mid."""
+    return row['close'] or ((row['bid'] + row['ask']) / 2 if (row['bid'] and row['ask']) else 0)
+
+
+class ChainIV:
+    """VI bruta por (símbolo, tipo, T, prêmio) para uma cadeia com spot e taxa fixos.
+
+    As rotas chamam `prime()` uma vez por vencimento com todas as linhas —
+    resolve o vencimento inteiro numa chamada vetorizada. `get()` devolve o
+    valor memorizado; o que não foi aquecido (outro T, linha avulsa) é
+    resolvido na hora e também memorizado.
+
+    `get()` devolve None quando não há prêmio ou ele não supera o intrínseco
+    em 0,5% (VI indefinida) — a mesma regra que as rotas já aplicavam."""
+
+    def __init__(self, spot, r):
+        self.spot = spot
+        self.r = r
+        self._memo = {}
+
+    @staticmethod
+    def _key(row, is_call, T):
+        # O prêmio entra na chave: rotas que reescrevem bid/ask da linha
+        # (preço efetivo) mudam o mid e não podem herdar a VI da original.
+        return (row['symbol'], bool(is_call), round(T, 10), chain_premium(row))
+
+    def _eligible(self, row, is_call, T):
+        prem = chain_premium(row)
+        K = row['strike']
+        if not prem or T <= 0 or not K or not self.spot:
+            return None
+        intr = max(0.0, (self.spot - K) if is_call else (K - self.spot))
+        if prem <= intr * 1.005:
+            return None
+        return prem
+
+    def prime(self, rows, is_call, T):
+        self.prime_many([(rows, is_call, T)])
+
+    def prime_many(self, groups):
+        """Aquece vários (linhas, is_call, T) numa única chamada vetorizada —
+        o custo fixo do NumPy por iteração é pago uma vez para a cadeia toda."""
+        todo, strikes, prems, Ts, calls = [], [], [], [], []
+        for rows, is_call, T in groups:
+            for row in rows:
+                key = self._key(row, is_call, T)
+                if key in self._memo:
+                    continue
+                prem = self._eligible(row, is_call, T)
+                if prem is None:
+                    self._memo[key] = None
+                    continue
+                self._memo[key] = None     # reserva a chave (linhas repetidas)
+                todo.append(key)
+                strikes.append(row['strike'])
+                prems.append(prem)
+                Ts.append(T)
+                calls.append(bool(is_call))
+        if not todo:
+            return
+        ivs = implied_vol_vec(self.spot, strikes, Ts, self.r, prems, calls)
+        for key, iv in zip(todo, ivs):
+            self._memo[key] = float(iv)
+
+    def get(self, row, is_call, T):
+        key = self._key(row, is_call, T)
+        if key not in self._memo:
+            prem = self._eligible(row, is_call, T)
+            self._memo[key] = (None if prem is None else
+                               implied_vol(self.spot, row['strike'], T, self.r, prem, is_call))
+        return self._memo[key]
+
+
+def chain_delta_pct(spot, r, strikes, premiums, T, is_call):
+    """Delta (escala ±100) de várias opções de uma vez, com a VI extraída do
+    prêmio. Devolve lista com None onde o prêmio não supera o intrínseco em
+    0,5% ou a VI não converge (mesmos cortes das rotas de cadeia)."""
+    if not len(strikes):
+        return []
+    K = np.asarray(strikes, dtype=float)
+    P = np.asarray(premiums, dtype=float)
+    T = np.broadcast_to(np.asarray(T, dtype=float), K.shape)
+    intr = np.maximum(0.0, (spot - K) if is_call else (K - spot))
+    iv = implied_vol_vec(spot, K, T, r, P, is_call)
+    ok = (P > intr * 1.005) & (iv > 0.005) & (iv < 4.9)
+    delta = bs_greeks_vec(spot, K, T, r, np.where(ok, iv, 1.0), is_call)['delta']
+    return [round(float(d) * 100, 1) if o else None for d, o in zip(delta, ok)]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# Probabilidade de lucro (POP)
+# ══════════════════════════════════════════════════════════════════════════════
+
+def lognormal_cdf(x, S, T, sigma, r=0.0):
+    """P(S_T <= x) sob a log-normal risk-neutral de Black-Scholes (vetorizado).
+    x <= 0 → 0; x = inf → 1."""
+    x = np.asarray(x, dtype=float)
+    mu = math.log(S) + (r - 0.5 * sigma * sigma) * T
+    sd = sigma * math.sqrt(T)
+    with np.errstate(divide='ignore'):
+        z = (np.log(np.where(x > 0, x, 1.0)) - mu) / sd
+    return np.where(x > 0, np.where(np.isinf(x), 1.0, norm_cdf_vec(z)), 0.0)
+
+
+def payoff_legs(base, legs, r=0.0):
+    """Payoff no vencimento como função vetorizada de S.
+
+    base: valor fixo (crédito/débito líquido + ajustes já realizados).
+    legs: iteráveis (q, tipo, K, T_rem, iv) com q já com sinal (+compra,
+    −venda) e tipo 'CALL'/'PUT'/'STOCK'. T_rem > 0 reprecifica a perna por
+    Black-Scholes com o tempo que sobra (perna longa de calendário); T_rem = 0
+    usa o intrínseco."""
+    legs = list(legs)
+
+    def fn(S):
+        S = np.asarray(S, dtype=float)
+        total = np.full(S.shape, float(base))
+        for q, kind, K, T_rem, iv in legs:
+            if kind == 'STOCK':
+                total += q * S
+            elif T_rem and T_rem > 0:
+                total += q * bs_price_vec(S, K, T_rem, r, iv, kind == 'CALL')
+            elif kind == 'CALL':
+                total += q * np.maximum(0.0, S - K)
+            else:
+                total += q * np.maximum(0.0, K - S)
+        return total
+    return fn
+
+
+def pop_closed_form(S, T, sigma, r, payoff_fn, kinks):
+    """POP (0-1) de um payoff linear por partes com quebras em `kinks`.
+
+    Entre duas quebras o payoff é uma reta: basta avaliá-lo nas quebras (e num
+    ponto além da última, para a inclinação da cauda), achar os zeros por
+    interpolação exata e somar P(a < S_T < b) = F(b) − F(a) nos trechos com
+    lucro, com F a CDF log-normal. Lucro = payoff estritamente positivo."""
+    pts = sorted({float(k) for k in kinks if k and k > 0}) or [float(S)]
+    xs = np.array([0.0] + pts + [2.0 * pts[-1] + 1.0])
+    ys = np.asarray(payoff_fn(xs), dtype=float)
+
+    bounds = []          # trechos (a, b) com payoff > 0
+    for i in range(len(xs) - 1):
+        x1, x2, y1, y2 = xs[i], xs[i + 1], ys[i], ys[i + 1]
+        if i == len(xs) - 2:
+            x2 = math.inf   # cauda: mesma reta do último trecho até o infinito
+        if y1 > 0 and y2 > 0:
+            bounds.append((x1, x2))
+        elif y1 > 0 or y2 > 0:
+            root = xs[i] + y1 * (xs[i + 1] - xs[i]) / (y1 - y2)
+            bounds.append((x1, root) if y1 > 0 else (root, x2))
+    if not bounds:
+        return 0.0
+    a, b = np.array(bounds).T
+    return float(np.sum(lognormal_cdf(b, S, T, sigma, r) - lognormal_cdf(a, S, T, sigma, r)))
+
+
+def pop_grid(S, T, sigma, r, payoff_fn, M=500):
+    """POP (0-1) por integração numérica — fallback para payoffs não lineares
+    (perna de calendário reprecificada por BS). Mesma grade de M+1 pontos em
+    ±4 desvios da versão antiga, mas com payoff_fn avaliada uma só vez sobre o
+    array de preços."""
+    mu = math.log(S) + (r - 0.5 * sigma * sigma) * T
+    sd = sigma * math.sqrt(T)
+    lo = max(S * math.exp(-4 * sd), 0.01)
+    hi = S * math.exp(4 * sd)
+    step = (hi - lo) / (M + 1)
+    sk = lo + step * (np.arange(M + 1) + 0.5)
+    z = (np.log(sk) - mu) / sd
+    w = np.exp(-0.5 * z * z) / sk      # ∝ densidade log-normal
+    tot = w.sum()
+    if tot <= 0:
+        return None
+    with np.errstate(invalid='ignore'):
+        win = w[np.asarray(payoff_fn(sk), dtype=float) > 0].sum()
+    return float(win / tot)
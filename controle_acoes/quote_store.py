@@ -0,0 +1,63 @@
+"""
+quote_store.py — última cotação de cada ticker, uma linha por ticker
+====================================================================
+quote guarda o preço de mercado (OpLab, Yahoo/brapi, MT5 local), comum a
+todos os usuários; quote_user, o preço que o próprio usuário trouxe
+(planilha, feeder, MT5 com usuário, edição manual). Vale a gravação mais
+recente das duas — como antes, quando tudo ia para as mesmas colunas da
+carteira e o último a escrever ganhava. O cache por requisição e a leitura
+pelos modelos ficam em models.Quote; aqui é só SQL.
+"""
+from datetime import datetime
+
+from sqlalchemy import bindparam, text
+
+_RESOLVE = text(
+    'SELECT 0, ticker, price, change_pct, ts FROM quote WHERE ticker IN :t '
+    'UNION ALL '
+    'SELECT user_id, ticker, price, change_pct, ts FROM quote_user WHERE user_id IN :u AND ticker IN :t'
+).bindparams(bindparam('t', expanding=True), bindparam('u', expanding=True))
+
+
+def resolve(conn, user_ids, tickers):
+    """{(user_id, ticker): (preço, variação %, ts)} numa consulta só, para
+    cada usuário × ticker que tenha cotação. Empate de ts: vale a do usuário."""
+    tickers, user_ids = sorted(set(tickers)), sorted(set(user_ids))
+    if not tickers or not user_ids:
+        return {}
+    market, own = {}, {}
+    for u, t, p, c, ts in conn.execute(_RESOLVE, {'t': tickers, 'u': user_ids}):
+        if isinstance(ts, str):          # SQL textual: o SQLite devolve o texto gravado
+            ts = datetime.fromisoformat(ts)
+        if u == 0:
+            market[t] = (p, c, ts)
+        else:
+            own[(u, t)] = (p, c, ts)
+    out = {}
+    for u in user_ids:
+        for t in tickers:
+            m, o = market.get(t), own.get((u, t))
+            if m and o:
+                out[(u, t)] = o if o[2] >= m[2] else m
+            elif m or o:
+                out[(u, t)] = m or o
+    return out
+
+
+def upsert(conn, rows, source, ts):
+    """Grava [(ticker, preço, variação)] em quote. Não faz commit."""
+    params = [{'t': t, 'p': p, 'v': v, 's': source, 'ts': ts} for t, p, v in rows]
+    if params:
+        conn.execute(text('INSERT OR REPLACE INTO quote (ticker, price, change_pct, source, ts) '
+                          'VALUES (:t, :p, :v, :s, :ts)'), params)
+    return len(params)
+
+
+def upsert_user(conn, user_id, rows, source, ts):
+    """Grava [(ticker, preço, variação)] em quote_user do usuário. Não faz
+    commit."""
+    params = [{'u': int(user_id), 't': t, 'p': p, 'v': v, 's': source, 'ts': ts} for t, p, v in rows]
+    if params:
+        conn.execute(text('INSERT OR REPLACE INTO quote_user (user_id, ticker, price, change_pct, source, ts) '
+                          'VALUES (:u, :t, :p, :v, :s, :ts)'), params)
+    return len(params)
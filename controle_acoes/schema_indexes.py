@@ -0,0 +1,76 @@
+"""
+schema_indexes.py — índices das consultas quentes por usuário
+=============================================================
+INDEXES (nome → tabela, colunas) é o conjunto gerenciado: os modelos pegam
+daqui o __table_args__ (table_args) e ensure cria num banco existente os que
+faltam. HOT_QUERIES registra as consultas quentes como o app as faz; o teste
+roda EXPLAIN QUERY PLAN em cada uma e falha se alguma varrer a tabela
+inteira (full_scans).
+"""
+from sqlalchemy import Index
+
+INDEXES = {
+    'ix_asset_user_ticker':           ('asset', ('user_id', 'ticker')),
+    'ix_trade_history_user_strategy': ('trade_history', ('user_id', 'strategy')),
+    'ix_option_user_underlying':      ('option', ('user_id', 'underlying_asset')),
+    'ix_option_user_ticker':          ('option', ('user_id', 'ticker')),
+    'ix_settings_user_key':           ('settings', ('user_id', 'key')),
+    'ix_structured_op_user_status':   ('structured_op', ('user_id', 'status')),
+    'ix_structured_leg_op':           ('structured_leg', ('op_id',)),
+    'ix_dividend_asset':              ('dividend', ('asset_id',)),
+    'idx_asset_txn_user_ticker':      ('asset_txn', ('user_id', 'ticker', 'txn_date')),
+    'idx_pm_event_user_ticker':       ('pm_event', ('user_id', 'ticker')),
+}
+
+# nome → (SQL, parâmetros)
+HOT_QUERIES = {
+    'asset_by_ticker':      ('SELECT * FROM asset WHERE ticker = :t AND user_id = :u',
+                             {'t': 'PETR4', 'u': 1}),
+    'assets_of_user':       ('SELECT * FROM asset WHERE user_id = :u AND quantity > 0', {'u': 1}),
+    'options_by_ticker':    ('SELECT * FROM option WHERE user_id = :u AND ticker = :t',
+                             {'u': 1, 't': 'PETRA40'}),
+    'options_by_underlying': ('SELECT * FROM option WHERE user_id = :u AND underlying_asset IN (:a, :b)',
+                              {'u': 1, 'a': 'PETR4', 'b': 'VALE3'}),
+    'open_structured':      ("SELECT * FROM structured_op WHERE user_id = :u AND status = 'OPEN'", {'u': 1}),
+    'structured_legs':      ('SELECT * FROM structured_leg WHERE op_id = :o ORDER BY id', {'o': 1}),
+    'dividends_of_asset':   ('SELECT * FROM dividend WHERE asset_id = :a', {'a': 1}),
+    'dividends_of_user':    ('SELECT dividend.* FROM dividend JOIN asset ON asset.id = dividend.asset_id '
+                             'WHERE asset.user_id = :u AND dividend.ticker = :t', {'u': 1, 't': 'PETR4'}),
+    'ledger_since':         ('SELECT * FROM asset_txn WHERE user_id = :u AND ticker = :t AND txn_date >= :d',
+                             {'u': 1, 't': 'PETR4', 'd': '2024-01-01'}),
+    'pm_events':            ('SELECT * FROM pm_event WHERE user_id = :u AND ticker = :t '
+                             'ORDER BY created_at, id', {'u': 1, 't': 'PETR4'}),
+    'setting':              ('SELECT * FROM settings WHERE key = :k AND user_id = :u',
+                             {'k': 'oplab_token', 'u': 1}),
+    'option_trades':        ("SELECT * FROM trade_history WHERE user_id = :u AND strategy = 'Opções'", {'u': 1}),
+}
+
+
+def table_args(table):
+    """__table_args__ do modelo de `table` com os índices gerenciados dela."""
+    return tuple(Index(nome, *cols) for nome, (t, cols) in INDEXES.items() if t == table)
+
+
+def ensure(cursor):
+    """Cria os índices gerenciados que faltam no banco. Pula tabela (ou
+    coluna) que ainda não existe — o create_all cria a tabela já com os
+    índices. `cursor`: cursor sqlite3. Devolve os nomes criados; não faz
+    commit."""
+    existentes = {r[0] for r in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    criados = []
+    for nome, (table, cols) in INDEXES.items():
+        if nome in existentes:
+            continue
+        tem = {r[1] for r in cursor.execute(f'PRAGMA table_info("{table}")')}
+        if not tem or not set(cols) <= tem:
+            continue
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {nome} ON "{table}" ({", ".join(cols)})')
+        criados.append(nome)
+    return criados
+
+
+def full_scans(conn, sql, params=None):
+    """Passos do EXPLAIN QUERY PLAN de `sql` que varrem uma tabela inteira
+    ('SCAN tabela', com ou sem índice de cobertura). `conn`: conexão sqlite3."""
+    plano = conn.execute('EXPLAIN QUERY PLAN ' + sql, params or {}).fetchall()
+    return [r[-1] for r in plano if r[-1].startswith('SCAN ')]
@@ -0,0 +1,69 @@
+"""
+schema_migrations.py — migrações do banco, cada uma aplicada uma única vez
+==========================================================================
+schema_version registra cada migração aplicada (versão, nome, quando);
+upgrade aplica as de versão acima da atual, cada uma numa transação BEGIN
+IMMEDIATE que relê a versão lá dentro (workers subindo juntos não repetem
+nada). current é só leitura; stamp marca como aplicadas as migrações de um
+banco novo, que já nasce do create_all no esquema atual.
+A lista de migrações fica no app (`flask db-upgrade`); aqui é só o mecanismo.
+"""
+from datetime import datetime
+
+
+def _ensure_table(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version ('
+                   'version INTEGER PRIMARY KEY, name VARCHAR(120), applied_at DATETIME)')
+
+
+def current(cursor):
+    """Maior versão aplicada (0 = banco anterior ao controle de versão)."""
+    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                          "AND name = 'schema_version'").fetchone():
+        return 0
+    return cursor.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+
+
+def latest(migrations):
+    return max((m[0] for m in migrations), default=0)
+
+
+def pending(cursor, migrations):
+    v = current(cursor)
+    return [m for m in sorted(migrations, key=lambda m: m[0]) if m[0] > v]
+
+
+def upgrade(conn, migrations, now=None):
+    """Aplica as migrações pendentes, em ordem, uma transação por migração.
+    `conn`: conexão sqlite3 em autocommit (isolation_level=None); cada
+    função recebe o cursor e não faz commit. Devolve as versões aplicadas —
+    se uma falha, ela é desfeita e a exceção sobe (as anteriores ficam)."""
+    cursor = conn.cursor()
+    aplicadas = []
+    for version, name, fn in sorted(migrations, key=lambda m: m[0]):
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            _ensure_table(cursor)
+            if version <= current(cursor):
+                cursor.execute('COMMIT')
+                continue
+            fn(cursor)
+            cursor.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                           (version, name, (now or datetime.now()).isoformat(sep=' ')))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        aplicadas.append(version)
+    return aplicadas
+
+
+def stamp(conn, migrations, now=None):
+    """Registra todas as migrações como aplicadas sem rodá-las — banco novo,
+    criado já no esquema atual. `conn` em autocommit, como em upgrade."""
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    _ensure_table(cursor)
+    cursor.executemany('INSERT OR IGNORE INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                       [(v, name, (now or datetime.now()).isoformat(sep=' ')) for v, name, _fn in migrations])
+    cursor.execute('COMMIT')
@@ -0,0 +1,89 @@
+"""Benchmark: VI da cadeia inteira — bissecção escalar x Newton vetorizado.
+
+Uso (do diretório do projeto):
+    ./venv/bin/python scripts/bench_chain_iv.py [n_vencimentos] [n_strikes]
+
+Monta uma cadeia sintética no formato das rotas de cadeia (calls e puts,
+strikes de 50% a 150% do spot, prêmio arredondado a centavos) e mede o tempo
+por cadeia de:
+  - antes:  a bissecção de 60 passos que as rotas chamavam por strike;
+  - depois: ChainIV.prime_many (uma chamada vetorizada para a cadeia toda).
+Não usa rede nem banco.
+"""
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pricing import ChainIV, bs_price, chain_premium   # noqa: E402
+
+
+def _bisseccao(S0, K, T, r, target, is_call):
+    """Cópia da `_implied_vol` original (referência do "antes")."""
+    if target <= 0 or T <= 0:
+        return 0.30
+    lo, hi = 0.001, 5.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if bs_price(S0, K, T, r, mid, is_call) < target:
+            lo = mid
+        else:
+            hi = mid
+        if hi - lo < 1e-6:
+            break
+    return (lo + hi) / 2
+
+
+def _cadeia(spot, n_exp, n_strikes, r):
+    grupos = []
+    for e in range(n_exp):
+        T = (7 + 30 * e) / 365.0
+        for is_call in (True, False):
+            rows = []
+            for i in range(n_strikes):
+                k = round(spot * (0.5 + i / max(n_strikes - 1, 1)), 2)
+                sig = 0.30 + 0.25 * abs(math.log(k / spot))
+                p = round(bs_price(spot, k, T, r, sig, is_call), 2)
+                rows.append({'symbol': f'X{e}{int(is_call)}{i}', 'strike': k,
+                             'bid': 0.0, 'ask': 0.0, 'close': p})
+            grupos.append((rows, is_call, T))
+    return grupos
+
+
+def main():
+    n_exp = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n_strikes = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    spot, r = 38.0, math.log(1.15)
+    grupos = _cadeia(spot, n_exp, n_strikes, r)
+    n = sum(len(g[0]) for g in grupos)
+
+    t0 = time.perf_counter()
+    antes = {}
+    for rows, is_call, T in grupos:
+        for rw in rows:
+            prem = chain_premium(rw)
+            intr = max(0.0, (spot - rw['strike']) if is_call else (rw['strike'] - spot))
+            if prem and prem > intr * 1.005:
+                antes[(rw['symbol'], is_call)] = _bisseccao(spot, rw['strike'], T, r, prem, is_call)
+    t_antes = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    civ = ChainIV(spot, r)
+    civ.prime_many(grupos)
+    t_depois = time.perf_counter() - t0
+
+    dif = max((abs(civ.get(rw, c, T) - antes[(rw['symbol'], c)])
+               for rows, c, T in grupos for rw in rows
+               if (rw['symbol'], c) in antes), default=0.0)
+    print(f'cadeia: {n_exp} vencimentos x {n_strikes} strikes x 2 tipos = {n} opções '
+          f'({len(antes)} com VI definida)')
+    print(f'antes  (bissecção escalar): {t_antes * 1000:8.1f} ms')
+    print(f'depois (vetorizado)       : {t_depois * 1000:8.1f} ms   '
+          f'({t_antes / t_depois:.0f}x)')
+    print(f'maior diferença de VI     : {dif:.2e}')
+
+
+if __name__ == '__main__':
+    main()
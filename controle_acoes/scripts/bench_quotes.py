@@ -0,0 +1,123 @@
+"""Benchmark: cotações brapi — requests.get solto x cliente com pool (services).
+
+Uso (do diretório do projeto):
+    ./venv/bin/python scripts/bench_quotes.py [latencia_ms] [handshake_ms]
+
+Sobe um provedor falso em localhost no formato da brapi (/api/quote/<T>) e
+mede get_quotes para 50 e 200 tickers:
+  - antes:  cópia do caminho original — ThreadPoolExecutor(8) novo por chamada
+            e requests.get por ticker (conexão nova a cada request);
+  - depois: services.get_quotes (Session keep-alive por provedor, executor
+            compartilhado, backoff em 429).
+O servidor falso atrasa cada conexão nova em `handshake_ms` (o custo do TLS,
+que em localhost não existe) e cada request em `latencia_ms`, e devolve 429
+em 1 de cada 25 requests — o "antes" perde esses tickers, o "depois" repete.
+Não usa rede externa nem banco.
+"""
+import itertools
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import services   # noqa: E402
+
+LATENCY = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.030
+HANDSHAKE = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.060
+_counter = itertools.count(1)
+
+
+class _MockBrapi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive: setup() roda uma vez por conexão
+
+    def setup(self):
+        time.sleep(HANDSHAKE)
+        # cabeçalho e corpo saem em writes separados: sem NODELAY o Nagle +
+        # ACK atrasado somam ~40 ms a cada request da conexão reaproveitada
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        if next(_counter) % 25 == 0:
+            body, status = b'{"error": "rate limit"}', 429
+        else:
+            tk = self.path.split('?')[0].rsplit('/', 1)[-1]
+            body = ('{"results": [{"symbol": "%s", "regularMarketPrice": 10.5, '
+                    '"regularMarketChangePercent": 1.2}]}' % tk).encode()
+            status = 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '0.2')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _antes_one(ticker, token):
+    """Cópia do _brapi_one original (referência do "antes")."""
+    params = {'range': '1d', 'interval': '1d', 'fundamental': 'false', 'dividends': 'false', 'token': token}
+    try:
+        r = requests.get(f"{services.BASE_URL}/{ticker}", params=params, timeout=10)
+        if r.status_code != 200:
+            return ticker, None
+        for item in r.json().get('results', []):
+            price = item.get('regularMarketPrice')
+            if price and price > 0:
+                return ticker, {'price': float(price),
+                                'change_percent': float(item.get('regularMarketChangePercent') or 0)}
+    except Exception:
+        pass
+    return ticker, None
+
+
+def _antes(tickers, token):
+    results = {}
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        for t, d in ex.map(lambda t: _antes_one(t, token), tickers):
+            if d:
+                results[t] = d
+    return results
+
+
+def _mede(fn, tickers, rodadas=3):
+    tempos, obtidos = [], 0
+    for _ in range(rodadas):
+        t0 = time.perf_counter()
+        obtidos = len(fn(tickers))
+        tempos.append(time.perf_counter() - t0)
+    return statistics.median(tempos), obtidos
+
+
+def main():
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), _MockBrapi)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    services.BASE_URL = f'http://127.0.0.1:{srv.server_port}/api/quote'
+    os.environ['BRAPI_API_KEY'] = 'bench'
+
+    print(f'latência {LATENCY * 1000:.0f} ms/request, handshake {HANDSHAKE * 1000:.0f} ms/conexão, '
+          f'429 em 1/25')
+    for n in (50, 200):
+        tickers = [f'TST{i:03d}3' for i in range(n)]
+        t_antes, ok_antes = _mede(lambda tks: _antes(tks, 'bench'), tickers)
+        t_depois, ok_depois = _mede(services.get_quotes, tickers)
+        print(f'{n:4d} tickers   antes {t_antes * 1000:7.0f} ms ({ok_antes}/{n})   '
+              f'depois {t_depois * 1000:7.0f} ms ({ok_depois}/{n})   {t_antes / t_depois:4.1f}x')
+    srv.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,7 @@ from datetime import date, timedelta
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import app as A                                   # noqa: E402
-from models import Settings, User, ChartCache     # noqa: E402
+from models import Settings, User                 # noqa: E402
 
 
 def main():
@@ -68,9 +68,9 @@ def main():
             print(f'[nosso] pontos sem HV    : {sem_hv} de {len(serie)}')
 
         # 3) Os candles que alimentam a HV
-        cc = ChartCache.query.get(tk)
-        if cc:
-            print(f'\n[candles] cache existe, último dia: {cc.last_date}')
+        cc = A._candles_load(tk)
+        if len(cc):
+            print(f'\n[candles] {len(cc)} candles, último dia: {cc.last_date}')
             atraso_c = (date.today() - date.fromisoformat(cc.last_date)).days
             print(f'[candles] atraso vs hoje : {atraso_c} dia(s)'
                   + ('   <-- CACHE VELHO (por isso HV falta no fim)' if atraso_c > 4 else ''))
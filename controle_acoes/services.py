@@ -1,11 +1,139 @@
 
-import requests
 import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as _CFTimeoutError
 
+import requests
 from flask import current_app
 
 BASE_URL = "https://brapi.dev/api/quote"
+YAHOO_CHART_URLS = ("https://query1.finance.yahoo.com/v8/finance/chart",
+                    "https://query2.finance.yahoo.com/v8/finance/chart")
+
+YF_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Accept': 'application/json,text/plain,*/*',
+    'Accept-Language': 'pt-BR,pt;q=0.9,en-US;q=0.8',
+    'Origin': 'https://finance.yahoo.com',
+    'Referer': 'https://finance.yahoo.com/',
+}
+YF_COOKIES = {'tbla_id': 'finan-web', 'GUC': 'AQEBCAFn', 'GUCS': 'AQEBCAFn'}
+
+
+# ── Cliente de cotações: conexões e concorrência compartilhadas ──────────────
+#   • cada provedor tem UMA requests.Session com pool keep-alive, reaproveitada
+#     por todas as threads (o handshake é pago uma vez por conexão do pool);
+#   • um semáforo por provedor limita as requisições simultâneas ao mesmo host
+#     — brapi e Yahoo fazem rate-limiting e devolvem 429 sob rajada;
+#   • 429/503 são repetidos com backoff (Retry-After quando vier, senão
+#     exponencial com jitter), fora do semáforo para não travar os demais;
+#   • um único executor do módulo roda tudo, sem pool por chamada.
+_RETRY_STATUS = (429, 503)
+_RETRIES      = 3
+_BACKOFF_BASE = 0.5     # s — 0.5, 1, 2 (+ jitter)
+_BACKOFF_MAX  = 8.0     # s — teto para Retry-After exagerado
+
+
+class _Provider:
+    """Session com pool próprio + limite de concorrência de um host."""
+
+    def __init__(self, name, limit, retries=_RETRIES, headers=None, cookies=None):
+        self.name = name
+        self.limit = limit
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=limit, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        if cookies:
+            self.session.cookies.update(cookies)
+        self._sem = threading.BoundedSemaphore(limit)
+
+    def get(self, url, retries=None, **kwargs):
+        kwargs.setdefault('timeout', 10)
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            with self._sem:
+                r = self.session.get(url, **kwargs)
+            if r.status_code not in _RETRY_STATUS or attempt == retries:
+                return r
+            r.close()
+            time.sleep(_backoff(r, attempt))
+        return r
+
+
+def _backoff(resp, attempt):
+    try:
+        wait = float(resp.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        wait = _BACKOFF_BASE * (2 ** attempt) + random.uniform(0, _BACKOFF_BASE / 2)
+    return max(0.0, min(wait, _BACKOFF_MAX))
+
+
+_brapi = _Provider('brapi', 8)
+# O Yahoo também responde 429 quando recusa o cookie (não é só rajada): uma
+# repetição basta, o resto cai em query2 / yfinance.
+_yahoo = _Provider('yahoo', 8, retries=1, headers=YF_HEADERS, cookies=YF_COOKIES)
+
+_POOL_PREFIX = 'quotes'
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=_brapi.limit + _yahoo.limit,
+                                           thread_name_prefix=_POOL_PREFIX)
+    return _pool
+
+
+def fetch_many(fn, items, timeout=None):
+    """Roda fn(item) para cada item no executor compartilhado e devolve
+    {item: resultado} só com os resultados não-nulos. Com `timeout` (s), o que
+    não terminar no prazo fica de fora e o que nem começou é cancelado.
+
+    Chamado de dentro de uma tarefa do próprio executor, roda em série — esperar
+    por tarefas do mesmo pool a partir de um worker dele pode travar. Em série
+    vale o mesmo contrato: item com erro fica de fora e, esgotado o `timeout`,
+    os itens que faltam nem começam."""
+    items = list(dict.fromkeys(items))
+    out = {}
+    if not items:
+        return out
+    if threading.current_thread().name.startswith(_POOL_PREFIX):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for it in items:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            try:
+                r = fn(it)
+            except Exception as e:
+                print(f"quote fetch error {it}: {e}")
+                continue
+            if r is not None:
+                out[it] = r
+        return out
+    futs = {_executor().submit(fn, it): it for it in items}
+    try:
+        for fut in as_completed(futs, timeout=timeout):
+            try:
+                r = fut.result()
+            except Exception as e:
+                print(f"quote fetch error {futs[fut]}: {e}")
+                continue
+            if r is not None:
+                out[futs[fut]] = r
+    except _CFTimeoutError:
+        for fut in futs:
+            fut.cancel()
+    return out
 
 
 def get_token(user_id=None):
@@ -24,7 +152,7 @@ def _brapi_one(ticker, token=None):
     """Busca um único ticker na brapi.dev."""
     params = {'range': '1d', 'interval': '1d', 'fundamental': 'false', 'dividends': 'false', 'token': token}
     try:
-        r = requests.get(f"{BASE_URL}/{ticker}", params=params, timeout=10)
+        r = _brapi.get(f"{BASE_URL}/{ticker}", params=params, timeout=10)
         if r.status_code != 200:
             return ticker, None
         for item in r.json().get('results', []):
@@ -46,19 +174,72 @@ def _brapi_quotes(tickers, token):
     """Busca cotações via brapi.dev em paralelo (1 ticker/request — plano gratuito)."""
     if not tickers or not token:
         return {}
-    from concurrent.futures import ThreadPoolExecutor
-    from functools import partial
-    results = {}
-    fetch = partial(_brapi_one, token=token)
-    with ThreadPoolExecutor(max_workers=8) as ex:
-        for ticker, data in ex.map(fetch, tickers):
-            if data:
-                results[ticker] = data
-    return results
+    return fetch_many(lambda t: _brapi_one(t, token)[1], tickers)
+
+
+def yahoo_quote(symbol, timeout=10):
+    """Cotação pelo endpoint chart do Yahoo (query1, depois query2), na Session
+    compartilhada. `symbol` já no formato do Yahoo (PETR4.SA, AAPL, BTC-USD,
+    USDBRL=X). Retorna {'price', 'change_percent'} ou None."""
+    for base in YAHOO_CHART_URLS:
+        try:
+            r = _yahoo.get(f"{base}/{symbol}", params={'interval': '1d', 'range': '1d'}, timeout=timeout)
+            if r.status_code != 200:
+                continue
+            meta = r.json()['chart']['result'][0]['meta']
+            price = meta.get('regularMarketPrice') or meta.get('previousClose')
+            if not price or float(price) <= 0:
+                continue
+            chg = meta.get('regularMarketChangePercent')
+            if chg is None:
+                prev = meta.get('chartPreviousClose') or meta.get('previousClose')
+                chg = ((price - prev) / prev * 100) if prev and prev > 0 else 0.0
+            return {'price': float(price), 'change_percent': float(chg)}
+        except Exception:
+            continue
+    return None
+
+
+def yahoo_quotes(symbols, timeout=None):
+    """yahoo_quote em paralelo: {symbol: {'price', 'change_percent'}}."""
+    return fetch_many(yahoo_quote, symbols, timeout=timeout)
+
+
+def yahoo_dividends(symbol, start=None, timeout=10):
+    """Proventos do símbolo pelo endpoint chart (events=div): {data_iso:
+    valor_por_ação}, de `start` (date) em diante ou o histórico todo. A data
+    vem no fuso da bolsa, como no índice de yf.Ticker(...).dividends.
+    Retorna None se nenhum host respondeu (≠ {} = sem proventos)."""
+    from datetime import datetime as _dt, timezone as _tz
+    params = {'interval': '1d', 'events': 'div', 'period2': int(time.time())}
+    if start:
+        params['period1'] = int(_dt(start.year, start.month, start.day, tzinfo=_tz.utc).timestamp())
+    else:
+        params = {'interval': '1mo', 'range': 'max', 'events': 'div'}
+    for base in YAHOO_CHART_URLS:
+        try:
+            r = _yahoo.get(f"{base}/{symbol}", params=params, timeout=timeout)
+            if r.status_code != 200:
+                continue
+            res = r.json()['chart']['result'][0]
+            off = int(res.get('meta', {}).get('gmtoffset') or 0)
+            out = {}
+            for ev in ((res.get('events') or {}).get('dividends') or {}).values():
+                d = _dt.fromtimestamp(int(ev['date']) + off, _tz.utc).date()
+                if start is None or d >= start:
+                    out[d.isoformat()] = float(ev['amount'])
+            return out
+        except Exception:
+            continue
+    return None
 
 
 def _yf_fast_info(yf_t, clean_key):
-    """Busca cotação individual via yfinance fast_info (preço atual de mercado)."""
+    """Cotação individual no Yahoo: endpoint chart na Session compartilhada e,
+    se ele falhar (cookie/crumb recusado), yfinance fast_info."""
+    q = yahoo_quote(yf_t)
+    if q:
+        return {'price': q['price'], 'change_percent': q['change_percent'], 'logo': '', 'shortName': clean_key}
     import yfinance as yf
     try:
         fi = yf.Ticker(yf_t).fast_info
@@ -124,56 +305,46 @@ def _yf_bulk(yf_tickers, map_yf_to_clean):
     return results, failed
 
 
+def _yahoo_symbol(t):
+    return t if '.' in t else f"{t}.SA"
+
+
 def get_quotes(tickers, user_id=None, prefer_yahoo=None):
     """
-    Busca cotações de ações/FIIs/ETFs BR.
-    - Com token brapi: um único request para todos os tickers (~0.5s).
-    - Sem token brapi: fast_info em paralelo via ThreadPoolExecutor (~3s para 15 tickers).
+    Busca cotações de ações/FIIs/ETFs BR, numa única rodada no executor
+    compartilhado:
+    - Com token brapi: brapi para todos e, ao mesmo tempo, Yahoo para os
+      `prefer_yahoo`; quem a brapi não devolver vai ao Yahoo numa 2ª leva.
+    - Sem token brapi: só Yahoo.
     """
     if not tickers:
         return {}
 
-    clean_tickers = [t.strip().upper() for t in tickers]
+    clean_tickers = list(dict.fromkeys(t.strip().upper() for t in tickers))
     prefer_yahoo = {t.strip().upper() for t in (prefer_yahoo or [])}
     token = get_token(user_id)
 
-    if token:
-        results = {}
-        for i in range(0, len(clean_tickers), 50):
-            results.update(_brapi_quotes(clean_tickers[i:i+50], token))
-        # Alguns ETFs brasileiros aparecem defasados/inconsistentes na brapi.
-        # Para esses tickers, usa Yahoo Finance como fonte preferencial.
-        if prefer_yahoo:
-            from concurrent.futures import ThreadPoolExecutor
-            def _fetch_yahoo(t):
-                return t, _yf_fast_info(f"{t}.SA" if '.' not in t else t, t)
-            with ThreadPoolExecutor(max_workers=8) as ex:
-                for t, r in ex.map(_fetch_yahoo, [t for t in clean_tickers if t in prefer_yahoo]):
-                    if r:
-                        results[t] = r
-        # fallback paralelo para os que a brapi não retornou
-        missing = [t for t in clean_tickers if t not in results]
-        if missing:
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            def _fetch(t):
-                return t, _yf_fast_info(f"{t}.SA" if '.' not in t else t, t)
-            with ThreadPoolExecutor(max_workers=8) as ex:
-                for t, r in ex.map(_fetch, missing):
-                    if r:
-                        results[t] = r
-        return results
-
-    # Sem token: fast_info em paralelo (preciso, sem depender de histórico)
-    from concurrent.futures import ThreadPoolExecutor
-    def _fetch(t):
-        yf_t = t if '.' in t else f"{t}.SA"
-        return t, _yf_fast_info(yf_t, t)
+    def _run(job):
+        src, t = job
+        if src == 'brapi':
+            return _brapi_one(t, token)[1]
+        return _yf_fast_info(_yahoo_symbol(t), t)
+
+    # Alguns ETFs brasileiros aparecem defasados/inconsistentes na brapi.
+    # Para esses tickers, Yahoo é a fonte preferencial (brapi fica de reserva).
+    jobs = [('brapi', t) for t in clean_tickers] if token else []
+    jobs += [('yahoo', t) for t in clean_tickers if not token or t in prefer_yahoo]
+    got = fetch_many(_run, jobs)
 
     results = {}
-    with ThreadPoolExecutor(max_workers=8) as ex:
-        for t, r in ex.map(_fetch, clean_tickers):
-            if r:
-                results[t] = r
+    for t in clean_tickers:
+        r = got.get(('yahoo', t)) or got.get(('brapi', t))
+        if r:
+            results[t] = r
+    # fallback para os que a brapi não retornou (e que o Yahoo ainda não viu)
+    missing = [('yahoo', t) for t in clean_tickers if t not in results and ('yahoo', t) not in jobs]
+    for (_, t), r in fetch_many(_run, missing).items():
+        results[t] = r
     return results
 
 
@@ -184,7 +355,7 @@ def get_raw_quote_data(ticker):
     if token:
         params['token'] = token
     try:
-        response = requests.get(f"{BASE_URL}/{ticker}", params=params, timeout=10)
+        response = _brapi.get(f"{BASE_URL}/{ticker}", params=params, timeout=10)
         if response.status_code == 200:
             return True, response.json()
         return False, {'error': f"Status {response.status_code}", 'body': response.text}
@@ -0,0 +1,22 @@
+"""
+settings_store.py — configurações por usuário, carregadas de uma vez
+=====================================================================
+load traz todas as chaves dos usuários pedidos numa consulta. O cache por
+usuário e a decifragem dos tokens ficam em models.Settings, que o invalida
+pela versão 'settings' de version_counter; aqui é só SQL.
+"""
+from sqlalchemy import bindparam, text
+
+
+def load(conn, user_ids):
+    """{user_id: {chave: valor cru}} — usuário sem nenhuma chave vem com {}."""
+    out = {u: {} for u in set(user_ids)}
+    if not out:
+        return out
+    # ORDER BY id: com chave repetida (não há UNIQUE em (user_id, key)) vale a
+    # primeira, como no filter_by(...).first() de antes
+    for u, k, v in conn.execute(text('SELECT user_id, key, value FROM settings WHERE user_id IN :u ORDER BY id')
+                                .bindparams(bindparam('u', expanding=True)), {'u': sorted(out)}):
+        out[u].setdefault(k, v)
+    return out
+
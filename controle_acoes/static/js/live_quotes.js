@@ -0,0 +1,67 @@
+/* live_quotes.js — cotações ao vivo (MT5 / OpLab) nas tabelas da carteira:
+ *   • 1º GET em /api/current_quotes traz o retrato completo e a versão;
+ *   • depois abre o stream SSE (/api/current_quotes/stream?since=versão),
+ *     que só empurra os tickers alterados;
+ *   • sem EventSource, ou se o servidor recusar o stream (204), cai no
+ *     polling de /api/current_quotes?since=versão no intervalo da página.
+ * Uso: LiveQuotes.start({ url, streamUrl, apply: fn(data),
+ *                         active: fn(data) (opcional), onStart: fn(data) (opcional) });
+ * `apply` recebe {assets, options, ...} — em delta, só os tickers alterados.
+ */
+(function (global) {
+    'use strict';
+
+    var MT5_INTERVAL = 15000;
+
+    function withSince(url, v) {
+        return url + (url.indexOf('?') < 0 ? '?' : '&') + 'since=' + encodeURIComponent(v);
+    }
+
+    function start(opts) {
+        var version = 0;
+        var timer = null;
+        var es = null;
+        var active = opts.active || function (d) { return d.mode === 'mt5' || d.oplab_enabled; };
+
+        function take(data) {
+            if (!data) return;
+            if (typeof data.version === 'number') version = data.version;
+            opts.apply(data);
+        }
+
+        function startPolling(interval) {
+            if (timer) return;
+            timer = setInterval(function () {
+                fetch(withSince(opts.url, version))
+                    .then(function (r) { return r.json(); })
+                    .then(function (data) { if (active(data)) take(data); })
+                    .catch(function () {});
+            }, interval);
+        }
+
+        fetch(opts.url).then(function (r) { return r.json(); }).then(function (data) {
+            if (!active(data)) return;
+            take(data);
+            if (opts.onStart) opts.onStart(data);
+            var interval = data.mode === 'mt5' ? MT5_INTERVAL : data.oplab_interval_ms;
+            if (!opts.streamUrl || !global.EventSource) { startPolling(interval); return; }
+
+            es = new EventSource(withSince(opts.streamUrl, version));
+            es.addEventListener('quotes', function (ev) {
+                try { take(JSON.parse(ev.data)); } catch (e) {}
+            });
+            es.onerror = function () {
+                // CONNECTING = o navegador vai reconectar sozinho (fim normal
+                // do stream); CLOSED = recusado (204/erro) → polling.
+                if (es.readyState === EventSource.CLOSED) {
+                    es = null;
+                    startPolling(interval);
+                }
+            };
+        }).catch(function () {});
+
+        global.addEventListener('pagehide', function () { if (es) es.close(); });
+    }
+
+    global.LiveQuotes = { start: start };
+})(window);
@@ -0,0 +1,73 @@
+"""
+task_store.py — registro das tarefas em segundo plano
+======================================================
+bg_task guarda status (queued → running → done), progresso, mensagem,
+início/fim e o resultado em JSON, visível a todos os workers. `version`
+cresce a cada gravação para o long-poll do app; cleanup apaga as tarefas
+vencidas e encerra as que ficaram "rodando" sem notícia.
+O pool que executa as tarefas fica no app; aqui é só o armazenamento.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import text
+
+_COLS = ('id', 'kind', 'user_id', 'status', 'progress', 'msg', 'category', 'result_json',
+         'version', 'created_at', 'started_at', 'finished_at', 'updated_at')
+_DT_COLS = ('created_at', 'started_at', 'finished_at', 'updated_at')
+
+
+def _dt(x):
+    # SQL cru no SQLite devolve DATETIME como texto ISO
+    return datetime.fromisoformat(x) if isinstance(x, str) else x
+
+
+def create(conn, task_id, kind, user_id, now, msg=''):
+    conn.execute(text('INSERT INTO bg_task (id, kind, user_id, status, msg, version, created_at, updated_at) '
+                      "VALUES (:id, :kind, :uid, 'queued', :msg, 0, :now, :now)"),
+                 {'id': task_id, 'kind': kind, 'uid': user_id, 'msg': msg, 'now': now})
+
+
+def update(conn, task_id, now, status=None, progress=None, msg=None, category=None, result=None):
+    """Grava só os campos informados e incrementa a versão. Entrar em
+    'running' marca started_at; 'done' marca finished_at."""
+    sets, params = ['version = version + 1', 'updated_at = :now'], {'id': task_id, 'now': now}
+    for col, val in (('status', status), ('progress', progress), ('msg', msg), ('category', category)):
+        if val is not None:
+            sets.append(f'{col} = :{col}')
+            params[col] = val
+    if result is not None:
+        sets.append('result_json = :result')
+        params['result'] = json.dumps(result, default=str)
+    if status == 'running':
+        sets.append('started_at = COALESCE(started_at, :now)')
+    elif status == 'done':
+        sets.append('finished_at = :now')
+    return conn.execute(text('UPDATE bg_task SET ' + ', '.join(sets) + ' WHERE id = :id'), params).rowcount
+
+
+def get(conn, task_id):
+    """Dict com as colunas (result_json já decodificado em 'result'), ou None."""
+    row = conn.execute(text('SELECT ' + ', '.join(_COLS) + ' FROM bg_task WHERE id = :id'),
+                       {'id': task_id}).fetchone()
+    if row is None:
+        return None
+    t = dict(zip(_COLS, row))
+    for c in _DT_COLS:
+        t[c] = _dt(t[c])
+    raw = t.pop('result_json')
+    t['result'] = json.loads(raw) if raw else None
+    return t
+
+
+def cleanup(conn, now, ttl, stale):
+    """Apaga as terminadas antes de `now - ttl` e encerra como erro as não
+    terminadas sem gravação desde `now - stale`. Devolve (apagadas, encerradas)."""
+    apagadas = conn.execute(text("DELETE FROM bg_task WHERE status = 'done' AND finished_at < :lim"),
+                            {'lim': now - ttl}).rowcount
+    encerradas = conn.execute(text(
+        "UPDATE bg_task SET status = 'done', category = 'danger', "
+        "msg = 'Tarefa interrompida (servidor reiniciado?).', "
+        'finished_at = :now, updated_at = :now, version = version + 1 '
+        "WHERE status != 'done' AND updated_at < :lim"), {'now': now, 'lim': now - stale}).rowcount
+    return apagadas, encerradas
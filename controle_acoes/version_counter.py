@@ -0,0 +1,44 @@
+"""
+version_counter.py — contadores de versão por (escopo, usuário)
+================================================================
+Uma linha por (scope, user_id) em version_counter. Quem guarda algo em
+memória por usuário (resumo do Preço Médio, Settings, cotações do stream)
+lê a versão e só recalcula quando ela muda; quem grava incrementa na mesma
+transação. Escopos em uso: 'pm', 'settings' e 'quote' (user_id 0 = relógio
+global das cotações).
+"""
+from sqlalchemy import bindparam, text
+
+
+def get(conn, scope, user_ids):
+    """{user_id: versão} — quem nunca foi incrementado fica com 0."""
+    if not user_ids:
+        return {}
+    found = dict(conn.execute(text('SELECT user_id, version FROM version_counter WHERE scope = :s AND user_id IN :u')
+                              .bindparams(bindparam('u', expanding=True)),
+                              {'s': scope, 'u': sorted(set(user_ids))}).fetchall())
+    return {u: found.get(u, 0) for u in set(user_ids)}
+
+
+def bump(conn, scope, user_ids, now):
+    """Incrementa a versão dos usuários informados. Não faz commit."""
+    rows = [{'s': scope, 'u': u, 'now': now} for u in sorted({int(u) for u in user_ids if u is not None})]
+    if rows:
+        conn.execute(text('INSERT OR IGNORE INTO version_counter (scope, user_id, version, updated_at) '
+                          'VALUES (:s, :u, 0, :now)'), rows)
+        conn.execute(text('UPDATE version_counter SET version = version + 1, updated_at = :now '
+                          'WHERE scope = :s AND user_id = :u'), rows)
+    return len(rows)
+
+
+def set_to(conn, scope, user_ids, version, now):
+    """Leva a versão dos `user_ids` (None = todos da tabela user) a `version`.
+    Não faz commit."""
+    if user_ids is None:
+        conn.execute(text('INSERT OR REPLACE INTO version_counter (scope, user_id, version, updated_at) '
+                          'SELECT :s, id, :v, :now FROM user'), {'s': scope, 'v': version, 'now': now})
+        return
+    rows = [{'s': scope, 'u': int(u), 'v': version, 'now': now} for u in set(user_ids) if u is not None]
+    if rows:
+        conn.execute(text('INSERT OR REPLACE INTO version_counter (scope, user_id, version, updated_at) '
+                          'VALUES (:s, :u, :v, :now)'), rows)
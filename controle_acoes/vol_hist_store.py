@@ -0,0 +1,95 @@
+"""
+vol_hist_store.py — VI (ATM) e HV diárias por ticker, uma linha por pregão
+===========================================================================
+vol_hist_day guarda um ponto por (ticker, data): VI ATM, HV, o vencimento
+usado e as estatísticas da VI contra os 12 meses anteriores (IV Rank,
+percentil, mín/máx/média), calculadas na gravação — a API e o Ranking só
+leem. A agregação de um dia só depende das opções daquele dia, então novos
+pregões entram sem recalcular os anteriores.
+"""
+import numpy as np
+from sqlalchemy import bindparam, text
+
+WINDOW_DAYS = 366   # janela das estatísticas: int(12 * 30.5), a mesma da busca original
+MIN_POINTS = 20     # menos que isso não é histórico, é ruído
+
+_COLS = ('iv', 'hv', 'dtm', 'iv_rank', 'iv_pct', 'iv_min', 'iv_max', 'iv_avg', 'n')
+STATS = ('iv_rank', 'iv_pct', 'iv_min', 'iv_max', 'iv_avg', 'n')
+
+
+def rolling_stats(dates, ivs, start=0, window_days=WINDOW_DAYS, min_points=MIN_POINTS):
+    """Onde a VI de cada dia estava em relação aos `window_days` anteriores.
+
+    - iv_pct: % dos dias da janela em que a VI ficou ABAIXO da do dia. 80% = a
+      VI só esteve mais alta em 20% dos pregões do período.
+    - iv_rank: posição no intervalo mín–máx (o "IV Rank" usual do mercado).
+      Difere do percentil: é sensível a extremos isolados, enquanto o
+      percentil conta dias. Os dois juntos evitam leitura enganosa.
+
+    dates: datas ISO em ordem; ivs: VI de cada data (None = sem VI).
+    Devolve uma entrada por data a partir de `start` — dict com STATS, ou
+    None quando o dia não tem VI ou a janela tem menos de `min_points`."""
+    d = np.array(dates, dtype='datetime64[D]')
+    v = np.array([np.nan if x is None else float(x) for x in ivs], dtype=float)
+    ini = np.searchsorted(d, d - np.timedelta64(window_days, 'D'), side='left')
+    out = []
+    for i in range(start, len(d)):
+        w = v[ini[i]:i + 1]
+        w = w[~np.isnan(w)]
+        atual = v[i]
+        if np.isnan(atual) or len(w) < min_points:
+            out.append(None)
+            continue
+        lo, hi = float(w.min()), float(w.max())
+        rank = ((atual - lo) / (hi - lo) * 100) if hi > lo else 50.0
+        out.append({
+            'iv_rank': round(float(rank), 1),
+            'iv_pct':  round(float((w < atual).sum()) / len(w) * 100, 1),
+            'iv_min':  round(lo, 1),
+            'iv_max':  round(hi, 1),
+            'iv_avg':  round(float(w.mean()), 1),
+            'n':       int(len(w)),
+        })
+    return out
+
+
+def load(conn, ticker, since=None):
+    """Pontos do ticker (dicts com 'd' + _COLS), em ordem, a partir de `since`
+    (inclusive). `conn`: conexão ou sessão SQLAlchemy."""
+    rows = conn.execute(text('SELECT d, ' + ', '.join(_COLS) + ' FROM vol_hist_day '
+                             'WHERE ticker = :t AND d >= :s ORDER BY d'),
+                        {'t': ticker, 's': since or ''}).fetchall()
+    return [dict(zip(('d',) + _COLS, r)) for r in rows]
+
+
+def last_date(conn, ticker):
+    return conn.execute(text('SELECT MAX(d) FROM vol_hist_day WHERE ticker = :t'),
+                        {'t': ticker}).scalar()
+
+
+def latest(conn, tickers):
+    """{ticker: último ponto com estatísticas} — uma consulta para a lista toda."""
+    if not tickers:
+        return {}
+    rows = conn.execute(text(
+        'SELECT v.ticker, v.d, ' + ', '.join('v.' + c for c in _COLS) + ' FROM vol_hist_day v '
+        'JOIN (SELECT ticker, MAX(d) AS d FROM vol_hist_day WHERE ticker IN :t AND iv_rank IS NOT NULL '
+        'GROUP BY ticker) m ON m.ticker = v.ticker AND m.d = v.d '
+        'WHERE v.ticker IN :t').bindparams(bindparam('t', expanding=True)),
+        {'t': sorted(set(tickers))}).fetchall()
+    return {r[0]: dict(zip(('d',) + _COLS, r[1:])) for r in rows}
+
+
+def upsert(conn, ticker, points):
+    """Grava (ou substitui) os pontos informados. Não faz commit."""
+    if not points:
+        return 0
+    cols = ('d',) + _COLS
+    conn.execute(text('INSERT OR REPLACE INTO vol_hist_day (ticker, ' + ', '.join(cols) + ') '
+                      'VALUES (:ticker, ' + ', '.join(':' + c for c in cols) + ')'),
+                 [{'ticker': ticker, **{c: p.get(c) for c in cols}} for p in points])
+    return len(points)
+
+
+def delete(conn, ticker):
+    conn.execute(text('DELETE FROM vol_hist_day WHERE ticker = :t'), {'t': ticker})
@@ -0,0 +1,50 @@
+"""Base comum dos testes do controle_acoes: põe os módulos no sys.path e monta
+as tabelas a partir dos modelos (models.db.metadata), sem DDL escrito à mão."""
+import importlib.util
+import os
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable
+
+# Módulos do controle_acoes ficam num subdiretório próprio
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'controle_acoes')
+if APP_DIR not in sys.path:
+    sys.path.append(APP_DIR)
+
+
+def models():
+    """controle_acoes/models.py — carregado com nome próprio, porque a raiz do
+    repositório tem outro models.py (o do app financeiro)."""
+    mod = sys.modules.get('controle_acoes_models')
+    if mod is None:
+        spec = importlib.util.spec_from_file_location('controle_acoes_models', os.path.join(APP_DIR, 'models.py'))
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = mod
+        spec.loader.exec_module(mod)
+    return mod
+
+
+def _tables(names):
+    md = models().db.metadata
+    return [md.tables[n] for n in names]
+
+
+def engine(*tables):
+    """SQLite em memória com as `tables` dos modelos (e seus índices)."""
+    eng = create_engine('sqlite://')
+    models().db.metadata.create_all(eng, tables=_tables(tables))
+    return eng
+
+
+def ddl(*tables):
+    """CREATE TABLE das `tables` dos modelos, SEM os índices — como num banco
+    antigo, para testar a migração que os cria."""
+    return [str(CreateTable(t).compile(dialect=sqlite.dialect())) for t in _tables(tables)]
+
+
+def insert(conn, table, rows):
+    """INSERT pela tabela do modelo — os defaults das colunas valem, então o
+    teste só escreve as colunas que importam para ele."""
+    conn.execute(models().db.metadata.tables[table].insert(), rows)
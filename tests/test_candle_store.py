@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+
+from _controle_acoes import engine
+
+import candle_store
+from candle_store import CandleSeries
+
+
+def _candle(t, c, v=100):
+    return {'t': t, 'o': c, 'h': c + 1, 'l': c - 1, 'c': c, 'v': v}
+
+
+class TestCandleSeries(unittest.TestCase):
+    def setUp(self):
+        # fora de ordem de propósito: from_dicts ordena por data
+        self.candles = [_candle('2026-01-0%d' % d, 10.0 + d) for d in (5, 2, 9, 6, 7, 8)]
+        self.s = CandleSeries.from_dicts('PETR4', self.candles)
+
+    def test_ordered_and_last_date(self):
+        self.assertEqual(list(self.s.t), sorted(c['t'] for c in self.candles))
+        self.assertEqual(self.s.last_date, '2026-01-09')
+        self.assertIsNone(CandleSeries.empty('X').last_date)
+
+    def test_since_is_exclusive(self):
+        self.assertEqual([c['t'] for c in self.s.to_dicts('2026-01-06')],
+                         ['2026-01-07', '2026-01-08', '2026-01-09'])
+        # data que não existe na série cai no próximo pregão
+        self.assertEqual(self.s.to_dicts('2026-01-03')[0]['t'], '2026-01-05')
+        self.assertEqual(self.s.to_dicts('2026-01-09'), [])
+        self.assertEqual(len(self.s.to_dicts()), 6)
+
+    def test_tail_limits_output(self):
+        self.assertEqual([c['t'] for c in self.s.to_dicts(tail=2)], ['2026-01-08', '2026-01-09'])
+        self.assertEqual(len(self.s.to_dicts('2026-01-02', tail=3)), 3)
+
+    def test_closes_is_a_view(self):
+        closes = self.s.closes('2026-01-05')
+        self.assertTrue(np.shares_memory(closes, self.s.c))
+        self.assertEqual(list(closes), [16.0, 17.0, 18.0, 19.0])
+
+    def test_merged_replaces_same_day(self):
+        m = self.s.merged([_candle('2026-01-09', 50.0), _candle('2026-01-12', 51.0)])
+        self.assertEqual(len(m), 7)
+        self.assertEqual(m.to_dicts('2026-01-08'),
+                         [_candle('2026-01-09', 50.0), _candle('2026-01-12', 51.0)])
+        self.assertEqual(self.s.last_date, '2026-01-09')   # original intacta
+
+
+class TestCandleStoreSql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('candle')
+
+    def test_upsert_and_load(self):
+        with self.engine.begin() as conn:
+            candle_store.upsert(conn, 'VALE3', [_candle('2026-02-03', 60.0), _candle('2026-02-02', 59.0)])
+            # append incremental: reescreve só o dia em formação e acrescenta o novo
+            candle_store.upsert(conn, 'VALE3', [_candle('2026-02-03', 61.0), _candle('2026-02-04', 62.0)])
+            candle_store.upsert(conn, 'PETR4', [_candle('2026-02-03', 38.0)])
+        with self.engine.connect() as conn:
+            s = candle_store.load(conn, 'VALE3')
+            self.assertEqual(list(s.t), ['2026-02-02', '2026-02-03', '2026-02-04'])
+            self.assertEqual(list(s.closes()), [59.0, 61.0, 62.0])
+            self.assertEqual(len(candle_store.load(conn, 'ITUB4')), 0)
+        self.assertEqual(candle_store.upsert(None, 'X', []), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
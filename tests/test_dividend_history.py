@@ -0,0 +1,29 @@
+import unittest
+from datetime import datetime, timedelta
+
+from _controle_acoes import engine
+
+import dividend_history
+
+
+class TestDividendHistorySql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('dividend_history', 'dividend_history_state')
+
+    def test_save_state_and_load(self):
+        t0 = datetime(2025, 3, 3, 10, 0)
+        with self.engine.begin() as conn:
+            dividend_history.save(conn, {'PETR4': {'2024-05-01': 1.2, '2024-08-01': 0.9}, 'BBAS3': {}}, t0)
+            # consulta incremental: só a data nova, a última data-com avança
+            dividend_history.save(conn, {'PETR4': {'2024-11-01': 1.1}}, t0 + timedelta(hours=1))
+        with self.engine.connect() as conn:
+            st = dividend_history.state(conn, ['PETR4', 'BBAS3', 'VALE3'])
+            self.assertEqual(st['PETR4'], ('2024-11-01', t0 + timedelta(hours=1)))
+            self.assertEqual(st['BBAS3'], (None, t0))
+            self.assertNotIn('VALE3', st)
+            self.assertEqual(dividend_history.load(conn, ['PETR4', 'BBAS3'], since='2024-08-01'),
+                             {'PETR4': [('2024-08-01', 0.9), ('2024-11-01', 1.1)]})
+
+
+if __name__ == '__main__':
+    unittest.main()
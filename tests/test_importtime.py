@@ -0,0 +1,66 @@
+import unittest
+import json
+import sys
+import os
+import subprocess
+import tempfile
+
+# Módulos do controle_acoes ficam num subdiretório próprio
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'controle_acoes')
+
+# Carregados só no primeiro uso (dentro das funções que precisam deles)
+HEAVY = ('yfinance', 'pandas', 'openpyxl')
+# Tempo cumulativo de `import app` (s) medido com -X importtime (mediana de 5);
+# atualizar junto com a mudança quando o import ficar mais pesado de propósito
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'importtime_baseline.json')) as _f:
+    BASELINE = json.load(_f)
+# Folga sobre a referência — máquinas lentas/CI: IMPORT_BUDGET_FACTOR
+FACTOR = float(os.environ.get('IMPORT_BUDGET_FACTOR', '1.5'))
+
+
+def _importtime():
+    """Roda `python -X importtime -c "import app"` num banco temporário e
+    devolve {módulo: tempo cumulativo em µs}."""
+    with tempfile.TemporaryDirectory() as inst:
+        env = dict(os.environ, CONTROLE_ACOES_INSTANCE=inst)
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                              cwd=APP_DIR, env=env, capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise AssertionError(proc.stderr[-2000:])
+    out = {}
+    for line in proc.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _self, cumul, name = line[len('import time:'):].split('|')
+        if cumul.strip().isdigit():
+            out[name.strip()] = int(cumul)
+    return out
+
+
+class TestImportTime(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.times = _importtime()
+
+    def test_heavy_deps_are_lazy(self):
+        carregados = [m for m in HEAVY if m in self.times]
+        self.assertEqual(carregados, [], f'importados na partida: {carregados}')
+
+    def test_blueprints_registered(self):
+        self.assertIn('estudos', self.times)
+
+    def test_blueprint_does_not_import_app(self):
+        # O blueprint usa módulos próprios (oplab_client, bg_tasks), não o app
+        proc = subprocess.run([sys.executable, '-c', "import sys, estudos; print('app' in sys.modules)"],
+                              cwd=APP_DIR, capture_output=True, text=True, timeout=120)
+        self.assertEqual(proc.stdout.strip(), 'False', proc.stderr[-2000:])
+
+    def test_app_import_budget(self):
+        segundos = self.times['app'] / 1e6
+        teto = BASELINE['app'] * FACTOR
+        self.assertLess(segundos, teto, f'import app: {segundos:.2f} s (referência {BASELINE["app"]:.2f} s)')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from datetime import datetime
+
+from _controle_acoes import engine, insert
+
+import pm_engine
+import version_counter
+
+
+class TestAttribution(unittest.TestCase):
+    def test_roots_only_unambiguous(self):
+        held = ['PETR3', 'PETR4', 'ABEV3', 'HGLG11']
+        self.assertEqual(pm_engine.roots(['PETR4', 'ABEV3', 'HGLG11'], held),
+                         {'ABEV': ['ABEV3'], 'HGLG': ['HGLG11']})
+
+    def test_underlyings(self):
+        tickers = {'PETR4', 'ABEV3', 'HGLG11'}
+        root_map = pm_engine.roots(tickers, ['PETR3', 'PETR4', 'ABEV3', 'HGLG11'])
+        casa = lambda und, tk, notes='': sorted(pm_engine.underlyings(und, tk, notes, tickers, root_map))
+        self.assertEqual(casa('petr4', 'ABEVA148'), ['PETR4'])          # underlying manda
+        self.assertEqual(casa('VALE3', 'VALEA60'), [])
+        self.assertEqual(casa('', 'ABEVA148'), ['ABEV3'])               # raiz inequívoca
+        self.assertEqual(casa('', 'PETRB30'), [])                       # PETR3 × PETR4
+        self.assertEqual(casa('', 'XPTO', 'PETR4 | trava'), ['PETR4'])  # close_estruturada
+        self.assertEqual(casa('', 'BOVA11', 'TRAVA | HGLG11 | x'), ['HGLG11'])   # close_spread
+
+
+class TestPMVersionSql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('asset', 'version_counter')
+        with self.engine.begin() as conn:
+            insert(conn, 'asset', [{'id': i, 'user_id': u, 'ticker': tk, 'type': 'ACAO'}
+                                   for i, u, tk in ((10, 1, 'PETR4'), (11, 1, 'VALE3'), (20, 2, 'PETR4'))])
+
+    def test_bump(self):
+        now = datetime(2025, 3, 3, 10, 0)
+        with self.engine.begin() as conn:
+            pm_engine.bump(conn, now, user_ids=[1])
+            pm_engine.bump(conn, now, asset_ids=[10, 11, 20])       # dono de cada ativo
+            pm_engine.bump(conn, now)                                # nada a fazer
+        with self.engine.connect() as conn:
+            self.assertEqual(version_counter.get(conn, 'pm', [1, 2, 3]), {1: 2, 2: 1, 3: 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from datetime import date
+
+from _controle_acoes import engine
+
+import price_history
+
+
+class TestPriceHistory(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('price_history', 'price_history_range')
+
+    def test_missing_ranges_around_coverage(self):
+        with self.engine.begin() as conn:
+            price_history.mark_covered(conn, {'PETR4': (date(2024, 3, 1), date(2024, 6, 30))},
+                                       through=date(2025, 1, 1))
+            gaps = price_history.missing_ranges(conn, ['PETR4', 'VALE3'],
+                                                date(2024, 1, 1), date(2024, 12, 31))
+        self.assertEqual(gaps['VALE3'], [(date(2024, 1, 1), date(2024, 12, 31))])
+        self.assertEqual(gaps['PETR4'], [(date(2024, 1, 1), date(2024, 2, 29)),
+                                         (date(2024, 7, 1), date(2024, 12, 31))])
+        with self.engine.connect() as conn:
+            self.assertEqual(price_history.missing_ranges(conn, ['PETR4'],
+                                                          date(2024, 4, 1), date(2024, 5, 1)), {})
+
+    def test_coverage_stops_before_today(self):
+        with self.engine.begin() as conn:
+            price_history.mark_covered(conn, {'ITUB4': (date(2024, 1, 1), date(2024, 1, 10))},
+                                       through=date(2024, 1, 9))
+            # só o dia corrente: nada a marcar
+            price_history.mark_covered(conn, {'BBAS3': (date(2024, 1, 10), date(2024, 1, 10))},
+                                       through=date(2024, 1, 9))
+            self.assertEqual(price_history.coverage(conn), {'ITUB4': (date(2024, 1, 1), date(2024, 1, 9))})
+            # o trecho seguinte emenda na cobertura existente
+            price_history.mark_covered(conn, {'ITUB4': (date(2024, 1, 10), date(2024, 1, 20))},
+                                       through=date(2024, 1, 19))
+            self.assertEqual(price_history.coverage(conn)['ITUB4'], (date(2024, 1, 1), date(2024, 1, 19)))
+
+    def test_save_and_load_range(self):
+        with self.engine.begin() as conn:
+            price_history.save(conn, {'PETR4': {'2024-01-02': 37.0, '2024-01-03': 37.5},
+                                      'VALE3': {'2024-01-02': 70.0}})
+            price_history.save(conn, {'PETR4': {'2024-01-03': 38.0}})
+        with self.engine.connect() as conn:
+            got = price_history.load(conn, ['PETR4', 'ITUB4'], date(2024, 1, 3), date(2024, 1, 31))
+            self.assertEqual(price_history.load(conn, [], date(2024, 1, 1), date(2024, 1, 31)), {})
+        self.assertEqual(got, {'PETR4': {'2024-01-03': 38.0}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+import sys
+import os
+import math
+
+import numpy as np
+
+# Módulos do controle_acoes ficam num subdiretório próprio
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'controle_acoes'))
+
+from pricing import (bs_price, implied_vol, bs_price_vec, bs_greeks_vec,
+                     implied_vol_vec, ChainIV, chain_delta_pct, IV_LO, IV_HI,
+                     payoff_legs, pop_closed_form, pop_grid)
+
+
+def _bisseccao(S0, K, T, r, target, is_call):
+    """Bissecção original do app.py — referência de resultado."""
+    if target <= 0 or T <= 0:
+        return 0.30
+    lo, hi = 0.001, 5.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if bs_price(S0, K, T, r, mid, is_call) < target:
+            lo = mid
+        else:
+            hi = mid
+        if hi - lo < 1e-6:
+            break
+    return (lo + hi) / 2
+
+
+class TestPricing(unittest.TestCase):
+    def setUp(self):
+        self.S, self.r = 38.0, math.log(1.145)
+        self.cases = []
+        for T in (5 / 365, 30 / 365, 0.5, 1.5):
+            for k in (20.0, 30.0, 36.0, 38.0, 40.0, 48.0, 60.0):
+                for is_call in (True, False):
+                    sig = 0.25 + 0.3 * abs(math.log(k / self.S))
+                    p = round(bs_price(self.S, k, T, self.r, sig, is_call), 2)
+                    self.cases.append((k, T, p, is_call))
+
+    def test_price_vec_matches_scalar(self):
+        K = [c[0] for c in self.cases]
+        T = [c[1] for c in self.cases]
+        calls = [c[3] for c in self.cases]
+        vec = bs_price_vec(self.S, K, T, self.r, 0.4, calls)
+        for v, (k, t, _, c) in zip(vec, self.cases):
+            self.assertAlmostEqual(v, bs_price(self.S, k, t, self.r, 0.4, c), places=10)
+
+    def test_price_vec_invalid_inputs_are_intrinsic(self):
+        vec = bs_price_vec([38, 38], [30, 30], [0, 0.5], self.r, [0.3, 0], [True, False])
+        self.assertEqual(list(vec), [8.0, 0.0])
+
+    def test_implied_vol_matches_bisection(self):
+        for k, T, p, is_call in self.cases:
+            intr = max(0.0, (self.S - k) if is_call else (k - self.S))
+            if p <= intr * 1.005:
+                continue
+            ref = _bisseccao(self.S, k, T, self.r, p, is_call)
+            self.assertAlmostEqual(implied_vol(self.S, k, T, self.r, p, is_call), ref, places=5)
+            vec = implied_vol_vec(self.S, k, T, self.r, p, is_call)
+            self.assertAlmostEqual(float(vec), ref, places=5)
+
+    def test_implied_vol_contract(self):
+        self.assertEqual(implied_vol(38, 38, 0, self.r, 1.0, True), 0.30)
+        self.assertEqual(implied_vol(38, 38, 0.5, self.r, 0, True), 0.30)
+        self.assertEqual(implied_vol(38, 38, 0.5, self.r, 100.0, True), IV_HI)
+        self.assertEqual(implied_vol(38, 20, 0.5, self.r, 18.0, True), IV_LO)
+        vec = implied_vol_vec(38, [38, 38, 38, 20], [0, 0.5, 0.5, 0.5], self.r,
+                              [1.0, 0, 100.0, 18.0], True)
+        self.assertEqual(list(vec), [0.30, 0.30, IV_HI, IV_LO])
+
+    def test_greeks_vec(self):
+        g = bs_greeks_vec(self.S, [36.0, 40.0], 0.25, self.r, 0.35, [True, False])
+        self.assertTrue(0.5 < g['delta'][0] < 1)
+        self.assertTrue(-1 < g['delta'][1] < 0)
+        # delta(call) - delta(put) = 1 no mesmo strike
+        pair = bs_greeks_vec(self.S, 38.0, 0.25, self.r, 0.35, [True, False])
+        self.assertAlmostEqual(pair['delta'][0] - pair['delta'][1], 1.0, places=6)
+        self.assertAlmostEqual(pair['gamma'][0], pair['gamma'][1], places=10)
+        self.assertTrue(np.isnan(bs_greeks_vec(38, 38, 0, self.r, 0.3, True)['delta']))
+
+    def test_chain_iv_memo(self):
+        rows = [{'symbol': f'X{i}', 'strike': k, 'bid': 0, 'ask': 0, 'close': p}
+                for i, (k, T, p, c) in enumerate(self.cases) if c and T == 0.5]
+        civ = ChainIV(self.S, self.r)
+        civ.prime(rows, True, 0.5)
+        for rw in rows:
+            iv = civ.get(rw, True, 0.5)
+            intr = max(0.0, self.S - rw['strike'])
+            if rw['close'] <= intr * 1.005:
+                self.assertIsNone(iv)
+            else:
+                self.assertAlmostEqual(iv, implied_vol(self.S, rw['strike'], 0.5, self.r,
+                                                       rw['close'], True), places=6)
+        # linha fora do memo (outro T) é resolvida na hora
+        self.assertIsNotNone(civ.get(rows[3], True, 0.25))
+
+    def test_chain_delta_pct(self):
+        deltas = chain_delta_pct(self.S, self.r, [36.0, 40.0, 20.0], [3.5, 1.2, 18.0], 0.25, True)
+        self.assertTrue(50 < deltas[0] < 100)
+        self.assertTrue(0 < deltas[1] < 50)
+        self.assertIsNone(deltas[2])          # prêmio = intrínseco: VI indefinida
+        self.assertEqual(chain_delta_pct(self.S, self.r, [], [], 0.25, False), [])
+
+
+def _pop_loop(S, T, sigma, r, payoff):
+    """Integração de 501 pontos do _calc_pop original (payoff escalar)."""
+    mu = math.log(S) + (r - 0.5 * sigma * sigma) * T
+    sd = sigma * math.sqrt(T)
+    lo = max(S * math.exp(-4 * sd), 0.01)
+    hi = S * math.exp(4 * sd)
+    tot = win = 0.0
+    M = 500
+    step = (hi - lo) / (M + 1)
+    for k in range(M + 1):
+        sk = lo + step * (k + 0.5)
+        z = (math.log(sk) - mu) / sd
+        w = math.exp(-0.5 * z * z) / sk
+        tot += w
+        if payoff(sk) > 0:
+            win += w
+    return win / tot
+
+
+class TestPop(unittest.TestCase):
+    """POP fechado/vetorizado x integração antiga, por tipo de estrutura."""
+
+    S, T, SIGMA, R = 38.0, 35 / 252, 0.32, math.log(1.145)
+
+    # (nome, base = crédito líquido, pernas (q, tipo, K, T_rem, iv))
+    STRATEGIES = [
+        ('venda_put',        1.10 * 100, [(-100, 'PUT', 36.0, 0, 0)]),
+        ('venda_call',       0.90 * 100, [(-100, 'CALL', 40.0, 0, 0)]),
+        ('lancamento_cob',   -38.0 * 100 + 0.9 * 100, [(100, 'STOCK', 0, 0, 0), (-100, 'CALL', 40.0, 0, 0)]),
+        ('collar',           -38.0 * 100 + 0.9 * 100 - 0.7 * 100,
+                             [(100, 'STOCK', 0, 0, 0), (-100, 'CALL', 41.0, 0, 0), (100, 'PUT', 36.0, 0, 0)]),
+        ('trava_alta_put',   0.60 * 100, [(-100, 'PUT', 37.0, 0, 0), (100, 'PUT', 35.0, 0, 0)]),
+        ('trava_alta_call',  -0.80 * 100, [(100, 'CALL', 38.0, 0, 0), (-100, 'CALL', 40.0, 0, 0)]),
+        ('iron_condor',      0.95 * 100, [(100, 'PUT', 33.0, 0, 0), (-100, 'PUT', 35.0, 0, 0),
+                                          (-100, 'CALL', 41.0, 0, 0), (100, 'CALL', 43.0, 0, 0)]),
+        ('straddle_vendido', 3.2 * 100, [(-100, 'PUT', 38.0, 0, 0), (-100, 'CALL', 38.0, 0, 0)]),
+        ('strangle_comprado', -1.5 * 100, [(100, 'PUT', 35.0, 0, 0), (100, 'CALL', 41.0, 0, 0)]),
+        ('borboleta',        -0.35 * 100, [(100, 'CALL', 36.0, 0, 0), (-200, 'CALL', 38.0, 0, 0),
+                                           (100, 'CALL', 40.0, 0, 0)]),
+        ('ratio_put',        0.20 * 100, [(100, 'PUT', 37.0, 0, 0), (-200, 'PUT', 35.0, 0, 0)]),
+    ]
+
+    def test_closed_form_matches_integration(self):
+        for name, base, legs in self.STRATEGIES:
+            fn = payoff_legs(base, legs, self.R)
+            kinks = [k for _, kind, k, _, _ in legs if kind != 'STOCK']
+            ref = _pop_loop(self.S, self.T, self.SIGMA, self.R, lambda x: float(fn(x)))
+            got = pop_closed_form(self.S, self.T, self.SIGMA, self.R, fn, kinks)
+            self.assertAlmostEqual(got, ref, delta=0.005, msg=name)
+
+    def test_grid_matches_loop_for_calendar(self):
+        # calendário: vende curta e compra longa reprecificada por BS
+        legs = [(-100, 'CALL', 38.0, 0, 0), (100, 'CALL', 38.0, 28 / 365.25, 0.30)]
+        fn = payoff_legs(-0.55 * 100, legs, self.R)
+        ref = _pop_loop(self.S, self.T, self.SIGMA, self.R, lambda x: float(fn(x)))
+        self.assertAlmostEqual(pop_grid(self.S, self.T, self.SIGMA, self.R, fn), ref, places=9)
+
+    def test_payoff_legs_vectorized(self):
+        fn = payoff_legs(50.0, [(-100, 'PUT', 36.0, 0, 0), (100, 'STOCK', 0, 0, 0)])
+        self.assertEqual(list(fn([30.0, 40.0])), [50 - 600 + 3000, 50 + 4000])
+
+    def test_never_profitable_and_always_profitable(self):
+        never = payoff_legs(-10.0, [])
+        always = payoff_legs(10.0, [])
+        self.assertEqual(pop_closed_form(self.S, self.T, self.SIGMA, self.R, never, []), 0.0)
+        self.assertAlmostEqual(pop_closed_form(self.S, self.T, self.SIGMA, self.R, always, []), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
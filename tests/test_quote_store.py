@@ -0,0 +1,124 @@
+import unittest
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy import event
+
+from _controle_acoes import engine, insert, models
+
+import quote_store
+
+T0 = datetime(2025, 3, 3, 10, 0)
+T1 = datetime(2025, 3, 3, 10, 5)
+
+
+class TestQuoteStoreSql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('quote', 'quote_user')
+        with self.engine.begin() as conn:
+            quote_store.upsert(conn, [('PETR4', 38.5, 1.2), ('VALE3', 60.0, None)], 'oplab', T0)
+
+    def test_newest_wins(self):
+        with self.engine.begin() as conn:
+            quote_store.upsert_user(conn, 1, [('PETR4', 38.7, 1.5)], 'excel', T1)   # depois do mercado
+            quote_store.upsert_user(conn, 1, [('VALE3', 59.0, None)], 'excel', T0)  # empate: vale a do usuário
+            quote_store.upsert(conn, [('VALE3', 61.0, 0.5)], 'oplab', T1)           # mercado mais novo
+            out = quote_store.resolve(conn, [1], ['PETR4', 'VALE3', 'ITUB4'])
+        self.assertEqual(out[(1, 'PETR4')], (38.7, 1.5, T1))
+        self.assertEqual(out[(1, 'VALE3')], (61.0, 0.5, T1))
+        self.assertNotIn((1, 'ITUB4'), out)
+
+    def test_user_rows_are_private(self):
+        with self.engine.begin() as conn:
+            quote_store.upsert_user(conn, 1, [('PETR4', 40.0, None), ('XPTO3', 9.0, None)], 'feeder', T1)
+            out = quote_store.resolve(conn, [1, 2], ['PETR4', 'XPTO3'])
+        self.assertEqual(out[(1, 'PETR4')][0], 40.0)
+        self.assertEqual(out[(2, 'PETR4')][0], 38.5)
+        self.assertIn((1, 'XPTO3'), out)
+        self.assertNotIn((2, 'XPTO3'), out)
+
+    def test_upsert_replaces(self):
+        with self.engine.begin() as conn:
+            self.assertEqual(quote_store.upsert(conn, [('PETR4', 39.0, 0.1)], 'yahoo', T1), 1)
+            self.assertEqual(quote_store.upsert(conn, [], 'yahoo', T1), 0)
+            out = quote_store.resolve(conn, [1], ['PETR4'])
+            n = conn.exec_driver_sql('SELECT COUNT(*) FROM quote').scalar()
+        self.assertEqual(out[(1, 'PETR4')], (39.0, 0.1, T1))
+        self.assertEqual(n, 2)
+
+
+class TestQuotedColumns(unittest.TestCase):
+    """Colunas de preço da carteira lidas de quote/quote_user (models._quoted)."""
+
+    def setUp(self):
+        m = models()
+        self.m, self.db = m, m.db
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.db.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        md = self.db.metadata
+        md.create_all(self.db.engine, tables=[md.tables[t] for t in (
+            'user', 'asset', 'structured_op', 'structured_leg', 'quote', 'quote_user')])
+        with self.db.engine.begin() as conn:
+            insert(conn, 'user', [{'id': u, 'username': f'u{u}'} for u in (1, 2)])
+            insert(conn, 'asset', [
+                {'user_id': 1, 'ticker': 'PETR4', 'type': 'ACAO', 'current_price': 30.0},
+                {'user_id': 1, 'ticker': 'VALE3', 'type': 'ACAO', 'current_price': 55.0},
+                {'user_id': 2, 'ticker': 'PETR4', 'type': 'ACAO', 'current_price': 31.0},
+            ])
+            quote_store.upsert(conn, [('PETR4', 38.5, 1.2)], 'oplab', T0)
+        self.sqls = []
+        event.listen(self.db.engine, 'before_cursor_execute', self._log)
+
+    def tearDown(self):
+        event.remove(self.db.engine, 'before_cursor_execute', self._log)
+        self.db.session.remove()
+        self.ctx.pop()
+
+    def _log(self, _conn, _cursor, statement, *_args):
+        self.sqls.append(statement)
+
+    def _quote_reads(self):
+        return [s for s in self.sqls if 'FROM quote' in s]
+
+    def test_reads_quote_then_column(self):
+        Asset = self.m.Asset
+        assets = {(a.user_id, a.ticker): a for a in Asset.query.all()}
+        self.assertEqual(assets[(1, 'PETR4')].current_price, 38.5)
+        self.assertEqual(assets[(1, 'PETR4')].daily_change, 1.2)
+        self.assertEqual(assets[(1, 'PETR4')].last_update, T0)
+        self.assertEqual(assets[(2, 'PETR4')].current_price, 38.5)
+        self.assertEqual(assets[(1, 'VALE3')].current_price, 55.0)     # sem cotação: a coluna
+        # Os tickers de tudo que foi carregado saem numa consulta só
+        self.assertEqual(len(self._quote_reads()), 1)
+
+    def test_manual_price_is_per_user(self):
+        Asset, QuoteUser = self.m.Asset, self.m.QuoteUser
+        a = Asset.query.filter_by(user_id=1, ticker='PETR4').one()
+        self.assertFalse(QuoteUser.manual(1, 'PETR4', a.current_price, 38.501, T1))   # arredondamento
+        self.assertTrue(QuoteUser.manual(1, 'PETR4', a.current_price, 40.0, T1))
+        self.db.session.commit()
+        self.assertEqual(a.current_price, 40.0)
+        b = Asset.query.filter_by(user_id=2, ticker='PETR4').one()
+        self.assertEqual(b.current_price, 38.5)
+
+    def test_closed_operation_keeps_columns(self):
+        StructuredOp, StructuredLeg = self.m.StructuredOp, self.m.StructuredLeg
+        op = StructuredOp(user_id=1, underlying_asset='PETR4', underlying_price=30.0, status='OPEN')
+        op.legs.append(StructuredLeg(ticker='PETRC40', side='SELL', current_price=0.5))
+        self.db.session.add(op)
+        self.db.session.commit()
+        with self.db.engine.begin() as conn:
+            quote_store.upsert(conn, [('PETRC40', 0.8, None)], 'oplab', T1)
+        self.m.Quote.forget()
+        self.assertEqual(op.underlying_price, 38.5)
+        self.assertEqual(op.legs[0].current_price, 0.8)
+        op.status = 'CLOSED'
+        self.assertEqual(op.underlying_price, 30.0)
+        self.assertEqual(op.legs[0].current_price, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import sqlite3
+
+from _controle_acoes import ddl
+
+import schema_indexes
+
+# Tabelas dos modelos sem os índices — como num banco antigo
+_TABELAS = ddl('asset', 'option', 'structured_op', 'structured_leg', 'dividend', 'asset_txn', 'pm_event',
+               'settings', 'trade_history')
+
+
+class TestSchemaIndexes(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        for sql in _TABELAS:
+            self.conn.execute(sql)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_ensure_idempotent(self):
+        cur = self.conn.cursor()
+        self.conn.execute('DROP TABLE trade_history')          # tabela que ainda não existe: pula
+        criados = schema_indexes.ensure(cur)
+        self.assertEqual(set(criados), set(schema_indexes.INDEXES) - {'ix_trade_history_user_strategy'})
+        self.assertEqual(schema_indexes.ensure(cur), [])
+
+    def test_hot_queries_use_index(self):
+        for nome, (sql, params) in schema_indexes.HOT_QUERIES.items():
+            self.assertTrue(schema_indexes.full_scans(self.conn, sql, params), nome)   # sem índice: varre
+        schema_indexes.ensure(self.conn.cursor())
+        for nome, (sql, params) in schema_indexes.HOT_QUERIES.items():
+            self.assertEqual(schema_indexes.full_scans(self.conn, sql, params), [], nome)
+
+
+if __name__ == '__main__':
+    unittest.main()
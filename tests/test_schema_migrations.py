@@ -0,0 +1,54 @@
+import unittest
+import sqlite3
+
+import _controle_acoes  # noqa: F401 — põe o controle_acoes no sys.path
+
+import schema_migrations
+
+
+class TestSchemaMigrations(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', isolation_level=None)
+        self.conn.execute('CREATE TABLE asset (id INTEGER PRIMARY KEY)')
+        self.calls = []
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _mig(self, version, ddl):
+        def fn(cur):
+            self.calls.append(version)
+            cur.execute(ddl)
+        return (version, f'v{version}', fn)
+
+    def test_upgrade_runs_each_once(self):
+        migs = [self._mig(2, 'CREATE INDEX ix_asset_id ON asset (id)'),
+                self._mig(1, 'ALTER TABLE asset ADD COLUMN ticker VARCHAR(10)')]
+        self.assertEqual(schema_migrations.current(self.conn.cursor()), 0)
+        self.assertEqual(schema_migrations.upgrade(self.conn, migs), [1, 2])
+        self.assertEqual(schema_migrations.upgrade(self.conn, migs), [])
+        self.assertEqual(self.calls, [1, 2])
+        migs.append(self._mig(3, 'ALTER TABLE asset ADD COLUMN qty INTEGER'))
+        self.assertEqual([m[0] for m in schema_migrations.pending(self.conn.cursor(), migs)], [3])
+        self.assertEqual(schema_migrations.upgrade(self.conn, migs), [3])
+        self.assertEqual(schema_migrations.current(self.conn.cursor()), schema_migrations.latest(migs))
+
+    def test_failed_migration_rolls_back(self):
+        migs = [self._mig(1, 'ALTER TABLE asset ADD COLUMN ticker VARCHAR(10)'),
+                (2, 'quebrada', lambda cur: (cur.execute('ALTER TABLE asset ADD COLUMN qty INTEGER'),
+                                             cur.execute('ALTER TABLE nao_existe ADD COLUMN x INTEGER')))]
+        with self.assertRaises(sqlite3.OperationalError):
+            schema_migrations.upgrade(self.conn, migs)
+        self.assertEqual(schema_migrations.current(self.conn.cursor()), 1)
+        cols = {r[1] for r in self.conn.execute('PRAGMA table_info(asset)')}
+        self.assertEqual(cols, {'id', 'ticker'})                     # qty foi desfeita
+
+    def test_stamp(self):
+        migs = [self._mig(1, 'SELECT 1'), self._mig(2, 'SELECT 1')]
+        schema_migrations.stamp(self.conn, migs)
+        self.assertEqual(schema_migrations.upgrade(self.conn, migs), [])
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
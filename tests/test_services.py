@@ -0,0 +1,88 @@
+import unittest
+import sys
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Módulos do controle_acoes ficam num subdiretório próprio
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'controle_acoes'))
+
+import services
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    hits = {}
+
+    def do_GET(self):
+        tk = self.path.split('?')[0].rsplit('/', 1)[-1]
+        n = _Handler.hits[tk] = _Handler.hits.get(tk, 0) + 1
+        if tk.startswith('LIMIT') and n <= 2:
+            status, body = 429, b'{}'
+        elif tk.startswith('NONE'):
+            status, body = 404, b'{}'
+        else:
+            status = 200
+            body = b'{"results": [{"regularMarketPrice": 12.5, "regularMarketChangePercent": -1.5}]}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestQuoteClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.srv = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        cls.srv.daemon_threads = True
+        threading.Thread(target=cls.srv.serve_forever, daemon=True).start()
+        cls.old_base = services.BASE_URL
+        services.BASE_URL = f'http://127.0.0.1:{cls.srv.server_port}/api/quote'
+
+    @classmethod
+    def tearDownClass(cls):
+        services.BASE_URL = cls.old_base
+        cls.srv.shutdown()
+
+    def setUp(self):
+        _Handler.hits.clear()
+
+    def test_brapi_quotes_merges_and_retries_429(self):
+        got = services._brapi_quotes(['PETR4', 'LIMIT1', 'NONE1'], 'tk')
+        self.assertEqual(sorted(got), ['LIMIT1', 'PETR4'])
+        self.assertEqual(got['PETR4']['price'], 12.5)
+        self.assertEqual(got['LIMIT1']['change_percent'], -1.5)
+        self.assertEqual(_Handler.hits['LIMIT1'], 3)   # 2 × 429 + sucesso
+        self.assertEqual(_Handler.hits['NONE1'], 1)    # 404 não é repetido
+
+    def test_backoff_uses_retry_after_with_cap(self):
+        class R:
+            def __init__(self, h):
+                self.headers = h
+        self.assertEqual(services._backoff(R({'Retry-After': '2'}), 0), 2.0)
+        self.assertEqual(services._backoff(R({'Retry-After': '600'}), 0), services._BACKOFF_MAX)
+        self.assertGreaterEqual(services._backoff(R({}), 2), services._BACKOFF_BASE * 4)
+
+    def test_fetch_many_timeout_and_nesting(self):
+        got = services.fetch_many(lambda x: (time.sleep(0.5) if x == 'slow' else None) or x,
+                                  ['a', 'b', 'slow', 'a'], timeout=0.2)
+        self.assertEqual(got, {'a': 'a', 'b': 'b'})
+        # dentro de um worker do executor compartilhado roda em série, sem travar
+        fut = services._executor().submit(services.fetch_many, str.upper, ['x', 'y'])
+        self.assertEqual(fut.result(timeout=5), {'x': 'X', 'y': 'Y'})
+        # em série, mesmo contrato: item com erro fica de fora e o prazo vale
+        fut = services._executor().submit(services.fetch_many, lambda x: 1 // int(x), ['1', '0', '1x', '-1'])
+        self.assertEqual(fut.result(timeout=5), {'1': 1, '-1': -1})
+        fut = services._executor().submit(services.fetch_many, lambda x: time.sleep(0.15) or x,
+                                          ['a', 'b', 'c', 'd'], timeout=0.2)
+        self.assertEqual(fut.result(timeout=5), {'a': 'a', 'b': 'b'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+from datetime import datetime
+
+from flask import Flask, g
+from sqlalchemy import event, text
+
+from _controle_acoes import engine, models
+
+import settings_store
+import version_counter
+
+
+class TestSettingsStoreSql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('settings')
+        with self.engine.begin() as conn:
+            conn.execute(text("INSERT INTO settings (user_id, key, value) VALUES "
+                              "(1, 'quote_mode', 'oplab'), (1, 'oplab_interval', '5'), "
+                              "(1, 'quote_mode', 'yahoo'), (2, 'selic_rate', '14.5')"))
+
+    def test_load(self):
+        with self.engine.connect() as conn:
+            out = settings_store.load(conn, [1, 2, 3])
+        self.assertEqual(out[1], {'quote_mode': 'oplab', 'oplab_interval': '5'})   # repetida: vale a 1ª
+        self.assertEqual(out[2], {'selic_rate': '14.5'})
+        self.assertEqual(out[3], {})
+
+
+class TestSettingsCache(unittest.TestCase):
+    """Settings pelo ORM: gravação incrementa a versão 'settings' (after_flush)
+    e a leitura seguinte recarrega; versão igual não relê a tabela."""
+
+    def setUp(self):
+        m = models()
+        self.Settings, self.db = m.Settings, m.db
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.db.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        md = self.db.metadata
+        md.create_all(self.db.engine, tables=[md.tables[t] for t in ('user', 'settings', 'version_counter')])
+        self.db.session.add(m.User(id=1, username='u1'))
+        self.db.session.commit()
+        self.Settings._cache.clear()
+        self.sqls = []
+        event.listen(self.db.engine, 'before_cursor_execute', self._log)
+
+    def tearDown(self):
+        event.remove(self.db.engine, 'before_cursor_execute', self._log)
+        self.db.session.remove()
+        self.ctx.pop()
+        self.Settings._cache.clear()
+
+    def _log(self, _conn, _cursor, statement, *_args):
+        self.sqls.append(statement)
+
+    def _settings_reads(self):
+        return [s for s in self.sqls if 'FROM settings' in s]
+
+    def _new_context(self):
+        # Novo contexto = nova requisição: g vazio, só o _cache da classe fica
+        self.db.session.remove()
+        self.ctx.pop()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.sqls.clear()
+
+    def test_write_through_orm_is_seen(self):
+        self.assertIsNone(self.Settings.get_value('quote_mode', 1))
+        self.db.session.add(self.Settings(user_id=1, key='quote_mode', value='oplab'))
+        self.db.session.commit()
+        self.assertEqual(self.Settings.get_value('quote_mode', 1), 'oplab')
+
+        row = self.Settings.query.filter_by(user_id=1, key='quote_mode').one()
+        row.value = 'yahoo'
+        self.db.session.commit()
+        self.assertEqual(self.Settings.get_value('quote_mode', 1), 'yahoo')
+
+    def test_unchanged_version_skips_settings(self):
+        self.Settings.set_value('selic_rate', '14.5', 1)
+        self._new_context()
+        self.assertEqual(self.Settings.get_value('selic_rate', 1), '14.5')
+        self.assertEqual(len(self._settings_reads()), 1)     # 1ª leitura: carrega o cache
+
+        self._new_context()
+        self.assertEqual(self.Settings.get_value('selic_rate', 1), '14.5')
+        self.assertEqual(self._settings_reads(), [])          # só a versão foi lida
+        self.assertEqual(len(self.sqls), 1)
+
+        self.sqls.clear()
+        self.Settings.get_value('selic_rate', 1)              # mesmo contexto: memo em g
+        self.assertEqual(self.sqls, [])
+
+    def test_prefetch_reloads_on_version_change(self):
+        self.Settings.set_value('oplab_interval', '5', 1)
+        self._new_context()
+        self.Settings.prefetch([1])
+        ver = self.Settings._cache[1][0]
+
+        # Outro processo grava: só a versão no banco muda, o _cache daqui não
+        with self.db.engine.begin() as conn:
+            conn.execute(text("UPDATE settings SET value = '7' WHERE key = 'oplab_interval'"))
+            version_counter.bump(conn, 'settings', [1], datetime(2025, 3, 3, 10, 0))
+        self._new_context()
+        self.assertEqual(self.Settings.prefetch([1])[1], {'oplab_interval': '7'})
+        self.assertEqual(self.Settings._cache[1][0], ver + 1)
+        self.assertEqual(len(self._settings_reads()), 1)
+
+    def test_flush_clears_memo_and_cache(self):
+        self.Settings.set_value('quote_mode', 'oplab', 1)
+        self.Settings.prefetch([1])
+        self.assertIn(1, g._settings)
+        self.assertIn(1, self.Settings._cache)
+
+        self.db.session.add(self.Settings(user_id=1, key='selic_rate', value='10'))
+        self.db.session.flush()
+        self.assertNotIn(1, g._settings)
+        self.assertNotIn(1, self.Settings._cache)
+        self.db.session.commit()
+
+    def test_typed_getters(self):
+        self.assertEqual(self.Settings.get_int('oplab_interval', 1, 5), 5)
+        self.assertEqual(self.Settings.get_float('selic_rate', 1, 10.5), 10.5)
+        self.assertIs(self.Settings.get_bool('oplab_auto_update', 1, True), True)
+        self.Settings.set_value('oplab_interval', 'x', 1)
+        self.Settings.set_value('selic_rate', '14.25', 1)
+        self.Settings.set_value('oplab_auto_update', 'false', 1)
+        self.assertEqual(self.Settings.get_int('oplab_interval', 1, 5), 5)   # inválido: default
+        self.assertEqual(self.Settings.get_float('selic_rate', 1), 14.25)
+        self.assertIs(self.Settings.get_bool('oplab_auto_update', 1, True), False)
+
+
+if __name__ == '__main__':
+    unittest.main()
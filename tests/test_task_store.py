@@ -0,0 +1,48 @@
+import unittest
+from datetime import datetime, timedelta
+
+from _controle_acoes import engine
+
+import task_store
+
+T0 = datetime(2025, 3, 3, 10, 0)
+
+
+class TestTaskStore(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('bg_task')
+
+    def test_lifecycle_bumps_version(self):
+        with self.engine.begin() as conn:
+            task_store.create(conn, 'a', 'quotes', 1, T0, 'Na fila')
+            task_store.update(conn, 'a', T0 + timedelta(seconds=1), status='running')
+            task_store.update(conn, 'a', T0 + timedelta(seconds=2), progress=50, msg='Metade')
+            t = task_store.get(conn, 'a')
+            self.assertEqual((t['status'], t['progress'], t['msg'], t['version']), ('running', 50, 'Metade', 2))
+            task_store.update(conn, 'a', T0 + timedelta(seconds=5), status='done', category='success',
+                              result={'updated': 3})
+            t = task_store.get(conn, 'a')
+        self.assertEqual(t['version'], 3)
+        self.assertEqual(t['result'], {'updated': 3})
+        self.assertEqual(t['started_at'], T0 + timedelta(seconds=1))
+        self.assertEqual(t['finished_at'], T0 + timedelta(seconds=5))
+        with self.engine.connect() as conn:
+            self.assertIsNone(task_store.get(conn, 'nada'))
+
+    def test_cleanup_ttl_and_stale(self):
+        with self.engine.begin() as conn:
+            task_store.create(conn, 'velha', 'quotes', 1, T0)
+            task_store.update(conn, 'velha', T0, status='done')
+            task_store.create(conn, 'orfa', 'b3_import', 1, T0)
+            task_store.update(conn, 'orfa', T0, status='running')
+            task_store.create(conn, 'viva', 'quotes', 1, T0 + timedelta(hours=7))
+            now = T0 + timedelta(hours=7)
+            self.assertEqual(task_store.cleanup(conn, now, timedelta(hours=6), timedelta(minutes=30)), (1, 1))
+            self.assertIsNone(task_store.get(conn, 'velha'))
+            self.assertEqual((task_store.get(conn, 'orfa')['status'], task_store.get(conn, 'orfa')['category']),
+                             ('done', 'danger'))
+            self.assertEqual(task_store.get(conn, 'viva')['status'], 'queued')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from datetime import datetime
+
+from _controle_acoes import engine, insert
+
+import version_counter
+
+
+class TestVersionCounterSql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('user', 'version_counter')
+        self.now = datetime(2025, 3, 3, 10, 0)
+        with self.engine.begin() as conn:
+            insert(conn, 'user', [{'id': u, 'username': f'u{u}'} for u in (1, 2, 3)])
+
+    def test_bump_per_scope(self):
+        with self.engine.begin() as conn:
+            self.assertEqual(version_counter.get(conn, 'settings', [1, 2]), {1: 0, 2: 0})
+            version_counter.bump(conn, 'settings', [1], self.now)
+            version_counter.bump(conn, 'settings', [1, 2, None], self.now)
+            version_counter.bump(conn, 'pm', [2], self.now)
+        with self.engine.connect() as conn:
+            self.assertEqual(version_counter.get(conn, 'settings', [1, 2, 3]), {1: 2, 2: 1, 3: 0})
+            self.assertEqual(version_counter.get(conn, 'pm', [1, 2]), {1: 0, 2: 1})   # escopos separados
+
+    def test_set_to(self):
+        with self.engine.begin() as conn:
+            version_counter.set_to(conn, 'quote', [2], 5, self.now)
+            self.assertEqual(version_counter.get(conn, 'quote', [1, 2]), {1: 0, 2: 5})
+            version_counter.set_to(conn, 'quote', None, 7, self.now)                 # todos da tabela user
+            self.assertEqual(version_counter.get(conn, 'quote', [1, 2, 3]), {1: 7, 2: 7, 3: 7})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from datetime import date, timedelta
+
+from _controle_acoes import engine
+
+import vol_hist_store
+
+
+def _dias(n, inicio=date(2025, 1, 1)):
+    return [(inicio + timedelta(days=i)).isoformat() for i in range(n)]
+
+
+class TestRollingStats(unittest.TestCase):
+    def test_matches_whole_window_stats(self):
+        datas = _dias(30)
+        ivs = [20.0 + (i % 7) for i in range(30)]
+        st = vol_hist_store.rolling_stats(datas, ivs)[-1]
+        atual, lo, hi = ivs[-1], min(ivs), max(ivs)
+        self.assertEqual(st['iv_rank'], round((atual - lo) / (hi - lo) * 100, 1))
+        self.assertEqual(st['iv_pct'], round(sum(v < atual for v in ivs) / 30 * 100, 1))
+        self.assertEqual((st['iv_min'], st['iv_max'], st['n']), (lo, hi, 30))
+        self.assertEqual(st['iv_avg'], round(sum(ivs) / 30, 1))
+
+    def test_window_and_min_points(self):
+        datas = _dias(40)
+        ivs = [50.0] * 10 + [10.0 + i for i in range(30)]
+        out = vol_hist_store.rolling_stats(datas, ivs, window_days=25, min_points=20)
+        self.assertEqual(len(out), 40)
+        self.assertIsNone(out[18])                     # só 19 pontos na janela
+        self.assertEqual(out[-1]['n'], 26)             # [d-25, d] inclusive
+        self.assertEqual(out[-1]['iv_max'], 39.0)      # os 50.0 ficaram fora da janela
+        self.assertEqual(out[-1]['iv_rank'], 100.0)
+
+    def test_start_and_missing_iv(self):
+        datas = _dias(25)
+        ivs = [30.0] * 24 + [None]
+        out = vol_hist_store.rolling_stats(datas, ivs, start=23)
+        self.assertEqual(len(out), 2)
+        self.assertEqual(out[0]['iv_rank'], 50.0)      # mín == máx
+        self.assertIsNone(out[1])
+
+
+class TestVolHistStoreSql(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine('vol_hist_day')
+
+    def test_upsert_load_latest(self):
+        with self.engine.begin() as conn:
+            vol_hist_store.upsert(conn, 'PETR4', [
+                {'d': '2025-03-03', 'iv': 30.0, 'iv_rank': 40.0, 'iv_pct': 35.0},
+                {'d': '2025-03-04', 'iv': 31.0, 'iv_rank': 45.0, 'iv_pct': 50.0},
+                {'d': '2025-03-05', 'iv': 32.0},               # sem estatística ainda
+            ])
+            vol_hist_store.upsert(conn, 'PETR4', [{'d': '2025-03-04', 'iv': 33.0, 'iv_rank': 60.0}])
+            vol_hist_store.upsert(conn, 'VALE3', [{'d': '2025-03-01', 'iv': 25.0, 'iv_rank': 10.0}])
+        with self.engine.connect() as conn:
+            self.assertEqual([p['d'] for p in vol_hist_store.load(conn, 'PETR4', since='2025-03-04')],
+                             ['2025-03-04', '2025-03-05'])
+            self.assertEqual(vol_hist_store.last_date(conn, 'PETR4'), '2025-03-05')
+            latest = vol_hist_store.latest(conn, ['PETR4', 'ITUB4'])
+        self.assertEqual(list(latest), ['PETR4'])
+        self.assertEqual((latest['PETR4']['d'], latest['PETR4']['iv'], latest['PETR4']['iv_pct']),
+                         ('2025-03-04', 33.0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()